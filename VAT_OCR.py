@@ -1,114 +1,42 @@
-if True:
-    from unsloth import FastVisionModel
-    model, tokenizer = FastVisionModel.from_pretrained(
-        model_name = "VAT_model", # YOUR MODEL YOU USED FOR TRAINING
-        load_in_4bit = True, # Set to False for 16bit LoRA
-    )
-    FastVisionModel.for_inference(model) # Enable for inference!
+# 模型改為第一次推論時才載入，import 本檔（例如只用 repair_json / check_compliance）不需要 GPU
+import weakref
+from extraction_cache import model_dir_digest
+
+MODEL_DIR = "VAT_model" # YOUR MODEL YOU USED FOR TRAINING
+model = None
+tokenizer = None
+# 模型 → adapter 權重內容雜湊（載入時算一次；抽取快取 key 與 relabel 指紋都用它，重新訓練後自動失效）
+_MODEL_DIGESTS: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+def _load_model_once():
+    global model, tokenizer
+    if model is None or tokenizer is None:
+        from unsloth import FastVisionModel
+        model, tokenizer = FastVisionModel.from_pretrained(
+            model_name = MODEL_DIR,
+            load_in_4bit = True, # Set to False for 16bit LoRA
+        )
+        FastVisionModel.for_inference(model) # Enable for inference!
+        _MODEL_DIGESTS[model] = model_dir_digest(MODEL_DIR)
+    return model, tokenizer
+
+
+def model_digest(model) -> str:
+    """模型的識別字串：VAT_model 目錄的 adapter 內容雜湊；外部傳入的模型依 name_or_path 計算一次。"""
+    digest = _MODEL_DIGESTS.get(model)
+    if digest is None:
+        digest = model_dir_digest(str(getattr(model, "name_or_path", MODEL_DIR)))
+        _MODEL_DIGESTS[model] = digest
+    return digest
 
 import re, json, ast
-from typing import Tuple, Any, List, Optional
+from typing import Any, Dict, List, Mapping, Optional, Tuple
 
-def repair_json(s: str, schema: Optional[dict] = None) -> Tuple[str, Any, List[str]]:
-    """
-    將「幾乎 JSON」的字串修復成合法 JSON。
-    回傳: (fixed_text, obj, logs)
-      fixed_text: 修復後的 JSON 字串
-      obj:        對應的 Python 物件 (dict/list)
-      logs:       修復步驟紀錄
-    """
-    logs: List[str] = []
-    text = s.strip()
+# 單次掃描的容錯解析（fences / 彎引號 / 單引號 / Python 常量 / 尾逗號）與快取的 schema 驗證器，見 json_repair.py
+from json_repair import repair_json, repair_stats
+# 各階段計時（預設關閉；tracing.enable() 或環境變數 VAT_TRACE 開啟），見 tracing.py
+from tracing import annotate, doc_class_of, record, span
 
-    # 0) 去掉 ```json ... ``` 或一般 ``` 區塊外殼
-    if "```" in text:
-        text = re.sub(r"```(?:json|JSON)?", "", text)
-        text = text.replace("```", "")
-        text = text.strip()
-        logs.append("removed code fences")
-
-    # 1) 只擷取最外層 {...} 或 [...]
-    def _extract_json_region(t: str) -> str:
-        lb, rb = t.find("{"), t.rfind("}")
-        if lb != -1 and rb != -1 and rb > lb:
-            return t[lb:rb+1]
-        lb, rb = t.find("["), t.rfind("]")
-        if lb != -1 and rb != -1 and rb > lb:
-            return t[lb:rb+1]
-        return t
-
-    text2 = _extract_json_region(text)
-    if text2 != text:
-        logs.append("extracted outer JSON-like region")
-        text = text2
-
-    # 2) 嘗試標準 JSON
-    try:
-        obj = json.loads(text)
-        logs.append("parsed by json")
-        if schema:
-            from jsonschema import validate
-            validate(obj, schema); logs.append("validated by jsonschema")
-        return json.dumps(obj, ensure_ascii=False, indent=2), obj, logs
-    except Exception as e:
-        logs.append(f"json.loads failed: {e}")
-
-    # 3) 用 ast.literal_eval 吃單引號/尾逗號 等 Python 字面量
-    try:
-        obj = ast.literal_eval(text)
-        logs.append("parsed by ast.literal_eval")
-        if schema:
-            from jsonschema import validate
-            validate(obj, schema); logs.append("validated by jsonschema")
-        return json.dumps(obj, ensure_ascii=False, indent=2), obj, logs
-    except Exception as e:
-        logs.append(f"ast.literal_eval failed: {e}")
-
-    # 4) 常見修補：彎引號→直引號、True/False/None→JSON、刪尾逗號、單引號→雙引號
-    fixed = text.translate(str.maketrans({
-        "\u201c": '"', "\u201d": '"', "\u2018": "'", "\u2019": "'",
-    }))
-    if fixed != text:
-        logs.append("normalized curly quotes")
-
-    # Python 常量 → JSON 常量
-    fixed2 = re.sub(r'(?<!")\bTrue\b(?!")', "true", fixed)
-    fixed2 = re.sub(r'(?<!")\bFalse\b(?!")', "false", fixed2)
-    fixed2 = re.sub(r'(?<!")\bNone\b(?!")', "null", fixed2)
-    if fixed2 != fixed:
-        logs.append("converted Python literals to JSON")
-    fixed = fixed2
-
-    # 移除尾逗號
-    no_trailing_commas = re.sub(r",\s*([}\]])", r"\1", fixed)
-    if no_trailing_commas != fixed:
-        logs.append("removed trailing commas")
-    fixed = no_trailing_commas
-
-    # 粗略：單引號 → 雙引號（在中文內容通常安全）
-    dq = re.sub(r"(?<!\\)'", '"', fixed)
-    if dq != fixed:
-        logs.append("replaced single quotes with double quotes")
-    fixed = dq
-
-    # 5) 最終嘗試標準 JSON
-    try:
-        obj = json.loads(fixed)
-        logs.append("fixed manually then parsed by json")
-        if schema:
-            from jsonschema import validate
-            validate(obj, schema); logs.append("validated by jsonschema")
-        return json.dumps(obj, ensure_ascii=False, indent=2), obj, logs
-    except Exception as e:
-        logs.append(f"final json.loads failed: {e}")
-        # 兜底：包 raw
-        fallback = {"raw": s}
-        if schema:
-            logs.append("returned raw because schema validation/parse failed")
-        return json.dumps(fallback, ensure_ascii=False, indent=2), fallback, logs
-
-import json, re
-from typing import Any, Dict, Tuple, Mapping, Optional
 
 def _extract_json(s: str) -> Dict[str, Any]:
     start = s.find("{"); end = s.rfind("}")
@@ -116,76 +44,39 @@ def _extract_json(s: str) -> Dict[str, Any]:
         raise ValueError("找不到可解析的 JSON 內容")
     return json.loads(s[start:end+1])
 
-def _canonical_key_map(d: Dict[str, Any]) -> Dict[str, str]:
-    # 建立不分大小寫的鍵名映射：lower(key) -> 原鍵名
-    return {k.lower(): k for k in d.keys()}
-
-def _get_ci(d: Dict[str, Any], key: str):
-    # 不分大小寫取值；找不到返回 None
-    if key in d: return d[key]
-    lk = key.lower()
-    for k in d.keys():
-        if k.lower() == lk:
-            return d[k]
-    return None
-
-def _is_none(x: Any) -> bool: return x is None
-def _is_nonempty_str(x: Any) -> bool: return isinstance(x, str) and len(x.strip()) > 0
-def _re_match(pattern: str, x: Any) -> bool:
-    if x is None: return True          # 非必填且 None 視為 OK；是否必填由 required 控制
-    if not isinstance(x, str): return False
-    return re.fullmatch(pattern, x.strip()) is not None
-
-def _amount_parse_and_normalize_int_str(x: Any) -> Optional[str]:
-    """允許千分位與 .00；回傳正規化整數字串，否則 None。"""
-    if not isinstance(x, str) or not x.strip():
-        return None
-    s = x.strip()
-    # 允許 "123456", "1,234,567", "1,234,567.00"
-    if re.fullmatch(r"\d{1,3}(,\d{3})*(?:\.00)?", s):
-        s_no_comma = s.replace(",", "")
-        if s_no_comma.endswith(".00"):
-            s_no_comma = s_no_comma[:-3]
-        try:
-            return str(int(s_no_comma))
-        except ValueError:
-            return None
-    # 允許無逗號但帶 .00
-    if re.fullmatch(r"\d+(?:\.00)?", s):
-        if s.endswith(".00"):
-            s = s[:-3]
-        try:
-            return str(int(s))
-        except ValueError:
-            return None
-    return None
-
-def _normalize_year_to_gregorian(y: Any) -> Optional[str]:
-    """2~3 碼視為民國年 +1911；4 碼視為西元年；其餘回 None。"""
-    if not isinstance(y, str) or not y.strip() or not y.strip().isdigit():
-        return None
-    s = y.strip()
-    if len(s) in (2, 3):  # 民國年
-        return str(int(s) + 1911)
-    if len(s) == 4:       # 西元年
-        return s
-    return None
-
-
-def _strip_leading_zero_num_str(x: Any) -> Optional[str]:
-    """將 '09' -> '9'；若非數字字串則回 None。"""
-    if not isinstance(x, str) or not x.strip():
-        return None
-    s = x.strip()
-    if not re.fullmatch(r"\d+", s):
-        return None
-    try:
-        return str(int(s))
-    except ValueError:
-        return None
+def flatten_sections(obj: Any) -> Dict[str, Any]:
+    """
+    Ollama 路徑輸出 {doc_class, rationale, header, body, tail}；check_compliance 吃扁平的 gt_parse。
+    這裡把 header/body/tail 攤平（後出現的非空值覆蓋前面的）並對齊 Doc_class / Rationale 鍵名。
+    已經是 {"gt_parse": {...}} 或扁平 dict 則原樣回傳。
+    """
+    if not isinstance(obj, dict):
+        return {"gt_parse": {}}
+    if "gt_parse" in obj:
+        return obj
+    flat: Dict[str, Any] = {}
+    for sec in ("header", "body", "tail", "Tail"):
+        part = obj.get(sec)
+        if isinstance(part, dict):
+            for k, v in part.items():
+                if v not in (None, "") or k not in flat:
+                    flat[k] = v
+    for k, v in obj.items():
+        if k in ("header", "body", "tail", "Tail"):
+            continue
+        lk = k.lower()
+        if lk in ("doc_class", "class"):
+            flat["Doc_class"] = v
+        elif lk == "rationale":
+            flat["Rationale"] = v
+        elif not isinstance(v, (dict, list)):
+            flat.setdefault(k, v)
+    return {"gt_parse": flat}
+
+
+# 欄位規則與單欄檢查的實作在 compliance.py（已編譯的 regex）
+from compliance import check_field, get_engine
 
-PAT_MM = r"(0?[1-9]|1[0-2])"
-PAT_DD = r"(0?[1-9]|[12]\d|3[01])"
 
 def check_compliance(
     data_or_str: Any,
@@ -196,222 +87,584 @@ def check_compliance(
     emit_normalized: bool = False,                  # ★ 會輸出 @normalized:*（三個金額欄位）
     return_normalized_object: bool = True,        # ★ 回傳 (結果, 正規化後物件)
 ) -> Dict[str, bool]:
-    # 1) 解析
-    if isinstance(data_or_str, str):
-        obj = _extract_json(data_or_str)
-    elif isinstance(data_or_str, dict):
-        obj = data_or_str
-    else:
-        raise TypeError("只接受 dict 或 str (JSON)")
-
-    # 2) 取出扁平的 gt_parse（若不在 gt_parse，則視為已是扁平）
-    root = obj.get("gt_parse", obj)
-    keymap = _canonical_key_map(root)
-    # 支援 Doc_class / doc_class；Rationale / rationale
-    doc_class_key = keymap.get("doc_class", "Doc_class" if "Doc_class" in root else "doc_class")
-    rationale_key = keymap.get("rationale", "Rationale" if "Rationale" in root else "rationale")
-    doc_class = _get_ci(root, doc_class_key)
-
-    # 3) 欄位格式規則（扁平版）
-    rules = {
-        "PrefixTwoLetters":    lambda v: _re_match(r"[A-Z]{2}", v),
-        "InvoiceNumber":       lambda v: _re_match(r"\d{8}", v),
-        "InvoiceYear":         lambda v: _re_match(r"(\d{2,3}|\d{4})", v),
-        "InvoiceMonth":        lambda v: _re_match(r"(0?[1-9]|1[0-2])", v),
-        "InvoiceDay":          lambda v: _re_match(r"(0?[1-9]|[12]\d|3[01])", v),
-        "BuyerName":           lambda v: True if v is None else _is_nonempty_str(v),
-        "BuyerTaxIDNumber":    lambda v: True if v is None else _re_match(r"\d{8}", v),
-        "CompanyName":         lambda v: True if v is None else _is_nonempty_str(v),
-        "CompanyAddress":      lambda v: True if v is None else _is_nonempty_str(v),
-        "CompanyTaxIDNumber":  lambda v: True if v is None else _re_match(r"\d{8}", v),
-        "PhoneNumber":         lambda v: True if v is None else _re_match(r"[0-9()+\- ]{7,}", v),
-        "Abstract":            lambda v: True if v is None else _is_nonempty_str(v),
-        "SalesTotalAmount":    lambda v: (_amount_parse_and_normalize_int_str(v) is not None),
-        "SalesTax":            lambda v: (_amount_parse_and_normalize_int_str(v) is not None),
-        "TotalAmount":         lambda v: (_amount_parse_and_normalize_int_str(v) is not None),
-        # meta
-        doc_class_key:         lambda v: _is_nonempty_str(v) if v is not None else True,
-        rationale_key:         lambda v: True if v is None else _is_nonempty_str(v),
-    }
-
-    # 4) 平面值（用輸入的實際鍵名；找不到就是 None）
-    values = { k: root.get(k) for k in [
-        "PrefixTwoLetters","InvoiceNumber","InvoiceYear","InvoiceMonth","InvoiceDay",
-        "BuyerName","BuyerTaxIDNumber","CompanyName","CompanyAddress","CompanyTaxIDNumber",
-        "PhoneNumber","Abstract","SalesTotalAmount","SalesTax","TotalAmount",
-    ]}
-    values[doc_class_key] = doc_class
-    values[rationale_key] = _get_ci(root, rationale_key)
-
-    # 5) 必填欄位（扁平版；可依需求調整）
-    default_required = required_fields or (
-        "PrefixTwoLetters","InvoiceNumber","SalesTotalAmount","SalesTax","TotalAmount",
-    )
-    per_class_required = required_fields_by_doc_class or {
-        "triple_invoice": (
-            "PrefixTwoLetters","InvoiceNumber", "BuyerTaxIDNumber",
-            "InvoiceYear","InvoiceMonth","InvoiceDay", "Abstract",
-            "SalesTotalAmount","SalesTax","TotalAmount", "CompanyTaxIDNumber",
-        ),
-        "triple_receipt": (
-            "PrefixTwoLetters","InvoiceNumber", "CompanyTaxIDNumber",
-            "InvoiceYear","InvoiceMonth","InvoiceDay", "BuyerTaxIDNumber",
-            "Abstract",
-            "SalesTotalAmount","SalesTax","TotalAmount",
-        ),
-    }
-    active_required = per_class_required.get(str(doc_class), default_required)
-
-    # 基本 + 必填
-    full_result: Dict[str, bool] = {}
-    for key, val in values.items():
-        validator = rules.get(key, lambda v: True)
-        ok = validator(val)
-        if ok and key in active_required:
-            ok = not _is_none(val) and (not isinstance(val, str) or len(val.strip()) > 0)
-        full_result[key] = bool(ok)
-
-    # 合計規則：以正規化後數值進行
-    def _to_int_from_amount(x: Any) -> Optional[int]:
-        norm = _amount_parse_and_normalize_int_str(x)
-        if norm is not None:
-            return int(norm)
-        if isinstance(x, str) and re.fullmatch(r"\d+", x or ""):
-            return int(x)
-        return None
-
-    st = _to_int_from_amount(values.get("SalesTotalAmount"))
-    tax = _to_int_from_amount(values.get("SalesTax"))
-    total = _to_int_from_amount(values.get("TotalAmount"))
-    if None not in (st, tax, total):
-        full_result["@rule:TotalAmount_equals_SalesTotal_plus_SalesTax"] = (st + tax == total)
-
-    # 正規化輸出與物件（依 doc_class 組出「固定欄位 + 固定順序」）
-    # 1) 先準備各欄位的正規化值
-    st_norm = _amount_parse_and_normalize_int_str(values.get("SalesTotalAmount"))
-    tax_norm = _amount_parse_and_normalize_int_str(values.get("SalesTax"))
-    total_norm = _amount_parse_and_normalize_int_str(values.get("TotalAmount"))
-    year_norm = _normalize_year_to_gregorian(values.get("InvoiceYear"))
-    mm_norm = _strip_leading_zero_num_str(values.get("InvoiceMonth")) or values.get("InvoiceMonth")
-    dd_norm = _strip_leading_zero_num_str(values.get("InvoiceDay")) or values.get("InvoiceDay")
-
-    # 2) 建立以固定順序輸出的 gt_parse
-    if str(doc_class) == "triple_receipt":
-        normalized_gt_parse = {
-            "Doc_class": "triple_receipt",
-            "Rationale": _get_ci(root, "Rationale"),
-            "PrefixTwoLetters": _get_ci(root, "PrefixTwoLetters"),
-            "InvoiceNumber": _get_ci(root, "InvoiceNumber"),
-            "CompanyName": _get_ci(root, "CompanyName"),
-            "PhoneNumber": _get_ci(root, "PhoneNumber"),
-            "CompanyTaxIDNumber": _get_ci(root, "CompanyTaxIDNumber"),
-            "CompanyAddress": _get_ci(root, "CompanyAddress"),
-            "InvoiceYear": _get_ci(root, "InvoiceYear"), # year_norm
-            "InvoiceMonth": mm_norm,
-            "InvoiceDay": dd_norm,
-            "BuyerTaxIDNumber": _get_ci(root, "BuyerTaxIDNumber"),
-            "BuyerName": _get_ci(root, "BuyerName"),
-            "Abstract": _get_ci(root, "Abstract"),
-            "SalesTotalAmount": st_norm if st_norm is not None else _get_ci(root, "SalesTotalAmount"),
-            "SalesTax": tax_norm if tax_norm is not None else _get_ci(root, "SalesTax"),
-            "TotalAmount": total_norm if total_norm is not None else _get_ci(root, "TotalAmount"),
-        }
-    else:  # 預設視為 triple_invoice（或其他類型也用這個順序以符合需求）
-        normalized_gt_parse = {
-            "Doc_class": "triple_invoice",
-            "Rationale": _get_ci(root, "Rationale"),
-            "PrefixTwoLetters": _get_ci(root, "PrefixTwoLetters"),
-            "InvoiceNumber": _get_ci(root, "InvoiceNumber"),
-            "BuyerName": _get_ci(root, "BuyerName"),
-            "BuyerTaxIDNumber": _get_ci(root, "BuyerTaxIDNumber"),
-            "InvoiceYear": _get_ci(root, "InvoiceYear"), # year_norm
-            "InvoiceMonth": mm_norm,
-            "InvoiceDay": dd_norm,
-            "Abstract": _get_ci(root, "Abstract"),
-            "SalesTotalAmount": st_norm if st_norm is not None else _get_ci(root, "SalesTotalAmount"),
-            "SalesTax": tax_norm if tax_norm is not None else _get_ci(root, "SalesTax"),
-            "TotalAmount": total_norm if total_norm is not None else _get_ci(root, "TotalAmount"),
-            "CompanyName": _get_ci(root, "CompanyName"),
-            "CompanyTaxIDNumber": _get_ci(root, "CompanyTaxIDNumber"),
-            "PhoneNumber": _get_ci(root, "PhoneNumber"),
-            "CompanyAddress": _get_ci(root, "CompanyAddress"),
-        }
+    """
+    合規檢查（必填、欄位格式、金額合計）＋ 依 doc_class 正規化。
+    實作為 compliance.ComplianceEngine：同一組參數的規則與必填表只編譯一次；
+    批次請改用 get_engine().check_batch(records)。
+    """
+    with span("check_compliance"):
+        engine = get_engine(required_fields, required_fields_by_doc_class, only_required_and_rules,
+                            emit_info, emit_normalized)
+        return engine.check(data_or_str, return_normalized_object)
+
+
+import copy
+import inspect
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from PIL import Image
 
-    normalized_obj = {"gt_parse": normalized_gt_parse}
-
-    # 3) 在結果中標出三個金額欄位的正規化值（如有）
-    if emit_normalized:
-        if year_norm is not None:  full_result["@normalized:InvoiceYear"] = year_norm
-        if mm_norm is not None: full_result["@normalized:InvoiceMonth"] = mm_norm
-        if dd_norm is not None:   full_result["@normalized:InvoiceDay"] = dd_norm
-        if st_norm is not None:    full_result["@normalized:SalesTotalAmount"] = st_norm
-        if tax_norm is not None:   full_result["@normalized:SalesTax"] = tax_norm
-        if total_norm is not None: full_result["@normalized:TotalAmount"] = total_norm
-
-    # 只輸出必填 + 規則 + 正規化資訊
-    if only_required_and_rules:
-        filtered = {k: v for k, v in full_result.items()
-                    if k in active_required or k.startswith("@rule:") or k.startswith("@normalized:") or (emit_info and k.startswith("@info:"))}
-    else:
-        filtered = full_result
+from vision_budget import load_image, resize_image, resolve_budget
+from extraction_cache import cached_call, make_key
+from json_constraint import GT_PARSE_SCHEMA, JsonSchemaLogitsProcessor
+from compact_format import INSTRUCTION_COMPACT, decode as compact_decode
+from stopping import FirstTokenTimer, build_stopping_criteria
+from json_stream import FieldStream
+from voting import VoteResult, vote
+from tensor_cache import encode as tensor_encode
 
-    return (filtered, normalized_obj) if return_normalized_object else filtered
+INSTRUCTION = "你是發票/單據分類器與結構化抽取器，請辨識這張文件"
 
 
-from pathlib import Path
-from PIL import Image
+def _text_tokenizer(tok):
+    # Unsloth 回傳的 tokenizer 其實是 processor；eos/pad/padding_side 在內層 tokenizer 上
+    return getattr(tok, "tokenizer", tok)
 
-FastVisionModel.for_inference(model)  # inference 模式
+
+def _generation_kwargs(tok, max_new_tokens: int = 512, constrained: bool = False) -> dict:
+    text_tok = _text_tokenizer(tok)
+    if constrained:
+        # 約束解碼搭配 greedy：每步在合法 token 中取分數最高者，輸出可重現
+        sampling = dict(do_sample=False)
+    else:
+        sampling = dict(
+            temperature=0.1,
+            min_p=0.1,
+            do_sample=True,              # 若你想要可重現，可改成 False
+        )
+    return dict(
+        max_new_tokens=max_new_tokens,
+        use_cache=True,
+        **sampling,
+        eos_token_id=text_tok.eos_token_id,
+        pad_token_id=text_tok.pad_token_id,
+    )
 
 
-def chat_once(image_path):
-    image = Image.open(image_path).convert("RGB")
-    instruction = "你是發票/單據分類器與結構化抽取器，請辨識這張文件"
+_PROMPT_CACHE: Dict[Tuple[int, str], str] = {}
 
+def _build_prompt(tok, instruction: str = INSTRUCTION) -> str:
+    # 固定指令（INSTRUCTION / INSTRUCTION_COMPACT）的 chat template 結果只跟 tokenizer 有關 → 每個 tokenizer 只 render 一次；
+    # 其他指令（例如 field_requery 每次內容不同的短 prompt）每次 render、不進快取，以免快取無限成長
+    key = (id(tok), instruction)
+    if key in _PROMPT_CACHE:
+        return _PROMPT_CACHE[key]
     messages = [
         {"role": "user", "content": [
             {"type": "image"},
             {"type": "text", "text": instruction}
         ]}
     ]
+    text = tok.apply_chat_template(messages, add_generation_prompt=True)
+    if instruction in (INSTRUCTION, INSTRUCTION_COMPACT):
+        _PROMPT_CACHE[key] = text
+    return text
 
-    # 準備輸入
-    input_text = tokenizer.apply_chat_template(messages, add_generation_prompt=True)
-    inputs = tokenizer(
-        image,
-        input_text,
-        add_special_tokens=False,
-        return_tensors="pt",
-    ).to("cuda")
+
+def chat_once(image_path, model=None, tokenizer=None, budget=None, cache=None, constrained=False,
+              compact=False, stopping=True, return_reason=False, tensor_cache=None, max_new_tokens: int = 512):
+    """
+    cache：None → greedy（constrained）解碼時用 extraction_cache 行程共用快取（同一張圖 + 同模型權重/
+           prompt/解碼參數直接回傳上次結果），取樣解碼（預設 do_sample=True）則不快取；
+           True → 取樣解碼也使用共用快取；False → 不使用快取；或直接給 ExtractionCache。
+    constrained：True → 以 json_constraint.GT_PARSE_SCHEMA 約束解碼（key 限定、金額只能是數字、
+                 Doc_class 限列舉值），輸出必定是合法 JSON，不必經過 repair_json。
+    compact：True → 以 compact_format 的精簡欄位代碼格式輸出（需用精簡格式微調過的模型），
+             解碼後一樣回傳 {"gt_parse": {...}} dict。不可與 constrained 同時使用。
+    stopping：True → 最外層 JSON 閉合即停、偵測到重複迴圈即中止（見 stopping.py）。
+    return_reason：True → 回傳 (result, 停止原因)，原因為 stopping.STOP_REASONS 之一。
+    tensor_cache：tensor_cache.TensorCache → 影像張量從磁碟快取讀，不再解碼/縮圖/正規化
+                  （縮圖預算以 TensorCache 建立時的 budget 為準）。
+    max_new_tokens：生成上限（計入快取 key）。
+    """
+    if constrained and compact:
+        raise ValueError("constrained 與 compact 不可同時使用")
+    if model is None or tokenizer is None:
+        model, tokenizer = _load_model_once()
+    gen_kwargs = _generation_kwargs(tokenizer, max_new_tokens, constrained=constrained)
+    if cache is None and gen_kwargs["do_sample"]:
+        cache = False   # 取樣輸出每次不同，不預設寫進永久快取；要快取請傳 cache=True
+
+    def _key():
+        gen = {k: v for k, v in gen_kwargs.items() if not k.endswith("_token_id")}
+        if constrained:
+            gen["schema"] = GT_PARSE_SCHEMA
+        options = {**gen, "budget": repr(resolve_budget(budget)), "stopping": bool(stopping)}
+        if tensor_cache is not None and isinstance(image_path, str):
+            # 走張量快取時實際縮圖預算是 TensorCache 的 budget，前處理設定也以它的指紋為準
+            options["budget"] = repr(tensor_cache.budget)
+            options["tensor_cache"] = tensor_cache.fingerprint
+        return make_key(
+            image_path=image_path,
+            model=model_digest(model),
+            prompt=INSTRUCTION_COMPACT if compact else INSTRUCTION,
+            options=options,
+        )
+
+    with span("chat_once", backend="local", image=str(image_path)) as sp:
+        result, reason = cached_call(
+            cache, _key,
+            lambda: _chat_once_uncached(image_path, model, tokenizer, budget, constrained, compact, stopping,
+                                        tensor_cache, max_new_tokens))
+        if sp:
+            sp.set(stop_reason=reason)
+            annotate(doc_class=doc_class_of(result))
+    return (result, reason) if return_reason else result
+
+
+def _generate_text(image_path, model, tokenizer, budget=None, constrained=False, max_new_tokens=512,
+                   instruction=INSTRUCTION, stopping=True, json_closure=True, schema=None, tensor_cache=None):
+    """
+    單張推論，回傳 (模型輸出文字, 新產生 token 數, 停止原因)。
+    image_path 也可以是已開啟的 PIL.Image（例如 field_requery 的局部裁切）；
+    schema：constrained 時改用這份 schema（預設 GT_PARSE_SCHEMA）。
+    """
+    with span("chat_template"):
+        input_text = _build_prompt(tokenizer, instruction)
+    if tensor_cache is not None and isinstance(image_path, str):
+        # 前處理好的 pixel_values / image_grid_thw 直接從 memmap 快取讀
+        with span("tensor_cache"):
+            inputs = tensor_encode(tokenizer, [input_text], [image_path], tensor_cache, add_special_tokens=False)
+            inputs = {k: v.to(model.device) for k, v in inputs.items()}
+    else:
+        # 依 vision 預算等比例縮圖（預設見 vision_budget.DEFAULT_BUDGET）
+        if isinstance(image_path, Image.Image):
+            image = resize_image(image_path, budget)
+        else:
+            image = load_image(image_path, budget)
+
+        # 準備輸入
+        with span("processor"):
+            inputs = tokenizer(
+                image,
+                input_text,
+                add_special_tokens=False,
+                return_tensors="pt",
+            ).to(model.device)
+
+    prompt_len = inputs["input_ids"].shape[1]
+    text_tok = _text_tokenizer(tokenizer)
+    extra = {}
+    if constrained:
+        from transformers import LogitsProcessorList
+        extra["logits_processor"] = LogitsProcessorList([
+            JsonSchemaLogitsProcessor(schema or GT_PARSE_SCHEMA, text_tok, prompt_len,
+                                      max_new_tokens=max_new_tokens)
+        ])
+    criteria, tracker = build_stopping_criteria(text_tok, prompt_len, json_closure=stopping and json_closure,
+                                                repetition=stopping)
+    if stopping:
+        extra["stopping_criteria"] = criteria
 
     # 產生（不使用 streamer，改成一次取回）
-    gen_ids = model.generate(
-        **inputs,
-        max_new_tokens=512,
-        use_cache=True,
-        temperature=0.1,
-        min_p=0.1,
-        do_sample=True,              # 若你想要可重現，可改成 False
-        eos_token_id=tokenizer.eos_token_id,
-        pad_token_id=tokenizer.pad_token_id,
-    )
+    with span("generate", prompt_tokens=int(prompt_len)) as sp:
+        if sp:
+            # 第一個新 token 出現的時間點拆開 prefill / decode
+            timer = FirstTokenTimer()
+            criteria = criteria if stopping else type(criteria)()
+            criteria.append(timer)
+            extra["stopping_criteria"] = criteria
+            t0 = time.perf_counter()
+        gen_ids = model.generate(**inputs, **_generation_kwargs(tokenizer, max_new_tokens, constrained), **extra)
+        if sp:
+            t_end = time.perf_counter()
+            t_first = timer.t_first or t_end
+            record("prefill", t_first - t0)
+            record("decode", t_end - t_first)
+            sp.set(output_tokens=int(gen_ids.shape[1] - prompt_len))
 
     # 只取「模型新產生」的 token，排除提示部分
-    prompt_len = inputs["input_ids"].shape[1]
     new_token_ids = gen_ids[0, prompt_len:]
 
     output_text = tokenizer.decode(new_token_ids, skip_special_tokens=True).strip()
+    return output_text, int(new_token_ids.shape[0]), tracker.reason(0, new_token_ids, max_new_tokens)
+
+
+def _chat_once_uncached(image_path, model, tokenizer, budget=None, constrained=False, compact=False,
+                        stopping=True, tensor_cache=None, max_new_tokens=512):
+    if compact:
+        # 精簡格式沒有 JSON 外殼，只啟用重複偵測
+        output_text, _, reason = _generate_text(image_path, model, tokenizer, budget,
+                                                max_new_tokens=max_new_tokens, instruction=INSTRUCTION_COMPACT,
+                                                stopping=stopping, json_closure=False, tensor_cache=tensor_cache)
+        return compact_decode(output_text), reason
+
+    output_text, _, reason = _generate_text(image_path, model, tokenizer, budget, constrained,
+                                            max_new_tokens=max_new_tokens, stopping=stopping,
+                                            tensor_cache=tensor_cache)
 
     try:
         result = json.loads(output_text)
     except Exception:
         result, obj, logs = repair_json(output_text)
 
+    return result, reason
+
+
+def chat_stream(image_path, model=None, tokenizer=None, budget=None, max_new_tokens: int = 512,
+                check=check_field, max_bad: int = 2, stopping=True) -> FieldStream:
+    """
+    串流版 chat_once：回傳 json_stream.FieldStream，迭代時每個欄位一閉合就產生 FieldEvent。
+    generate 在背景執行緒跑，文字經 TextIteratorStreamer 逐段送出；逐欄 check 不合格達 max_bad 個時
+    取消生成（CancelCriteria），最外層 JSON 閉合即停。迭代結束後：
+        stream.result（完整物件；未完成時為 None，可改用 repair_json(stream.text)）、
+        stream.cancelled / stream.reason、stream.stop_reason（stopping.STOP_REASONS 之一；
+        提早取消時要等 stream.worker.join() 之後才會填上）
+    不經過 extraction_cache。
+    """
+    from transformers import TextIteratorStreamer
+
+    if model is None or tokenizer is None:
+        model, tokenizer = _load_model_once()
+    image = load_image(image_path, budget)
+    inputs = tokenizer(
+        image,
+        _build_prompt(tokenizer),
+        add_special_tokens=False,
+        return_tensors="pt",
+    ).to(model.device)
+
+    prompt_len = inputs["input_ids"].shape[1]
+    text_tok = _text_tokenizer(tokenizer)
+    cancel_event = threading.Event()
+    criteria, tracker = build_stopping_criteria(text_tok, prompt_len, json_closure=stopping,
+                                                repetition=stopping, cancel_event=cancel_event)
+    streamer = TextIteratorStreamer(text_tok, skip_prompt=True, skip_special_tokens=True)
+    errors: List[BaseException] = []
+
+    def _run():
+        try:
+            gen_ids = model.generate(**inputs, **_generation_kwargs(tokenizer, max_new_tokens),
+                                     streamer=streamer, stopping_criteria=criteria)
+            stream.stop_reason = tracker.reason(0, gen_ids[0, prompt_len:], max_new_tokens)
+        except BaseException as e:   # 讓迭代端看得到例外，且不會卡在 streamer 上
+            errors.append(e)
+            streamer.end()
+
+    def _pieces():
+        yield from streamer
+        worker.join()
+        if errors:
+            raise errors[0]
+
+    stream = FieldStream(_pieces(), check=check, max_bad=max_bad, cancel=cancel_event.set)
+    stream.stop_reason = None
+    worker = threading.Thread(target=_run, daemon=True)
+    stream.worker = worker
+    worker.start()
+    return stream
+
+
+def _prefill_logits_kwargs(model) -> dict:
+    # prefill 只需要最後一個位置的 logits（與 generate 相同的判斷）；舊版 transformers 叫 num_logits_to_keep
+    params = inspect.signature(model.forward).parameters
+    for name in ("logits_to_keep", "num_logits_to_keep"):
+        if name in params:
+            return {name: 1}
+    return {}
+
+
+def _repeat_rope_deltas(model, n: int) -> None:
+    # Qwen2.5-VL 在 prefill 時把 M-RoPE 的位置位移（rope_deltas，shape (1, 1)）存在模型上，
+    # 之後 decode 步驟都靠它算 position_ids；位置依 transformers 版本在外層或 .model → 逐一找出來展成 n 列
+    for m in model.modules():
+        d = getattr(m, "rope_deltas", None)
+        if d is not None and hasattr(d, "repeat_interleave") and d.shape[0] == 1:
+            m.rope_deltas = d.repeat_interleave(n, dim=0)
+
+
+def chat_vote(image_path, n: int = 5, model=None, tokenizer=None, budget=None, max_new_tokens: int = 512,
+              temperature: float = 0.7, stopping=True, weight_compliance=True) -> VoteResult:
+    """
+    Self-consistency 投票：prompt 只 prefill 一次，n 個樣本共用同一份 KV cache 接著取樣，
+    再以 voting.vote 逐欄多數決（權重依合規程度、三個金額整組投票）。
+      1) batch 1 跑一次 forward（prompt 的前 L-1 個 token，含全部 vision token）→ past_key_values
+         與 rope_deltas；vision tower 與 prefill 只算一次，與 n 無關
+      2) DynamicCache.batch_repeat_interleave(n) 把 cache 展成 n 列，rope_deltas 同樣展開
+      3) model.generate 從 cache 接著跑：最後一個 prompt token 在各列算出第一個 token 的 logits，
+         之後每列各自取樣（n 列只多了 decode 的批次成本）
+    回傳 voting.VoteResult：consensus（{"gt_parse": ...}）、agreement（各欄一致比例）、stop_reasons，
+    以及 prefill_s / decode_s（共用 prefill 與 n 列 decode 的耗時）。
+    temperature 要比 chat_once 的 0.1 高，樣本之間才有差異可投。不經過 extraction_cache。
+    """
+    import torch
+    from transformers import DynamicCache
+
+    if model is None or tokenizer is None:
+        model, tokenizer = _load_model_once()
+    image = load_image(image_path, budget)
+    inputs = tokenizer(
+        image,
+        _build_prompt(tokenizer),
+        add_special_tokens=False,
+        return_tensors="pt",
+    ).to(model.device)
+    input_ids, attention_mask = inputs["input_ids"], inputs["attention_mask"]
+    vision = {k: v for k, v in inputs.items() if k not in ("input_ids", "attention_mask")}
+
+    prompt_len = input_ids.shape[1]
+    t0 = time.perf_counter()
+    with span("vote_prefill", prompt_tokens=int(prompt_len), n=n), torch.no_grad():
+        # cache_position 從 0 起算 → 模型視為新的 prefill，依這張圖重算 rope_deltas（不沿用上一次呼叫留下的）
+        out = model(input_ids=input_ids[:, :-1], attention_mask=attention_mask[:, :-1],
+                    past_key_values=DynamicCache(), use_cache=True,
+                    cache_position=torch.arange(prompt_len - 1, device=input_ids.device),
+                    **vision, **_prefill_logits_kwargs(model))
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+    prefill_s = time.perf_counter() - t0
+    past = out.past_key_values
+    if not isinstance(past, DynamicCache):
+        past = DynamicCache.from_legacy_cache(past)
+    past.batch_repeat_interleave(n)
+    _repeat_rope_deltas(model, n)
+    del out
+
+    text_tok = _text_tokenizer(tokenizer)
+    # 每個樣本各自判斷 JSON 閉合 / 重複迴圈；已停的 row 之後只補 pad
+    criteria, tracker = build_stopping_criteria(text_tok, prompt_len, batch_size=n, json_closure=stopping,
+                                                repetition=stopping)
+    gen_kwargs = _generation_kwargs(tokenizer, max_new_tokens)
+    gen_kwargs.update(do_sample=True, temperature=temperature)
+    extra = {"stopping_criteria": criteria} if stopping else {}
+    t1 = time.perf_counter()
+    with span("vote_decode", n=n):
+        # pixel_values 不再傳：影像已在 cache 裡，generate 只處理 cache 之後的 token
+        gen_ids = model.generate(input_ids=input_ids.repeat_interleave(n, dim=0),
+                                 attention_mask=attention_mask.repeat_interleave(n, dim=0),
+                                 past_key_values=past, **gen_kwargs, **extra)
+    decode_s = time.perf_counter() - t1
+
+    samples = []
+    for text in tokenizer.batch_decode(gen_ids[:, prompt_len:], skip_special_tokens=True):
+        text = text.strip()
+        try:
+            obj = json.loads(text)
+        except Exception:
+            fixed_text, obj, logs = repair_json(text)
+        samples.append(flatten_sections(obj) if isinstance(obj, dict) and "raw" not in obj else obj)
+
+    result = vote(samples, weight_compliance=weight_compliance)
+    result.stop_reasons = [tracker.reason(i, gen_ids[i, prompt_len:], max_new_tokens) for i in range(n)]
+    result.prefill_s, result.decode_s = prefill_s, decode_s
     return result
 
 
-input_string = json.loads(chat_once("./invoice2.jpg"))
-compliance, edit_string = check_compliance(input_string)
-print(type(compliance))
-print(json.dumps(compliance, ensure_ascii=False, indent=2))
-print(json.dumps(edit_string, ensure_ascii=False, indent=2))
+def count_prompt_tokens(image_path, tokenizer=None, budget=None) -> int:
+    """chat_once 對這張圖（套用 budget 後）的 prompt token 數（文字 + vision token）。"""
+    if tokenizer is None:
+        _, tokenizer = _load_model_once()
+    inputs = tokenizer(
+        load_image(image_path, budget),
+        _build_prompt(tokenizer),
+        add_special_tokens=False,
+        return_tensors="pt",
+    )
+    return int(inputs["input_ids"].shape[1])
+
+
+def _estimate_vision_tokens(size: Tuple[int, int], tok=None) -> int:
+    """依 Qwen2-VL smart_resize 規則估算一張圖會變成幾個 vision token。"""
+    ip = getattr(tok, "image_processor", None)
+    patch = getattr(ip, "patch_size", 14) or 14
+    merge = getattr(ip, "merge_size", 2) or 2
+    min_pixels = getattr(ip, "min_pixels", 56 * 56) or 56 * 56
+    max_pixels = getattr(ip, "max_pixels", 28 * 28 * 1280) or 28 * 28 * 1280
+    factor = patch * merge
+
+    w, h = size
+    h_bar = max(factor, round(h / factor) * factor)
+    w_bar = max(factor, round(w / factor) * factor)
+    if h_bar * w_bar > max_pixels:
+        beta = ((h * w) / max_pixels) ** 0.5
+        h_bar = max(factor, int(h / beta / factor) * factor)
+        w_bar = max(factor, int(w / beta / factor) * factor)
+    elif h_bar * w_bar < min_pixels:
+        beta = (min_pixels / (h * w)) ** 0.5
+        h_bar = -(-int(h * beta) // factor) * factor
+        w_bar = -(-int(w * beta) // factor) * factor
+    return (h_bar // factor) * (w_bar // factor)
+
+
+def _order_by_vision_tokens(paths: List[str], tok, budget=None) -> List[int]:
+    b = resolve_budget(budget)
+    sizes = []
+    for p in paths:
+        with Image.open(p) as im:   # 只讀 header，不解碼像素
+            sizes.append(b.target_size(im.size))
+    return sorted(range(len(paths)), key=lambda i: _estimate_vision_tokens(sizes[i], tok))
+
+
+def chat_batch(image_paths, batch_size: int = 8, model=None, tokenizer=None,
+               max_new_tokens: int = 512, budget=None) -> List[str]:
+    """
+    一次 generate 多張影像。
+    - 依估算的 vision token 數排序後分批，讓同批影像長度相近、padding 最少
+    - prompt 靠左 padding（decoder-only 生成必須），新 token 一律從 prompt 長度之後取
+    - 每張輸出都經過 repair_json，回傳與輸入順序相同的 JSON 字串 list
+    """
+    if model is None or tokenizer is None:
+        model, tokenizer = _load_model_once()
+    paths = list(image_paths)
+    if not paths:
+        return []
+
+    order = _order_by_vision_tokens(paths, tokenizer, budget)
+    input_text = _build_prompt(tokenizer)
+    gen_kwargs = _generation_kwargs(tokenizer, max_new_tokens)
+    text_tok = _text_tokenizer(tokenizer)
+    results: List[Optional[str]] = [None] * len(paths)
+
+    old_side = text_tok.padding_side
+    text_tok.padding_side = "left"
+    try:
+        for start in range(0, len(order), batch_size):
+            idx = order[start:start + batch_size]
+            images = [load_image(paths[i], budget) for i in idx]
+            inputs = tokenizer(
+                images,
+                [input_text] * len(idx),
+                add_special_tokens=False,
+                padding=True,
+                return_tensors="pt",
+            ).to(model.device)
+
+            gen_ids = model.generate(**inputs, **gen_kwargs)
+
+            prompt_len = inputs["input_ids"].shape[1]
+            texts = tokenizer.batch_decode(gen_ids[:, prompt_len:], skip_special_tokens=True)
+            for i, text in zip(idx, texts):
+                fixed_text, obj, logs = repair_json(text.strip())
+                results[i] = fixed_text
+    finally:
+        text_tok.padding_side = old_side
+
+    return results
+
+
+@dataclass
+class PipelineStats:
+    """chat_pipeline 各階段計時；consumer_wait_s 高 → CPU 前處理是瓶頸，producer_wait_s 高 → GPU 是瓶頸。"""
+    batches: int = 0
+    images: int = 0
+    preprocess_s: float = 0.0       # 工作執行緒：解碼 + processor 的累計時間
+    producer_wait_s: float = 0.0    # 前處理已完成、排隊等 GPU 取用的累計時間
+    consumer_wait_s: float = 0.0    # GPU 端等待下一批前處理完成的累計時間
+    generate_s: float = 0.0         # model.generate（含 .to(device)）累計時間
+    queue_depth_samples: List[int] = field(default_factory=list)  # 每次取批時已備妥的批數
+
+    @property
+    def max_queue_depth(self) -> int:
+        return max(self.queue_depth_samples, default=0)
+
+    @property
+    def avg_queue_depth(self) -> float:
+        q = self.queue_depth_samples
+        return sum(q) / len(q) if q else 0.0
+
+    def summary(self) -> dict:
+        return {
+            "batches": self.batches,
+            "images": self.images,
+            "preprocess_s": round(self.preprocess_s, 3),
+            "producer_wait_s": round(self.producer_wait_s, 3),
+            "consumer_wait_s": round(self.consumer_wait_s, 3),
+            "generate_s": round(self.generate_s, 3),
+            "avg_queue_depth": round(self.avg_queue_depth, 2),
+            "max_queue_depth": self.max_queue_depth,
+        }
+
+
+def chat_pipeline(image_paths, batch_size: int = 4, prefetch: int = 2, num_workers: int = 2,
+                  model=None, tokenizer=None, max_new_tokens: int = 512,
+                  budget=None) -> Tuple[List[str], PipelineStats]:
+    """
+    producer/consumer 版本的 chat_batch：
+    - 執行緒池預先解碼 JPEG 並跑 processor（最多領先 prefetch 批），同時 GPU 在 generate 目前這批
+    - 每個工作執行緒持有自己的 processor 副本（fast tokenizer 不適合跨執行緒共用）
+    - chat template 只 render 一次（_build_prompt 快取）
+    回傳 (與輸入順序相同的 JSON 字串 list, PipelineStats)
+    """
+    if model is None or tokenizer is None:
+        model, tokenizer = _load_model_once()
+    paths = list(image_paths)
+    stats = PipelineStats()
+    if not paths:
+        return [], stats
+
+    order = _order_by_vision_tokens(paths, tokenizer, budget)
+    batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+    input_text = _build_prompt(tokenizer)
+    gen_kwargs = _generation_kwargs(tokenizer, max_new_tokens)
+    results: List[Optional[str]] = [None] * len(paths)
+    local = threading.local()
+    pin = getattr(model.device, "type", "cpu") == "cuda"
+
+    def _worker_processor():
+        if not hasattr(local, "proc"):
+            local.proc = copy.deepcopy(tokenizer)
+            _text_tokenizer(local.proc).padding_side = "left"
+        return local.proc
+
+    def _preprocess(idx: List[int]):
+        t0 = time.perf_counter()
+        proc = _worker_processor()
+        images = [load_image(paths[i], budget) for i in idx]
+        inputs = proc(
+            images,
+            [input_text] * len(idx),
+            add_special_tokens=False,
+            padding=True,
+            return_tensors="pt",
+        )
+        if pin:
+            inputs = {k: (v.pin_memory() if hasattr(v, "pin_memory") else v) for k, v in inputs.items()}
+        done = time.perf_counter()
+        return idx, inputs, done - t0, done
+
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+        pending = deque()
+        next_batch = 0
+        while next_batch < len(batches) and len(pending) < max(1, prefetch):
+            pending.append(pool.submit(_preprocess, batches[next_batch])); next_batch += 1
+
+        while pending:
+            stats.queue_depth_samples.append(sum(1 for f in pending if f.done()))
+            t_wait = time.perf_counter()
+            idx, inputs, prep_s, ready_at = pending.popleft().result()
+            got = time.perf_counter()
+            stats.consumer_wait_s += got - t_wait
+            stats.producer_wait_s += max(0.0, t_wait - ready_at)
+            stats.preprocess_s += prep_s
+
+            # 先補貨再 generate，讓前處理與 GPU 重疊
+            if next_batch < len(batches):
+                pending.append(pool.submit(_preprocess, batches[next_batch])); next_batch += 1
+
+            t_gen = time.perf_counter()
+            inputs = {k: (v.to(model.device, non_blocking=True) if hasattr(v, "to") else v)
+                      for k, v in inputs.items()}
+            gen_ids = model.generate(**inputs, **gen_kwargs)
+            prompt_len = inputs["input_ids"].shape[1]
+            texts = tokenizer.batch_decode(gen_ids[:, prompt_len:], skip_special_tokens=True)
+            stats.generate_s += time.perf_counter() - t_gen
+
+            for i, text in zip(idx, texts):
+                fixed_text, obj, logs = repair_json(text.strip())
+                results[i] = fixed_text
+            stats.batches += 1
+            stats.images += len(idx)
+
+    return results, stats
+
+
+if __name__ == "__main__":
+    input_string = json.loads(chat_once("./invoice2.jpg"))
+    compliance, edit_string = check_compliance(input_string)
+    print(type(compliance))
+    print(json.dumps(compliance, ensure_ascii=False, indent=2))
+    print(json.dumps(edit_string, ensure_ascii=False, indent=2))
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+chat_once 逐張迴圈 vs chat_batch vs chat_pipeline 的吞吐量比較。
+
+預設用「極小、隨機初始化」的 Qwen2-VL 設定在 CPU 上跑，不需要 GPU、VAT_model 或網路
+（processor / tokenizer 在本地建立：小型 byte-level BPE + 最簡 chat template）：
+   python bench/bench_chat_batch.py --n 16 --batch-size 4
+   python bench/bench_chat_batch.py --processor-id Qwen/Qwen2-VL-2B-Instruct   # 改用官方 processor（需下載）
+
+若要在真模型上比較，加 --real（會走 VAT_OCR._load_model_once 載入 VAT_model）：
+   python bench/bench_chat_batch.py --real --images ../AllDataset/VAT-OCR/triple_receipt/image --n 64
+
+備註：隨機權重的輸出是亂碼，repair_json 多半會落到 {"raw": ...}，
+      這裡只看每秒張數，不看內容。
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+import VAT_OCR
+
+
+SPECIAL_TOKENS = ["<|endoftext|>", "<|im_start|>", "<|im_end|>", "<|vision_start|>", "<|vision_end|>",
+                  "<|image_pad|>", "<|video_pad|>"]
+# Qwen2-VL chat template 的最小子集：只處理 text / image 兩種內容
+CHAT_TEMPLATE = (
+    "{% for message in messages %}<|im_start|>{{ message['role'] }}\n"
+    "{% if message['content'] is string %}{{ message['content'] }}"
+    "{% else %}{% for c in message['content'] %}"
+    "{% if c['type'] == 'image' %}<|vision_start|><|image_pad|><|vision_end|>"
+    "{% elif c['type'] == 'text' %}{{ c['text'] }}{% endif %}"
+    "{% endfor %}{% endif %}<|im_end|>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+
+def build_local_processor(min_pixels: int = 28 * 28 * 4, max_pixels: int = 28 * 28 * 64):
+    """不連網建立 Qwen2-VL processor：以 INSTRUCTION 訓練的小型 byte-level BPE + Qwen2VLImageProcessor。"""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast, Qwen2VLImageProcessor, Qwen2VLProcessor
+
+    tok = Tokenizer(models.BPE())
+    tok.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tok.decoder = decoders.ByteLevel()
+    tok.train_from_iterator([VAT_OCR.INSTRUCTION, "user assistant"], trainers.BpeTrainer(
+        vocab_size=512, special_tokens=SPECIAL_TOKENS, initial_alphabet=pre_tokenizers.ByteLevel.alphabet()))
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tok, eos_token="<|im_end|>", pad_token="<|endoftext|>",
+                                        additional_special_tokens=SPECIAL_TOKENS[1:])
+    image_processor = Qwen2VLImageProcessor(min_pixels=min_pixels, max_pixels=max_pixels)
+    extra = {}
+    try:   # 新版 transformers 的 Qwen2VLProcessor 另有 video_processor
+        from transformers import Qwen2VLVideoProcessor
+        extra["video_processor"] = Qwen2VLVideoProcessor()
+    except Exception:
+        pass
+    return Qwen2VLProcessor(image_processor=image_processor, tokenizer=tokenizer, chat_template=CHAT_TEMPLATE,
+                            **extra)
+
+
+def build_tiny_qwen2vl(processor_id: str = None):
+    """
+    建立隨機初始化的小型 Qwen2-VL（權重為隨機）。processor_id=None → 本地建立 processor（不需網路）；
+    給 HF hub id 則沿用官方 processor。
+    """
+    import torch
+    from transformers import AutoProcessor, Qwen2VLConfig, Qwen2VLForConditionalGeneration
+
+    if processor_id is None:
+        processor = build_local_processor()
+    else:
+        processor = AutoProcessor.from_pretrained(
+            processor_id,
+            min_pixels=28 * 28 * 4,
+            max_pixels=28 * 28 * 64,     # 壓低 vision token 數，CPU 才跑得動
+        )
+    vocab_size = len(processor.tokenizer)
+    config = Qwen2VLConfig(
+        vocab_size=vocab_size,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=4096,
+        rope_scaling={"type": "mrope", "mrope_section": [4, 2, 2]},
+        vision_config={
+            "depth": 1, "embed_dim": 32, "num_heads": 2, "mlp_ratio": 2,
+            "hidden_size": 64, "patch_size": 14, "spatial_merge_size": 2,
+        },
+        image_token_id=processor.tokenizer.convert_tokens_to_ids("<|image_pad|>"),
+        video_token_id=processor.tokenizer.convert_tokens_to_ids("<|video_pad|>"),
+        vision_start_token_id=processor.tokenizer.convert_tokens_to_ids("<|vision_start|>"),
+    )
+    torch.manual_seed(0)
+    model = Qwen2VLForConditionalGeneration(config).eval()
+    return model, processor
+
+
+def make_synthetic_images(n: int, out_dir: str):
+    """產生 n 張不同解析度的假「發票」影像（手機直拍/橫拍/掃描比例混合）。"""
+    rng = random.Random(0)
+    sizes = [(640, 480), (480, 640), (1024, 768), (800, 1200), (320, 240)]
+    paths = []
+    for i in range(n):
+        w, h = sizes[rng.randrange(len(sizes))]
+        img = Image.new("RGB", (w, h), (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+        p = os.path.join(out_dir, f"synthetic_{i:04d}.jpg")
+        img.save(p, quality=85)
+        paths.append(p)
+    return paths
+
+
+def list_images(d: str):
+    exts = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff"}
+    return sorted(os.path.join(d, f) for f in os.listdir(d) if os.path.splitext(f)[1].lower() in exts)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=16, help="影像張數")
+    ap.add_argument("--batch-size", type=int, default=4)
+    ap.add_argument("--max-new-tokens", type=int, default=32)
+    ap.add_argument("--prefetch", type=int, default=2, help="chat_pipeline 預先前處理的批數")
+    ap.add_argument("--workers", type=int, default=2, help="chat_pipeline 前處理執行緒數")
+    ap.add_argument("--real", action="store_true", help="改用 VAT_model（需 GPU）")
+    ap.add_argument("--images", default=None, help="影像資料夾；未給則產生假影像")
+    ap.add_argument("--processor-id", default=None, help="隨機小模型改用 HF hub 上的 processor（需網路）")
+    args = ap.parse_args()
+
+    if args.real:
+        model, tokenizer = VAT_OCR._load_model_once()
+    else:
+        model, tokenizer = build_tiny_qwen2vl(args.processor_id)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = list_images(args.images)[:args.n] if args.images else make_synthetic_images(args.n, tmp)
+
+        # 暖機一次，避免第一次呼叫的初始化成本算進迴圈
+        VAT_OCR.chat_batch(paths[:1], batch_size=1, model=model, tokenizer=tokenizer,
+                           max_new_tokens=args.max_new_tokens)
+
+        # 現行做法：逐張 chat_once（不經抽取快取；stopping 關閉，與 chat_batch 一樣生成到 max_new_tokens）
+        t0 = time.perf_counter()
+        for p in paths:
+            VAT_OCR.chat_once(p, model, tokenizer, cache=False, stopping=False,
+                              max_new_tokens=args.max_new_tokens)
+        t_loop = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        out = VAT_OCR.chat_batch(paths, batch_size=args.batch_size, model=model, tokenizer=tokenizer,
+                                 max_new_tokens=args.max_new_tokens)
+        t_batch = time.perf_counter() - t0
+        assert len(out) == len(paths)
+
+        t0 = time.perf_counter()
+        out, stats = VAT_OCR.chat_pipeline(paths, batch_size=args.batch_size, prefetch=args.prefetch,
+                                           num_workers=args.workers, model=model, tokenizer=tokenizer,
+                                           max_new_tokens=args.max_new_tokens)
+        t_pipe = time.perf_counter() - t0
+        assert len(out) == len(paths)
+
+    print(f"images           : {len(paths)}")
+    print(f"chat_once loop   : {t_loop:.2f}s  ({len(paths) / t_loop:.2f} img/s)")
+    print(f"chat_batch (bs={args.batch_size}): {t_batch:.2f}s  ({len(paths) / t_batch:.2f} img/s)")
+    print(f"speedup          : {t_loop / t_batch:.2f}x")
+    print(f"chat_pipeline (bs={args.batch_size}, prefetch={args.prefetch}): {t_pipe:.2f}s  "
+          f"({len(paths) / t_pipe:.2f} img/s)")
+    print(f"pipeline stats   : {stats.summary()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+JSON ground_truth vs 精簡欄位代碼格式（compact_format）：輸出 token 數與端到端延遲。
+
+1) token 數：用 Qwen tokenizer 分別計算每筆 ground_truth 的 JSON 與精簡格式長度
+   （--dataset 給 Donut 資料集；未給時用內建的兩筆範例）
+2) 延遲：生成時間隨輸出長度線性成長，以「強制產生 N 個 token」量測 JSON 與精簡格式
+   平均長度各自的生成時間，再加上解析（json.loads+repair_json vs compact decode）時間
+   - 預設用極小隨機 Qwen2-VL（CPU），看相對比例
+   - --real 用 VAT_model（需 GPU）；若模型已用精簡格式微調，另加 --images 直接比較 chat_once 兩種輸出
+
+用法：
+   python bench/bench_compact_format.py --dataset ../AllDataset/VAT-OCR/train2_donut_dataset.json
+   python bench/bench_compact_format.py --real --images ../AllDataset/VAT-OCR/triple_receipt/image --n 20
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import VAT_OCR
+from compact_format import encode, decode, load_donut_samples
+from bench_chat_batch import build_tiny_qwen2vl, make_synthetic_images, list_images
+
+SAMPLE_GT = [
+    {"gt_parse": {
+        "Abstract": "零件2批 25780", "BuyerName": "建邦貿易有限公司", "BuyerTaxIDNumber": "12361788",
+        "CompanyAddress": "台北市中山區新生北路3段93巷18號", "CompanyName": "金暉汽材有限公司",
+        "CompanyTaxIDNumber": "12868673", "Doc_class": "triple_invoice", "InvoiceDay": "6",
+        "InvoiceMonth": "3", "InvoiceNumber": "54957806", "InvoiceYear": "112",
+        "PhoneNumber": "02-2599-5123", "PrefixTwoLetters": "KY", "Rationale": "統一發票(三聯式)",
+        "SalesTax": "1289", "SalesTotalAmount": "25780", "TotalAmount": "27069"}},
+    {"gt_parse": {
+        "Abstract": "喵咪刺繡皮標上翻筆貸 105個 119.73 12,572", "BuyerName": "彩琿實業有限公司",
+        "BuyerTaxIDNumber": "53812386", "CompanyAddress": "台南市歸仁區許厝里公園路152號1樓",
+        "CompanyName": "九達生活禮品股份有限公司", "CompanyTaxIDNumber": "16900386",
+        "Doc_class": "triple_receipt", "InvoiceDay": "17", "InvoiceMonth": "9", "InvoiceNumber": "15255935",
+        "InvoiceYear": "110", "PhoneNumber": "06-2702917", "PrefixTwoLetters": "RH",
+        "Rationale": "收銀機統一發票", "SalesTax": "629", "SalesTotalAmount": "12572", "TotalAmount": "13201"}},
+]
+
+
+def load_ground_truths(path):
+    if not path:
+        return [json.dumps(g, ensure_ascii=False) for g in SAMPLE_GT]
+    samples, _ = load_donut_samples(path)
+    return [s["ground_truth"] if isinstance(s["ground_truth"], str) else json.dumps(s["ground_truth"], ensure_ascii=False)
+            for s in samples if s.get("ground_truth")]
+
+
+def token_stats(gts, tok):
+    text_tok = VAT_OCR._text_tokenizer(tok)
+    j, c = [], []
+    for gt in gts:
+        j.append(len(text_tok.encode(gt, add_special_tokens=False)))
+        c.append(len(text_tok.encode(encode(json.loads(gt)), add_special_tokens=False)))
+    return statistics.mean(j), statistics.mean(c)
+
+
+def parse_time(gts, repeat=200):
+    compact = [encode(json.loads(g)) for g in gts]
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for g in gts:
+            try:
+                json.loads(g)
+            except Exception:
+                VAT_OCR.repair_json(g)
+    t_json = (time.perf_counter() - t0) / (repeat * len(gts))
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for c in compact:
+            decode(c)
+    t_compact = (time.perf_counter() - t0) / (repeat * len(gts))
+    return t_json, t_compact
+
+
+def gen_time(model, tok, image_path, n_tokens, repeat=3):
+    """強制產生剛好 n_tokens 個 token 的時間（含 prefill）。"""
+    image = VAT_OCR.load_image(image_path)
+    inputs = tok(image, VAT_OCR._build_prompt(tok), add_special_tokens=False, return_tensors="pt").to(model.device)
+    kw = VAT_OCR._generation_kwargs(tok, n_tokens)
+    kw.update(min_new_tokens=n_tokens, do_sample=False)
+    kw.pop("temperature", None); kw.pop("min_p", None)
+    ts = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        model.generate(**inputs, **kw)
+        ts.append(time.perf_counter() - t0)
+    return statistics.median(ts)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--dataset", default=None, help="Donut 資料集（ground_truth 為 JSON 字串）")
+    ap.add_argument("--real", action="store_true", help="改用 VAT_model（需 GPU）")
+    ap.add_argument("--images", default=None, help="--real 時直接比較 chat_once(compact=False/True)")
+    ap.add_argument("--n", type=int, default=20)
+    args = ap.parse_args()
+
+    model, tok = VAT_OCR._load_model_once() if args.real else build_tiny_qwen2vl()
+    gts = load_ground_truths(args.dataset)
+
+    j_tok, c_tok = token_stats(gts, tok)
+    t_json, t_compact = parse_time(gts)
+    print(f"samples            : {len(gts)}")
+    print(f"output tokens      : JSON {j_tok:.1f}  compact {c_tok:.1f}  ({c_tok / j_tok:.2f}x)")
+    print(f"parse time / sample: JSON {t_json * 1e6:.1f}us  compact {t_compact * 1e6:.1f}us")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        img = list_images(args.images)[0] if args.images else make_synthetic_images(1, tmp)[0]
+        gen_time(model, tok, img, 4, repeat=1)   # 暖機
+        g_json = gen_time(model, tok, img, round(j_tok))
+        g_compact = gen_time(model, tok, img, round(c_tok))
+    e2e_json, e2e_compact = g_json + t_json, g_compact + t_compact
+    print(f"generate (forced)  : JSON {g_json:.3f}s  compact {g_compact:.3f}s")
+    print(f"end-to-end         : JSON {e2e_json:.3f}s  compact {e2e_compact:.3f}s  "
+          f"({e2e_json / e2e_compact:.2f}x faster)")
+
+    if args.real and args.images:
+        # 需要已用精簡格式（INSTRUCTION_COMPACT）微調過的 VAT_model 才有意義
+        paths = list_images(args.images)[:args.n]
+        for compact in (False, True):
+            t0 = time.perf_counter()
+            for p in paths:
+                VAT_OCR.chat_once(p, model, tok, cache=False, compact=compact)
+            dt = (time.perf_counter() - t0) / len(paths)
+            print(f"chat_once compact={compact!s:<5}: {dt:.3f}s / image")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+合規檢查：舊版逐筆實作（bench/compliance_reference.py）vs 編譯式引擎（compliance.py）。
+
+1) 產生 N 筆（預設 100k）合成 gt_parse：合法、格式錯誤、缺欄、千分位金額、鍵名大小寫不一、
+   doc_class 各類混合，另有少量 JSON 字串輸入
+2) 逐筆比對兩者輸出（結果 dict 與正規化物件）必須完全相同
+3) 計時：舊版逐筆、引擎逐筆（check_compliance）、引擎批次（check_batch，list 與欄式表）
+
+用法：
+   python bench/bench_compliance.py --n 100000
+   python bench/bench_compliance.py --audit ../AllDataset/VAT-OCR --workers 8   # 另外計時資料夾稽核
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from compliance_reference import check_compliance_reference
+from compliance import get_engine, audit_dir
+
+DOC_CLASSES = ["triple_invoice", "triple_receipt", "e_invoice", "other", None, ""]
+
+
+def _amount(rng):
+    v = rng.randrange(1, 2_000_000)
+    return rng.choice([str(v), f"{v:,}", f"{v}.00", f"{v:,}.00", f"{v}.5", f"NT${v}", "", None, v])
+
+
+def make_records(n: int, seed: int = 0):
+    rng = random.Random(seed)
+    out = []
+    for i in range(n):
+        st = rng.randrange(100, 100000)
+        tax = round(st * 0.05) if rng.random() < 0.8 else rng.randrange(0, 5000)
+        gt = {
+            "Doc_class": rng.choice(DOC_CLASSES),
+            "Rationale": rng.choice(["統一發票(三聯式)", "收銀機統一發票", "", None]),
+            "PrefixTwoLetters": rng.choice(["KY", "RH", "ky", "K1", None]),
+            "InvoiceNumber": rng.choice([f"{rng.randrange(10**8):08d}", f"{rng.randrange(10**7)}", None]),
+            "InvoiceYear": rng.choice(["112", "2023", "99", "1", None]),
+            "InvoiceMonth": rng.choice(["3", "03", "12", "13", "0", None]),
+            "InvoiceDay": rng.choice(["6", "06", "31", "32", None]),
+            "BuyerName": rng.choice(["建邦貿易有限公司", " ", None]),
+            "BuyerTaxIDNumber": rng.choice(["12361788", "1236178", None]),
+            "CompanyName": rng.choice(["金暉汽材有限公司", None]),
+            "CompanyAddress": rng.choice(["台北市中山區新生北路3段93巷18號", "", None]),
+            "CompanyTaxIDNumber": rng.choice(["12868673", "abc", None]),
+            "PhoneNumber": rng.choice(["02-2599-5123", "(02) 2599 5123", "123", None]),
+            "Abstract": rng.choice(["零件2批 25780", "", None]),
+            "SalesTotalAmount": rng.choice([str(st), f"{st:,}", _amount(rng)]),
+            "SalesTax": rng.choice([str(tax), _amount(rng)]),
+            "TotalAmount": rng.choice([str(st + tax), f"{st + tax:,}.00", _amount(rng)]),
+        }
+        # 缺欄、鍵名大小寫、doc_class 小寫鍵
+        for k in rng.sample(list(gt), rng.randrange(0, 4)):
+            del gt[k]
+        if rng.random() < 0.1 and "Doc_class" in gt:
+            gt["doc_class"] = gt.pop("Doc_class")
+        if rng.random() < 0.05 and "InvoiceNumber" in gt:
+            gt["invoicenumber"] = gt.pop("InvoiceNumber")
+        rec = {"gt_parse": gt} if rng.random() < 0.9 else gt
+        if rng.random() < 0.02:
+            rec = "模型輸出：" + json.dumps(rec, ensure_ascii=False)
+        out.append(rec)
+    return out
+
+
+def timeit(fn):
+    t0 = time.perf_counter()
+    res = fn()
+    return res, time.perf_counter() - t0
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=100_000)
+    ap.add_argument("--audit", default=None, help="另外計時 compliance.audit_dir 的資料夾")
+    ap.add_argument("--workers", type=int, default=None)
+    args = ap.parse_args()
+
+    records = make_records(args.n)
+    eng = get_engine()
+
+    ref, t_ref = timeit(lambda: [check_compliance_reference(r) for r in records])
+    new, t_new = timeit(lambda: [eng.check(r) for r in records])
+    batch, t_batch = timeit(lambda: eng.check_batch(records))
+
+    mismatches = [i for i, (a, b) in enumerate(zip(ref, new)) if a != b]
+    mismatches += [i for i in range(len(records))
+                   if (batch.row(i), batch.normalized[i]) != ref[i] and i not in mismatches]
+    dict_rows = [r for r in records if isinstance(r, dict)]
+    flat = [r.get("gt_parse", r) for r in dict_rows]
+    keys = sorted({k for g in flat for k in g})
+    columnar = {k: [g.get(k) for g in flat] for k in keys}
+    _, t_col = timeit(lambda: eng.check_batch(columnar))
+
+    n = len(records)
+    print(f"records            : {n}   mismatches: {len(mismatches)}")
+    print(f"reference per-record: {t_ref:.2f}s  ({t_ref / n * 1e6:.1f}us/record)")
+    print(f"engine per-record   : {t_new:.2f}s  ({t_new / n * 1e6:.1f}us/record, {t_ref / t_new:.1f}x)")
+    print(f"engine check_batch  : {t_batch:.2f}s  ({t_batch / n * 1e6:.1f}us/record, {t_ref / t_batch:.1f}x)")
+    print(f"columnar table      : {t_col:.2f}s  ({len(flat)} rows)")
+    print(f"pass rate           : {sum(batch.passed) / n:.1%}")
+    if mismatches:
+        i = mismatches[0]
+        print("first mismatch:", json.dumps(records[i], ensure_ascii=False))
+        print("  reference:", ref[i])
+        print("  engine   :", new[i])
+        sys.exit(1)
+
+    if args.audit:
+        rep, t_audit = timeit(lambda: audit_dir(args.audit, workers=args.workers))
+        print(f"audit {args.audit}: {rep['records']} records in {t_audit:.2f}s, pass rate {rep['pass_rate']:.1%}")
+
+
+if __name__ == "__main__":
+    main()
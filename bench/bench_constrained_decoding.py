@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+chat_once 自由取樣 vs 約束解碼（constrained=True）：修復率 / {"raw": ...} 兜底率 / 產生 token 數 / 延遲。
+
+每張影像兩種模式各跑一次（不經快取），輸出分成三類：
+  direct   ：json.loads 直接成功
+  repaired ：json.loads 失敗、repair_json 修得回來
+  fallback ：repair_json 也失敗，只剩 {"raw": ...}
+
+預設用極小的隨機 Qwen2-VL（見 bench_chat_batch.build_tiny_qwen2vl）在 CPU 上跑，
+隨機權重的自由輸出幾乎全是 fallback，約束後應全部為 direct：
+   python bench/bench_constrained_decoding.py --n 8 --max-new-tokens 96
+
+真模型（VAT_model）：
+   python bench/bench_constrained_decoding.py --real --images ../AllDataset/VAT-OCR/triple_receipt/image --n 50
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import VAT_OCR
+from bench_chat_batch import build_tiny_qwen2vl, make_synthetic_images, list_images
+
+
+def classify_output(text: str) -> str:
+    try:
+        json.loads(text)
+        return "direct"
+    except Exception:
+        pass
+    _, obj, _ = VAT_OCR.repair_json(text)
+    return "fallback" if isinstance(obj, dict) and set(obj) == {"raw"} else "repaired"
+
+
+def run(paths, model, tokenizer, constrained: bool, max_new_tokens: int) -> dict:
+    counts = {"direct": 0, "repaired": 0, "fallback": 0}
+    tokens, latency = [], []
+    for p in paths:
+        t0 = time.perf_counter()
+        text, n_new, _ = VAT_OCR._generate_text(p, model, tokenizer, constrained=constrained,
+                                                max_new_tokens=max_new_tokens)
+        latency.append(time.perf_counter() - t0)
+        tokens.append(n_new)
+        counts[classify_output(text)] += 1
+    n = len(paths)
+    return {
+        "mode": "constrained" if constrained else "free",
+        **counts,
+        "repair_rate": counts["repaired"] / n,
+        "fallback_rate": counts["fallback"] / n,
+        "mean_new_tokens": statistics.mean(tokens),
+        "mean_latency_s": statistics.mean(latency),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=8, help="影像張數")
+    ap.add_argument("--max-new-tokens", type=int, default=None, help="預設：隨機小模型 96、--real 512")
+    ap.add_argument("--real", action="store_true", help="改用 VAT_model（需 GPU）")
+    ap.add_argument("--images", default=None, help="影像資料夾；未給則產生假影像")
+    ap.add_argument("--out", default=None, help="結果另存 JSON")
+    args = ap.parse_args()
+
+    if args.real:
+        model, tokenizer = VAT_OCR._load_model_once()
+    else:
+        model, tokenizer = build_tiny_qwen2vl()
+    max_new_tokens = args.max_new_tokens or (512 if args.real else 96)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = list_images(args.images)[:args.n] if args.images else make_synthetic_images(args.n, tmp)
+        VAT_OCR._generate_text(paths[0], model, tokenizer, max_new_tokens=8)   # 暖機
+        rows = [run(paths, model, tokenizer, c, max_new_tokens) for c in (False, True)]
+
+    print(f"images: {len(paths)}   max_new_tokens: {max_new_tokens}")
+    print(f"{'mode':<12}{'direct':>8}{'repaired':>10}{'fallback':>10}{'tokens':>9}{'latency':>10}")
+    for r in rows:
+        print(f"{r['mode']:<12}{r['direct']:>8}{r['repaired']:>10}{r['fallback']:>10}"
+              f"{r['mean_new_tokens']:>9.1f}{r['mean_latency_s']:>9.2f}s")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+docvqa_final2 的 import 時間量測（few-shot 影像延遲載入前後）。
+
+每一項都在全新的子行程裡量，避免模組已在記憶體中：
+  - import only              ：現在的 import 成本（不讀檔、不編碼）
+  - import + shots (cold)    ：快取清空後第一次取用 shots（= 改版前 import 時就要付的編碼成本）
+  - import + shots (warm)    ：快取已建立，之後的行程以 mmap 讀取
+
+用法：python bench/bench_fewshot_import.py --repeat 5
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DOCVQA = os.path.join(ROOT, "docvqa")
+
+SNIPPET = r"""
+import sys, time, json
+sys.path.insert(0, {docvqa!r})
+t0 = time.perf_counter()
+import docvqa_final2
+t1 = time.perf_counter()
+if {use_shots}:
+    docvqa_final2.get_shots()
+t2 = time.perf_counter()
+print(json.dumps({{"import": t1 - t0, "shots": t2 - t1}}))
+"""
+
+
+def run_once(use_shots: bool, cache_dir: str) -> dict:
+    env = dict(os.environ, VAT_FEWSHOT_CACHE=cache_dir)
+    code = SNIPPET.format(docvqa=DOCVQA, use_shots=use_shots)
+    out = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    cache_dir = tempfile.mkdtemp(prefix="vat_fewshot_bench_")
+    try:
+        rows = {"import only": [], "import + shots (cold)": [], "import + shots (warm)": []}
+        for _ in range(args.repeat):
+            r = run_once(False, cache_dir)
+            rows["import only"].append(r["import"])
+
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            r = run_once(True, cache_dir)
+            rows["import + shots (cold)"].append(r["import"] + r["shots"])
+
+            r = run_once(True, cache_dir)
+            rows["import + shots (warm)"].append(r["import"] + r["shots"])
+
+        for name, xs in rows.items():
+            print(f"{name:<24} median {statistics.median(xs) * 1000:8.1f} ms   (n={len(xs)})")
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+後處理 microbenchmark：每份文件都會經過的 repair_json、extract_first_json_block（docvqa 的
+_extract_first_json_block）、_extract_json 與 check_compliance。
+
+語料：
+  - 精選：bench/postprocess_corpus.jsonl，從 notebook 記錄（"bad json is repaired!"）整理的典型壞輸出，
+    每筆附預期結果（能否解析、正規化後的欄位值），順便當回歸測試
+  - 產生：以 bench_compliance.make_records 的 gt_parse 渲染成模型輸出文字，再隨機疊加
+    ``` 外殼、前後說明文字、單引號 / Python 常量、尾逗號、截斷、全形數字、彎引號、字串內換行、
+    Ollama 的 header/body/tail 分段格式（千分位金額來自 make_records 本身）
+
+量測：
+  1) 精選語料逐筆計時（每筆重複 --repeat 次取中位數）
+  2) --sizes（預設 10k、100k）筆產生語料，各函式的總時間、us/record、records/s
+  3) --baseline：與先前 --save-baseline 存下的報告比較，任一函式 records/s 下降超過 --threshold 即 exit 1
+
+用法：
+   python bench/bench_postprocess.py --save-baseline postprocess_baseline.json
+   python bench/bench_postprocess.py --baseline postprocess_baseline.json --threshold 0.15
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_compliance import make_records
+from VAT_OCR import _extract_json, check_compliance, flatten_sections, repair_json, repair_stats
+from ollama_client import extract_first_json_block
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "postprocess_corpus.jsonl")
+FULL_WIDTH = str.maketrans("0123456789", "０１２３４５６７８９")
+_AMOUNTS = ("SalesTotalAmount", "SalesTax", "TotalAmount")
+_SECTIONS = {
+    "header": ("CompanyName", "InvoiceYear", "InvoiceMonth", "InvoiceDay", "PrefixTwoLetters", "InvoiceNumber",
+               "BuyerName", "BuyerTaxIDNumber"),
+    "body": ("Abstract",),
+}
+
+
+# ---- 語料 ---------------------------------------------------------------------------
+def load_corpus(path: str = CORPUS):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _sectioned(gt: dict) -> dict:
+    """Ollama 路徑的 {doc_class, rationale, header, body, tail} 格式。"""
+    out = {"doc_class": gt.get("Doc_class", gt.get("doc_class")), "rationale": gt.get("Rationale")}
+    rest = {k: v for k, v in gt.items() if k not in ("Doc_class", "doc_class", "Rationale")}
+    for sec, keys in _SECTIONS.items():
+        out[sec] = {k: rest.pop(k) for k in keys if k in rest}
+    out["tail"] = rest
+    return out
+
+
+def _curly(text: str) -> str:
+    out, left = [], True
+    for ch in text:
+        if ch == '"':
+            out.append("“" if left else "”")
+            left = not left
+        else:
+            out.append(ch)
+    return "".join(out)
+
+
+def render_output(gt: dict, rng: random.Random):
+    """gt_parse → (模擬的模型輸出文字, 套用的變形)。"""
+    gt = dict(gt)
+    tags = rng.sample(["fences", "prose", "single_quotes", "trailing_commas", "truncated", "full_width",
+                       "curly_quotes", "newline_in_string", "sectioned"], rng.choice([0, 1, 1, 2, 3]))
+    if "full_width" in tags:
+        for k in _AMOUNTS + ("InvoiceNumber",):
+            if isinstance(gt.get(k), str):
+                gt[k] = gt[k].translate(FULL_WIDTH)
+    if "newline_in_string" in tags and isinstance(gt.get("Abstract"), str):
+        gt["Abstract"] = gt["Abstract"] + "\n運費 1 120 120"
+    obj = _sectioned(gt) if "sectioned" in tags else {"gt_parse": gt}
+    if "single_quotes" in tags:
+        text = repr(obj)                         # 單引號 + None/True 等 Python 常量
+    else:
+        text = json.dumps(obj, ensure_ascii=False, indent=rng.choice([None, 2]))
+        if "newline_in_string" in tags:
+            text = text.replace("\\n", "\n")     # 字串內的裸換行
+        if "curly_quotes" in tags:
+            text = _curly(text)
+    if "trailing_commas" in tags:
+        text = text[:text.rfind("}")].rstrip() + ",\n}" + text[text.rfind("}") + 1:]
+    if "truncated" in tags:
+        text = text[:rng.randrange(len(text) // 2, len(text))]
+    if "fences" in tags:
+        text = f"```json\n{text}\n```"
+    if "prose" in tags:
+        text = f"以下是這張文件的辨識結果：\n{text}\n如需其他欄位請告訴我。"
+    return text, tags
+
+
+def make_outputs(n: int, seed: int = 0):
+    rng = random.Random(seed)
+    gts = [r.get("gt_parse", r) for r in make_records(n, seed) if isinstance(r, dict)]
+    while len(gts) < n:
+        gts += gts[: n - len(gts)]
+    return [render_output(g, rng)[0] for g in gts[:n]]
+
+
+# ---- 待測函式 -----------------------------------------------------------------------
+def _extract_json_safe(text: str):
+    try:
+        return _extract_json(text)
+    except ValueError:
+        return None
+
+
+def _gt_parse_of(text: str) -> dict:
+    return flatten_sections(repair_json(text)[1])
+
+
+def pipeline(text: str):
+    """模型輸出文字 → repair_json → 攤平 → check_compliance（每份文件實際走的路徑）。"""
+    return check_compliance(_gt_parse_of(text))
+
+
+FUNCTIONS = {
+    "repair_json": lambda corpus: [repair_json(t) for t in corpus],
+    "extract_first_json_block": lambda corpus: [extract_first_json_block(t) for t in corpus],
+    "_extract_json": lambda corpus: [_extract_json_safe(t) for t in corpus],
+    # check_compliance 的輸入先算好，只計檢查本身
+    "check_compliance": lambda objs: [check_compliance(o) for o in objs],
+    "pipeline": lambda corpus: [pipeline(t) for t in corpus],
+}
+
+
+# ---- 正確性（精選語料） -------------------------------------------------------------
+def check_expectations(corpus) -> list:
+    failures = []
+    for case in corpus:
+        exp = case.get("expect") or {}
+        _, obj, logs = repair_json(case["text"])
+        parsed = not (isinstance(obj, dict) and set(obj) == {"raw"})
+        if "parsed" in exp and parsed != exp["parsed"]:
+            failures.append((case["id"], "parsed", exp["parsed"], parsed))
+            continue
+        if exp.get("fields"):
+            _, norm = check_compliance(flatten_sections(obj))
+            got = norm["gt_parse"]
+            for k, v in exp["fields"].items():
+                if got.get(k) != v:
+                    failures.append((case["id"], k, v, got.get(k)))
+    return failures
+
+
+# ---- 計時 ---------------------------------------------------------------------------
+def time_per_record(corpus, repeat: int = 50) -> dict:
+    out = {}
+    for case in corpus:
+        text = case["text"]
+        obj = _gt_parse_of(text)
+        row = {}
+        for name, fn in FUNCTIONS.items():
+            arg = [obj] if name == "check_compliance" else [text]
+            ts = []
+            for _ in range(repeat):
+                t0 = time.perf_counter_ns()
+                fn(arg)
+                ts.append(time.perf_counter_ns() - t0)
+            row[name] = round(statistics.median(ts) / 1000, 2)
+        out[case["id"]] = row
+    return out
+
+
+def time_scale(n: int, seed: int = 0, rounds: int = 3) -> dict:
+    corpus = make_outputs(n, seed)
+    objs = [_gt_parse_of(t) for t in corpus]
+    out = {}
+    for name, fn in FUNCTIONS.items():
+        arg = objs if name == "check_compliance" else corpus
+        best = min(_timed(fn, arg) for _ in range(rounds))
+        out[name] = {"seconds": round(best, 4), "us_per_record": round(best / n * 1e6, 2),
+                     "records_per_s": round(n / best, 1)}
+    return out
+
+
+def _timed(fn, arg) -> float:
+    t0 = time.perf_counter()
+    fn(arg)
+    return time.perf_counter() - t0
+
+
+def find_regressions(report: dict, baseline: dict, threshold: float) -> list:
+    """records/s 比 baseline 低超過 threshold 的 (規模, 函式, 舊, 新)。"""
+    out = []
+    for size, funcs in report["scale"].items():
+        for name, cur in funcs.items():
+            old = (baseline.get("scale", {}).get(size) or {}).get(name)
+            if old and cur["records_per_s"] < old["records_per_s"] * (1 - threshold):
+                out.append((size, name, old["records_per_s"], cur["records_per_s"]))
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--corpus", default=CORPUS)
+    ap.add_argument("--sizes", default="10000,100000")
+    ap.add_argument("--repeat", type=int, default=50, help="精選語料逐筆計時的重複次數")
+    ap.add_argument("--rounds", type=int, default=3, help="各規模重跑幾輪取最快")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--baseline", default=None, help="先前的報告；records/s 退步超過 --threshold 時 exit 1")
+    ap.add_argument("--threshold", type=float, default=0.15)
+    ap.add_argument("--save-baseline", default=None, help="把本次報告存成 baseline")
+    ap.add_argument("--out", default="bench_postprocess.json")
+    args = ap.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    failures = check_expectations(corpus)
+    for f in failures:
+        print(f"[MISMATCH] {f[0]} {f[1]}: expected {f[2]!r}, got {f[3]!r}")
+
+    per_record = time_per_record(corpus, args.repeat)
+    names = list(FUNCTIONS)
+    print(f"{'case':<28}" + "".join(f"{n:>26}" for n in names) + "   (us, median)")
+    for cid, row in per_record.items():
+        print(f"{cid:<28}" + "".join(f"{row[n]:>26.2f}" for n in names))
+
+    scale = {}
+    for n in (int(s) for s in args.sizes.split(",")):
+        scale[str(n)] = time_scale(n, args.seed, args.rounds)
+        print(f"\n{n} records")
+        for name, r in scale[str(n)].items():
+            print(f"  {name:<26}{r['seconds']:>9.3f}s {r['us_per_record']:>9.2f}us/record "
+                  f"{r['records_per_s']:>12.0f} records/s")
+
+    report = {"corpus_cases": len(corpus), "mismatches": len(failures), "per_record_us": per_record,
+              "scale": scale, "repair_stats": repair_stats()}
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"baseline → {args.save_baseline}")
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = find_regressions(report, json.load(f), args.threshold)
+        for size, name, old, new in regressions:
+            print(f"[REGRESSION] {name} @ {size}: {old:.0f} → {new:.0f} records/s ({new / old - 1:+.1%})")
+    if failures or regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
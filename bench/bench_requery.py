@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+欄位重問（field_requery.py）vs 整張重跑：在有標註的資料上量測
+
+1) 每張圖先做一次完整推論 → check_compliance
+2) 不合規的文件：只重問出錯欄位（可選 --crop），記錄耗時、修正欄位數、是否轉為合規
+3) --compare-full：同一批不合規文件另外整張重跑一次（不走快取），比較延遲與欄位準確率
+4) 報告：避免的整張重跑次數、每張修正文件的重問延遲（mean/p50/max）、重問前後的欄位準確率
+
+用法：
+   python bench/bench_requery.py --dataset ../AllDataset/VAT-OCR/val_donut_dataset.json \
+       --root ../AllDataset/VAT-OCR/ --backend local --crop --compare-full --limit 100
+   python bench/bench_requery.py ... --backend ollama --model qwen2.5vl:7b
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "docvqa"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sweep_vision_budget import load_labelled_set, score
+from field_requery import RequeryStats, requery_repair
+from VAT_OCR import flatten_sections, repair_json
+
+
+def infer_full(img_path: str, backend: str, model: str, cache=None):
+    """完整推論一次，回傳 ({"gt_parse": ...}, 秒數)。"""
+    t0 = time.perf_counter()
+    if backend == "local":
+        import VAT_OCR
+        out = VAT_OCR.chat_once(img_path, cache=cache)
+        obj = out if isinstance(out, dict) else repair_json(out)[1]
+    else:
+        import docvqa_final2
+        obj = repair_json(docvqa_final2.infer_image_json(img_path, model=model, cache=cache))[1]
+    return flatten_sections(obj), time.perf_counter() - t0
+
+
+def accuracy(matches):
+    hits = [v for m in matches for v in m.values()]
+    return sum(hits) / len(hits) if hits else None
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--dataset", required=True)
+    ap.add_argument("--root", default="")
+    ap.add_argument("--backend", choices=["local", "ollama"], default="local")
+    ap.add_argument("--model", default="qwen2.5vl:7b", help="Ollama 模型名稱")
+    ap.add_argument("--limit", type=int, default=0)
+    ap.add_argument("--crop", action="store_true")
+    ap.add_argument("--max-rounds", type=int, default=1)
+    ap.add_argument("--max-fields", type=int, default=6)
+    ap.add_argument("--compare-full", action="store_true", help="不合規文件另外整張重跑一次作為對照")
+    ap.add_argument("--out", default="bench_requery.json")
+    args = ap.parse_args()
+
+    samples = load_labelled_set(args.dataset, args.root, args.limit)
+    stats = RequeryStats()
+    first_lat, full_lat = [], []
+    before, after, full_after = [], [], []
+    rows = []
+    for img_path, gt in samples:
+        try:
+            first, t_first = infer_full(img_path, args.backend, args.model)
+            first_lat.append(t_first)
+            merged, rep = requery_repair(img_path, first, backend=args.backend, crop=args.crop,
+                                         max_fields=args.max_fields, max_rounds=args.max_rounds,
+                                         stats=stats, ollama_model=args.model)
+        except Exception as e:
+            print(f"[ERROR] {img_path}: {e}")
+            continue
+        if rep.passed_before:
+            continue
+        before.append(score(first, gt)[0])
+        after.append(score(merged, gt)[0])
+        row = {"image": img_path, "requested": rep.requested, "fixed": rep.fixed,
+               "unresolved": rep.unresolved, "full_rerun": rep.full_rerun,
+               "requery_s": round(rep.latency_s, 3)}
+        if args.compare_full:
+            rerun, t_full = infer_full(img_path, args.backend, args.model, cache=False)
+            full_lat.append(t_full)
+            full_after.append(score(rerun, gt)[0])
+            row["full_rerun_s"] = round(t_full, 3)
+        rows.append(row)
+        print(f"{os.path.basename(img_path)}: {row}")
+
+    summary = stats.summary()
+    summary.update({
+        "first_pass_latency_mean_s": round(statistics.mean(first_lat), 3) if first_lat else None,
+        "field_accuracy_before": accuracy(before),
+        "field_accuracy_after_requery": accuracy(after),
+    })
+    if args.compare_full:
+        summary.update({
+            "full_rerun_latency_mean_s": round(statistics.mean(full_lat), 3) if full_lat else None,
+            "field_accuracy_after_full_rerun": accuracy(full_after),
+        })
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump({"args": vars(args), "summary": summary, "docs": rows}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+提早停止條件（stopping.py）省下多少 token / 時間：同一組驗證資料，每張影像各跑
+stopping=False（等 EOS 或 max_new_tokens）與 stopping=True 一次，比較：
+  - 平均新產生 token 數、平均延遲，以及兩者的節省比例
+  - 停止原因分布（eos / json_closed / repetition / max_new_tokens）
+  - 欄位準確率（與標註比對，同 sweep_vision_budget.score），確認提早停止沒有改變結果
+兩次都用相同的亂數種子，取樣路徑一致，差別只在何時停止。
+
+用法：
+   python bench/bench_stopping.py --dataset ../AllDataset/VAT-OCR/val_donut_dataset.json \
+       --root ../AllDataset/VAT-OCR/ --limit 100 --out stopping_report.json
+   python bench/bench_stopping.py --tiny --n 8        # 極小隨機 Qwen2-VL（CPU），只看流程與重複偵測
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import VAT_OCR
+from VAT_OCR import repair_json
+from sweep_vision_budget import load_labelled_set, score
+
+
+def _to_obj(text: str):
+    try:
+        return json.loads(text)
+    except Exception:
+        return repair_json(text)[1]
+
+
+def run(samples, model, tokenizer, stopping: bool, max_new_tokens: int) -> dict:
+    import torch
+    tokens, latency, reasons, acc = [], [], Counter(), []
+    outputs = []
+    for i, (img_path, gt) in enumerate(samples):
+        torch.manual_seed(i)
+        t0 = time.perf_counter()
+        text, n_new, reason = VAT_OCR._generate_text(img_path, model, tokenizer, stopping=stopping,
+                                                     max_new_tokens=max_new_tokens)
+        latency.append(time.perf_counter() - t0)
+        tokens.append(n_new)
+        reasons[reason] += 1
+        obj = _to_obj(text)
+        outputs.append(obj)
+        if gt is not None and isinstance(obj, dict):
+            match, _ = score(obj, gt)
+            acc.append(sum(match.values()) / len(match))
+    return {
+        "stopping": stopping,
+        "n": len(samples),
+        "mean_new_tokens": statistics.mean(tokens),
+        "total_new_tokens": sum(tokens),
+        "mean_latency_s": statistics.mean(latency),
+        "total_latency_s": sum(latency),
+        "stop_reasons": dict(reasons),
+        "field_accuracy": statistics.mean(acc) if acc else None,
+        "_outputs": outputs,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--dataset", default=None, help="Donut 格式驗證集（例：val_donut_dataset.json）")
+    ap.add_argument("--root", default="", help="image_path 的前綴目錄")
+    ap.add_argument("--limit", type=int, default=0)
+    ap.add_argument("--tiny", action="store_true", help="改用極小隨機 Qwen2-VL + 假影像（CPU）")
+    ap.add_argument("--n", type=int, default=8, help="--tiny 時的影像張數")
+    ap.add_argument("--max-new-tokens", type=int, default=None, help="預設：--tiny 128、否則 512")
+    ap.add_argument("--out", default=None, help="結果另存 JSON")
+    args = ap.parse_args()
+    if not args.tiny and not args.dataset:
+        ap.error("需要 --dataset，或改用 --tiny")
+
+    max_new_tokens = args.max_new_tokens or (128 if args.tiny else 512)
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.tiny:
+            from bench_chat_batch import build_tiny_qwen2vl, make_synthetic_images
+            model, tokenizer = build_tiny_qwen2vl()
+            samples = [(p, None) for p in make_synthetic_images(args.n, tmp)]
+        else:
+            model, tokenizer = VAT_OCR._load_model_once()
+            samples = load_labelled_set(args.dataset, args.root, args.limit)
+
+        VAT_OCR._generate_text(samples[0][0], model, tokenizer, max_new_tokens=8)   # 暖機
+        base = run(samples, model, tokenizer, False, max_new_tokens)
+        stop = run(samples, model, tokenizer, True, max_new_tokens)
+
+    same = sum(a == b for a, b in zip(base.pop("_outputs"), stop.pop("_outputs")))
+    report = {
+        "max_new_tokens": max_new_tokens,
+        "baseline": base,
+        "stopping": stop,
+        "tokens_saved": base["total_new_tokens"] - stop["total_new_tokens"],
+        "tokens_saved_ratio": 1 - stop["total_new_tokens"] / max(1, base["total_new_tokens"]),
+        "time_saved_s": base["total_latency_s"] - stop["total_latency_s"],
+        "time_saved_ratio": 1 - stop["total_latency_s"] / base["total_latency_s"],
+        "identical_outputs": same,
+    }
+
+    print(f"images: {base['n']}   max_new_tokens: {max_new_tokens}")
+    print(f"{'mode':<10}{'tokens':>9}{'latency':>10}{'field_acc':>11}  stop reasons")
+    for r in (base, stop):
+        acc = f"{r['field_accuracy']:.3f}" if r["field_accuracy"] is not None else "-"
+        print(f"{'stopping' if r['stopping'] else 'baseline':<10}{r['mean_new_tokens']:>9.1f}"
+              f"{r['mean_latency_s']:>9.2f}s{acc:>11}  {r['stop_reasons']}")
+    print(f"saved: {report['tokens_saved']} tokens ({report['tokens_saved_ratio']:.1%}), "
+          f"{report['time_saved_s']:.2f}s ({report['time_saved_ratio']:.1%}); "
+          f"identical parsed outputs {same}/{base['n']}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+訓練資料集：eager list（notebook 的 convert_to_conversation 全部預先解碼）vs LazyConversationDataset。
+
+各模式在獨立子行程執行，量測：
+  - time_to_first_batch_s：建立資料集 + 取得第一個 batch（打亂順序，同 Trainer 的 RandomSampler）的時間
+  - peak_rss_mb          ：子行程峰值常駐記憶體
+  - epoch_s              ：（--epoch）跑完一整個 epoch 的取樣時間
+--processor 給 Qwen processor 的模型 id 時，batch 會再經過 processor（接近 collator 的實際成本）。
+
+用法：
+   python bench/bench_train_dataset.py --dataset ../AllDataset/VAT-OCR/train2_donut_dataset.json \
+       --root ../AllDataset/VAT-OCR/ --budget high --workers 4 --epoch
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from train_dataset import INSTRUCTION, LazyConversationDataset, build_conversation
+
+
+def peak_rss_mb() -> float:
+    """本行程的峰值常駐記憶體（不是目前的 RSS）。"""
+    if os.name == "nt":
+        import psutil                                   # Windows 只有 psutil 的 peak_wset 是峰值
+        return psutil.Process().memory_info().peak_wset / 2 ** 20
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 1024   # macOS: bytes；Linux: KB
+
+
+def _batches(n: int, batch_size: int, seed: int = 3407):
+    order = list(range(n))
+    random.Random(seed).shuffle(order)
+    return [order[i:i + batch_size] for i in range(0, n, batch_size)]
+
+
+def child(args) -> dict:
+    from PIL import Image
+    with open(args.dataset, "r", encoding="utf-8") as f:
+        records = json.load(f)
+    if args.limit:
+        records = records[:args.limit]
+    processor = None
+    if args.processor:
+        from transformers import AutoProcessor
+        processor = AutoProcessor.from_pretrained(args.processor)
+
+    def process(batch):
+        if processor is None:
+            return batch
+        texts = [processor.apply_chat_template(c["messages"], tokenize=False) for c in batch]
+        images = [[p["image"] for p in c["messages"][0]["content"] if p["type"] == "image"] for c in batch]
+        return processor(text=texts, images=images, return_tensors="pt", padding=True)
+
+    t0 = time.perf_counter()
+    if args.mode == "eager":
+        def convert(sample):
+            image = Image.open(os.path.join(args.root, sample["image_path"])).convert("RGB")
+            return build_conversation(image, sample["ground_truth"], INSTRUCTION)
+        data = [convert(s) for s in records]
+        batches = _batches(len(data), args.batch_size)
+        first = process([data[i] for i in batches[0]])
+    else:
+        data = LazyConversationDataset.from_records(records, args.root, budget=args.budget,
+                                                    cache_size=args.cache_size)
+        batches = _batches(len(data), args.batch_size)
+        if args.workers:
+            it = data.iter_prefetch([i for b in batches for i in b], workers=args.workers)
+            first = process([next(it) for _ in batches[0]])
+        else:
+            first = process([data[i] for i in batches[0]])
+    t_first = time.perf_counter() - t0
+
+    out = {"mode": args.mode, "samples": len(records), "time_to_first_batch_s": round(t_first, 3)}
+    if args.epoch:
+        t1 = time.perf_counter()
+        if args.mode == "lazy" and args.workers:
+            for b in batches[1:]:
+                process([next(it) for _ in b])
+        else:
+            for b in batches[1:]:
+                process([data[i] for i in b])
+        out["epoch_s"] = round(t_first + time.perf_counter() - t1, 3)
+    out["peak_rss_mb"] = round(peak_rss_mb(), 1)
+    if args.mode == "lazy":
+        out["cache"] = data.cache_info()
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--dataset", required=True)
+    ap.add_argument("--root", default="")
+    ap.add_argument("--limit", type=int, default=0)
+    ap.add_argument("--batch-size", type=int, default=2)
+    ap.add_argument("--budget", default=None, help="lazy 模式的 vision 預算（low/medium/high/full）")
+    ap.add_argument("--cache-size", type=int, default=64)
+    ap.add_argument("--workers", type=int, default=4, help="lazy 模式的預取執行緒數（0 = 不預取）")
+    ap.add_argument("--processor", default=None, help="例如 unsloth/Qwen2.5-VL-7B-Instruct-bnb-4bit")
+    ap.add_argument("--epoch", action="store_true", help="另外量測整個 epoch")
+    ap.add_argument("--mode", choices=["eager", "lazy"], default=None, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.mode:
+        print(json.dumps(child(args)))
+        return
+
+    results = []
+    for mode in ("eager", "lazy"):
+        cmd = [sys.executable, os.path.abspath(__file__), "--mode", mode] + sys.argv[1:]
+        out = subprocess.run(cmd, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    for r in results:
+        print(json.dumps(r, ensure_ascii=False))
+    eager, lazy = results
+    print(f"time-to-first-batch: {eager['time_to_first_batch_s']}s -> {lazy['time_to_first_batch_s']}s, "
+          f"peak RSS: {eager['peak_rss_mb']}MB -> {lazy['peak_rss_mb']}MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Self-consistency 投票：VAT_OCR.chat_vote（prompt 只 prefill 一次，N 個樣本共用 KV cache）vs 現行做法（N 次 chat_once 再投票）。
+
+每張圖：
+  - sequential：N 次 chat_once(cache=False)，結果交給 voting.vote
+  - batched   ：chat_vote(n=N)
+比較延遲、欄位準確率（與單次 chat_once 對照）以及各欄平均一致比例。
+--sweep-n 另外對每張圖以不同 n 跑 chat_vote，回報各 n 的平均 prefill / decode 秒數：
+prompt 的 KV cache 共用時 prefill 只跑一次（batch 1），應與 n 無關、大致持平。
+
+用法：
+   python bench/bench_vote.py --dataset ../AllDataset/VAT-OCR/val_donut_dataset.json \
+       --root ../AllDataset/VAT-OCR/ --n 5 --limit 30
+   python bench/bench_vote.py --dataset ../AllDataset/VAT-OCR/val_donut_dataset.json \
+       --root ../AllDataset/VAT-OCR/ --limit 10 --skip-sequential --sweep-n 1,2,4,8,16
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sweep_vision_budget import load_labelled_set, score
+import VAT_OCR
+from voting import vote
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--dataset", required=True)
+    ap.add_argument("--root", default="")
+    ap.add_argument("--limit", type=int, default=0)
+    ap.add_argument("--n", type=int, default=5, help="每張圖的樣本數")
+    ap.add_argument("--temperature", type=float, default=0.7)
+    ap.add_argument("--skip-sequential", action="store_true", help="不跑 N 次 chat_once 的對照組")
+    ap.add_argument("--sweep-n", default="", help="逗號分隔的 n（例 1,2,4,8,16）：各跑一次 chat_vote 比較 prefill/decode 秒數")
+    ap.add_argument("--out", default="bench_vote.json")
+    args = ap.parse_args()
+
+    model, tokenizer = VAT_OCR._load_model_once()
+    samples = load_labelled_set(args.dataset, args.root, args.limit)
+    lat = defaultdict(list)
+    hits = defaultdict(list)
+    agreement = defaultdict(list)
+    sweep = [int(x) for x in args.sweep_n.split(",") if x.strip()]
+    prefill = defaultdict(list)
+    decode = defaultdict(list)
+    for img_path, gt in samples:
+        t0 = time.perf_counter()
+        single = VAT_OCR.chat_once(img_path, model, tokenizer, cache=False)
+        lat["single"].append(time.perf_counter() - t0)
+        hits["single"] += score(single, gt)[0].values()
+
+        if not args.skip_sequential:
+            t0 = time.perf_counter()
+            seq = [single] + [VAT_OCR.chat_once(img_path, model, tokenizer, cache=False) for _ in range(args.n - 1)]
+            seq_vote = vote(seq)
+            lat["sequential"].append(lat["single"][-1] + time.perf_counter() - t0)
+            hits["sequential"] += score(seq_vote.consensus, gt)[0].values()
+
+        t0 = time.perf_counter()
+        res = VAT_OCR.chat_vote(img_path, args.n, model, tokenizer, temperature=args.temperature)
+        lat["batched"].append(time.perf_counter() - t0)
+        hits["batched"] += score(res.consensus, gt)[0].values()
+        for k, a in res.agreement.items():
+            agreement[k].append(a)
+        print(f"{os.path.basename(img_path)}: {json.dumps(res.summary(), ensure_ascii=False)}")
+
+        for n in sweep:
+            r = VAT_OCR.chat_vote(img_path, n, model, tokenizer, temperature=args.temperature)
+            prefill[n].append(r.prefill_s)
+            decode[n].append(r.decode_s)
+
+    report = {
+        "n": args.n,
+        "images": len(lat["single"]),
+        "latency_mean_s": {k: round(statistics.mean(v), 3) for k, v in lat.items() if v},
+        "field_accuracy": {k: round(sum(v) / len(v), 4) for k, v in hits.items() if v},
+        "mean_agreement": {k: round(statistics.mean(v), 3) for k, v in agreement.items()},
+    }
+    if sweep:
+        report["prefill_mean_s_by_n"] = {n: round(statistics.mean(prefill[n]), 3) for n in sweep}
+        report["decode_mean_s_by_n"] = {n: round(statistics.mean(decode[n]), 3) for n in sweep}
+    if lat["sequential"] and lat["batched"]:
+        report["speedup_vs_sequential"] = round(statistics.mean(lat["sequential"]) / statistics.mean(lat["batched"]), 2)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""
+端到端評估：任一後端跑過整個有標註的資料集（例：val_donut_dataset.json），輸出可機器比對的 JSON 報告。
+
+後端（一律不走 extraction_cache，量到的是真實推論）：
+  - local  ：VAT_OCR 的 FastVisionModel（VAT_model LoRA）
+  - ollama ：docvqa_final2.infer_image_json 的 few-shot 提示
+  - session：old/ollama_fewshot_session_reuse.classify_image（暖機 context 重用；暖機時間另計為 setup_s）
+
+報告內容：
+  - 各欄位完全一致率（check_compliance 正規化後比對）與平均
+  - doc_class 準確率與混淆表 confusion[標註][預測]
+  - check_compliance 整筆通過率與各規則通過率（以模型自己預測的 doc_class 選必填欄位）
+  - 延遲 mean/p50/p95/p99/max、images/s（牆鐘時間，含併發）
+  - prompt / output token（local 的 prompt token 在計時外另算）
+  - ollama / session：每張圖附 Ollama 伺服器端統計（records[].server），ollama_usage 依 (model, strategy) 彙總
+  - 每張圖的明細 records（--no-records 省略）
+
+用法：
+   python bench/evaluate.py run --dataset ../AllDataset/VAT-OCR/val_donut_dataset.json \
+       --root ../AllDataset/VAT-OCR/ --backend local --out eval_local.json
+   python bench/evaluate.py run ... --backend ollama --model qwen2.5vl:7b --concurrency 4
+   python bench/evaluate.py run ... --backend session --variant default
+
+   # 兩份報告比較（例如新舊模型版本）；準確率下降超過 --max-drop 或 p95 變慢超過 --max-slowdown 時 exit 1
+   python bench/evaluate.py compare eval_v1.json eval_v2.json --max-drop 0.01
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "docvqa"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "old"))   # 放最後：old/ 另有一份舊版 VAT_OCR.py
+
+from sweep_vision_budget import CORE_FIELDS, load_labelled_set, score
+from VAT_OCR import check_compliance, flatten_sections, repair_json
+
+NO_CLASS = "(none)"
+
+
+@dataclass
+class Backend:
+    name: str
+    model: str
+    run: Callable[[str], Tuple[dict, Optional[int], Optional[int], Optional[dict]]]
+    # 影像 → ({"gt_parse"}, prompt token, output token, Ollama 伺服器端統計)
+    count_prompt: Optional[Callable[[str], int]] = None                # 計時外另算 prompt token
+    setup_s: float = 0.0
+    concurrent: bool = False
+
+
+@dataclass
+class Record:
+    image: str
+    gt_class: str
+    pred_class: str = NO_CLASS
+    fields: Dict[str, bool] = field(default_factory=dict)
+    compliance: Dict[str, bool] = field(default_factory=dict)
+    latency_s: Optional[float] = None
+    prompt_tokens: Optional[int] = None
+    output_tokens: Optional[int] = None
+    server: Optional[dict] = None
+    error: Optional[str] = None
+
+
+def _as_gt_parse(obj: Any) -> dict:
+    if isinstance(obj, str):
+        obj = repair_json(obj)[1]
+    return flatten_sections(obj)
+
+
+def _doc_class(root: dict) -> str:
+    v = root.get("Doc_class") or root.get("doc_class")
+    return str(v).strip() if v else NO_CLASS
+
+
+# ---- 後端 ---------------------------------------------------------------------------
+def local_backend(budget=None, constrained: bool = False) -> Backend:
+    import VAT_OCR
+    t0 = time.perf_counter()
+    model, tokenizer = VAT_OCR._load_model_once()
+    setup = time.perf_counter() - t0
+
+    def run(img_path):
+        text, n_out, _ = VAT_OCR._generate_text(img_path, model, tokenizer, budget, constrained)
+        return _as_gt_parse(text), None, n_out, None
+
+    return Backend("local", str(getattr(model, "name_or_path", "VAT_model")), run,
+                   count_prompt=lambda p: VAT_OCR.count_prompt_tokens(p, tokenizer, budget), setup_s=setup)
+
+
+def ollama_backend(model: str, budget=None) -> Backend:
+    import docvqa_final2
+
+    def run(img_path):
+        resp = docvqa_final2.infer_image_response(img_path, model, budget)
+        m = resp.get("metrics") or {}
+        return _as_gt_parse(resp["message"]["content"] or ""), m.get("prompt_tokens"), m.get("output_tokens"), m
+
+    return Backend("ollama", model, run, concurrent=True)
+
+
+def session_backend(model: Optional[str] = None, variant: Optional[str] = None) -> Backend:
+    import ollama_fewshot_session_reuse as sess
+    if model:
+        sess.MODEL = model
+    t0 = time.perf_counter()
+    ctx = sess.get_context(variant)
+    setup = time.perf_counter() - t0
+
+    def run(img_path):
+        resp = sess.classify_image_response(img_path, ctx)
+        content = (resp.get("message") or {}).get("content", "")
+        m = resp.get("metrics") or {}
+        return _as_gt_parse(content), m.get("prompt_tokens"), m.get("output_tokens"), m
+
+    return Backend("session", sess.MODEL, run, setup_s=setup, concurrent=True)
+
+
+# ---- 執行與彙整 ---------------------------------------------------------------------
+def evaluate_one(backend: Backend, img_path: str, gt: dict) -> Record:
+    rec = Record(image=img_path, gt_class=_doc_class(gt.get("gt_parse", gt)))
+    try:
+        t0 = time.perf_counter()
+        pred, rec.prompt_tokens, rec.output_tokens, rec.server = backend.run(img_path)
+        rec.latency_s = time.perf_counter() - t0
+    except Exception as e:
+        rec.error = f"{type(e).__name__}: {e}"
+        return rec
+    rec.pred_class = _doc_class(pred["gt_parse"])
+    rec.fields, _ = score(pred, gt)
+    comp = check_compliance(pred)[0]
+    rec.compliance = {k: v for k, v in comp.items() if isinstance(v, bool)}
+    return rec
+
+
+def run_eval(backend: Backend, samples, concurrency: int = 1, warmup: int = 1) -> Tuple[List[Record], float]:
+    """回傳 (records, 牆鐘秒數)；前 warmup 張先跑一次不計（載入權重、CUDA kernel 編譯）。"""
+    for img_path, gt in samples[:warmup]:
+        evaluate_one(backend, img_path, gt)
+    t0 = time.perf_counter()
+    if concurrency > 1 and backend.concurrent:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            records = list(pool.map(lambda s: evaluate_one(backend, *s), samples))
+    else:
+        records = []
+        for i, (img_path, gt) in enumerate(samples, 1):
+            records.append(evaluate_one(backend, img_path, gt))
+            if i % 20 == 0 or i == len(samples):
+                print(f"[{i}/{len(samples)}] {time.perf_counter() - t0:.1f}s", file=sys.stderr)
+    wall = time.perf_counter() - t0
+    if backend.count_prompt is not None:
+        for r in records:
+            if r.error is None and r.prompt_tokens is None:
+                r.prompt_tokens = backend.count_prompt(r.image)
+    return records, wall
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """nearest-rank 百分位數。"""
+    if not values:
+        return None
+    xs = sorted(values)
+    return xs[max(0, min(len(xs) - 1, math.ceil(q / 100 * len(xs)) - 1))]
+
+
+def _rate(xs: List[bool]) -> Optional[float]:
+    return round(sum(xs) / len(xs), 4) if xs else None
+
+
+def _token_stats(xs: List[int]) -> Optional[dict]:
+    if not xs:
+        return None
+    return {"mean": round(statistics.mean(xs), 1), "p50": percentile(xs, 50), "max": max(xs), "total": sum(xs)}
+
+
+def summarize(records: List[Record], wall_s: float) -> dict:
+    ok = [r for r in records if r.error is None]
+    field_hits, rule_hits = defaultdict(list), defaultdict(list)
+    confusion: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+    passed = []
+    for r in ok:
+        for k, v in r.fields.items():
+            field_hits[k].append(v)
+        for k, v in r.compliance.items():
+            rule_hits[k].append(v)
+        passed.append(all(r.compliance.values()) if r.compliance else False)
+        confusion[r.gt_class][r.pred_class] += 1
+    per_field = {k: _rate(field_hits[k]) for k in CORE_FIELDS if field_hits[k]}
+    lat = [r.latency_s for r in ok]
+    prompt = [r.prompt_tokens for r in ok if r.prompt_tokens is not None]
+    output = [r.output_tokens for r in ok if r.output_tokens is not None]
+    per_class = {gt: _rate([r.pred_class == gt for r in ok if r.gt_class == gt]) for gt in sorted(confusion)}
+    return {
+        "n": len(records),
+        "errors": len(records) - len(ok),
+        "field_accuracy": round(statistics.mean(per_field.values()), 4) if per_field else None,
+        "per_field_accuracy": per_field,
+        "doc_class_accuracy": _rate([r.pred_class == r.gt_class for r in ok]),
+        "doc_class_recall": per_class,
+        "doc_class_confusion": {gt: dict(row) for gt, row in sorted(confusion.items())},
+        "compliance_pass_rate": _rate(passed),
+        "compliance_rule_pass_rate": {k: _rate(v) for k, v in sorted(rule_hits.items())},
+        "latency_s": {
+            "mean": round(statistics.mean(lat), 3) if lat else None,
+            **{f"p{q}": round(percentile(lat, q), 3) if lat else None for q in (50, 95, 99)},
+            "max": round(max(lat), 3) if lat else None,
+        },
+        "wall_s": round(wall_s, 2),
+        "images_per_s": round(len(ok) / wall_s, 3) if wall_s > 0 else None,
+        "prompt_tokens": _token_stats(prompt),
+        "output_tokens": _token_stats(output),
+        "output_tokens_per_s": round(sum(output) / sum(lat), 1) if output and lat else None,
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def make_backend(args) -> Backend:
+    if args.backend == "local":
+        return local_backend(args.budget, args.constrained)
+    if args.backend == "ollama":
+        return ollama_backend(args.model, args.budget)
+    return session_backend(args.model, args.variant)
+
+
+def _ollama_host(backend: Backend) -> Optional[str]:
+    if backend.name == "session":
+        import ollama_fewshot_session_reuse as sess
+        return sess.OLLAMA_HOST
+    return None
+
+
+def cmd_run(args) -> int:
+    samples = load_labelled_set(args.dataset, args.root, args.limit)
+    backend = make_backend(args)
+    if backend.name != "local" and backend.concurrent:
+        from ollama_client import get_client
+        get_client(_ollama_host(backend), pool_size=args.concurrency)   # 連線池跟著併發數
+    records, wall = run_eval(backend, samples, args.concurrency, args.warmup)
+    report = {
+        "meta": {
+            "backend": backend.name,
+            "model": backend.model,
+            "dataset": os.path.abspath(args.dataset),
+            "budget": args.budget,
+            "constrained": bool(args.constrained),
+            "concurrency": args.concurrency if backend.concurrent else 1,
+            "setup_s": round(backend.setup_s, 2),
+            "git_commit": _git_commit(),
+            "host": platform.node(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "summary": summarize(records, wall),
+    }
+    if backend.name != "local":
+        from ollama_client import get_client
+        report["ollama_usage"] = get_client(_ollama_host(backend)).usage_stats()
+    if not args.no_records:
+        report["records"] = [asdict(r) for r in records]
+    s = report["summary"]
+    print(f"{backend.name} {backend.model}: n={s['n']} errors={s['errors']} field_acc={s['field_accuracy']} "
+          f"doc_class_acc={s['doc_class_accuracy']} comp_pass={s['compliance_pass_rate']} "
+          f"p50={s['latency_s']['p50']}s p95={s['latency_s']['p95']}s images/s={s['images_per_s']}")
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"report → {args.out}")
+    return 0
+
+
+# ---- 報告比較 -----------------------------------------------------------------------
+_HIGHER_BETTER = ("field_accuracy", "doc_class_accuracy", "compliance_pass_rate", "images_per_s")
+
+
+def compare(old: dict, new: dict, max_drop: float = 0.01, max_slowdown: Optional[float] = None) -> List[str]:
+    """印出兩份報告的差異，回傳判定為退步的項目。"""
+    a, b = old["summary"], new["summary"]
+    regressions = []
+
+    def line(name, x, y, bad):
+        delta = "" if x is None or y is None else f"{y - x:+.4f}"
+        print(f"{name:<40}{str(x):>12}{str(y):>12}{delta:>12}{'  <-- regression' if bad else ''}")
+        if bad:
+            regressions.append(name)
+
+    print(f"{'metric':<40}{'old':>12}{'new':>12}{'delta':>12}")
+    for k in _HIGHER_BETTER:
+        x, y = a.get(k), b.get(k)
+        bad = k != "images_per_s" and x is not None and y is not None and x - y > max_drop
+        line(k, x, y, bad)
+    for k in sorted(set(a["per_field_accuracy"]) | set(b["per_field_accuracy"])):
+        x, y = a["per_field_accuracy"].get(k), b["per_field_accuracy"].get(k)
+        line(f"  {k}", x, y, x is not None and y is not None and x - y > max_drop)
+    for q in ("p50", "p95", "p99"):
+        x, y = a["latency_s"].get(q), b["latency_s"].get(q)
+        bad = q == "p95" and max_slowdown is not None and x and y is not None and y / x - 1 > max_slowdown
+        line(f"latency_{q}_s", x, y, bad)
+    for k in ("prompt_tokens", "output_tokens"):
+        x, y = (a.get(k) or {}).get("mean"), (b.get(k) or {}).get("mean")
+        line(f"{k}_mean", x, y, False)
+    return regressions
+
+
+def cmd_compare(args) -> int:
+    with open(args.old, "r", encoding="utf-8") as f:
+        old = json.load(f)
+    with open(args.new, "r", encoding="utf-8") as f:
+        new = json.load(f)
+    print(f"old: {old['meta'].get('backend')} {old['meta'].get('model')} @ {old['meta'].get('git_commit')}")
+    print(f"new: {new['meta'].get('backend')} {new['meta'].get('model')} @ {new['meta'].get('git_commit')}")
+    regressions = compare(old, new, args.max_drop, args.max_slowdown)
+    if regressions:
+        print(f"退步：{', '.join(r.strip() for r in regressions)}")
+        return 1
+    return 0
+
+
+def main():
+    ap = argparse.ArgumentParser(description="端到端準確率 / 吞吐量評估")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    r = sub.add_parser("run", help="跑一個後端並寫出報告")
+    r.add_argument("--dataset", required=True, help="Donut 格式 JSON（例：val_donut_dataset.json）")
+    r.add_argument("--root", default="", help="image_path 的前綴目錄")
+    r.add_argument("--backend", choices=["local", "ollama", "session"], default="local")
+    r.add_argument("--model", default=None, help="Ollama 模型名稱（ollama 預設 qwen2.5vl:7b；session 預設模組的 MODEL）")
+    r.add_argument("--budget", default=None, help="vision 預算（low/medium/high/full）；session 後端不適用")
+    r.add_argument("--constrained", action="store_true", help="local：約束解碼")
+    r.add_argument("--variant", default=None, help="session：few-shot 範例 variant")
+    r.add_argument("--concurrency", type=int, default=1, help="ollama / session 的同時請求數")
+    r.add_argument("--warmup", type=int, default=1, help="先跑幾張不計入")
+    r.add_argument("--limit", type=int, default=0)
+    r.add_argument("--no-records", action="store_true", help="報告不含每張圖明細")
+    r.add_argument("--out", default="eval_report.json")
+    c = sub.add_parser("compare", help="比較兩份報告")
+    c.add_argument("old")
+    c.add_argument("new")
+    c.add_argument("--max-drop", type=float, default=0.01, help="準確率 / 通過率容許下降幅度")
+    c.add_argument("--max-slowdown", type=float, default=None, help="p95 延遲容許增加比例，例如 0.2")
+    args = ap.parse_args()
+
+    if args.cmd == "run":
+        if args.backend == "ollama" and not args.model:
+            args.model = "qwen2.5vl:7b"
+        sys.exit(cmd_run(args))
+    sys.exit(cmd_compare(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+本機假 Ollama HTTP 伺服器（只用標準函式庫），用來測試併發/重試/串流等 client 行為，不需要 GPU 或模型。
+
+支援：
+  POST /api/chat   回傳固定的發票 JSON；stream=true 時以 NDJSON 逐段回傳
+  GET  /api/tags   回傳單一模型與假 digest
+  POST /api/show   回傳假 modelfile 與 digest
+
+行為參數：
+  --delay 1.0        每個請求的模擬推論時間（秒）
+  --parallel 4       同時處理的請求上限（模擬 OLLAMA_NUM_PARALLEL）
+  --fail-rate 0.0    以此機率回 503（測試重試）
+
+用法：
+   python bench/fake_ollama_server.py --port 11435 --delay 0.5 --parallel 8
+   OLLAMA_HOST=http://127.0.0.1:11435 python old/ollama_fewshot_session_reuse.py --dir ./few_shot_sample/image --concurrency 8
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAKE_DIGEST = "sha256:0000000000000000000000000000000000000000000000000000000000fake01"
+
+FAKE_ANSWER = {
+    "doc_class": "triple_invoice",
+    "header": {"PrefixTwoLetters": "KY", "InvoiceNumber": "54957806", "BuyerTaxIDNumber": "12361788",
+               "InvoiceYear": "112", "InvoiceMonth": "3", "InvoiceDay": "6"},
+    "body": {"Abstract": "零件2批 25780"},
+    "tail": {"SalesTotalAmount": "25780", "SalesTax": "1289", "TotalAmount": "27069",
+             "CompanyTaxIDNumber": "12868673"},
+}
+
+
+class FakeOllama(BaseHTTPRequestHandler):
+    delay = 0.5
+    fail_rate = 0.0
+    slots = threading.Semaphore(4)
+    model = "qwen2.5vl:7b"
+
+    def log_message(self, fmt, *args):  # 安靜模式
+        pass
+
+    def _send_json(self, obj, status=200):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(n) or b"{}")
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            return self._send_json({"models": [{"name": self.model, "model": self.model, "digest": FAKE_DIGEST}]})
+        self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        req = self._read_json()
+        if self.path == "/api/show":
+            return self._send_json({"modelfile": f"FROM {self.model}", "digest": FAKE_DIGEST,
+                                    "details": {"family": "qwen25vl"}})
+        if self.path != "/api/chat":
+            return self._send_json({"error": "not found"}, 404)
+        if random.random() < self.fail_rate:
+            return self._send_json({"error": "server busy"}, 503)
+
+        with self.slots:
+            t0 = time.perf_counter()
+            time.sleep(self.delay)
+            n_images = sum(len(m.get("images") or []) for m in req.get("messages", []))
+            content = json.dumps(FAKE_ANSWER, ensure_ascii=False)
+            prompt_eval_count = 20 + 1000 * n_images + len(req.get("context") or [])
+            ns = int((time.perf_counter() - t0) * 1e9)
+            stats = {
+                "done": True,
+                "done_reason": "stop",
+                "total_duration": ns,
+                "load_duration": 0,
+                "prompt_eval_count": prompt_eval_count,
+                "prompt_eval_duration": ns // 2,
+                "eval_count": len(content) // 3,
+                "eval_duration": ns // 2,
+                "context": list(range(prompt_eval_count % 64)),
+            }
+
+            if not req.get("stream"):
+                return self._send_json({"model": req.get("model"), "message": {"role": "assistant", "content": content},
+                                        **stats})
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            for i in range(0, len(content), 8):
+                chunk = {"model": req.get("model"), "message": {"role": "assistant", "content": content[i:i + 8]},
+                         "done": False}
+                self.wfile.write((json.dumps(chunk, ensure_ascii=False) + "\n").encode("utf-8"))
+                self.wfile.flush()
+            final = {"model": req.get("model"), "message": {"role": "assistant", "content": ""}, **stats}
+            self.wfile.write((json.dumps(final) + "\n").encode("utf-8"))
+
+
+def serve(port: int = 11435, delay: float = 0.5, parallel: int = 4, fail_rate: float = 0.0):
+    FakeOllama.delay = delay
+    FakeOllama.fail_rate = fail_rate
+    FakeOllama.slots = threading.Semaphore(parallel)
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeOllama)
+    return server
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=11435)
+    ap.add_argument("--delay", type=float, default=0.5)
+    ap.add_argument("--parallel", type=int, default=4)
+    ap.add_argument("--fail-rate", type=float, default=0.0)
+    args = ap.parse_args()
+    srv = serve(args.port, args.delay, args.parallel, args.fail_rate)
+    print(f"fake ollama on http://127.0.0.1:{args.port} (delay={args.delay}s, parallel={args.parallel})")
+    srv.serve_forever()
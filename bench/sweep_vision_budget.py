@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Vision token 預算掃描：同一組有標註的資料，在多個解析度預算下跑一次，
+比較欄位準確率（check_compliance 正規化後比對）、合規通過率、prompt token 與延遲，
+用來挑「準確率不掉、成本最低」的預算。
+
+用法（資料集為 data_json.ipynb 產生的 Donut 格式：[{"image_path", "ground_truth"}, ...]）：
+   python bench/sweep_vision_budget.py --dataset ../AllDataset/VAT-OCR/val_donut_dataset.json \
+       --root ../AllDataset/VAT-OCR/ --backend local --budgets low,medium,high,full --limit 50
+   python bench/sweep_vision_budget.py ... --backend ollama --model qwen2.5vl:7b
+
+結果印成表格並寫入 --out（JSON）。
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "docvqa"))
+
+from vision_budget import PRESETS, VisionBudget
+from VAT_OCR import check_compliance, flatten_sections, repair_json
+
+CORE_FIELDS = (
+    "PrefixTwoLetters", "InvoiceNumber", "InvoiceYear", "InvoiceMonth", "InvoiceDay",
+    "BuyerTaxIDNumber", "CompanyTaxIDNumber", "Abstract",
+    "SalesTotalAmount", "SalesTax", "TotalAmount",
+)
+
+
+def parse_budget(spec: str) -> VisionBudget:
+    """'low' 等預設名稱，或 'max_pixels=401408,max_long_edge=1024' 形式的自訂預算。"""
+    if spec in PRESETS:
+        return PRESETS[spec]
+    kw = {}
+    for part in spec.split(","):
+        k, v = part.split("=")
+        kw[k.strip()] = int(v)
+    return VisionBudget(name=spec, **kw)
+
+
+def load_labelled_set(dataset: str, root: str, limit: int):
+    with open(dataset, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    samples = []
+    for d in data[:limit] if limit else data:
+        gt = d["ground_truth"]
+        gt = json.loads(gt) if isinstance(gt, str) else gt
+        samples.append((os.path.join(root, d["image_path"]), gt))
+    return samples
+
+
+def run_local(img_path: str, budget: VisionBudget):
+    import VAT_OCR
+    model, tokenizer = VAT_OCR._load_model_once()
+    prompt_tokens = VAT_OCR.count_prompt_tokens(img_path, tokenizer, budget)
+    t0 = time.perf_counter()
+    # cache=False：量的是推論延遲，不能是上次跑留下的 SQLite 命中
+    out = VAT_OCR.chat_once(img_path, model, tokenizer, budget=budget, cache=False)
+    latency = time.perf_counter() - t0
+    obj = out if isinstance(out, dict) else repair_json(out)[1]
+    return obj, prompt_tokens, latency
+
+
+def run_ollama(img_path: str, budget: VisionBudget, model: str):
+    import docvqa_final2
+    messages = docvqa_final2.build_messages_for_image(docvqa_final2.img_to_b64(img_path, budget))
+    t0 = time.perf_counter()
+    resp = docvqa_final2.chat_once(model, messages, fmt="json")
+    latency = time.perf_counter() - t0
+    _, obj, _ = repair_json(resp["message"]["content"] or "")
+    return flatten_sections(obj), resp.get("prompt_eval_count"), latency
+
+
+def score(pred_obj, gt_obj):
+    """回傳 ({field: 是否與標註一致}, {field: 是否通過合規})；兩邊都先經 check_compliance 正規化。"""
+    gt_root = gt_obj.get("gt_parse", gt_obj)
+    doc_class = gt_root.get("Doc_class") or gt_root.get("doc_class")
+    pred = pred_obj if "gt_parse" in pred_obj else {"gt_parse": pred_obj}
+    pred = {"gt_parse": dict(pred["gt_parse"])}
+    if doc_class:
+        # 以標註類別選擇必填欄位，避免分類錯誤連帶影響欄位評分
+        pred["gt_parse"]["doc_class"] = doc_class
+    comp, pred_norm = check_compliance(pred)
+    _, gt_norm = check_compliance({"gt_parse": dict(gt_root)})
+    p, g = pred_norm["gt_parse"], gt_norm["gt_parse"]
+    match = {k: (str(p.get(k) or "").strip() == str(g.get(k) or "").strip()) for k in CORE_FIELDS}
+    return match, {k: v for k, v in comp.items() if isinstance(v, bool)}
+
+
+def sweep(samples, budgets, backend: str, model: str):
+    report = []
+    for budget in budgets:
+        field_hits = defaultdict(list)
+        comp_hits = defaultdict(list)
+        prompt_tokens, latencies, errors = [], [], 0
+        for img_path, gt in samples:
+            try:
+                if backend == "local":
+                    obj, n_tok, lat = run_local(img_path, budget)
+                else:
+                    obj, n_tok, lat = run_ollama(img_path, budget, model)
+            except Exception as e:
+                errors += 1
+                print(f"[ERROR] {budget.name} {img_path}: {e}")
+                continue
+            match, comp = score(obj, gt)
+            for k, v in match.items():
+                field_hits[k].append(v)
+            for k, v in comp.items():
+                comp_hits[k].append(v)
+            if n_tok is not None:
+                prompt_tokens.append(n_tok)
+            latencies.append(lat)
+
+        per_field = {k: sum(v) / len(v) for k, v in field_hits.items() if v}
+        all_comp = [x for v in comp_hits.values() for x in v]
+        report.append({
+            "budget": budget.name,
+            "max_pixels": budget.max_pixels,
+            "max_long_edge": budget.max_long_edge,
+            "n": len(latencies),
+            "errors": errors,
+            "field_accuracy": sum(per_field.values()) / len(per_field) if per_field else 0.0,
+            "per_field_accuracy": per_field,
+            "compliance_pass_rate": sum(all_comp) / len(all_comp) if all_comp else 0.0,
+            "prompt_tokens_mean": statistics.mean(prompt_tokens) if prompt_tokens else None,
+            "latency_mean_s": statistics.mean(latencies) if latencies else None,
+            "latency_p50_s": statistics.median(latencies) if latencies else None,
+        })
+    return report
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--dataset", required=True, help="Donut 格式 JSON（例：val_donut_dataset.json）")
+    ap.add_argument("--root", default="", help="image_path 的前綴目錄")
+    ap.add_argument("--backend", choices=["local", "ollama"], default="local")
+    ap.add_argument("--model", default="qwen2.5vl:7b", help="--backend ollama 時的模型名稱")
+    ap.add_argument("--budgets", default="low,medium,high,full",
+                    help="預設名稱以逗號分隔；含自訂預算時改用分號，例如 'low;max_pixels=401408,max_long_edge=1024'")
+    ap.add_argument("--limit", type=int, default=0)
+    ap.add_argument("--out", default="vision_budget_sweep.json")
+    args = ap.parse_args()
+
+    samples = load_labelled_set(args.dataset, args.root, args.limit)
+    budgets = [parse_budget(b) for b in args.budgets.split(";" if "=" in args.budgets else ",")]
+    report = sweep(samples, budgets, args.backend, args.model)
+
+    print(f"{'budget':<10}{'n':>5}{'field_acc':>11}{'comp_pass':>11}{'prompt_tok':>12}{'p50_s':>9}")
+    for r in report:
+        tok = f"{r['prompt_tokens_mean']:.0f}" if r["prompt_tokens_mean"] is not None else "-"
+        p50 = f"{r['latency_p50_s']:.2f}" if r["latency_p50_s"] is not None else "-"
+        print(f"{r['budget']:<10}{r['n']:>5}{r['field_accuracy']:>11.3f}{r['compliance_pass_rate']:>11.3f}{tok:>12}{p50:>9}")
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"report → {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+精簡的「欄位代碼」輸出格式：取代 Donut 風格 ground_truth 的 JSON，減少模型輸出 token。
+
+JSON（每個欄位都要重複長 key 名稱、引號、逗號）：
+    {"gt_parse": {"Doc_class": "triple_receipt", "InvoiceNumber": "54957806", "SalesTax": "1289", ...}}
+精簡格式（一行一個欄位，代碼=值）：
+    dc=triple_receipt
+    in=54957806
+    tx=1289
+
+規則（encode/decode 互為反函數，gt_parse 可無損還原，欄位順序也保留）：
+  - `代碼=值`         字串值；值內的 \\ 與換行分別寫成 \\\\ 與 \\n（\\r 寫成 \\r）
+  - `代碼`            值為 null（沒有 '='）
+  - `代碼:JSON`       非字串值（數字、list、dict…），以 JSON 表示
+  - `@原始key=值`     代碼表沒有的 key 原樣保留
+  - 沒出現的欄位 = gt_parse 裡沒有這個 key
+
+用法：
+    from compact_format import encode, decode
+    text = encode({"gt_parse": {...}})
+    obj = decode(text)            # → {"gt_parse": {...}}，可直接給 check_compliance
+    python compact_format.py convert train2_donut_dataset.json train2_compact_dataset.json
+"""
+
+from __future__ import annotations
+import sys
+import json
+import argparse
+from typing import Any, Dict, List, Tuple
+
+# 代碼表：固定兩個小寫字母（Qwen tokenizer 下多為單一 token）；新增欄位只能往後加，不可改既有代碼
+FIELD_CODES: Dict[str, str] = {
+    "Doc_class": "dc",
+    "Rationale": "rn",
+    "PrefixTwoLetters": "p2",
+    "PrefixThreeLetters": "p3",
+    "PrefixFourLetters": "p4",
+    "InvoiceNumber": "in",
+    "InvoiceYear": "iy",
+    "InvoiceMonth": "im",
+    "InvoiceDay": "id",
+    "BuyerName": "bn",
+    "BuyerTaxIDNumber": "bt",
+    "BuyerAddress": "ba",
+    "CompanyName": "cn",
+    "CompanyAddress": "ca",
+    "CompanyTaxIDNumber": "ct",
+    "PhoneNumber": "ph",
+    "Abstract": "ab",
+    "SalesTotalAmount": "st",
+    "SalesTax": "tx",
+    "TotalAmount": "ta",
+    "TaxBillNumber": "tb",
+    "SerialNumber": "sn",
+    "GeneralTaxRate": "gt",
+    "ZeroTax": "zt",
+    "DutyFree": "df",
+    "OtherFee": "of",
+}
+CODE_FIELDS: Dict[str, str] = {v: k for k, v in FIELD_CODES.items()}
+assert len(CODE_FIELDS) == len(FIELD_CODES), "代碼重複"
+
+# 給 prompt / 微調指令用的說明
+INSTRUCTION_COMPACT = "你是發票/單據分類器與結構化抽取器，請辨識這張文件，以精簡欄位代碼格式輸出"
+
+
+def legend() -> str:
+    """代碼對照說明（few-shot / system prompt 用）。"""
+    return "；".join(f"{c}={k}" for k, c in FIELD_CODES.items())
+
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def _unescape(v: str) -> str:
+    out: List[str] = []
+    i = 0
+    while i < len(v):
+        ch = v[i]
+        if ch == "\\" and i + 1 < len(v):
+            nxt = v[i + 1]
+            out.append({"n": "\n", "r": "\r", "\\": "\\"}.get(nxt, "\\" + nxt))
+            i += 2
+            continue
+        out.append(ch)
+        i += 1
+    return "".join(out)
+
+
+def encode(obj: Dict[str, Any]) -> str:
+    """{"gt_parse": {...}}（或已扁平的 dict）→ 精簡格式字串。"""
+    root = obj.get("gt_parse", obj) if isinstance(obj, dict) else obj
+    if not isinstance(root, dict):
+        raise TypeError("gt_parse 必須是 dict")
+    lines = []
+    for k, v in root.items():
+        code = FIELD_CODES.get(k, "@" + k)
+        if "=" in code or ":" in code or "\n" in code:
+            raise ValueError(f"key 不可含 '='、':' 或換行：{k!r}")
+        if v is None:
+            lines.append(code)
+        elif isinstance(v, str):
+            lines.append(f"{code}={_escape(v)}")
+        else:
+            lines.append(f"{code}:{json.dumps(v, ensure_ascii=False)}")
+    return "\n".join(lines)
+
+
+def decode_with_logs(text: str) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    精簡格式 → ({"gt_parse": {...}}, logs)。模型輸出容錯：空白行、```區塊外殼、
+    無法辨識的行都略過並記在 logs（與 repair_json 的 logs 同樣用途）。
+    """
+    logs: List[str] = []
+    gt: Dict[str, Any] = {}
+    for n, raw in enumerate(text.split("\n"), 1):
+        line = raw.rstrip("\r")
+        if not line.strip() or line.strip().startswith("```"):
+            continue
+        eq, colon = line.find("="), line.find(":")
+        if eq != -1 and (colon == -1 or eq < colon):
+            code, value = line[:eq].strip(), _unescape(line[eq + 1:])
+        elif colon != -1:
+            code, payload = line[:colon].strip(), line[colon + 1:]
+            try:
+                value = json.loads(payload)
+            except ValueError:
+                logs.append(f"line {n}: bad JSON value for {code!r}, kept as string")
+                value = payload
+        else:
+            code, value = line.strip(), None
+        if code.startswith("@"):
+            key = code[1:]
+        elif code in CODE_FIELDS:
+            key = CODE_FIELDS[code]
+        else:
+            logs.append(f"line {n}: unknown code {code!r}, skipped")
+            continue
+        if key in gt:
+            logs.append(f"line {n}: duplicate {key}, last value wins")
+        gt[key] = value
+    return {"gt_parse": gt}, logs
+
+
+def decode(text: str) -> Dict[str, Any]:
+    return decode_with_logs(text)[0]
+
+
+# ---- 訓練資料轉換 -----------------------------------------------------------
+def load_donut_samples(path: str) -> Tuple[List[dict], bool]:
+    """Donut 資料集：JSON 陣列或 JSONL；回傳 (samples, 是否為 JSONL)。"""
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    try:
+        data = json.loads(text)
+        return (data if isinstance(data, list) else [data]), False
+    except ValueError:
+        return [json.loads(l) for l in text.splitlines() if l.strip()], True
+
+
+def convert_dataset(src: str, dst: str, verify: bool = True) -> dict:
+    """把每筆 ground_truth（JSON 字串）改寫成精簡格式；verify=True 時逐筆檢查可無損還原。"""
+    samples, is_jsonl = load_donut_samples(src)
+    stats = {"samples": len(samples), "converted": 0, "skipped": 0, "json_chars": 0, "compact_chars": 0}
+    out = []
+    for s in samples:
+        gt_text = s.get("ground_truth")
+        try:
+            gt = json.loads(gt_text) if isinstance(gt_text, str) else gt_text
+            compact = encode(gt)
+        except Exception as e:
+            print(f"[略過] {s.get('image_path')}: {e}", file=sys.stderr)
+            stats["skipped"] += 1
+            out.append(s)
+            continue
+        if verify and decode(compact)["gt_parse"] != gt.get("gt_parse", gt):
+            raise AssertionError(f"無法無損還原：{s.get('image_path')}")
+        stats["converted"] += 1
+        stats["json_chars"] += len(gt_text if isinstance(gt_text, str) else json.dumps(gt, ensure_ascii=False))
+        stats["compact_chars"] += len(compact)
+        out.append({**s, "ground_truth": compact})
+    with open(dst, "w", encoding="utf-8") as f:
+        if is_jsonl:
+            for s in out:
+                f.write(json.dumps(s, ensure_ascii=False) + "\n")
+        else:
+            json.dump(out, f, ensure_ascii=False, indent=2)
+    return stats
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    c = sub.add_parser("convert", help="Donut 資料集 ground_truth → 精簡格式")
+    c.add_argument("src")
+    c.add_argument("dst")
+    c.add_argument("--no-verify", action="store_true")
+    d = sub.add_parser("decode", help="精簡格式（stdin）→ gt_parse JSON")
+    args = ap.parse_args()
+
+    if args.cmd == "convert":
+        st = convert_dataset(args.src, args.dst, verify=not args.no_verify)
+        ratio = st["compact_chars"] / st["json_chars"] if st["json_chars"] else 0
+        print(f"[完成] {st}  字元數比例 {ratio:.2f}")
+    else:
+        obj, logs = decode_with_logs(sys.stdin.read())
+        print(json.dumps(obj, ensure_ascii=False, indent=2))
+        for l in logs:
+            print("[log]", l, file=sys.stderr)
@@ -0,0 +1,486 @@
+# -*- coding: utf-8 -*-
+"""
+編譯式合規檢查引擎：VAT_OCR.check_compliance 的實作，另提供批次（欄式）API 與標註資料夾的多行程稽核。
+
+與舊版逐筆實作（bench/compliance_reference.py）輸出完全相同，差別在於：
+  - 欄位規則、必填表、正規化輸出順序在建立引擎時編譯一次（regex 先 compile，必填改用 frozenset）
+  - 不分大小寫取值不再每個欄位線性掃描：每筆只掃一次 key，且只有 exact key 不存在時才用到
+  - 同一組參數（required_fields / required_fields_by_doc_class / 輸出選項）共用同一個引擎
+
+用法：
+    from compliance import get_engine
+    eng = get_engine()
+    result, normalized = eng.check({"gt_parse": {...}})            # 同 check_compliance
+    batch = eng.check_batch(records)                               # list，或 {"InvoiceNumber": [...], ...} 欄式表
+    batch.columns["InvoiceNumber"]   # [True, False, None(該筆不輸出此欄), ...]
+    batch.passed                     # 每筆是否全部通過
+    batch.normalized                 # 每筆的正規化物件
+    batch.row(i)                     # 還原成第 i 筆的 check_compliance 結果 dict
+
+    python compliance.py audit ../AllDataset/VAT-OCR --workers 8 --out audit.json
+"""
+
+from __future__ import annotations
+import os
+import re
+import sys
+import json
+import argparse
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Mapping, Optional, Sequence, Tuple
+
+FIELDS = (
+    "PrefixTwoLetters", "InvoiceNumber", "InvoiceYear", "InvoiceMonth", "InvoiceDay",
+    "BuyerName", "BuyerTaxIDNumber", "CompanyName", "CompanyAddress", "CompanyTaxIDNumber",
+    "PhoneNumber", "Abstract", "SalesTotalAmount", "SalesTax", "TotalAmount",
+)
+
+DEFAULT_REQUIRED = ("PrefixTwoLetters", "InvoiceNumber", "SalesTotalAmount", "SalesTax", "TotalAmount")
+REQUIRED_BY_DOC_CLASS: Dict[str, Tuple[str, ...]] = {
+    "triple_invoice": (
+        "PrefixTwoLetters", "InvoiceNumber", "BuyerTaxIDNumber",
+        "InvoiceYear", "InvoiceMonth", "InvoiceDay", "Abstract",
+        "SalesTotalAmount", "SalesTax", "TotalAmount", "CompanyTaxIDNumber",
+    ),
+    "triple_receipt": (
+        "PrefixTwoLetters", "InvoiceNumber", "CompanyTaxIDNumber",
+        "InvoiceYear", "InvoiceMonth", "InvoiceDay", "BuyerTaxIDNumber",
+        "Abstract",
+        "SalesTotalAmount", "SalesTax", "TotalAmount",
+    ),
+}
+
+SUM_RULE = "@rule:TotalAmount_equals_SalesTotal_plus_SalesTax"
+_AMOUNTS = ("SalesTotalAmount", "SalesTax", "TotalAmount")
+
+# ---- 編譯後的欄位規則 -------------------------------------------------------
+_AMOUNT_COMMA = re.compile(r"\d{1,3}(,\d{3})*(?:\.00)?")
+_AMOUNT_PLAIN = re.compile(r"\d+(?:\.00)?")
+_DIGITS = re.compile(r"\d+")
+
+
+def normalize_amount(x: Any) -> Optional[str]:
+    """允許千分位與 .00；回傳正規化整數字串，否則 None。"""
+    if not isinstance(x, str):
+        return None
+    s = x.strip()
+    if not s:
+        return None
+    if _AMOUNT_COMMA.fullmatch(s):
+        s = s.replace(",", "")
+    elif not _AMOUNT_PLAIN.fullmatch(s):
+        return None
+    if s.endswith(".00"):
+        s = s[:-3]
+    try:
+        return str(int(s))
+    except ValueError:
+        return None
+
+
+def normalize_year(y: Any) -> Optional[str]:
+    """2~3 碼視為民國年 +1911；4 碼視為西元年；其餘回 None。"""
+    if not isinstance(y, str):
+        return None
+    s = y.strip()
+    if not s or not s.isdigit():
+        return None
+    if len(s) in (2, 3):
+        return str(int(s) + 1911)
+    if len(s) == 4:
+        return s
+    return None
+
+
+def strip_leading_zero(x: Any) -> Optional[str]:
+    """將 '09' -> '9'；若非數字字串則回 None。"""
+    if not isinstance(x, str):
+        return None
+    s = x.strip()
+    if not s or not _DIGITS.fullmatch(s):
+        return None
+    try:
+        return str(int(s))
+    except ValueError:
+        return None
+
+
+def _pattern_rule(pattern: str) -> Callable[[Any], bool]:
+    rx = re.compile(pattern)
+
+    def rule(v: Any) -> bool:
+        if v is None:                  # 非必填且 None 視為 OK；是否必填由 required 控制
+            return True
+        return isinstance(v, str) and rx.fullmatch(v.strip()) is not None
+    return rule
+
+
+def _nonempty_or_none(v: Any) -> bool:
+    return v is None or (isinstance(v, str) and len(v.strip()) > 0)
+
+
+def _amount_rule(v: Any) -> bool:
+    return normalize_amount(v) is not None
+
+
+# 欄位格式規則（扁平版）；check_compliance 與串流逐欄檢查（check_field）共用
+FIELD_RULES: Dict[str, Callable[[Any], bool]] = {
+    "PrefixTwoLetters":    _pattern_rule(r"[A-Z]{2}"),
+    "InvoiceNumber":       _pattern_rule(r"\d{8}"),
+    "InvoiceYear":         _pattern_rule(r"(\d{2,3}|\d{4})"),
+    "InvoiceMonth":        _pattern_rule(r"(0?[1-9]|1[0-2])"),
+    "InvoiceDay":          _pattern_rule(r"(0?[1-9]|[12]\d|3[01])"),
+    "BuyerName":           _nonempty_or_none,
+    "BuyerTaxIDNumber":    _pattern_rule(r"\d{8}"),
+    "CompanyName":         _nonempty_or_none,
+    "CompanyAddress":      _nonempty_or_none,
+    "CompanyTaxIDNumber":  _pattern_rule(r"\d{8}"),
+    "PhoneNumber":         _pattern_rule(r"[0-9()+\- ]{7,}"),
+    "Abstract":            _nonempty_or_none,
+    "SalesTotalAmount":    _amount_rule,
+    "SalesTax":            _amount_rule,
+    "TotalAmount":         _amount_rule,
+    # meta
+    "Doc_class":           _nonempty_or_none,
+    "Rationale":           _nonempty_or_none,
+}
+_FIELD_RULES_CI = {k.lower(): k for k in FIELD_RULES}
+
+
+def check_field(key: str, value: Any) -> Optional[str]:
+    """
+    單一欄位的格式檢查（規則同 check_compliance，不含必填與合計規則）。
+    通過或不在規則內 → None；不通過 → 錯誤訊息。鍵名不分大小寫（doc_class / Doc_class 皆可）。
+    """
+    name = _FIELD_RULES_CI.get(str(key).lower())
+    if name is None or value is None:
+        return None
+    # 串流解析出的數字（Ollama 路徑金額常為 number）比照字串檢查
+    v = str(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else value
+    return None if FIELD_RULES[name](v) else f"{name} 格式不符：{value!r}"
+
+
+# 正規化輸出的欄位順序（Doc_class 之後）；月/日/金額用正規化值，其餘不分大小寫取原值
+_NORMALIZED_LAYOUT = {
+    "triple_receipt": (
+        "Rationale", "PrefixTwoLetters", "InvoiceNumber", "CompanyName", "PhoneNumber",
+        "CompanyTaxIDNumber", "CompanyAddress", "InvoiceYear", "InvoiceMonth", "InvoiceDay",
+        "BuyerTaxIDNumber", "BuyerName", "Abstract", "SalesTotalAmount", "SalesTax", "TotalAmount",
+    ),
+    "triple_invoice": (   # 預設：其他類型也用這個順序
+        "Rationale", "PrefixTwoLetters", "InvoiceNumber", "BuyerName", "BuyerTaxIDNumber",
+        "InvoiceYear", "InvoiceMonth", "InvoiceDay", "Abstract", "SalesTotalAmount", "SalesTax",
+        "TotalAmount", "CompanyName", "CompanyTaxIDNumber", "PhoneNumber", "CompanyAddress",
+    ),
+}
+
+
+def _extract_json(s: str) -> Dict[str, Any]:
+    start = s.find("{"); end = s.rfind("}")
+    if start == -1 or end == -1 or end < start:
+        raise ValueError("找不到可解析的 JSON 內容")
+    return json.loads(s[start:end+1])
+
+
+@dataclass
+class BatchResult:
+    """check_batch 的欄式結果：columns[key][i] 為第 i 筆該欄結果（該筆不輸出此欄時為 None）。"""
+    n: int
+    columns: Dict[str, List[Any]] = field(default_factory=dict)
+    passed: List[bool] = field(default_factory=list)
+    normalized: List[Optional[dict]] = field(default_factory=list)
+    errors: Dict[int, str] = field(default_factory=dict)   # 解析失敗的列 → 錯誤訊息
+
+    def row(self, i: int) -> Dict[str, Any]:
+        return {k: col[i] for k, col in self.columns.items() if col[i] is not None}
+
+    def pass_rate(self) -> Dict[str, float]:
+        out = {}
+        for k, col in self.columns.items():
+            vals = [v for v in col if isinstance(v, bool)]
+            if vals:
+                out[k] = sum(vals) / len(vals)
+        return out
+
+
+class ComplianceEngine:
+    """一組 check_compliance 參數編譯成一個引擎；check() 與 check_compliance 同輸出。"""
+
+    def __init__(self, required_fields: Optional[Sequence[str]] = None,
+                 required_fields_by_doc_class: Optional[Mapping[str, Sequence[str]]] = None,
+                 only_required_and_rules: bool = True, emit_info: bool = True,
+                 emit_normalized: bool = False):
+        self.default_required = frozenset(required_fields or DEFAULT_REQUIRED)
+        per_class = required_fields_by_doc_class or REQUIRED_BY_DOC_CLASS
+        self.required = {k: frozenset(v) for k, v in per_class.items()}
+        self.only_required_and_rules = only_required_and_rules
+        self.emit_info = emit_info
+        self.emit_normalized = emit_normalized
+        self._doc_rule = FIELD_RULES["Doc_class"]
+        self._rat_rule = FIELD_RULES["Rationale"]
+        self._plans: Dict[frozenset, list] = {}
+
+    def _plan(self, required: frozenset) -> list:
+        """
+        某組必填欄位下要輸出的欄位：[(key, rule, 是否必填)]；金額欄位的 rule 為 None（用已算好的正規化值）。
+        only_required_and_rules 時非必填欄位的結果會被濾掉，因此根本不必檢查。
+        """
+        plan = self._plans.get(required)
+        if plan is None:
+            plan = [(k, None if k in _AMOUNTS else FIELD_RULES[k], k in required) for k in FIELDS
+                    if not self.only_required_and_rules or k in required]
+            self._plans[required] = plan
+        return plan
+
+    # ---- 單筆 ---------------------------------------------------------------
+    def check(self, data_or_str: Any, return_normalized_object: bool = True):
+        if isinstance(data_or_str, str):
+            obj = _extract_json(data_or_str)
+        elif isinstance(data_or_str, dict):
+            obj = data_or_str
+        else:
+            raise TypeError("只接受 dict 或 str (JSON)")
+        filtered, normalized_obj = self._check_root(obj.get("gt_parse", obj))
+        return (filtered, normalized_obj) if return_normalized_object else filtered
+
+    def _check_root(self, root: Dict[str, Any]) -> Tuple[Dict[str, Any], dict]:
+        # Doc_class / Rationale 的實際鍵名：最後一個 lower 相同的 key（同舊版 _canonical_key_map）
+        dc_key = rat_key = None
+        for k in root:
+            lk = k.lower()
+            if lk == "doc_class":
+                dc_key = k
+            elif lk == "rationale":
+                rat_key = k
+        dc_key = dc_key or "doc_class"
+        rat_key = rat_key or "rationale"
+        get = root.get
+        doc_class = get(dc_key)
+        doc_class_s = str(doc_class)
+        required = self.required.get(doc_class_s, self.default_required)
+        only_required = self.only_required_and_rules
+
+        amounts = {k: normalize_amount(get(k)) for k in _AMOUNTS}
+        full: Dict[str, Any] = {}
+        for key, rule, req in self._plan(required):
+            val = get(key)
+            ok = amounts[key] is not None if rule is None else rule(val)
+            if ok and req:
+                ok = val is not None and (not isinstance(val, str) or len(val.strip()) > 0)
+            full[key] = bool(ok)
+        for key, rule in ((dc_key, self._doc_rule), (rat_key, self._rat_rule)):
+            if only_required and key not in required:
+                continue
+            val = get(key)
+            ok = rule(val)
+            if ok and key in required:
+                ok = val is not None and (not isinstance(val, str) or len(val.strip()) > 0)
+            full[key] = bool(ok)
+
+        # 合計規則：以正規化後數值進行
+        st_norm, tax_norm, total_norm = amounts["SalesTotalAmount"], amounts["SalesTax"], amounts["TotalAmount"]
+        if st_norm is not None and tax_norm is not None and total_norm is not None:
+            full[SUM_RULE] = (int(st_norm) + int(tax_norm) == int(total_norm))
+
+        month, day = get("InvoiceMonth"), get("InvoiceDay")
+        mm_norm = strip_leading_zero(month) or month
+        dd_norm = strip_leading_zero(day) or day
+
+        # 正規化物件（依 doc_class 的固定欄位 + 固定順序）
+        cls = "triple_receipt" if doc_class_s == "triple_receipt" else "triple_invoice"
+        gt = {"Doc_class": cls}
+        first: Optional[Dict[str, str]] = None
+        for k in _NORMALIZED_LAYOUT[cls]:
+            if k == "InvoiceMonth":
+                gt[k] = mm_norm
+            elif k == "InvoiceDay":
+                gt[k] = dd_norm
+            elif k in amounts and amounts[k] is not None:
+                gt[k] = amounts[k]
+            elif k in root:
+                gt[k] = root[k]
+            else:
+                # 不分大小寫：取第一個 lower 相同的 key（同舊版 _get_ci）；只在缺 exact key 時才建表
+                if first is None:
+                    first = {}
+                    for rk in root:
+                        first.setdefault(rk.lower(), rk)
+                rk = first.get(k.lower())
+                gt[k] = root[rk] if rk is not None else None
+        normalized_obj = {"gt_parse": gt}
+
+        if self.emit_normalized:
+            year_norm = normalize_year(get("InvoiceYear"))
+            for k, v in (("InvoiceYear", year_norm), ("InvoiceMonth", mm_norm), ("InvoiceDay", dd_norm),
+                         ("SalesTotalAmount", st_norm), ("SalesTax", tax_norm), ("TotalAmount", total_norm)):
+                if v is not None:
+                    full["@normalized:" + k] = v
+        return full, normalized_obj
+
+    # ---- 批次 ---------------------------------------------------------------
+    def check_batch(self, records: Any) -> BatchResult:
+        """
+        records：dict / JSON 字串的 list，或欄式表 {欄位: [值, ...]}（每列組成一筆 gt_parse），
+        或任何有 to_dict("records") 的表格（pandas DataFrame）。
+        解析失敗的列記在 errors，columns 該列皆為 None、passed 為 False。
+        """
+        rows = _rows(records)
+        out = BatchResult(n=len(rows))
+        columns = out.columns
+        for i, rec in enumerate(rows):
+            try:
+                if isinstance(rec, str):
+                    rec = _extract_json(rec)
+                elif not isinstance(rec, dict):
+                    raise TypeError("只接受 dict 或 str (JSON)")
+                res, norm = self._check_root(rec.get("gt_parse", rec))
+            except (ValueError, TypeError, AttributeError) as e:
+                out.errors[i] = f"{type(e).__name__}: {e}"
+                res, norm = {}, None
+            for k, v in res.items():
+                col = columns.get(k)
+                if col is None:
+                    col = columns[k] = [None] * i
+                col.append(v)
+            for col in columns.values():
+                if len(col) <= i:
+                    col.append(None)
+            out.passed.append(norm is not None and all(v for v in res.values() if isinstance(v, bool)))
+            out.normalized.append(norm)
+        for col in columns.values():
+            col.extend([None] * (out.n - len(col)))
+        return out
+
+
+def _rows(records: Any) -> List[Any]:
+    if hasattr(records, "to_dict") and not isinstance(records, dict):
+        return records.to_dict("records")
+    if isinstance(records, dict) and records and all(isinstance(v, list) for v in records.values()):
+        keys = list(records)
+        n = max(len(v) for v in records.values())
+        cols = [records[k] for k in keys]
+        return [{"gt_parse": {k: (c[i] if i < len(c) else None) for k, c in zip(keys, cols)}}
+                for i in range(n)]
+    return list(records)
+
+
+_engines: Dict[Any, ComplianceEngine] = {}
+
+
+def get_engine(required_fields: Optional[Sequence[str]] = None,
+               required_fields_by_doc_class: Optional[Mapping[str, Sequence[str]]] = None,
+               only_required_and_rules: bool = True, emit_info: bool = True,
+               emit_normalized: bool = False) -> ComplianceEngine:
+    """同一組參數共用一個已編譯的引擎。"""
+    per_class = None
+    if required_fields_by_doc_class is not None:
+        per_class = tuple(sorted((str(k), tuple(v)) for k, v in required_fields_by_doc_class.items()))
+    key = (tuple(required_fields) if required_fields else None, per_class,
+           bool(only_required_and_rules), bool(emit_info), bool(emit_normalized))
+    eng = _engines.get(key)
+    if eng is None:
+        eng = _engines[key] = ComplianceEngine(required_fields, required_fields_by_doc_class,
+                                               only_required_and_rules, emit_info, emit_normalized)
+    return eng
+
+
+# ---- 標註資料夾稽核（多行程） -------------------------------------------------
+def _label_records(path: str) -> List[Tuple[str, Any]]:
+    """一個標註檔 → [(來源, 記錄)]。支援單筆 JSON、list 與 Donut 資料集（ground_truth 為 JSON 字串）。"""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    items = data if isinstance(data, list) else [data]
+    out = []
+    for j, d in enumerate(items):
+        src = path if len(items) == 1 else f"{path}#{j}"
+        if isinstance(d, dict) and "ground_truth" in d:
+            src = d.get("image_path") or src
+            d = d["ground_truth"]
+            d = json.loads(d) if isinstance(d, str) else d
+        if isinstance(d, dict) and "gt_parse" not in d and any(isinstance(d.get(s), dict)
+                                                               for s in ("header", "body", "tail", "Tail")):
+            from VAT_OCR import flatten_sections
+            d = flatten_sections(d)
+        out.append((src, d))
+    return out
+
+
+def _audit_chunk(args) -> dict:
+    paths, engine_kwargs = args
+    eng = get_engine(**engine_kwargs)
+    sources, records, file_errors = [], [], {}
+    for p in paths:
+        try:
+            for src, rec in _label_records(p):
+                sources.append(src)
+                records.append(rec)
+        except (OSError, ValueError) as e:
+            file_errors[p] = f"{type(e).__name__}: {e}"
+    batch = eng.check_batch(records)
+    failed = []
+    for i, src in enumerate(sources):
+        if not batch.passed[i]:
+            row = batch.row(i)
+            failed.append({"source": src, "error": batch.errors.get(i),
+                           "failed": [k for k, v in row.items() if v is False]})
+    counts = {k: [sum(1 for v in col if v is True), sum(1 for v in col if v is False)]
+              for k, col in batch.columns.items()}
+    return {"records": len(records), "passed": sum(batch.passed), "failed": failed,
+            "counts": counts, "file_errors": file_errors}
+
+
+def audit_dir(root: str, workers: Optional[int] = None, pattern: str = ".json", chunk_size: int = 256,
+              **engine_kwargs) -> dict:
+    """
+    遞迴稽核資料夾下所有標註 JSON：檔案分塊交給多個行程，回傳
+    {records, passed, pass_rate, per_field: {欄位: {pass, fail}}, failed: [...], file_errors}。
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    paths = sorted(os.path.join(d, f) for d, _, files in os.walk(root) for f in files if f.endswith(pattern))
+    chunks = [(paths[i:i + chunk_size], engine_kwargs) for i in range(0, len(paths), chunk_size)]
+    report = {"root": root, "files": len(paths), "records": 0, "passed": 0,
+              "per_field": {}, "failed": [], "file_errors": {}}
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(chunks) <= 1:
+        parts = map(_audit_chunk, chunks)
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        parts = pool.map(_audit_chunk, chunks)
+    try:
+        for part in parts:
+            report["records"] += part["records"]
+            report["passed"] += part["passed"]
+            report["failed"].extend(part["failed"])
+            report["file_errors"].update(part["file_errors"])
+            for k, (ok, bad) in part["counts"].items():
+                agg = report["per_field"].setdefault(k, {"pass": 0, "fail": 0})
+                agg["pass"] += ok
+                agg["fail"] += bad
+    finally:
+        if workers > 1 and len(chunks) > 1:
+            pool.shutdown()
+    report["pass_rate"] = report["passed"] / report["records"] if report["records"] else 0.0
+    return report
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    a = sub.add_parser("audit", help="稽核標註資料夾（遞迴找 .json）")
+    a.add_argument("root")
+    a.add_argument("--workers", type=int, default=None)
+    a.add_argument("--pattern", default=".json", help="檔名結尾")
+    a.add_argument("--out", default=None)
+    args = ap.parse_args()
+
+    rep = audit_dir(args.root, workers=args.workers, pattern=args.pattern)
+    print(f"files {rep['files']}  records {rep['records']}  passed {rep['passed']}  ({rep['pass_rate']:.1%})")
+    for k, v in sorted(rep["per_field"].items(), key=lambda kv: -kv[1]["fail"]):
+        if v["fail"]:
+            print(f"  {k:<50} fail {v['fail']}")
+    for p, e in rep["file_errors"].items():
+        print(f"[讀取失敗] {p}: {e}", file=sys.stderr)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(rep, f, ensure_ascii=False, indent=2)
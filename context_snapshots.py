@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Ollama context 快照管理（session reuse 用）。
+
+每個快照 = 一組「暖機後 Ollama 回傳的 context token 序列」，以指紋辨識是哪個設定產生的：
+  指紋 = sha256(模型 digest + system_msg + few-shot 範例（影像雜湊 + 回覆文字）+ NUM_CTX + 其他選項)
+模型更新、system prompt 或 few-shot 改動時指紋不同 → 視為過期，自動重新暖機。
+
+儲存格式（每個 variant 兩個檔）：
+  <variant>.ctx   token 以 uint32 little-endian 連續存放（固定 4 bytes/token，讀取時 mmap，不需解析 JSON）
+  <variant>.json  sidecar：fingerprint、token 數、建立時間、描述欄位（除錯用）
+可同時保留多個 variant（例如預設的全部範例 + 每個 doc_class 各一份）。
+
+用法：
+    from context_snapshots import ContextSnapshotStore, fingerprint
+    store = ContextSnapshotStore()
+    fp = fingerprint(model_digest, system_msg, exemplars, num_ctx)
+    ctx = store.get_or_build("default", fp, lambda: warmup_and_return_context())
+
+快照目錄：環境變數 VAT_CTX_DIR，預設 ~/.cache/vat_ocr/ollama_ctx
+"""
+
+from __future__ import annotations
+import os
+import re
+import sys
+import json
+import mmap
+import time
+import array
+import hashlib
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_CTX_DIR = os.environ.get(
+    "VAT_CTX_DIR", os.path.join(os.path.expanduser("~"), ".cache", "vat_ocr", "ollama_ctx")
+)
+FORMAT_VERSION = 1
+
+
+def fingerprint(model_digest: str, system_msg: str, exemplars: Iterable[Tuple[str, str]],
+                num_ctx: int, extra: Optional[dict] = None) -> str:
+    """exemplars：[(影像 sha256, 範例回覆文字), ...]，順序有意義（few-shot 順序不同 context 也不同）。"""
+    payload = json.dumps(
+        {"v": FORMAT_VERSION, "model": model_digest, "system": system_msg,
+         "exemplars": [list(e) for e in exemplars], "num_ctx": num_ctx, "extra": extra or {}},
+        ensure_ascii=False, sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _safe_name(variant: str) -> str:
+    return re.sub(r"[^0-9A-Za-z_.-]", "_", variant) or "default"
+
+
+class ContextSnapshotStore:
+    def __init__(self, root: str = DEFAULT_CTX_DIR):
+        self.root = root
+        self._lock = threading.Lock()
+        self._building: Dict[str, threading.Lock] = {}
+        self._counters = {"hits": 0, "rebuilds": 0, "stale": 0}
+
+    def _paths(self, variant: str) -> Tuple[str, str]:
+        base = os.path.join(self.root, _safe_name(variant))
+        return base + ".ctx", base + ".json"
+
+    # ---- 讀寫 --------------------------------------------------------------
+    def meta(self, variant: str) -> Optional[dict]:
+        _, meta_path = self._paths(variant)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            return None
+
+    def load(self, variant: str, fp: Optional[str] = None) -> Optional[List[int]]:
+        """指紋相符（或 fp=None 不檢查）時回傳 token list；不存在、過期或損毀回傳 None。"""
+        ctx_path, _ = self._paths(variant)
+        meta = self.meta(variant)
+        if meta is None or meta.get("version") != FORMAT_VERSION:
+            return None
+        if fp is not None and meta.get("fingerprint") != fp:
+            return None
+        try:
+            size = os.path.getsize(ctx_path)
+            if size != 4 * meta["n_tokens"]:
+                return None
+            if size == 0:
+                return []
+            with open(ctx_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm).cast("I")
+                try:
+                    tokens = view.tolist()
+                finally:
+                    view.release()
+        except (OSError, KeyError, TypeError):
+            return None
+        if sys.byteorder != "little":
+            a = array.array("I", tokens); a.byteswap(); tokens = a.tolist()
+        return tokens
+
+    def save(self, variant: str, fp: str, tokens: List[int], info: Optional[dict] = None) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        ctx_path, meta_path = self._paths(variant)
+        a = array.array("I", tokens)
+        if sys.byteorder != "little":
+            a.byteswap()
+        tag = f"{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(f"{ctx_path}.{tag}", "wb") as f:
+            a.tofile(f)
+        meta = {"version": FORMAT_VERSION, "variant": variant, "fingerprint": fp,
+                "n_tokens": len(tokens), "created": time.time(), "info": info or {}}
+        with open(f"{meta_path}.{tag}", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        # 先換 token 檔再換 sidecar；讀者若看到新 token + 舊 sidecar，長度或指紋不符 → 視為過期
+        os.replace(f"{ctx_path}.{tag}", ctx_path)
+        os.replace(f"{meta_path}.{tag}", meta_path)
+
+    def get_or_build(self, variant: str, fp: str, build: Callable[[], List[int]],
+                     force: bool = False, info: Optional[dict] = None) -> List[int]:
+        """指紋相符直接回傳；否則呼叫 build()（重新暖機）並存檔。同一 variant 同時只建一次。"""
+        if not force:
+            tokens = self.load(variant, fp)
+            if tokens is not None:
+                with self._lock:
+                    self._counters["hits"] += 1
+                return tokens
+            if self.meta(variant) is not None:
+                with self._lock:
+                    self._counters["stale"] += 1   # 有快照但指紋不符（模型/提示/範例變更）
+        with self._lock:
+            lock = self._building.setdefault(variant, threading.Lock())
+        with lock:
+            if not force:
+                tokens = self.load(variant, fp)   # 等待期間別的執行緒可能已經建好
+                if tokens is not None:
+                    with self._lock:
+                        self._counters["hits"] += 1
+                    return tokens
+            tokens = list(build())
+            self.save(variant, fp, tokens, info)
+            with self._lock:
+                self._counters["rebuilds"] += 1
+            return tokens
+
+    def variants(self) -> List[str]:
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(n[:-len(".json")] for n in os.listdir(self.root) if n.endswith(".json"))
+
+    def remove(self, variant: str) -> None:
+        for p in self._paths(variant):
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
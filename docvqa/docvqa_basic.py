@@ -1,11 +1,15 @@
 # save as qwen_test.py
-import base64, requests, sys, json, time
+import sys, json, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))  # 專案根目錄：共用模組
+from vision_budget import encode_image_b64
+from ollama_client import get_client
 
 img_path = sys.argv[1]          # e.g. .\invoice.jpg
 question = sys.argv[2]          # e.g. "What is the invoice number?"
 
-with open(img_path, 'rb') as f:
-    b64 = base64.b64encode(f.read()).decode('utf-8')
+b64 = encode_image_b64(img_path)  # 依 VAT_VISION_BUDGET 縮圖；預設 full 即原檔
 
 
 payload = {
@@ -24,10 +28,11 @@ payload = {
   ]
 }
 start_time = time.time()
-r = requests.post("http://localhost:11434/api/chat", json=payload, timeout=120)
-print(r.text)
-print(json.loads(r.text)["message"]["content"].strip())
-print(r)
+client = get_client()  # OLLAMA_HOST，預設 http://localhost:11434；失敗會自動重試
+resp = client.chat(payload["model"], payload["messages"], options=payload["options"], deadline=120)
+print(json.dumps(resp, ensure_ascii=False))
+print(resp["message"]["content"].strip())
+print(client.stats())
 print("running time: ", time.time()-start_time)
 
 # "你是發票/單據分類器與結構化抽取器，請辨識這張文件"
\ No newline at end of file
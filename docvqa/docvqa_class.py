@@ -1,7 +1,11 @@
-from ollama import chat
 from pydantic import ValidationError
 from typing import Literal, Optional
 from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))  # 專案根目錄：共用模組
+from vision_budget import encode_image_b64
+from ollama_client import get_client
 
 labels = [
     {"name":"business_invoice", "definition":"header is 電子發票證明聯，具有表格的發票，包含統編、發票字軌與品項總計"},
@@ -23,16 +27,16 @@ class DocClass(BaseModel):
     confidence: float
     rationale: Optional[str]
 
-resp = chat(
+resp = get_client().chat(
     model='qwen2.5vl:7b',
     messages=[
         {'role':'system','content':system_rules},
         {'role':'user',
          'content':"請以單選分類這張圖片，並解釋你依據的線索。",
-         'images':[img]},  # 路徑可直接放入（新版支援），或改用 base64
+         'images':[encode_image_b64(img)]},  # 統一走 vision_budget 縮圖後的 base64
     ],
-    format=DocClass.model_json_schema(),   # ★ 強制 JSON Schema
+    fmt=DocClass.model_json_schema(),   # ★ 強制 JSON Schema
     options={'temperature':0, 'seed':42},  # 穩定輸出
 )
 
-print(resp.message.content)  # 嚴格的 JSON，符合 DocClass
+print(resp["message"]["content"])  # 嚴格的 JSON，符合 DocClass
@@ -1,12 +1,15 @@
 from typing import Literal, Optional
+from pathlib import Path
 from pydantic import BaseModel
-from ollama import chat
-import base64
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))  # 專案根目錄：共用模組
+from vision_budget import encode_image_b64
+from ollama_client import get_client
 
 
 def img_to_b64(path: str) -> str:
-    with open(path, 'rb') as f:
-        return base64.b64encode(f.read()).decode('utf-8')
+    return encode_image_b64(path)
 
 class Header(BaseModel):
     PrefixTwoLetters: Optional[str] = None
@@ -138,16 +141,16 @@ shots = [
 # Test image (you can change this path)
 test_img_path = './invoice2.jpg' #'./few_shot_sample/image/1_business_invoice.jpg', './invoice2.jpg'
 
-resp = chat(
+resp = get_client().chat(
     model='qwen2.5vl:7b',
     messages=[
         {'role': 'system', 'content': system_rules},
         *shots,
         {'role': 'user', 'content': '請分類這張待測文件', 'images': [img_to_b64(test_img_path)]},
     ],
-    format=DocClass.model_json_schema(),
+    fmt=DocClass.model_json_schema(),
     options={'temperature': 0, 'seed': 7},
 )
 
-print(resp.message.content)
+print(resp["message"]["content"])
 
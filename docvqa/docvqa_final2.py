@@ -1,14 +1,21 @@
 from typing import Literal, Optional
+from pathlib import Path
 from pydantic import BaseModel
-from ollama import chat
-import base64
 import sys
 import json
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))  # 專案根目錄：共用模組
+from vision_budget import encode_image_b64, resolve_budget
+from extraction_cache import cached_call, make_key, ollama_model_digest
+from fewshot_assets import get_store
+from ollama_client import get_client, extract_first_json_block
+from json_stream import FieldStream
+from tracing import annotate, doc_class_of, span
 
-def img_to_b64(path: str) -> str:
-    with open(path, 'rb') as f:
-        return base64.b64encode(f.read()).decode('utf-8')
+
+def img_to_b64(path: str, budget=None) -> str:
+    # budget=None → vision_budget.DEFAULT_BUDGET（可用環境變數 VAT_VISION_BUDGET 調整）
+    return encode_image_b64(path, budget)
 
 
 
@@ -210,126 +217,62 @@ triple_receipt = """{
 """
 
 # Few-shot examples using repository images
-ex1_img_path = '../few_shot_sample/image/1_business_invoice.jpg'
-ex2_img_path = '../few_shot_sample/image/2_customs_tax_payment.jpg'
-ex3_img_path = '../few_shot_sample/image/3_e_invoice.jpg'
-ex4_img_path = '../few_shot_sample/image/4_plumb_payment_order.jpg'
-ex5_img_path = '../few_shot_sample/image/5_tele_payment_order.jpg'
-ex6_img_path = '../few_shot_sample/image/6_tradition_invoice.jpg'
-ex7_img_path = '../few_shot_sample/image/7_triple_invoice.jpg'
-ex8_img_path = '../few_shot_sample/image/8_triple_receipt.jpg'
-
-shots = [
-    # 1.
-    {
-        'role': 'user',
-        'content': '請分類這張文件',
-        'images': [img_to_b64(ex1_img_path)],
-    },
-    {
-        'role': 'assistant',
-        'content': business_invoice,
-    },
-    # 2.
-    {
-        'role': 'user',
-        'content': '請分類這張文件',
-        'images': [img_to_b64(ex2_img_path)],
-    },
-    {
-        'role': 'assistant',
-        'content': customs_tax_payment,
-    },
-    # 3.
-    {
-        'role': 'user',
-        'content': '請分類這張文件',
-        'images': [img_to_b64(ex3_img_path)],
-    },
-    {
-        'role': 'assistant',
-        'content': e_invoice,
-    },
-    # 4.
-    {
-        'role': 'user',
-        'content': '請分類這張文件',
-        'images': [img_to_b64(ex4_img_path)],
-    },
-    {
-        'role': 'assistant',
-        'content': plumb_payment_order,
-    },
-    # 5.
-    {
-        'role': 'user',
-        'content': '請分類這張文件',
-        'images': [img_to_b64(ex5_img_path)],
-    },
-    {
-        'role': 'assistant',
-        'content': tele_payment_order,
-    },
-    # 6.
-    {
-        'role': 'user',
-        'content': '請分類這張文件',
-        'images': [img_to_b64(ex6_img_path)],
-    },
-    {
-        'role': 'assistant',
-        'content': tradition_invoice,
-    },
-    # 7.
-    {
-        'role': 'user',
-        'content': '請分類這張文件',
-        'images': [img_to_b64(ex7_img_path)],
-    },
-    {
-        'role': 'assistant',
-        'content': triple_invoice,
-    },
-    # 8.
-    {
-        'role': 'user',
-        'content': '請分類這張文件',
-        'images': [img_to_b64(ex8_img_path)],
-    },
-    {
-        'role': 'assistant',
-        'content': triple_receipt,
-    },
+# 影像改由 fewshot_assets 延遲載入：import 本模組不讀檔/不編碼；第一次用到 shots 才從快取（mmap）取出
+FEWSHOT_EXAMPLES = [
+    ('1_business_invoice.jpg', business_invoice),
+    ('2_customs_tax_payment.jpg', customs_tax_payment),
+    ('3_e_invoice.jpg', e_invoice),
+    ('4_plumb_payment_order.jpg', plumb_payment_order),
+    ('5_tele_payment_order.jpg', tele_payment_order),
+    ('6_tradition_invoice.jpg', tradition_invoice),
+    ('7_triple_invoice.jpg', triple_invoice),
+    ('8_triple_receipt.jpg', triple_receipt),
 ]
 
+_shots_cache = {}
+
+
+def get_shots(budget=None) -> list:
+    """few-shot 對話（user 影像 + assistant JSON）× 8；找不到的範例影像以空 images 帶過。"""
+    store = get_store(budget)
+    # 範例影像換掉時 store.version 會變（store 每 CHECK_INTERVAL_S 秒重新檢查一次），舊的 shots 不再使用
+    key = (repr(resolve_budget(budget)), store.current_version())
+    if key not in _shots_cache:
+        for old in [k for k in _shots_cache if k[0] == key[0]]:
+            del _shots_cache[old]
+        shots = []
+        for img_name, answer in FEWSHOT_EXAMPLES:
+            b64 = store.get_b64(img_name)
+            if b64 is None:
+                print(f"[警告] 找不到 few-shot 影像：{img_name}")
+            shots.append({
+                'role': 'user',
+                'content': '請分類這張文件',
+                'images': [b64] if b64 else [],
+            })
+            shots.append({
+                'role': 'assistant',
+                'content': answer,
+            })
+        _shots_cache[key] = shots
+    return _shots_cache[key]
 
 
-def _extract_first_json_block(text: str) -> str:
-    depth = 0
-    start = -1
-    for i, ch in enumerate(text or ""):
-        if ch == '{':
-            if depth == 0:
-                start = i
-            depth += 1
-        elif ch == '}':
-            if depth > 0:
-                depth -= 1
-                if depth == 0 and start != -1:
-                    return text[start:i+1]
-    return text
+def __getattr__(name):
+    # 相容舊用法 `from docvqa_final2 import shots`：存取時才載入
+    if name == "shots":
+        return get_shots()
+    raise AttributeError(name)
+
+
+
+_extract_first_json_block = extract_first_json_block  # 舊名稱相容
 
 
 def _chat_once(model: str, messages: list, fmt=None):
-    kwargs = {
-        "model": model,
-        "messages": messages,
-        "stream": False,
-        "options": {"temperature": 0, "seed": 42},
-    }
-    if fmt is not None:
-        kwargs["format"] = fmt
-    return chat(**kwargs)
+    # 共用連線池 + 重試；回傳 Ollama 回應 dict（resp["message"]["content"]）
+    return get_client().chat(model, messages, fmt=fmt, options={"temperature": 0, "seed": 42},
+                             strategy="fewshot")
 
 
 # Public wrapper for reuse in other modules
@@ -337,48 +280,105 @@ def chat_once(model: str, messages: list, fmt=None):
     return _chat_once(model, messages, fmt)
 
 
-def build_messages_for_image(b64_image: str) -> list:
-    system_msg = (
-        "You are a document understanding assistant. "
-        "Classify the document into one of: "
-        "['business_invoice','customs_tax_payment','e_invoice','plumb_payment_order',"
-        "'tele_payment_order','tradition_invoice','triple_invoice','triple_receipt','other']. "
-        "Then extract fields into JSON with keys: doc_class, header, body, tail, rationale (optional). "
-        "Amounts must be digits only (no commas). If unknown, use null or omit the property. "
-        "Return JSON only, no extra text."
-    )
+SYSTEM_MSG = (
+    "You are a document understanding assistant. "
+    "Classify the document into one of: "
+    "['business_invoice','customs_tax_payment','e_invoice','plumb_payment_order',"
+    "'tele_payment_order','tradition_invoice','triple_invoice','triple_receipt','other']. "
+    "Then extract fields into JSON with keys: doc_class, header, body, tail, rationale (optional). "
+    "Amounts must be digits only (no commas). If unknown, use null or omit the property. "
+    "Return JSON only, no extra text."
+)
 
-    user_msg = (
-        "請分類這張文件並輸出單一 JSON："
-        "1) 給出 doc_class（上述類別其一）；"
-        "2) 依 header/body/tail 結構輸出欄位；未知請為 null 或省略；"
-        "3) 可附上 rationale（可省略）；只輸出 JSON，勿加解說。"
-    )
+USER_MSG = (
+    "請分類這張文件並輸出單一 JSON："
+    "1) 給出 doc_class（上述類別其一）；"
+    "2) 依 header/body/tail 結構輸出欄位；未知請為 null 或省略；"
+    "3) 可附上 rationale（可省略）；只輸出 JSON，勿加解說。"
+)
 
+
+def build_messages_for_image(b64_image: str) -> list:
     messages = [
-        {"role": "system", "content": system_msg},
-        *shots,
-        {"role": "user", "content": user_msg, "images": [b64_image]},
+        {"role": "system", "content": SYSTEM_MSG},
+        *get_shots(),
+        {"role": "user", "content": USER_MSG, "images": [b64_image]},
     ]
     return messages
 
 
-def infer_image_json(img_path: str, model: str = 'qwen2.5vl:7b') -> str:
+def _prompt_fingerprint() -> list:
+    # 快取 key 用：prompt 文字 + 每個範例的 (檔名, 影像內容雜湊, 答案)；只讀 fewshot_assets 的 index，
+    # 不取出/解碼範例影像。換掉範例影像 → 雜湊改變 → 舊結果不再命中
+    store = get_store()
+    return [SYSTEM_MSG, USER_MSG, [(name, store.sha256(name), answer) for name, answer in FEWSHOT_EXAMPLES]]
+
+
+def infer_image_json(img_path: str, model: str = 'qwen2.5vl:7b', budget=None, cache=None,
+                     with_metrics: bool = False):
     """Run a single-image inference and return JSON string content.
 
     Returns the assistant content as JSON string. Falls back to extracting
-    the first JSON block if the model returns extra text.
+    the first JSON block if the model returns extra text. ``budget`` is a
+    ``vision_budget.VisionBudget`` (or preset name) applied to the query image.
+    ``cache`` follows ``extraction_cache.resolve_cache`` (None = shared cache,
+    False = disabled). ``with_metrics=True`` returns ``(content, metrics)``
+    where ``metrics`` is ``ollama_client.request_metrics`` of the call
+    (``None`` when served from the cache).
     """
-    b64 = img_to_b64(img_path)
+    def _key():
+        return make_key(
+            image_path=img_path,
+            model=ollama_model_digest(model),
+            prompt=_prompt_fingerprint(),
+            options={"temperature": 0, "seed": 42, "budget": repr(resolve_budget(budget))},
+        )
+
+    metrics = {}
+
+    def _run():
+        resp = infer_image_response(img_path, model, budget)
+        metrics.update(resp["metrics"])
+        return resp["message"]["content"]
+
+    with span("infer_image_json", backend="ollama", model=model, image=img_path) as sp:
+        content = cached_call(cache, _key, _run)
+        if sp:
+            annotate(doc_class=doc_class_of(content))
+    return (content, metrics or None) if with_metrics else content
+
+
+def infer_image_response(img_path: str, model: str = 'qwen2.5vl:7b', budget=None) -> dict:
+    """不經快取呼叫一次，回傳完整 Ollama 回應（resp["metrics"]：token 數與伺服器端各階段秒數）。"""
+    b64 = img_to_b64(img_path, budget)
     messages = build_messages_for_image(b64)
 
-    try:
-        resp = _chat_once(model, messages, fmt="json")
-        return resp.message.content
-    except Exception:
-        # Fallback without format
-        resp = _chat_once(model, messages, fmt=None)
-        return _extract_first_json_block(resp.message.content)
+    # JSON 模式失敗或回空時，client 會改用無 format 重送並擷取第一段 JSON
+    return get_client().chat_json(model, messages, fmt="json", options={"temperature": 0, "seed": 42},
+                                  strategy="fewshot")
+
+
+
+def stream_image_fields(img_path: Optional[str] = None, model: str = 'qwen2.5vl:7b', budget=None,
+                        b64_image: Optional[str] = None, check=True, max_bad: int = 2,
+                        host: Optional[str] = None, deadline: Optional[float] = None) -> FieldStream:
+    """Streaming variant of ``infer_image_json``.
+
+    Returns a ``json_stream.FieldStream``; iterating it yields a ``FieldEvent``
+    as soon as each field value closes in the model output. ``check=True``
+    runs ``VAT_OCR.check_field`` on every field and cancels the request once
+    ``max_bad`` fields fail (closing the HTTP stream stops generation on the
+    server). Pass ``b64_image`` instead of ``img_path`` for in-memory uploads.
+    Not cached.
+    """
+    if check is True:
+        from VAT_OCR import check_field
+        check = check_field
+    b64 = b64_image if b64_image is not None else img_to_b64(img_path, budget)
+    pieces = get_client(host).chat_stream_text(model, build_messages_for_image(b64), fmt="json",
+                                               options={"temperature": 0, "seed": 42}, deadline=deadline,
+                                               strategy="fewshot_stream")
+    return FieldStream(pieces, check=check or None, max_bad=max_bad)
 
 
 if __name__ == "__main__":
@@ -408,7 +408,7 @@ if __name__ == "__main__":
 
     messages = [
         {"role": "system", "content": system_msg},
-        *shots,
+        *get_shots(),
         {"role": "user", "content": user_msg, "images": [b64]},
     ]
 
@@ -418,14 +418,14 @@ if __name__ == "__main__":
     # 1) Try preferred model with JSON mode
     try:
         resp = _chat_once('qwen2.5vl:7b', messages, fmt="json")
-        content = resp.message.content
-        print(resp.message.content)
+        content = resp["message"]["content"]
+        print(content)
     except Exception as e:
         errors.append(f"7b json mode: {e}")
         # 2) Retry same model without format (some servers/models choke on format)
         try:
             resp = _chat_once('qwen2.5vl:7b', messages, fmt=None)
-            content = _extract_first_json_block(resp.message.content)
+            content = _extract_first_json_block(resp["message"]["content"])
         except Exception as e2:
             errors.append(f"7b raw: {e2}")
 
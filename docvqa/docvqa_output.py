@@ -1,16 +1,18 @@
 from typing import Optional, Literal
 from pydantic import BaseModel
-from ollama import chat
-import base64
 import sys
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))  # 專案根目錄：共用模組
+from vision_budget import encode_image_b64
+from ollama_client import get_client
+
 
 def img_to_b64(path: str) -> str:
     p = Path(path)
     if not p.exists() or not p.is_file():
         raise FileNotFoundError(f"Image not found: {path}")
-    return base64.b64encode(p.read_bytes()).decode("utf-8")
+    return encode_image_b64(str(p))
 
 
 class Header(BaseModel):
@@ -61,15 +63,15 @@ if __name__ == "__main__":
 
     schema = ExtractedDoc.model_json_schema()
 
-    resp = chat(
+    resp = get_client().chat(
         model='qwen2.5vl:7b',
         messages=[
             {"role": "system", "content": system_msg},
             {"role": "user", "content": user_msg, "images": [b64]},
         ],
-        format=schema,
+        fmt=schema,
         options={"temperature": 0, "seed": 42},
     )
 
-    print(resp.message.content)
+    print(resp["message"]["content"])
 
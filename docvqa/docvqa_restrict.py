@@ -1,17 +1,20 @@
 from typing import Optional, Literal, Annotated
 from pydantic import BaseModel, Field
-from ollama import chat
-import base64
 import sys
 import json
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))  # 專案根目錄：共用模組
+from vision_budget import encode_image_b64
+from ollama_client import get_client, extract_first_json_block
+from json_repair import repair_json
+
 
 def img_to_b64(path: str) -> str:
     p = Path(path)
     if not p.exists() or not p.is_file():
         raise FileNotFoundError(f"Image not found: {path}")
-    return base64.b64encode(p.read_bytes()).decode("utf-8")
+    return encode_image_b64(str(p))
 
 GENERATION_SCHEMA = {
   "type": "object",
@@ -46,32 +49,12 @@ GENERATION_SCHEMA = {
 }
 
 
-def _extract_first_json_block(text: str) -> str:
-    depth = 0
-    start = -1
-    for i, ch in enumerate(text or ""):
-        if ch == '{':
-            if depth == 0:
-                start = i
-            depth += 1
-        elif ch == '}':
-            if depth > 0:
-                depth -= 1
-                if depth == 0 and start != -1:
-                    return text[start:i+1]
-    return text
+_extract_first_json_block = extract_first_json_block  # 舊名稱相容
 
 
 def _chat_once(model: str, messages: list, fmt=None):
-    kwargs = {
-        "model": model,
-        "messages": messages,
-        "stream": False,
-        "options": {"temperature": 0, "seed": 42},
-    }
-    if fmt is not None:
-        kwargs["format"] = fmt
-    return chat(**kwargs)
+    return get_client().chat(model, messages, fmt=fmt, options={"temperature": 0, "seed": 42},
+                             strategy="restrict")
 
 
 if __name__ == "__main__":
@@ -105,14 +88,22 @@ if __name__ == "__main__":
     # 1) Try preferred model with JSON mode
     try:
         resp = _chat_once('qwen2.5vl:7b', messages, fmt="json")
-        content = resp.message.content
-        print(resp.message.content)
+        content = resp["message"]["content"]
+        print(content)
     except Exception as e:
         errors.append(f"7b json mode: {e}")
         # 2) Retry same model without format (some servers/models choke on format)
         try:
             resp = _chat_once('qwen2.5vl:7b', messages, fmt=None)
-            content = _extract_first_json_block(resp.message.content)
+            content = _extract_first_json_block(resp["message"]["content"])
         except Exception as e2:
             errors.append(f"7b raw: {e2}")
 
+    # 依 GENERATION_SCHEMA 修復 + 驗證（validator 只編譯一次，重複呼叫不再重建）
+    if content is not None:
+        fixed_text, obj, logs = repair_json(content, GENERATION_SCHEMA)
+        print(fixed_text)
+        for line in logs:
+            print("[repair]", line)
+    for err in errors:
+        print("[error]", err)
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+兩階段：先分類、再依類別抽取（docvqa_final2.infer_image_json 的可選替代路徑）。
+
+單階段（docvqa_final2）每次都送 8 張 few-shot 影像，並要求模型一次完成九選一分類 + 完整 header/body/tail。
+兩階段改為：
+  1) 分類：只送待測影像 + 類別提示，format = StageClass schema（label + confidence），輸出極短
+  2) 抽取：依類別使用精簡的 pydantic schema（只列該類別會出現的欄位）+ 1 個同類 few-shot 範例
+  'other' 或分類失敗 → 退回單階段完整流程。
+輸出 JSON 結構與單階段相同（doc_class, header, body, tail），下游 flatten_sections / check_compliance 不需改。
+
+用法：
+   python docvqa/docvqa_two_stage.py ./invoice2.jpg                    # 兩階段抽取
+   python docvqa/docvqa_two_stage.py --report out.json img1.jpg ...    # 與單階段比較每類 token 用量
+   python docvqa/docvqa_two_stage.py --report out.json --dir ./inbox
+"""
+
+from __future__ import annotations
+import os
+import sys
+import json
+import argparse
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Literal, Optional, Tuple
+
+from pydantic import BaseModel, create_model
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))  # 專案根目錄：共用模組
+from extraction_cache import cached_call, make_key, ollama_model_digest
+from ollama_client import get_client
+from vision_budget import resolve_budget
+import docvqa_final2
+from docvqa_final2 import FEWSHOT_EXAMPLES, img_to_b64, get_store
+
+DOC_CLASSES = (
+    'business_invoice', 'customs_tax_payment', 'e_invoice',
+    'plumb_payment_order', 'tele_payment_order', 'tradition_invoice',
+    'triple_invoice', 'triple_receipt',
+)
+OPTIONS = {"temperature": 0, "seed": 42}
+
+
+class StageClass(BaseModel):
+    # 同 docvqa_fewshot.DocClass，但去掉 rationale：第一階段只需要 label，輸出越短越好
+    label: Literal[
+        'business_invoice', 'customs_tax_payment', 'e_invoice',
+        'plumb_payment_order', 'tele_payment_order', 'tradition_invoice',
+        'triple_invoice', 'triple_receipt', 'other'
+    ]
+    confidence: float
+
+
+# 每個類別實際會出現的欄位（依 docvqa_final2 的 few-shot 範例整理）
+CLASS_FIELDS: Dict[str, Dict[str, Tuple[str, ...]]] = {
+    "business_invoice": {
+        "header": ("CompanyName", "InvoiceYear", "InvoiceMonth", "InvoiceDay",
+                   "PrefixTwoLetters", "InvoiceNumber", "BuyerTaxIDNumber"),
+        "body": ("Abstract",),
+        "tail": ("SalesTotalAmount", "SalesTax", "TotalAmount", "CompanyTaxIDNumber"),
+    },
+    "customs_tax_payment": {
+        "header": ("PrefixThreeLetters", "TaxBillNumber", "CompanyTaxIDNumber", "CompanyName"),
+        "body": ("InvoiceYear", "InvoiceMonth", "InvoiceDay", "Abstract"),
+        "tail": ("SalesTax", "TotalAmount"),
+    },
+    "e_invoice": {
+        "header": ("PrefixTwoLetters", "InvoiceNumber"),
+        "body": ("InvoiceYear", "InvoiceMonth", "InvoiceDay", "CompanyTaxIDNumber",
+                 "BuyerTaxIDNumber", "Abstract"),
+        "tail": ("SalesTotalAmount", "SalesTax", "TotalAmount"),
+    },
+    "plumb_payment_order": {
+        "header": ("BuyerAddress", "BuyerName"),
+        "body": ("PrefixFourLetters", "SerialNumber", "BuyerTaxIDNumber", "CompanyTaxIDNumber"),
+        "tail": ("TotalAmount",),
+    },
+    "tele_payment_order": {
+        "header": ("BuyerAddress", "BuyerName", "PrefixTwoLetters", "SerialNumber", "CompanyTaxIDNumber"),
+        "body": ("BuyerTaxIDNumber", "Abstract"),
+        "tail": ("GeneralTaxRate", "ZeroTax", "DutyFree", "OtherFee", "SalesTax", "TotalAmount"),
+    },
+    "tradition_invoice": {
+        "header": ("PrefixTwoLetters", "InvoiceNumber"),
+        "body": ("CompanyTaxIDNumber", "PhoneNumber", "InvoiceYear", "InvoiceMonth", "InvoiceDay", "Abstract"),
+        "tail": ("TotalAmount",),
+    },
+    "triple_invoice": {
+        "header": ("PrefixTwoLetters", "InvoiceNumber", "BuyerName", "BuyerTaxIDNumber",
+                   "InvoiceYear", "InvoiceMonth", "InvoiceDay"),
+        "body": ("Abstract",),
+        "tail": ("SalesTotalAmount", "SalesTax", "TotalAmount", "CompanyName",
+                 "CompanyTaxIDNumber", "PhoneNumber", "CompanyAddress"),
+    },
+    "triple_receipt": {
+        "header": ("PrefixTwoLetters", "InvoiceNumber"),
+        "body": ("CompanyName", "PhoneNumber", "CompanyTaxIDNumber", "CompanyAddress",
+                 "InvoiceYear", "InvoiceMonth", "InvoiceDay", "BuyerTaxIDNumber", "BuyerName", "Abstract"),
+        "tail": ("SalesTotalAmount", "SalesTax", "TotalAmount"),
+    },
+}
+
+# 類別提示：取自各 few-shot 範例的 rationale，讓第一階段不必送範例影像
+CLASS_HINTS = {
+    "business_invoice": "電子發票證明聯（營業人），含品名明細、銷售額合計、營業稅、總計",
+    "customs_tax_payment": "海關進口快遞貨物稅費繳納證明，含稅單號碼",
+    "e_invoice": "電子發票證明聯（小張），含隨機碼",
+    "plumb_payment_order": "台灣自來水公司水費通知單",
+    "tele_payment_order": "電信公司繳費通知",
+    "tradition_invoice": "收銀機統一發票（收執聯）",
+    "triple_invoice": "統一發票（三聯式，手寫/印製）",
+    "triple_receipt": "收銀機統一發票（三聯式），含統編、買受人、銷售額、營業稅",
+}
+
+_schema_cache: Dict[str, type] = {}
+
+
+def class_schema(doc_class: str) -> type:
+    """doc_class → 精簡 pydantic model（只含該類欄位，皆為 Optional[str]）。"""
+    if doc_class not in _schema_cache:
+        sections = {
+            sec: (Optional[create_model(f"{doc_class}_{sec}", **{f: (Optional[str], None) for f in fields})], None)
+            for sec, fields in CLASS_FIELDS[doc_class].items()
+        }
+        _schema_cache[doc_class] = create_model(
+            f"{doc_class}_doc", doc_class=(Literal[doc_class], doc_class), **sections,
+        )
+    return _schema_cache[doc_class]
+
+
+def build_classify_messages(b64_image: str) -> list:
+    hints = "；".join(f"{k}：{v}" for k, v in CLASS_HINTS.items())
+    system_msg = (
+        "你是發票/單據分類器。請輸出嚴格符合 JSON Schema 的 JSON。"
+        f"類別說明：{hints}；都不符合則為 other。"
+    )
+    return [
+        {"role": "system", "content": system_msg},
+        {"role": "user", "content": "請分類這張文件", "images": [b64_image]},
+    ]
+
+
+def build_extract_messages(doc_class: str, b64_image: str, budget=None) -> list:
+    fields = "; ".join(f"{sec}: {', '.join(fs)}" for sec, fs in CLASS_FIELDS[doc_class].items())
+    system_msg = (
+        f"You are a document understanding assistant. The document is a {doc_class}. "
+        f"Extract fields into JSON with keys doc_class, header, body, tail ({fields}). "
+        "Amounts must be digits only (no commas). If unknown, use null or omit the property. "
+        "Return JSON only, no extra text."
+    )
+    messages = [{"role": "system", "content": system_msg}]
+    # 只帶同類別的一個範例
+    for img_name, answer in FEWSHOT_EXAMPLES:
+        if img_name.split("_", 1)[1].rsplit(".", 1)[0] == doc_class:
+            b64 = get_store(budget).get_b64(img_name)
+            messages.append({"role": "user", "content": "請擷取這張文件的欄位", "images": [b64] if b64 else []})
+            messages.append({"role": "assistant", "content": answer})
+            break
+    messages.append({"role": "user", "content": "請擷取這張文件的欄位並輸出單一 JSON。", "images": [b64_image]})
+    return messages
+
+
+def _usage(resp: dict) -> dict:
+    # ollama_client.request_metrics 的秒數 / 冷載入旗標，加上舊的 token 計數鍵名
+    return {"prompt_eval_count": resp.get("prompt_eval_count") or 0, "eval_count": resp.get("eval_count") or 0,
+            **(resp.get("metrics") or {})}
+
+
+def classify(b64_image: str, model: str = 'qwen2.5vl:7b') -> Tuple[str, float, dict]:
+    """第一階段 → (doc_class, confidence, usage)；解析失敗視為 'other'。"""
+    resp = get_client().chat(model, build_classify_messages(b64_image), fmt=StageClass.model_json_schema(),
+                             options={**OPTIONS, "num_predict": 64}, strategy="two_stage_classify")
+    try:
+        parsed = StageClass.model_validate_json(resp["message"]["content"])
+        return parsed.label, parsed.confidence, _usage(resp)
+    except Exception:
+        return "other", 0.0, _usage(resp)
+
+
+def two_stage_infer(img_path: str, model: str = 'qwen2.5vl:7b', budget=None) -> dict:
+    """
+    不經快取的兩階段推論，回傳：
+      {"content": JSON 字串, "doc_class", "confidence", "fallback": bool,
+       "usage": {"classify": {...}, "extract": {...}}}
+    """
+    b64 = img_to_b64(img_path, budget)
+    doc_class, conf, cls_usage = classify(b64, model)
+    if doc_class not in CLASS_FIELDS:
+        # 'other'：沒有精簡 schema，走單階段完整 prompt
+        resp = get_client().chat_json(model, docvqa_final2.build_messages_for_image(b64), fmt="json",
+                                      options=OPTIONS, strategy="fewshot")
+        return {"content": resp["message"]["content"], "doc_class": doc_class, "confidence": conf,
+                "fallback": True, "usage": {"classify": cls_usage, "extract": _usage(resp)}}
+
+    resp = get_client().chat_json(model, build_extract_messages(doc_class, b64, budget),
+                                  fmt=class_schema(doc_class).model_json_schema(), options=OPTIONS,
+                                  strategy="two_stage_extract")
+    return {"content": resp["message"]["content"], "doc_class": doc_class, "confidence": conf,
+            "fallback": False, "usage": {"classify": cls_usage, "extract": _usage(resp)}}
+
+
+def infer_image_json_two_stage(img_path: str, model: str = 'qwen2.5vl:7b', budget=None, cache=None) -> str:
+    """與 docvqa_final2.infer_image_json 相同介面（回傳 JSON 字串），改走兩階段。"""
+    def _key():
+        # 第二階段（同類範例）與 other 的單階段 fallback 都用 docvqa_final2 的範例 → key 帶上它的 prompt/範例指紋
+        return make_key(
+            image_path=img_path,
+            model=ollama_model_digest(model, get_client().host),
+            prompt={"mode": "two_stage", "classify": build_classify_messages("")[0]["content"],
+                    "fields": CLASS_FIELDS, "fewshot": docvqa_final2._prompt_fingerprint()},
+            options={**OPTIONS, "budget": repr(resolve_budget(budget))},
+        )
+
+    return cached_call(cache, _key, lambda: two_stage_infer(img_path, model, budget)["content"])
+
+
+# ---- 與單階段比較 -----------------------------------------------------------
+def single_stage_usage(img_path: str, model: str = 'qwen2.5vl:7b', budget=None) -> Tuple[str, dict]:
+    """單階段（docvqa_final2）不經快取跑一次，回傳 (doc_class, usage)。"""
+    messages = docvqa_final2.build_messages_for_image(img_to_b64(img_path, budget))
+    resp = get_client().chat_json(model, messages, fmt="json", options=OPTIONS, strategy="fewshot")
+    try:
+        doc_class = json.loads(resp["message"]["content"]).get("doc_class")
+    except Exception:
+        doc_class = None
+    return doc_class, _usage(resp)
+
+
+def compare(image_paths: List[str], model: str = 'qwen2.5vl:7b', budget=None) -> dict:
+    """每張影像各跑一次單階段與兩階段，依（兩階段判定的）類別彙總 prompt/輸出 token。"""
+    per_class = defaultdict(lambda: defaultdict(int))
+    rows = []
+    for p in image_paths:
+        single_class, single = single_stage_usage(p, model, budget)
+        two = two_stage_infer(p, model, budget)
+        u = two["usage"]
+        two_prompt = u["classify"]["prompt_eval_count"] + u["extract"]["prompt_eval_count"]
+        two_output = u["classify"]["eval_count"] + u["extract"]["eval_count"]
+        row = {"path": p, "doc_class": two["doc_class"], "single_doc_class": single_class,
+               "fallback": two["fallback"],
+               "single_prompt": single["prompt_eval_count"], "single_output": single["eval_count"],
+               "two_stage_prompt": two_prompt, "two_stage_output": two_output}
+        rows.append(row)
+        agg = per_class[two["doc_class"]]
+        agg["n"] += 1
+        agg["class_agree"] += int(single_class == two["doc_class"])
+        for k in ("single_prompt", "single_output", "two_stage_prompt", "two_stage_output"):
+            agg[k] += row[k]
+        print(f"{os.path.basename(p)}: {two['doc_class']}  prompt {row['single_prompt']} → {two_prompt}  "
+              f"output {row['single_output']} → {two_output}")
+
+    def _saving(before, after):
+        return round(1 - after / before, 4) if before else None
+
+    summary = {}
+    for cls, a in sorted(per_class.items()):
+        summary[cls] = {
+            "n": a["n"],
+            "class_agree": a["class_agree"],
+            "mean_single_prompt": a["single_prompt"] / a["n"],
+            "mean_two_stage_prompt": a["two_stage_prompt"] / a["n"],
+            "mean_single_output": a["single_output"] / a["n"],
+            "mean_two_stage_output": a["two_stage_output"] / a["n"],
+            "prompt_saving": _saving(a["single_prompt"], a["two_stage_prompt"]),
+            "output_saving": _saving(a["single_output"], a["two_stage_output"]),
+        }
+    return {"model": model, "budget": repr(resolve_budget(budget)), "per_class": summary, "images": rows,
+            "server_usage": get_client().usage_stats()}
+
+
+def _list_images(d: str) -> List[str]:
+    exts = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff"}
+    return sorted(os.path.join(d, n) for n in os.listdir(d) if os.path.splitext(n)[1].lower() in exts)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("images", nargs="*")
+    ap.add_argument("--dir")
+    ap.add_argument("--model", default="qwen2.5vl:7b")
+    ap.add_argument("--budget", default=None, help="vision_budget 預設名稱（low/medium/high/full）")
+    ap.add_argument("--report", help="與單階段比較 token 用量，結果寫入此 JSON 檔")
+    args = ap.parse_args()
+
+    paths = list(args.images) + (_list_images(args.dir) if args.dir else [])
+    if not paths:
+        ap.error("請給影像路徑或 --dir")
+
+    if args.report:
+        report = compare(paths, args.model, args.budget)
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print("\n類別                  n   prompt 單→兩 (節省)          output 單→兩 (節省)")
+        for cls, s in report["per_class"].items():
+            ps = f"{s['prompt_saving']:.0%}" if s["prompt_saving"] is not None else "-"
+            os_ = f"{s['output_saving']:.0%}" if s["output_saving"] is not None else "-"
+            print(f"{cls:<20} {s['n']:>3}   {s['mean_single_prompt']:7.0f} → {s['mean_two_stage_prompt']:7.0f} ({ps:>4})"
+                  f"   {s['mean_single_output']:6.0f} → {s['mean_two_stage_output']:6.0f} ({os_:>4})")
+    else:
+        for p in paths:
+            out = two_stage_infer(p, args.model, args.budget)
+            print("====", p, out["doc_class"], "(fallback)" if out["fallback"] else "")
+            print(out["content"])
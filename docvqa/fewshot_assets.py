@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+few-shot 範例影像的延遲載入資產庫。
+
+- 第一次用到才 base64 編碼（import docvqa_final2 不再讀檔/編碼）
+- 編碼結果連同內容雜湊寫到快取目錄的單一檔案 assets.bin（header + index JSON + payload），
+  之後的行程以 mmap 讀取，不必重新編碼；重建時寫暫存檔再 os.replace，index 與 payload 一起換，
+  讀者拿到的一定是同一版的 offset 與內容
+- few_shot_sample/image 底下的檔案變動（大小/mtime 改變且內容雜湊不同、新增、刪除）時自動重建；
+  長時間執行的行程（例如 Streamlit）每 CHECK_INTERVAL_S 秒重新 stat 一次，範例換掉不必重啟
+- 編碼會套用 vision_budget，預算不同則各自一份快取
+
+快取目錄：環境變數 VAT_FEWSHOT_CACHE，預設 ~/.cache/vat_ocr/fewshot
+"""
+
+from __future__ import annotations
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+import hashlib
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))  # 專案根目錄：共用模組
+from vision_budget import encode_image_b64, resolve_budget
+
+FEWSHOT_IMAGE_DIR = Path(__file__).resolve().parent.parent / "few_shot_sample" / "image"
+DEFAULT_CACHE_DIR = Path(os.environ.get(
+    "VAT_FEWSHOT_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "vat_ocr", "fewshot")
+))
+IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff"}
+CHECK_INTERVAL_S = 2.0           # 重新檢查影像檔 stat 的最短間隔
+STORE_FILE = "assets.bin"
+_MAGIC = b"VATFS\x00\x00\x01"
+_HEADER = struct.Struct("<8sQ")  # magic + index JSON 長度；payload 緊接在 index 之後
+
+
+def _sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class FewShotAssetStore:
+    def __init__(self, image_dir: Path = FEWSHOT_IMAGE_DIR, cache_dir: Path = DEFAULT_CACHE_DIR, budget=None,
+                 check_interval: float = CHECK_INTERVAL_S):
+        self.image_dir = Path(image_dir)
+        self.budget = resolve_budget(budget)
+        tag = hashlib.sha256(f"{self.image_dir.resolve()}|{self.budget!r}".encode("utf-8")).hexdigest()[:16]
+        self.cache_dir = Path(cache_dir) / tag
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._index: Optional[Dict[str, dict]] = None
+        self._snapshot: Tuple[Dict[str, dict], Optional[mmap.mmap]] = ({}, None)   # 同一版的 (index, mmap)
+        self._checked = 0.0      # 上次檢查影像檔 stat 的時間（time.monotonic）
+        self.version = 0         # 內容每變一次 +1（呼叫端可據此丟掉自己的快取）
+        self.rebuilt = 0         # 本行程內重新編碼的檔案數（量測用）
+
+    # ---- 內部 --------------------------------------------------------------
+    def _scan(self) -> Dict[str, os.stat_result]:
+        if not self.image_dir.is_dir():
+            return {}
+        return {p.name: p.stat() for p in sorted(self.image_dir.iterdir())
+                if p.is_file() and p.suffix.lower() in IMAGE_EXTS}
+
+    def _read_store(self) -> Tuple[Dict[str, dict], Optional[mmap.mmap]]:
+        """一次 open 同時取得 index 與 payload；offset 已換算成檔案內的絕對位置。"""
+        path = self.cache_dir / STORE_FILE
+        try:
+            with open(path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):      # 不存在或空檔
+            return {}, None
+        try:
+            magic, n = _HEADER.unpack_from(mm, 0)
+            if magic != _MAGIC:
+                raise ValueError("bad magic")
+            index = json.loads(mm[_HEADER.size:_HEADER.size + n].decode("utf-8"))
+        except Exception:
+            mm.close()
+            return {}, None
+        base = _HEADER.size + n
+        for e in index.values():
+            e["offset"] += base
+        return index, mm
+
+    @staticmethod
+    def _fresh(index: Dict[str, dict], files: Dict[str, os.stat_result]) -> bool:
+        return index.keys() == files.keys() and all(
+            index[n]["size"] == st.st_size and index[n]["mtime_ns"] == st.st_mtime_ns for n, st in files.items())
+
+    def _ensure_loaded(self) -> None:
+        if self._index is not None and time.monotonic() - self._checked < self.check_interval:
+            return
+        with self._lock:
+            if self._index is not None and time.monotonic() - self._checked < self.check_interval:
+                return
+            files = self._scan()
+            if self._index is None or not self._fresh(self._index, files):
+                self._load(files)
+            self._checked = time.monotonic()
+
+    def _load(self, files: Dict[str, os.stat_result]) -> None:
+        index, mm = self._read_store()
+        stale = set(index) - set(files)   # 已刪除的檔案
+        touched = False
+        for name, st in files.items():
+            e = index.get(name)
+            if e is None:
+                stale.add(name); continue
+            if e["size"] == st.st_size and e["mtime_ns"] == st.st_mtime_ns:
+                continue
+            # 大小/mtime 變了才算雜湊；內容沒變只更新 stat
+            if _sha256(self.image_dir / name) == e["sha256"]:
+                e["size"], e["mtime_ns"] = st.st_size, st.st_mtime_ns
+                touched = True
+            else:
+                stale.add(name)
+
+        if stale or touched or (mm is None and files):
+            # index 與 payload 來自同一個檔案，offset 一定對得上同一版內容，可以放心沿用
+            reuse = {n: bytes(mm[e["offset"]:e["offset"] + e["length"]])
+                     for n, e in index.items() if n not in stale and n in files} if mm is not None else {}
+            index, mm = self._rebuild(files, reuse, index)
+
+        old = self._index
+        # 一次換掉 (index, mmap)；舊的 mmap 不主動 close：其他執行緒可能正在讀，交給 GC 回收
+        self._snapshot = (index, mm)
+        self._index = index
+        if old is not None and {n: e["sha256"] for n, e in old.items()} != {n: e["sha256"] for n, e in index.items()}:
+            self.version += 1
+
+    def _rebuild(self, files: Dict[str, os.stat_result], reuse: Dict[str, bytes], known: Dict[str, dict]):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        index: Dict[str, dict] = {}
+        payloads = []
+        offset = 0
+        for name, st in files.items():
+            path = self.image_dir / name
+            data = reuse.get(name)
+            if data is None:
+                data = encode_image_b64(str(path), self.budget).encode("ascii")
+                self.rebuilt += 1
+                digest = _sha256(path)
+            else:
+                digest = known[name]["sha256"]
+            payloads.append(data)
+            index[name] = {"sha256": digest, "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+                           "offset": offset, "length": len(data)}
+            offset += len(data)
+        header = json.dumps(index).encode("utf-8")
+        tmp = self.cache_dir / f"{STORE_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as out:
+            out.write(_HEADER.pack(_MAGIC, len(header)))
+            out.write(header)
+            for data in payloads:
+                out.write(data)
+        # index 與 payload 同一個檔案一次換掉：併發讀者看到的不是整份舊版就是整份新版
+        os.replace(tmp, self.cache_dir / STORE_FILE)
+        return self._read_store()
+
+    # ---- 對外介面 ----------------------------------------------------------
+    def names(self):
+        self._ensure_loaded()
+        return list(self._index)
+
+    def get_b64(self, name: str) -> Optional[str]:
+        """檔名（例如 '1_business_invoice.jpg'）→ base64 字串；檔案不存在回傳 None。"""
+        self._ensure_loaded()
+        index, mm = self._snapshot
+        e = index.get(name)
+        if e is None or mm is None:
+            return None
+        return mm[e["offset"]:e["offset"] + e["length"]].decode("ascii")
+
+    def current_version(self) -> int:
+        """檢查影像檔（依 check_interval 節流）後回傳 version。"""
+        self._ensure_loaded()
+        return self.version
+
+    def sha256(self, name: str) -> Optional[str]:
+        self._ensure_loaded()
+        e = self._index.get(name)
+        return e["sha256"] if e else None
+
+
+_stores: Dict[str, FewShotAssetStore] = {}
+
+
+def get_store(budget=None) -> FewShotAssetStore:
+    b = resolve_budget(budget)
+    key = repr(b)
+    if key not in _stores:
+        _stores[key] = FewShotAssetStore(budget=b)
+    return _stores[key]
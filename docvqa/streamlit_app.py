@@ -2,10 +2,19 @@
 # Streamlit app to query Ollama Qwen2.5-VL with an uploaded image and a question
 
 import streamlit as st
-import base64
-import requests
 import time
 import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))  # 專案根目錄：共用模組
+sys.path.insert(0, str(Path(__file__).resolve().parent))         # docvqa/：docvqa_final2
+from vision_budget import PRESETS, DEFAULT_BUDGET, encode_bytes_b64
+from ollama_client import get_client, OllamaError
+from extraction_cache import ExtractionCache, hash_bytes, make_key
+from json_repair import repair_json
+
+ANSWER_CACHE_SIZE = 256   # 問答快取筆數上限（LRU 淘汰）
 
 st.set_page_config(page_title="DocVQA - 文件問答", page_icon="🧾")
 
@@ -26,6 +35,21 @@ with st.sidebar:
     )
     temperature = st.slider("temperature", 0.0, 1.0, 0.0, 0.1)
     timeout_s = st.number_input("請求逾時（秒）", min_value=10, max_value=600, value=120, step=10)
+    budget_names = list(PRESETS)
+    budget_name = st.selectbox(
+        "影像解析度預算",
+        budget_names,
+        index=budget_names.index(DEFAULT_BUDGET.name) if DEFAULT_BUDGET.name in budget_names else budget_names.index("full"),
+        help="縮小影像可大幅減少 vision token 與推理時間；full 為原圖。",
+    )
+    mode = st.radio("模式", ["文件問答", "多題問答", "結構化抽取"], horizontal=True,
+                    help="多題問答：每行一題，一次請求回答全部問題（影像只送一次）；"
+                         "結構化抽取：分類並輸出發票欄位，欄位一產生就顯示並即時做格式檢查。")
+    use_cache = st.checkbox("回答快取", value=True,
+                            help="同一張圖 + 同一問題 + 同模型/temperature/解析度預算直接回傳先前的回答，不再呼叫模型。")
+    stream_on = st.checkbox("串流顯示", value=True, help="邊產生邊顯示，不必等整段回答完成。")
+    max_bad = st.number_input("不合格欄位達幾個即取消（0 = 不取消）", min_value=0, max_value=10, value=2,
+                              help="結構化抽取時，逐欄格式檢查（同 check_compliance 規則）不合格的欄位數達此值就中止生成。")
     st.markdown("---")
     st.markdown("**小提示**：請先確保已在終端機執行 `ollama run qwen2.5vl:7b` 或 `ollama pull qwen2.5vl:7b` 下載模型。")
 
@@ -33,26 +57,47 @@ st.subheader("步驟 1：上傳影像")
 uploaded = st.file_uploader("支援 jpg / jpeg / png / webp / bmp / tiff / gif（圖片越清晰越好）",
                             type=["jpg","jpeg","png","webp","bmp","tiff","gif"])
 
-# === 影像預覽：上傳後即顯示在頁面 ===
-file_bytes = None
+@st.cache_data(max_entries=8, show_spinner=False)
+def encode_image_to_b64(file_bytes: bytes, budget=None) -> str:
+    """縮圖 + base64：同一張上傳影像與預算只編碼一次（Streamlit 每次 rerun 直接取用）。"""
+    return encode_bytes_b64(file_bytes, budget)
+
+
+@st.cache_resource
+def answer_cache() -> ExtractionCache:
+    """問答快取：行程內共用、只放記憶體，超過 ANSWER_CACHE_SIZE 筆淘汰最久未用的回答。"""
+    return ExtractionCache(db_path=None, max_memory_items=ANSWER_CACHE_SIZE)
+
+
+def answer_key(image_hash: str, question: str, model: str, temperature: float, budget_name: str) -> str:
+    # 單題與多題共用同一把 key：多題問過的問題，單題再問也會命中
+    return make_key(image_hash=image_hash, model=model, prompt={"qa": question.strip()},
+                    options={"temperature": float(temperature), "budget": budget_name})
+
+
+# === 影像預覽：上傳後即顯示在頁面；同時先算好雜湊與 base64，之後每個問題直接沿用 ===
+file_bytes = b64_image = image_hash = None
 if uploaded is not None:
     file_bytes = uploaded.getvalue()
     size_kb = len(file_bytes) / 1024
     with st.expander("📷 影像預覽（點此展開/收合）", expanded=True):
         st.image(file_bytes, caption=f"已上傳：{uploaded.name}（{size_kb:.1f} KB）", use_column_width=True)
+    image_hash = hash_bytes(file_bytes)
+    b64_image = encode_image_to_b64(file_bytes, budget_name)
 
 st.subheader("步驟 2：輸入問題")
-question = st.text_input("範例：What is the invoice number? （英文更準確）", value="")
+if mode == "多題問答":
+    questions_text = st.text_area("每行一個問題（英文更準確）", value="",
+                                  placeholder="What is the invoice number?\nWhat is the total amount?")
+    question = ""
+else:
+    question = st.text_input("範例：What is the invoice number? （英文更準確）", value="",
+                             disabled=(mode == "結構化抽取"))
 
 go = st.button("🚀 送出查詢")
 
-def encode_image_to_b64(file_bytes: bytes) -> str:
-    return base64.b64encode(file_bytes).decode("utf-8")
-
-def ask_ollama(server_url: str, model: str, b64_image: str, question: str, temperature: float, timeout_s: int):
-    payload = {
-        "model": model,
-        "stream": False,
+def _qa_payload(b64_image: str, question: str, temperature: float) -> dict:
+    return {
         "options": {"temperature": float(temperature)},
         "messages": [
             {"role": "system", "content": "You are a document QA assistant. Reply with the exact text span from the document only."},
@@ -60,42 +105,233 @@ def ask_ollama(server_url: str, model: str, b64_image: str, question: str, tempe
             {"role": "user", "content": question}
         ]
     }
+
+
+def ask_ollama(server_url: str, model: str, b64_image: str, question: str, temperature: float, timeout_s: int):
+    payload = _qa_payload(b64_image, question, temperature)
+    # 同一個 server_url 共用連線池（Streamlit 每次 rerun 不必重新建立連線）；5xx/連線錯誤會自動重試
+    client = get_client(server_url)
     start_time = time.time()
     try:
-        r = requests.post(server_url, json=payload, timeout=timeout_s)
-    except requests.exceptions.RequestException as e:
-        return {"error": f"連線錯誤：{e}"}, 0.0
+        data = client.chat(model, payload["messages"], options=payload["options"], deadline=timeout_s,
+                           strategy="streamlit_qa")
+    except OllamaError as e:
+        return {"error": f"連線錯誤：{e}" if e.status is None else str(e)}, time.time() - start_time
+    except ValueError as e:
+        return {"error": f"無法解析回應：{e}"}, time.time() - start_time
 
     elapsed = time.time() - start_time
+    return data, elapsed
 
-    if r.status_code != 200:
-        return {"error": f"HTTP {r.status_code}: {r.text}"}, elapsed
 
+def _multi_payload(b64_image: str, questions: list, temperature: float) -> dict:
+    numbered = "\n".join(f"{i}. {q}" for i, q in enumerate(questions, 1))
+    return {
+        "options": {"temperature": float(temperature)},
+        "messages": [
+            {"role": "system", "content": "You are a document QA assistant. Answer each question with the exact text span from the document only."},
+            {"role": "user", "content": "If an answer is not found, use `unknown`. Reply with one JSON object mapping each "
+                                        "question number to its answer, e.g. {\"1\": \"...\", \"2\": \"...\"}.",
+             "images": [b64_image]},
+            {"role": "user", "content": numbered}
+        ]
+    }
+
+
+def _answers_schema(n: int) -> dict:
+    keys = [str(i) for i in range(1, n + 1)]
+    return {"type": "object", "properties": {k: {"type": "string"} for k in keys}, "required": keys}
+
+
+def ask_ollama_multi(server_url: str, model: str, b64_image: str, questions: list, temperature: float, timeout_s: int):
+    """
+    多題一次請求：回傳 ({"answers": [...], "response": 原始回應}, elapsed)；錯誤時 ({"error": ...}, elapsed)。
+    模型 JSON 裡缺少的題號回答為 None（不是模型說的 unknown，不可寫進快取）。
+    """
+    payload = _multi_payload(b64_image, questions, temperature)
+    start_time = time.time()
     try:
-        data = r.json()
-    except json.JSONDecodeError:
-        return {"error": f"無法解析回應：{r.text[:500]}..."}, elapsed
+        data = get_client(server_url).chat_json(model, payload["messages"], fmt=_answers_schema(len(questions)),
+                                                options=payload["options"], deadline=timeout_s,
+                                                strategy="streamlit_multi_qa")
+    except OllamaError as e:
+        return {"error": f"連線錯誤：{e}" if e.status is None else str(e)}, time.time() - start_time
+    except ValueError as e:
+        return {"error": f"無法解析回應：{e}"}, time.time() - start_time
 
-    return data, elapsed
+    obj = repair_json((data.get("message") or {}).get("content", ""))[1]
+    if not isinstance(obj, dict) or set(obj) == {"raw"}:
+        return {"error": "模型未回傳可解析的 JSON", "response": data}, time.time() - start_time
+    answers = [None if obj.get(str(i)) is None else str(obj[str(i)]).strip() for i in range(1, len(questions) + 1)]
+    return {"answers": answers, "response": data}, time.time() - start_time
+
+
+def stream_answer(server_url: str, model: str, b64_image: str, question: str, temperature: float, timeout_s: int):
+    """串流問答：回答文字逐段寫進 placeholder；回傳 (data, elapsed)，data 與 ask_ollama 相同格式。"""
+    payload = _qa_payload(b64_image, question, temperature)
+    placeholder = st.empty()
+    start_time = time.time()
+    parts, last = [], {}
+    try:
+        for chunk in get_client(server_url).chat_stream(model, payload["messages"], options=payload["options"],
+                                                        deadline=timeout_s, strategy="streamlit_qa"):
+            parts.append((chunk.get("message") or {}).get("content", ""))
+            placeholder.info("".join(parts) + " ▌")
+            last = chunk
+    except OllamaError as e:
+        placeholder.empty()
+        return {"error": f"連線錯誤：{e}" if e.status is None else str(e)}, time.time() - start_time
+    placeholder.empty()
+    data = {**last, "message": {"role": "assistant", "content": "".join(parts)}}
+    return data, time.time() - start_time
+
+
+def _render_metrics(m):
+    if m:
+        st.caption(f"prompt {m['prompt_tokens']} tokens / {m['prompt_eval_s']:.2f}s · "
+                   f"輸出 {m['output_tokens']} tokens（{m['decode_tok_s'] or 0:.1f} tok/s）· "
+                   f"載入 {m['load_s']:.2f}s{'（冷載入）' if m['cold_load'] else ''}")
 
-if go:
+
+def _render_fields(placeholder, events):
+    rows = ["| 欄位 | 值 | 檢查 |", "|---|---|---|"]
+    for ev in events:
+        mark = "" if ev.ok is None else ("✅" if ev.ok else "❌")
+        rows.append(f"| {'.'.join(ev.path)} | {json.dumps(ev.value, ensure_ascii=False)} | {mark} |")
+    placeholder.markdown("\n".join(rows))
+
+
+def run_extraction(server_url: str, model: str, b64_image: str, stream_on: bool, max_bad: int, timeout_s: int):
+    """結構化抽取：欄位一閉合就加到表格；不合格欄位達 max_bad 個即取消生成。"""
+    import docvqa_final2
+    from VAT_OCR import repair_json, flatten_sections, check_compliance
+
+    start_time = time.time()
+    placeholder = st.empty()
+    stream = docvqa_final2.stream_image_fields(model=model, b64_image=b64_image, max_bad=int(max_bad),
+                                               host=server_url, deadline=timeout_s)
+    try:
+        if stream_on:
+            for _ in stream:
+                _render_fields(placeholder, stream.fields)
+        else:
+            with st.spinner("模型推理中，請稍候…"):
+                for _ in stream:
+                    pass
+            _render_fields(placeholder, stream.fields)
+    except OllamaError as e:
+        st.error(f"連線錯誤：{e}" if e.status is None else str(e))
+        return
+    elapsed = time.time() - start_time
+
+    if stream.cancelled:
+        st.warning(f"已提早取消生成：{stream.reason}")
+        return
+    obj = stream.result if stream.result is not None else repair_json(stream.text)[1]
+    comp, _ = check_compliance(flatten_sections(obj))
+    st.caption(f"執行時間：{elapsed:.2f} 秒（{len(stream.fields)} 個欄位）")
+    with st.expander("合規檢查", expanded=not all(v for v in comp.values() if isinstance(v, bool))):
+        st.json(comp)
+    with st.expander("檢視完整 JSON"):
+        st.code(json.dumps(obj, ensure_ascii=False, indent=2), language="json")
+
+
+def run_multi_qa(questions: list, cache):
+    """多題問答：快取命中的問題直接回答，其餘合併成一次請求；模型確實回答的題目逐題寫回快取。"""
+    keys = [answer_key(image_hash, q, model, temperature, budget_name) for q in questions]
+    answers, sources = [None] * len(questions), [""] * len(questions)
+    if cache is not None:
+        for i, k in enumerate(keys):
+            hit, value = cache.get(k)
+            if hit:
+                answers[i], sources[i] = value, "快取"
+    todo = [i for i, a in enumerate(answers) if a is None]
+    data, elapsed = {}, 0.0
+    if todo:
+        with st.spinner(f"模型推理中（{len(todo)} 題一次送出），請稍候…"):
+            data, elapsed = ask_ollama_multi(server_url, model, b64_image, [questions[i] for i in todo],
+                                             temperature, int(timeout_s))
+        if "error" in data:
+            st.error(data["error"])
+        else:
+            for i, a in zip(todo, data["answers"]):
+                if a is None:
+                    sources[i] = "❌ 模型未回答"
+                    continue
+                answers[i], sources[i] = a, "模型"
+                if cache is not None:
+                    cache.put(keys[i], a)
+            missing = sum(a is None for a in data["answers"])
+            if missing:
+                st.warning(f"{missing} 題模型沒有回答（未寫入快取），再送出一次會只重問這幾題。")
+
+    rows = ["| # | 問題 | 回答 | 來源 |", "|---|---|---|---|"]
+    for i, (q, a, src) in enumerate(zip(questions, answers, sources), 1):
+        cell = "" if a is None else a
+        rows.append(f"| {i} | {q.replace('|', '¦')} | {cell.replace('|', '¦')} | {src} |")
+    st.markdown("\n".join(rows))
+    if todo and "error" not in data:
+        st.caption(f"執行時間：{elapsed:.2f} 秒（{len(todo)} 題一次請求，{len(questions) - len(todo)} 題快取命中）")
+        _render_metrics(data["response"].get("metrics"))
+    elif not todo:
+        st.caption(f"全部 {len(questions)} 題快取命中，未呼叫模型")
+    if data.get("response"):
+        with st.expander("檢視原始回應 JSON"):
+            st.code(json.dumps(data["response"], ensure_ascii=False, indent=2), language="json")
+
+
+cache = answer_cache() if use_cache else None
+if go and mode == "結構化抽取":
+    if uploaded is None:
+        st.warning("請先上傳一張影像。")
+    else:
+        run_extraction(server_url, model, b64_image, stream_on, max_bad, int(timeout_s))
+elif go and mode == "多題問答":
+    questions = list(dict.fromkeys(q.strip() for q in questions_text.splitlines() if q.strip()))
+    if uploaded is None:
+        st.warning("請先上傳一張影像。")
+    elif not questions:
+        st.warning("請輸入至少一個問題。")
+    else:
+        run_multi_qa(questions, cache)
+elif go:
     if uploaded is None:
         st.warning("請先上傳一張影像。")
     elif not question.strip():
         st.warning("請輸入問題。")
     else:
-        b64 = encode_image_to_b64(uploaded.getvalue())
-        with st.spinner("模型推理中，請稍候…"):
-            data, elapsed = ask_ollama(server_url, model, b64, question.strip(), temperature, int(timeout_s))
-
-        if "error" in data:
-            st.error(data["error"])
-        else:
-            answer = (data.get("message") or {}).get("content", "").strip()
+        key = answer_key(image_hash, question, model, temperature, budget_name)
+        hit, answer = cache.get(key) if cache is not None else (False, None)
+        if hit:
             st.success(f"回答：{answer}")
-            st.caption(f"執行時間：{elapsed:.2f} 秒")
+            st.caption("快取命中，未呼叫模型")
+        else:
+            if stream_on:
+                data, elapsed = stream_answer(server_url, model, b64_image, question.strip(), temperature,
+                                              int(timeout_s))
+            else:
+                with st.spinner("模型推理中，請稍候…"):
+                    data, elapsed = ask_ollama(server_url, model, b64_image, question.strip(), temperature,
+                                               int(timeout_s))
+
+            if "error" in data:
+                st.error(data["error"])
+            else:
+                answer = (data.get("message") or {}).get("content", "").strip()
+                if cache is not None:
+                    cache.put(key, answer)
+                st.success(f"回答：{answer}")
+                st.caption(f"執行時間：{elapsed:.2f} 秒")
+                _render_metrics(data.get("metrics"))
+
+                with st.expander("檢視原始回應 JSON"):
+                    st.code(json.dumps(data, ensure_ascii=False, indent=2), language="json")
 
-            with st.expander("檢視原始回應 JSON"):
-                st.code(json.dumps(data, ensure_ascii=False, indent=2), language="json")
+if cache is not None:
+    c = cache.stats()
+    with st.sidebar:
+        st.caption(f"回答快取：{c['memory_items']}/{ANSWER_CACHE_SIZE} 筆，命中率 {c['hit_rate']:.0%}（{c['lookups']} 次查詢）")
+        if st.button("清除回答快取"):
+            cache.clear()
 
 
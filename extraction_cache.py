@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+以內容定址的抽取結果快取（同一張發票重傳 / 批次重跑時不再重跑模型）。
+
+key = sha256(影像位元組) + 模型名稱/digest + prompt + 解碼參數 的雜湊。
+兩層：
+  1) 記憶體 LRU（OrderedDict，依筆數上限淘汰）
+  2) SQLite 永久層（依總位元組上限淘汰最久未用的列）
+同一個 key 同時有多個請求時只跑一次模型，其他請求等待同一個結果（in-flight 合併）。
+回傳給呼叫端的一律是副本：呼叫端修改結果（例如改寫 gt_parse）不會回頭改到快取內容。
+
+用法：
+    from extraction_cache import get_default_cache, make_key
+    cache = get_default_cache()
+    key = make_key(image_path=p, model="VAT_model", prompt=INSTRUCTION, options={...})
+    result = cache.get_or_compute(key, lambda: expensive_call(p))
+    print(cache.stats())
+
+入口函式（VAT_OCR.chat_once、docvqa_final2.infer_image_json、classify_image）皆有 cache 參數：
+None = 行程共用快取，False = 不使用，或傳入自建的 ExtractionCache。
+
+環境變數：VAT_CACHE_PATH（SQLite 檔，預設 ~/.cache/vat_ocr/extractions.sqlite3）、
+          VAT_CACHE_DISABLE=1 關閉快取。
+"""
+
+from __future__ import annotations
+import os
+import copy
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional
+
+DEFAULT_DB_PATH = os.environ.get(
+    "VAT_CACHE_PATH", os.path.join(os.path.expanduser("~"), ".cache", "vat_ocr", "extractions.sqlite3")
+)
+
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_key(image_path: Optional[str] = None, image_bytes: Optional[bytes] = None,
+             model: str = "", prompt: Any = "", options: Optional[dict] = None,
+             image_hash: Optional[str] = None) -> str:
+    """
+    影像內容 + 模型 + prompt + 解碼參數 → 快取 key。
+    prompt 可以是字串或可 JSON 序列化的結構（例如 messages 不含影像的部分）。
+    image_hash：已算好的 hash_bytes / hash_file 結果（同一張圖問多個問題時不必重複雜湊）。
+    """
+    if image_hash is not None:
+        img_hash = image_hash
+    elif image_bytes is not None:
+        img_hash = hash_bytes(image_bytes)
+    elif image_path is not None:
+        img_hash = hash_file(image_path)
+    else:
+        raise ValueError("需要 image_path、image_bytes 或 image_hash")
+    payload = json.dumps(
+        {"image": img_hash, "model": model, "prompt": prompt, "options": options or {}},
+        ensure_ascii=False, sort_keys=True, default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ExtractionCache:
+    def __init__(self, db_path: Optional[str] = DEFAULT_DB_PATH, max_memory_items: int = 1024,
+                 max_disk_bytes: int = 256 * 1024 * 1024):
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self._mem: "OrderedDict[str, Any]" = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0,
+                          "evicted_memory": 0, "evicted_disk": 0, "errors": 0}
+
+        self._db = None
+        if db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS extractions ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,"
+                " created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_accessed ON extractions(accessed)")
+
+    # ---- 記憶體層 ----------------------------------------------------------
+    # 記憶體層存的是快取自己的副本，取出時也給副本（與 SQLite 層每次 json.loads 出新物件一致）
+    def _mem_get(self, key: str):
+        if key in self._mem:
+            self._mem.move_to_end(key)
+            return True, self._mem[key]
+        return False, None
+
+    def _mem_put(self, key: str, value: Any) -> None:
+        self._mem[key] = value
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_memory_items:
+            self._mem.popitem(last=False)
+            self._counters["evicted_memory"] += 1
+
+    # ---- SQLite 層 ---------------------------------------------------------
+    def _disk_get(self, key: str):
+        if self._db is None:
+            return False, None
+        with self._db_lock:
+            row = self._db.execute("SELECT value FROM extractions WHERE key=?", (key,)).fetchone()
+            if row is None:
+                return False, None
+            self._db.execute("UPDATE extractions SET accessed=? WHERE key=?", (time.time(), key))
+        return True, json.loads(row[0])
+
+    def _disk_put(self, key: str, value: Any) -> None:
+        if self._db is None:
+            return
+        text = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO extractions(key, value, size, created, accessed) VALUES (?,?,?,?,?)",
+                (key, text, len(text.encode("utf-8")), now, now),
+            )
+            self._evict_disk_locked()
+
+    def _evict_disk_locked(self) -> None:
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM extractions").fetchone()[0]
+        if total <= self.max_disk_bytes:
+            return
+        # 依最久未存取淘汰，直到低於上限
+        for key, size in self._db.execute("SELECT key, size FROM extractions ORDER BY accessed ASC").fetchall():
+            if total <= self.max_disk_bytes:
+                break
+            self._db.execute("DELETE FROM extractions WHERE key=?", (key,))
+            total -= size
+            self._counters["evicted_disk"] += 1
+
+    # ---- 對外介面 ----------------------------------------------------------
+    def get(self, key: str):
+        """回傳 (是否命中, 值)。"""
+        with self._lock:
+            hit, value = self._mem_get(key)
+            if hit:
+                self._counters["memory_hits"] += 1
+                return True, copy.deepcopy(value)
+        hit, value = self._disk_get(key)
+        if hit:
+            with self._lock:
+                self._counters["disk_hits"] += 1
+                self._mem_put(key, copy.deepcopy(value))
+        return hit, value
+
+    def put(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._mem_put(key, copy.deepcopy(value))
+        self._disk_put(key, value)
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any]) -> Any:
+        """
+        命中直接回傳；未命中時只有第一個請求執行 compute()，
+        同 key 的並行請求等待同一個 Future（例外也會一併傳給等待者，且不寫入快取）。
+        """
+        hit, value = self.get(key)
+        if hit:
+            return value
+
+        with self._lock:
+            # 在 get() 與取得鎖之間，別的請求可能剛算完並寫入記憶體層
+            hit, value = self._mem_get(key)
+            if hit:
+                self._counters["memory_hits"] += 1
+                return copy.deepcopy(value)
+            fut = self._inflight.get(key)
+            owner = fut is None
+            if owner:
+                fut = Future()
+                self._inflight[key] = fut
+                self._counters["misses"] += 1
+            else:
+                self._counters["coalesced"] += 1
+
+        if not owner:
+            return copy.deepcopy(fut.result())   # 與第一個請求拿到的物件分開
+
+        try:
+            value = compute()
+            self.put(key, value)
+        except BaseException as e:
+            with self._lock:
+                self._counters["errors"] += 1
+                self._inflight.pop(key, None)
+            fut.set_exception(e)
+            raise
+        with self._lock:
+            self._inflight.pop(key, None)
+        fut.set_result(value)
+        return value
+
+    def stats(self) -> dict:
+        with self._lock:
+            c = dict(self._counters)
+            c["memory_items"] = len(self._mem)
+        lookups = c["memory_hits"] + c["disk_hits"] + c["misses"] + c["coalesced"]
+        c["lookups"] = lookups
+        c["hit_rate"] = (c["memory_hits"] + c["disk_hits"] + c["coalesced"]) / lookups if lookups else 0.0
+        if self._db is not None:
+            with self._db_lock:
+                n, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM extractions").fetchone()
+            c["disk_items"], c["disk_bytes"] = n, size
+        return c
+
+    def clear(self) -> None:
+        with self._lock:
+            self._mem.clear()
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute("DELETE FROM extractions")
+
+
+_default_cache: Optional[ExtractionCache] = None
+_default_lock = threading.Lock()
+
+
+def get_default_cache() -> Optional[ExtractionCache]:
+    """行程共用的快取；VAT_CACHE_DISABLE=1 時回傳 None（呼叫端直接跑模型）。"""
+    global _default_cache
+    if os.environ.get("VAT_CACHE_DISABLE") == "1":
+        return None
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = ExtractionCache()
+        return _default_cache
+
+
+def resolve_cache(cache) -> Optional[ExtractionCache]:
+    """入口函式的 cache 參數：None → 行程共用快取；False → 不用快取；或直接給 ExtractionCache。"""
+    if cache is False:
+        return None
+    if cache is None or cache is True:
+        return get_default_cache()
+    return cache
+
+
+def cached_call(cache, key_fn: Callable[[], str], compute: Callable[[], Any]) -> Any:
+    """關閉快取時直接 compute()；否則走 get_or_compute。key_fn 延後計算，關閉快取時不必雜湊影像。"""
+    cache = resolve_cache(cache)
+    if cache is None:
+        return compute()
+    return cache.get_or_compute(key_fn(), compute)
+
+
+ADAPTER_FILES = ("adapter_model.safetensors", "adapter_config.json")
+
+
+def model_dir_digest(path: str) -> str:
+    """
+    本地模型目錄的內容雜湊：adapter_model.safetensors + adapter_config.json（合併後的完整模型則用
+    *.safetensors + config.json）。重新訓練寫回同一個目錄後 key 就會改變；不是目錄時回傳原字串。
+    權重檔可能很大，呼叫端應在載入模型時算一次並保存結果。
+    """
+    if not os.path.isdir(path):
+        return path
+    names = [n for n in ADAPTER_FILES if os.path.isfile(os.path.join(path, n))]
+    if not names:
+        names = sorted(n for n in os.listdir(path) if n.endswith(".safetensors") or n == "config.json")
+    h = hashlib.sha256()
+    for n in names:
+        h.update(n.encode("utf-8"))
+        h.update(hash_file(os.path.join(path, n)).encode("ascii"))
+    return f"{os.path.basename(os.path.normpath(path))}@{h.hexdigest()}"
+
+
+_OLLAMA_DIGESTS: Dict[tuple, str] = {}
+_OLLAMA_DIGESTS_LOCK = threading.Lock()
+
+
+def ollama_model_digest(model: str, host: Optional[str] = None) -> str:
+    """
+    查 Ollama /api/tags 取得模型 digest（模型更新後 key 自動改變）；查不到就回傳模型名稱。
+    經由 ollama_client.get_client(host)（共用連線池與重試）。只快取查到的 digest：
+    伺服器暫時連不上、或模型還沒 pull 時，下次呼叫會再查一次，不會整個行程都用裸模型名稱當 key。
+    """
+    from ollama_client import OllamaError, get_client
+    client = get_client(host)
+    key = (client.host, model)
+    with _OLLAMA_DIGESTS_LOCK:
+        if key in _OLLAMA_DIGESTS:
+            return _OLLAMA_DIGESTS[key]
+    try:
+        tags = client.tags(deadline=5.0)
+    except (OllamaError, ValueError):
+        return model
+    for m in tags.get("models", []):
+        if model in (m.get("name"), m.get("model")) and m.get("digest"):
+            digest = f"{model}@{m['digest']}"
+            with _OLLAMA_DIGESTS_LOCK:
+                _OLLAMA_DIGESTS[key] = digest
+            return digest
+    return model
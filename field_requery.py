@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""
+合規檢查失敗時「只重問出錯的欄位」：不必整張重跑（完整 prompt + 全部 vision token + 整份 JSON）。
+
+流程：
+  1) check_compliance 的結果 → plan_requery() 挑出要重問的欄位
+       - 格式/必填不通過的欄位（例：InvoiceNumber 不是 8 碼）
+       - @rule:TotalAmount_equals_SalesTotal_plus_SalesTax 不成立 → 三個金額一起重問
+       - Doc_class 錯、或出錯欄位超過 max_fields → 不重問，標記需要整張重跑
+  2) 組一段只列這些欄位的短 prompt（附上次讀到的值），答案格式以只含這些 key 的小 schema 約束：
+       本地模型 → json_constraint 約束解碼；Ollama → format 直接給 schema（不帶 few-shot）
+  3) crop=True 時只送欄位所在區域的裁切（依文件類別的版面粗估，見 REGIONS），vision token 更少、細節更清楚
+  4) 新值通過 check_field 才合併回原結果，再跑一次 check_compliance；max_rounds 控制最多重問幾輪
+
+用法：
+    from field_requery import requery_repair, RequeryStats
+    stats = RequeryStats()
+    merged, report = requery_repair(img_path, result, backend="local", crop=True, stats=stats)
+    stats.summary()   # 避免的整張重跑次數、每張修正文件的延遲等
+"""
+
+from __future__ import annotations
+import io
+import json
+import time
+import statistics
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from compliance import FIELDS, SUM_RULE, check_field, get_engine
+from json_constraint import GT_PARSE_SCHEMA
+from json_repair import repair_json
+from vision_budget import encode_bytes_b64
+
+_AMOUNTS = ("SalesTotalAmount", "SalesTax", "TotalAmount")
+_FIELD_SCHEMAS = GT_PARSE_SCHEMA["properties"]["gt_parse"]["properties"]
+
+# 每個欄位在短 prompt 裡的說明
+FIELD_PROMPTS: Dict[str, str] = {
+    "PrefixTwoLetters":   "發票號碼前的兩個大寫英文字母（字軌），例如 KY",
+    "InvoiceNumber":      "字軌後的發票號碼，8 位數字",
+    "InvoiceYear":        "發票年份（民國年 2~3 碼或西元年 4 碼）",
+    "InvoiceMonth":       "發票月份（1~12）",
+    "InvoiceDay":         "發票日期的「日」（1~31）",
+    "BuyerName":          "買受人名稱",
+    "BuyerTaxIDNumber":   "買受人統一編號，8 位數字",
+    "CompanyName":        "賣方營業人名稱（統一發票專用章上）",
+    "CompanyAddress":     "賣方地址",
+    "CompanyTaxIDNumber": "賣方統一編號，8 位數字",
+    "PhoneNumber":        "賣方電話",
+    "Abstract":           "品名摘要",
+    "SalesTotalAmount":   "銷售額合計，只寫數字不含逗號",
+    "SalesTax":           "營業稅，只寫數字不含逗號",
+    "TotalAmount":        "總計，只寫數字不含逗號；應等於銷售額合計＋營業稅",
+}
+
+# 欄位所在區域（相對座標 x0, y0, x1, y1），依文件類別；只是粗估，裁切時會再外擴 CROP_MARGIN
+_TOP = (0.0, 0.0, 1.0, 0.4)
+_UPPER = (0.0, 0.05, 1.0, 0.5)
+_MIDDLE = (0.0, 0.2, 1.0, 0.85)
+_BOTTOM = (0.0, 0.5, 1.0, 1.0)
+REGIONS: Dict[str, Dict[str, Tuple[float, float, float, float]]] = {
+    "triple_invoice": {   # 預設：字軌/日期/買方在上，品名居中，金額與賣方專用章在下
+        "PrefixTwoLetters": _TOP, "InvoiceNumber": _TOP,
+        "InvoiceYear": _TOP, "InvoiceMonth": _TOP, "InvoiceDay": _TOP,
+        "BuyerName": _UPPER, "BuyerTaxIDNumber": _UPPER, "Abstract": _MIDDLE,
+        "SalesTotalAmount": _BOTTOM, "SalesTax": _BOTTOM, "TotalAmount": _BOTTOM,
+        "CompanyName": _BOTTOM, "CompanyAddress": _BOTTOM, "CompanyTaxIDNumber": _BOTTOM, "PhoneNumber": _BOTTOM,
+    },
+    "triple_receipt": {   # 收銀機發票：賣方資訊在最上方
+        "PrefixTwoLetters": _UPPER, "InvoiceNumber": _UPPER,
+        "InvoiceYear": _UPPER, "InvoiceMonth": _UPPER, "InvoiceDay": _UPPER,
+        "CompanyName": _TOP, "CompanyAddress": _TOP, "CompanyTaxIDNumber": _TOP, "PhoneNumber": _TOP,
+        "BuyerName": _MIDDLE, "BuyerTaxIDNumber": _MIDDLE, "Abstract": _MIDDLE,
+        "SalesTotalAmount": _BOTTOM, "SalesTax": _BOTTOM, "TotalAmount": _BOTTOM,
+    },
+}
+CROP_MARGIN = 0.05
+MAX_CROP_AREA = 0.85     # 區域聯集超過此比例就直接送整張
+
+SYSTEM_PROMPT = "你是發票欄位校對員。只回答被問到的欄位，輸出單一 JSON，看不清楚的欄位填 null。"
+
+FULL_RERUN_DOC_CLASS = "doc_class"
+FULL_RERUN_TOO_MANY = "too_many_fields"
+
+
+# ---- 規劃 -------------------------------------------------------------------
+def plan_requery(compliance: Dict[str, Any], max_fields: int = 6) -> Tuple[List[str], Optional[str]]:
+    """
+    check_compliance 的結果 → (要重問的欄位, 需要整張重跑的原因)。
+    原因為 None 時表示可以只重問欄位（欄位 list 為空 = 全部通過）。
+    """
+    if any(k.lower() == "doc_class" and v is False for k, v in compliance.items()):
+        return [], FULL_RERUN_DOC_CLASS
+    failing = {k for k in FIELDS if compliance.get(k) is False}
+    if compliance.get(SUM_RULE) is False:
+        failing.update(_AMOUNTS)
+    fields = [k for k in FIELDS if k in failing]
+    if len(fields) > max_fields:
+        return fields, FULL_RERUN_TOO_MANY
+    return fields, None
+
+
+def field_schema(fields: Sequence[str]) -> dict:
+    """只含這些欄位的答案 schema（每個 key 都必填，值可為 null）。"""
+    return {
+        "type": "object",
+        "properties": {k: _FIELD_SCHEMAS[k] for k in fields},
+        "required": list(fields),
+        "additionalProperties": False,
+    }
+
+
+def failed_rules(field_name: str, value: Any, compliance: Optional[Dict[str, Any]] = None) -> List[str]:
+    """
+    這個欄位上次沒通過的規則名稱：欄位本身（格式/必填）記為欄位名，金額加總記為 SUM_RULE。
+    有 check_compliance 的結果就照它；沒有時才用 check_field 與金額欄位推測。
+    """
+    if compliance is not None:
+        rules = [field_name] if compliance.get(field_name) is False else []
+        if field_name in _AMOUNTS and compliance.get(SUM_RULE) is False:
+            rules.append(SUM_RULE)
+        return rules
+    if check_field(field_name, value) is not None:
+        return [field_name]
+    return [SUM_RULE] if field_name in _AMOUNTS else []
+
+
+def build_prompt(fields: Sequence[str], previous: Optional[Dict[str, Any]] = None,
+                 compliance: Optional[Dict[str, Any]] = None) -> str:
+    """compliance：check_compliance 的結果，用來註明每個欄位上次實際沒通過哪些規則。"""
+    lines = ["請重新辨識這張文件的下列欄位，只輸出一個 JSON 物件，key 與下面相同："]
+    for k in fields:
+        line = f"- {k}：{FIELD_PROMPTS[k]}"
+        prev = previous.get(k) if previous is not None else None
+        if prev is not None and not isinstance(prev, str):
+            prev = str(prev)          # Ollama 可能回數字；gt_parse 欄位一律以字串檢查
+        if prev:
+            rules = failed_rules(k, prev, compliance)
+            names = [r if r == SUM_RULE else f"{r} 格式規則" for r in rules]
+            why = f"未通過 {'、'.join(names)}" if names else "需再確認"
+            line += f"（上次讀到 {prev!r}，{why}）"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def crop_box(fields: Sequence[str], doc_class: Optional[str], size: Tuple[int, int]) -> Optional[Tuple[int, int, int, int]]:
+    """欄位區域聯集 + 外擴後的像素座標；面積太大（或沒有對應區域）時回傳 None = 用整張。"""
+    regions = REGIONS.get(str(doc_class), REGIONS["triple_invoice"])
+    boxes = [regions[k] for k in fields if k in regions]
+    if not boxes:
+        return None
+    x0 = max(0.0, min(b[0] for b in boxes) - CROP_MARGIN)
+    y0 = max(0.0, min(b[1] for b in boxes) - CROP_MARGIN)
+    x1 = min(1.0, max(b[2] for b in boxes) + CROP_MARGIN)
+    y1 = min(1.0, max(b[3] for b in boxes) + CROP_MARGIN)
+    if (x1 - x0) * (y1 - y0) > MAX_CROP_AREA:
+        return None
+    w, h = size
+    return int(x0 * w), int(y0 * h), int(round(x1 * w)), int(round(y1 * h))
+
+
+def _open_region(image_path: str, fields: Sequence[str], doc_class: Optional[str]):
+    """原圖（未縮放）裁出欄位區域，之後再套 vision 預算 → 同樣的 token 數換到更多細節。"""
+    from PIL import Image
+    image = Image.open(image_path).convert("RGB")
+    box = crop_box(fields, doc_class, image.size)
+    return image.crop(box) if box else image
+
+
+# ---- 後端 -------------------------------------------------------------------
+def _ask_local(image, fields, prompt, schema, model, tokenizer, budget) -> str:
+    import VAT_OCR
+    if model is None or tokenizer is None:
+        model, tokenizer = VAT_OCR._load_model_once()
+    # 每個欄位的答案都很短：token 預算依欄位數給
+    text, _, _ = VAT_OCR._generate_text(image, model, tokenizer, budget, constrained=True,
+                                        max_new_tokens=16 + 40 * len(fields), instruction=prompt,
+                                        schema=schema)
+    return text
+
+
+def _ask_ollama(image, fields, prompt, schema, ollama_model, host, budget, deadline) -> str:
+    from ollama_client import get_client
+    if isinstance(image, str):
+        with open(image, "rb") as f:
+            data = f.read()
+    else:
+        buf = io.BytesIO()
+        image.save(buf, format="JPEG", quality=95)
+        data = buf.getvalue()
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt, "images": [encode_bytes_b64(data, budget)]},
+    ]
+    resp = get_client(host).chat_json(ollama_model, messages, fmt=schema,
+                                      options={"temperature": 0, "seed": 42}, deadline=deadline)
+    return resp["message"]["content"]
+
+
+def requery_fields(image_path: str, fields: Sequence[str], previous: Optional[Dict[str, Any]] = None,
+                   backend: str = "local", doc_class: Optional[str] = None, crop: bool = False,
+                   model=None, tokenizer=None, budget=None, ollama_model: str = "qwen2.5vl:7b",
+                   host: Optional[str] = None, deadline: Optional[float] = None,
+                   compliance: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    只問 fields 這幾個欄位，回傳 {欄位: 新值}（解析失敗的欄位不會出現）。
+    compliance：previous 的 check_compliance 結果（prompt 裡註明實際沒通過的規則）。
+    """
+    fields = list(fields)
+    schema = field_schema(fields)
+    prompt = build_prompt(fields, previous, compliance)
+    image = _open_region(image_path, fields, doc_class) if crop else image_path
+    if backend == "local":
+        text = _ask_local(image, fields, prompt, schema, model, tokenizer, budget)
+    elif backend == "ollama":
+        text = _ask_ollama(image, fields, prompt, schema, ollama_model, host, budget, deadline)
+    else:
+        raise ValueError(f"未知的 backend：{backend}")
+    _, obj, _ = repair_json(text)
+    if not isinstance(obj, dict):
+        return {}
+    obj = obj.get("gt_parse", obj)
+    lower = {k.lower(): k for k in obj}
+    return {k: obj[lower[k.lower()]] for k in fields if k.lower() in lower}
+
+
+# ---- 合併 -------------------------------------------------------------------
+def _as_root(result: Any) -> Dict[str, Any]:
+    """chat_once / Ollama 的結果（dict 或 JSON 字串、扁平或 header/body/tail）→ 扁平 gt_parse 的複本。"""
+    from VAT_OCR import flatten_sections
+    if isinstance(result, str):
+        _, result, _ = repair_json(result)
+    return dict(flatten_sections(result)["gt_parse"])
+
+
+def merge_fields(root: Dict[str, Any], answers: Dict[str, Any]) -> List[str]:
+    """
+    通過 check_field 的新值寫回 root（原地修改；原本鍵名大小寫不同時沿用原鍵名），回傳值有變動的欄位。
+    數字答案轉成字串（gt_parse 欄位一律是字串）；null 與格式不符的答案捨棄。
+    """
+    lower = {}
+    for k in root:
+        lower.setdefault(k.lower(), k)
+    taken = []
+    for k, v in answers.items():
+        if v is None or isinstance(v, bool):
+            continue
+        if isinstance(v, (int, float)):
+            v = str(int(v)) if float(v).is_integer() else str(v)
+        if not isinstance(v, str) or not v.strip() or check_field(k, v) is not None:
+            continue
+        key = lower.get(k.lower(), k)
+        if root.get(key) != v:
+            root[key] = v
+            taken.append(k)
+    return taken
+
+
+def _passed(compliance: Dict[str, Any]) -> bool:
+    return all(v for v in compliance.values() if isinstance(v, bool))
+
+
+# ---- 修復迴圈 ---------------------------------------------------------------
+@dataclass
+class RequeryReport:
+    """單張文件的重問紀錄。"""
+    requested: List[str] = field(default_factory=list)   # 各輪重問過的欄位（去重）
+    fixed: List[str] = field(default_factory=list)       # 新值被採用且與原值不同的欄位
+    unresolved: List[str] = field(default_factory=list)  # 最後仍不通過的欄位（含 SUM_RULE）
+    rounds: int = 0
+    latency_s: float = 0.0
+    passed_before: bool = False
+    passed_after: bool = False
+    full_rerun: Optional[str] = None                     # 需要整張重跑的原因（plan_requery）
+
+    @property
+    def corrected(self) -> bool:
+        return not self.passed_before and self.passed_after
+
+
+@dataclass
+class RequeryStats:
+    """
+    多張文件的累計：每張「原本不合規、重問後合規」的文件都省下一次整張重跑。
+    corrected_latency_s 只記這些文件的重問耗時（不含第一次完整推論）。
+    """
+    docs: int = 0
+    failed: int = 0                  # 第一次推論不合規
+    requeried: int = 0               # 有送出欄位重問
+    corrected: int = 0               # 重問後合規 = 避免的整張重跑次數
+    full_rerun_needed: int = 0       # plan_requery 判定要整張重跑，或重問後仍不合規
+    fields_requested: int = 0
+    fields_fixed: int = 0
+    requery_calls: int = 0
+    corrected_latency_s: List[float] = field(default_factory=list)
+
+    def add(self, report: RequeryReport) -> None:
+        self.docs += 1
+        if report.passed_before:
+            return
+        self.failed += 1
+        if report.rounds:
+            self.requeried += 1
+            self.requery_calls += report.rounds
+            self.fields_requested += len(report.requested)
+            self.fields_fixed += len(report.fixed)
+        if report.corrected:
+            self.corrected += 1
+            self.corrected_latency_s.append(report.latency_s)
+        else:
+            self.full_rerun_needed += 1
+
+    def summary(self) -> dict:
+        lat = self.corrected_latency_s
+        return {
+            "docs": self.docs,
+            "failed": self.failed,
+            "requeried": self.requeried,
+            "full_reruns_avoided": self.corrected,
+            "full_reruns_needed": self.full_rerun_needed,
+            "fields_requested": self.fields_requested,
+            "fields_fixed": self.fields_fixed,
+            "requery_calls": self.requery_calls,
+            "corrected_latency_mean_s": round(statistics.mean(lat), 3) if lat else None,
+            "corrected_latency_p50_s": round(statistics.median(lat), 3) if lat else None,
+            "corrected_latency_max_s": round(max(lat), 3) if lat else None,
+        }
+
+
+def requery_repair(image_path: str, result: Any, backend: str = "local", crop: bool = False,
+                   max_fields: int = 6, max_rounds: int = 1, stats: Optional[RequeryStats] = None,
+                   compliance_kwargs: Optional[dict] = None, **ask_kwargs) -> Tuple[Dict[str, Any], RequeryReport]:
+    """
+    第一次推論的結果 → ({"gt_parse": 合併後的欄位}, RequeryReport)。
+    合規的結果原樣（扁平化後）回傳，不會送出任何請求。ask_kwargs 轉給 requery_fields
+    （model / tokenizer / budget / ollama_model / host / deadline）。
+    """
+    engine = get_engine(**(compliance_kwargs or {}))
+    root = _as_root(result)
+    comp, _ = engine.check({"gt_parse": root})
+    report = RequeryReport(passed_before=_passed(comp))
+    t0 = time.perf_counter()
+    while not _passed(comp) and report.rounds < max_rounds:
+        fields, rerun = plan_requery(comp, max_fields)
+        if rerun is not None:
+            report.full_rerun = rerun
+            break
+        doc_class = next((root[k] for k in root if k.lower() == "doc_class"), None)
+        answers = requery_fields(image_path, fields, previous=root, backend=backend, doc_class=doc_class,
+                                 crop=crop, compliance=comp, **ask_kwargs)
+        report.rounds += 1
+        report.requested += [k for k in fields if k not in report.requested]
+        report.fixed += [k for k in merge_fields(root, answers) if k not in report.fixed]
+        comp, _ = engine.check({"gt_parse": root})
+    report.latency_s = time.perf_counter() - t0
+    report.passed_after = _passed(comp)
+    report.unresolved = [k for k, v in comp.items() if v is False]
+    if not report.passed_after and report.full_rerun is None and not report.passed_before:
+        report.full_rerun = "unresolved"
+    if stats is not None:
+        stats.add(report)
+    return {"gt_parse": root}, report
+
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description="對一張圖：完整推論 → 合規檢查 → 只重問不合規的欄位")
+    ap.add_argument("image")
+    ap.add_argument("--backend", choices=["local", "ollama"], default="local")
+    ap.add_argument("--model", default="qwen2.5vl:7b", help="Ollama 模型名稱")
+    ap.add_argument("--crop", action="store_true", help="只送欄位所在區域的裁切")
+    ap.add_argument("--max-rounds", type=int, default=1)
+    args = ap.parse_args()
+
+    if args.backend == "local":
+        from VAT_OCR import chat_once
+        first = chat_once(args.image)
+    else:
+        import os
+        import sys
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "docvqa"))
+        from docvqa_final2 import infer_image_json
+        first = infer_image_json(args.image, model=args.model)
+    merged, report = requery_repair(args.image, first, backend=args.backend, crop=args.crop,
+                                    max_rounds=args.max_rounds, ollama_model=args.model)
+    print(json.dumps(merged, ensure_ascii=False, indent=2))
+    print(report)
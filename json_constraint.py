@@ -0,0 +1,491 @@
+# -*- coding: utf-8 -*-
+"""
+以 JSON Schema 約束本地模型的解碼（VAT_OCR.chat_once(constrained=True)）。
+
+做法：把 schema 編譯成逐字元的下推自動機（JSON 物件/字串/null），在 model.generate 每一步
+只保留「接上去之後仍可能是合法輸出」的 token：
+  - 物件的 key 只能是 schema properties 裡、尚未出現過的名稱；required 未齊前不能收 '}'
+  - 金額等欄位 pattern 為 ^[0-9]+$ → 字串內只能出現數字
+  - Doc_class 為 enum → 只能拼出列舉值之一
+  - 字串內不可出現裸控制字元；跳脫只接受 JSON 標準跳脫（含 \\uXXXX），且只在沒有 pattern/enum 的欄位
+  - 根物件關閉後只能接 EOS
+因此輸出一定能被 json.loads 解析，不會再落到 repair_json 的 {"raw": ...}。
+
+支援的 schema 子集：type=object（properties / required / additionalProperties=false）、
+type=string（enum / maxLength / pattern 僅限 ^[字元類]+$ 、^[字元類]*$ 、^[字元類]{m,n}$ 、^[字元類]{n}$）、
+type 含 "null"。
+
+每步只檢查分數最高的 top_k 個 token（預設 64）；都不合法時再擴大到 1024，
+仍找不到才掃描預先整理的單字元 token 表，所以一般情況每步只多出幾十次字元轉移。
+
+用法：
+    from json_constraint import GT_PARSE_SCHEMA, JsonSchemaLogitsProcessor
+    proc = JsonSchemaLogitsProcessor(GT_PARSE_SCHEMA, text_tokenizer, prompt_len=inputs["input_ids"].shape[1])
+    model.generate(**inputs, logits_processor=LogitsProcessorList([proc]), do_sample=False, ...)
+"""
+
+from __future__ import annotations
+import re
+from typing import Any, Dict, FrozenSet, List, Optional, Sequence, Tuple
+
+DOC_CLASSES = [
+    "business_invoice", "customs_tax_payment", "e_invoice", "plumb_payment_order",
+    "tele_payment_order", "tradition_invoice", "triple_invoice", "triple_receipt", "other",
+]
+
+_DIGITS = {"type": ["string", "null"], "pattern": "^[0-9]+$"}
+_TEXT = {"type": ["string", "null"], "maxLength": 256}
+
+# 訓練資料（Donut 格式）的 gt_parse：扁平欄位 + Doc_class / Rationale
+GT_PARSE_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "gt_parse": {
+            "type": "object",
+            "properties": {
+                "Doc_class": {"type": "string", "enum": DOC_CLASSES},
+                "Rationale": _TEXT,
+                "PrefixTwoLetters": {"type": ["string", "null"], "pattern": "^[A-Z]{2}$"},
+                "InvoiceNumber": {"type": ["string", "null"], "pattern": "^[0-9]{8}$"},
+                "InvoiceYear": {"type": ["string", "null"], "pattern": "^[0-9]{2,4}$"},
+                "InvoiceMonth": {"type": ["string", "null"], "pattern": "^[0-9]{1,2}$"},
+                "InvoiceDay": {"type": ["string", "null"], "pattern": "^[0-9]{1,2}$"},
+                "BuyerName": _TEXT,
+                "BuyerTaxIDNumber": {"type": ["string", "null"], "pattern": "^[0-9]{8}$"},
+                "CompanyName": _TEXT,
+                "CompanyAddress": _TEXT,
+                "CompanyTaxIDNumber": {"type": ["string", "null"], "pattern": "^[0-9]{8}$"},
+                "PhoneNumber": {"type": ["string", "null"], "pattern": "^[0-9()+# -]{1,20}$"},
+                "Abstract": {"type": ["string", "null"], "maxLength": 512},
+                "SalesTotalAmount": _DIGITS,
+                "SalesTax": _DIGITS,
+                "TotalAmount": _DIGITS,
+            },
+            "required": ["Doc_class"],
+            "additionalProperties": False,
+        },
+    },
+    "required": ["gt_parse"],
+    "additionalProperties": False,
+}
+
+WS = " \t\n\r"
+MAX_WS_RUN = 16            # 連續空白上限，避免模型卡在縮排迴圈
+_ESCAPES = set('"\\/bfntr')
+_HEX = set("0123456789abcdefABCDEF")
+_PATTERN_RE = re.compile(r"^\^(\[[^\]]+\])(\+|\*|\{(\d+)(?:,(\d+))?\})\$$")
+
+
+# ---- schema 編譯 -------------------------------------------------------------
+class _Leaf:
+    """字串/null 葉節點：允許的字元、長度範圍、列舉值。"""
+    __slots__ = ("nullable", "char_re", "min_len", "max_len", "enum", "enum_prefixes")
+
+    def __init__(self, spec: dict):
+        types = spec.get("type", "string")
+        types = [types] if isinstance(types, str) else list(types)
+        if "string" not in types:
+            raise ValueError(f"不支援的 type：{types}")
+        self.nullable = "null" in types
+        self.char_re = None
+        self.min_len, self.max_len = 0, spec.get("maxLength")
+        self.enum = tuple(spec["enum"]) if "enum" in spec else None
+        self.enum_prefixes = ({e[:i] for e in self.enum for i in range(len(e) + 1)}
+                              if self.enum else None)
+        pat = spec.get("pattern")
+        if pat:
+            m = _PATTERN_RE.match(pat)
+            if not m:
+                raise ValueError(f"不支援的 pattern（只接受 ^[...]+$ / ^[...]{{m,n}}$ 形式）：{pat}")
+            self.char_re = re.compile(m.group(1))
+            q = m.group(2)
+            if q == "+":
+                self.min_len = 1
+            elif q.startswith("{"):
+                lo = int(m.group(3))
+                hi = int(m.group(4)) if m.group(4) else lo
+                self.min_len, self.max_len = lo, hi if self.max_len is None else min(hi, self.max_len)
+
+
+class _Obj:
+    __slots__ = ("props", "required", "key_prefixes")
+
+    def __init__(self, spec: dict):
+        if spec.get("additionalProperties", False) not in (False, None):
+            raise ValueError("只支援 additionalProperties=false 的物件")
+        self.props = {k: compile_node(v) for k, v in spec.get("properties", {}).items()}
+        self.required = frozenset(spec.get("required", ()))
+        self.key_prefixes = {k[:i] for k in self.props for i in range(len(k) + 1)}
+
+
+def _filler(leaf: "_Leaf") -> str:
+    # 補長度用的字元：優先數字，其次字母
+    for ch in "0Aa ":
+        if leaf.char_re is None or leaf.char_re.fullmatch(ch):
+            return ch
+    return "0"
+
+
+def compile_node(spec: dict):
+    t = spec.get("type")
+    if t == "object":
+        return _Obj(spec)
+    return _Leaf(spec)
+
+
+# ---- 自動機 -----------------------------------------------------------------
+# 狀態為不可變 tuple，可以直接當候選 token 的分支起點（不必複製）：
+#   (stack, mode, data, ws_run)
+#   stack：((obj, seen_keys, cur_key), ...)   由外到內的物件框
+#   mode ：'value'   等待值開頭（根或 key 之後）
+#          'obj'     剛進物件，等 key 或 '}'
+#          'key'     key 字串中，data = 目前字元
+#          'colon'   key 結束等 ':'
+#          'after'   值結束，等 ',' 或 '}'
+#          'next'    ',' 之後等下一個 key
+#          'str'     葉字串中，data = (已輸入內容, 跳脫狀態：False / True / 剩餘 \\u 十六進位位數)
+#          'null'    拼 null 中，data = 已輸入字元數
+#          'done'    根物件已關閉
+State = Tuple[Tuple[Tuple[Any, FrozenSet[str], Optional[str]], ...], str, Any, int]
+
+
+class JsonSchemaAutomaton:
+    def __init__(self, schema: dict):
+        self.root = compile_node(schema)
+        if not isinstance(self.root, _Obj):
+            raise ValueError("根節點必須是 object")
+
+    def initial(self) -> State:
+        return ((), "value", self.root, 0)
+
+    @staticmethod
+    def is_done(state: Optional[State]) -> bool:
+        return state is not None and state[1] == "done"
+
+    def _close_value(self, stack) -> State:
+        if not stack:
+            return ((), "done", None, 0)
+        return (stack, "after", None, 0)
+
+    def step(self, state: State, ch: str) -> Optional[State]:
+        """吃一個字元；不合法回傳 None。"""
+        stack, mode, data, ws = state
+
+        if mode == "str":
+            buf, esc = data
+            obj, seen, key = stack[-1]
+            leaf = obj.props[key]
+            if esc is not False:
+                if esc is True:
+                    if leaf.char_re is not None or leaf.enum is not None:
+                        return None
+                    if ch == "u":
+                        return (stack, "str", (buf + "\\u", 4), 0)   # 之後需要 4 個十六進位數字
+                    if ch not in _ESCAPES:
+                        return None
+                    return (stack, "str", (buf + "\\" + ch, False), 0)
+                if ch not in _HEX:
+                    return None
+                return (stack, "str", (buf + ch, esc - 1 if esc > 1 else False), 0)
+            if ch == '"':
+                if leaf.enum is not None and buf not in leaf.enum:
+                    return None
+                if len(buf) < leaf.min_len:
+                    return None
+                return self._close_value(stack[:-1] + ((obj, seen, None),))
+            if ch == "\\":
+                return (stack, "str", (buf, True), 0)
+            if ord(ch) < 0x20:
+                return None
+            nb = buf + ch
+            if leaf.enum is not None and nb not in leaf.enum_prefixes:
+                return None
+            if leaf.char_re is not None and not leaf.char_re.fullmatch(ch):
+                return None
+            if leaf.max_len is not None and len(nb) > leaf.max_len:
+                return None
+            return (stack, "str", (nb, False), 0)
+
+        if mode == "key":
+            obj, seen, _ = stack[-1]
+            if ch == '"':
+                if data not in obj.props or data in seen:
+                    return None
+                return (stack[:-1] + ((obj, seen | {data}, data),), "colon", None, 0)
+            nk = data + ch
+            if nk not in obj.key_prefixes:
+                return None
+            # 前綴仍要有至少一個未出現過的 key 可以補完
+            if not any(k.startswith(nk) and k not in seen for k in obj.props):
+                return None
+            return (stack, "key", nk, 0)
+
+        if mode == "null":
+            if ch != "null"[data]:
+                return None
+            if data == 3:
+                obj, seen, _ = stack[-1]
+                return self._close_value(stack[:-1] + ((obj, seen, None),))
+            return (stack, "null", data + 1, 0)
+
+        if mode == "done":
+            if ch in WS and ws < MAX_WS_RUN:
+                return (stack, mode, data, ws + 1)
+            return None
+
+        if ch in WS:
+            return (stack, mode, data, ws + 1) if ws < MAX_WS_RUN else None
+
+        if mode == "value":
+            # data = 要填的節點（根）；或 stack[-1] 的 cur_key 對應的節點
+            node = data if data is not None else stack[-1][0].props[stack[-1][2]]
+            if isinstance(node, _Obj):
+                if ch != "{":
+                    return None
+                return (stack + ((node, frozenset(), None),), "obj", None, 0)
+            if ch == '"':
+                return (stack, "str", ("", False), 0)
+            if ch == "n" and node.nullable:
+                return (stack, "null", 1, 0)
+            return None
+
+        if mode in ("obj", "next"):
+            obj, seen, _ = stack[-1]
+            if ch == '"':
+                if not any(k not in seen for k in obj.props):
+                    return None
+                return (stack, "key", "", 0)
+            if ch == "}" and mode == "obj" and obj.required <= seen:
+                return self._close_value(stack[:-1])
+            return None
+
+        if mode == "colon":
+            if ch != ":":
+                return None
+            return (stack, "value", None, 0)
+
+        if mode == "after":
+            obj, seen, _ = stack[-1]
+            if ch == ",":
+                if not any(k not in seen for k in obj.props):
+                    return None
+                return (stack, "next", None, 0)
+            if ch == "}":
+                if not obj.required <= seen:
+                    return None
+                return self._close_value(stack[:-1])
+            return None
+
+        return None
+
+    def feed(self, state: Optional[State], text: str) -> Optional[State]:
+        for ch in text:
+            if state is None:
+                return None
+            state = self.step(state, ch)
+        return state
+
+    def accepts(self, text: str) -> bool:
+        return self.is_done(self.feed(self.initial(), text))
+
+    # ---- 收尾：token 預算快用完時，補出最短的合法結尾 -------------------------
+    @staticmethod
+    def _min_value(node) -> str:
+        if isinstance(node, _Obj):
+            return "{" + ",".join(f'"{k}":{JsonSchemaAutomaton._min_value(node.props[k])}'
+                                  for k in sorted(node.required)) + "}"
+        if node.nullable:
+            return "null"
+        if node.enum:
+            return '"' + node.enum[-1] + '"'
+        return '"' + _filler(node) * node.min_len + '"'
+
+    def completion(self, state: State) -> str:
+        """從 state 到 'done' 的最短合法字串（不含 EOS）。"""
+        stack, mode, data, _ = state
+        if mode == "done":
+            return ""
+        if mode == "value" and not stack:
+            return self._min_value(data)
+        out = ""
+        obj, seen, key = stack[-1]
+        if mode == "str":
+            leaf = obj.props[key]
+            buf, esc = data
+            if esc is True:
+                out += "n"
+            elif esc is not False:
+                out += "0" * esc
+            if leaf.enum is not None:
+                target = next(e for e in leaf.enum if e.startswith(buf))
+                out += target[len(buf):]
+            elif len(buf) < leaf.min_len:
+                out += _filler(leaf) * (leaf.min_len - len(buf))
+            out += '"'
+        elif mode == "null":
+            out += "null"[data:]
+        elif mode == "value":
+            out += self._min_value(obj.props[key])
+        elif mode == "colon":
+            out += ":" + self._min_value(obj.props[key])
+        elif mode in ("key", "next"):
+            prefix = data if mode == "key" else ""
+            k = next(k for k in obj.props if k.startswith(prefix) and k not in seen)
+            out += ('"' if mode == "next" else "") + k[len(prefix):] + '":' + self._min_value(obj.props[k])
+            seen = seen | {k}
+        # 由內而外補齊 required 並關閉物件
+        for i in range(len(stack) - 1, -1, -1):
+            frame_obj = stack[i][0]
+            frame_seen = seen if i == len(stack) - 1 else stack[i][1]
+            for k in sorted(frame_obj.required - frame_seen):
+                need_comma = bool(frame_seen) or mode != "obj" or i != len(stack) - 1
+                out += ("," if need_comma else "") + f'"{k}":' + self._min_value(frame_obj.props[k])
+                frame_seen = frame_seen | {k}
+            out += "}"
+        return out
+
+
+# ---- transformers logits processor -----------------------------------------
+class JsonSchemaLogitsProcessor:
+    """
+    給 model.generate(logits_processor=[...]) 用。每個 batch row 各自維護自動機狀態；
+    prompt_len 為輸入長度（左 padding 時為補齊後長度），之後新增的 token 才會送進自動機。
+    violations：自動機被迫中止約束的次數（理論上為 0；非 0 代表 token 表解碼有落差）。
+    """
+
+    def __init__(self, schema: dict, tokenizer, prompt_len: int, top_k: int = 64,
+                 max_new_tokens: Optional[int] = None):
+        self.automaton = JsonSchemaAutomaton(schema)
+        self.tok = tokenizer
+        self.prompt_len = prompt_len
+        self.top_k = top_k
+        self.max_new_tokens = max_new_tokens
+        self.forced_finishes = 0      # 因 token 預算不足而強制收尾的列數
+        self._finishing: set = set()
+        self.eos_ids = self._eos_ids(tokenizer)
+        self._banned = set(getattr(tokenizer, "all_special_ids", []) or [])
+        self._banned |= set((getattr(tokenizer, "added_tokens_decoder", None) or {}).keys())
+        self._banned -= set(self.eos_ids)
+        self._pieces: Dict[int, str] = {}
+        self._short_ids: Optional[List[int]] = None
+        self.states: List[Optional[State]] = []
+        self.fed: List[int] = []
+        self.violations = 0
+
+    @staticmethod
+    def _eos_ids(tok) -> List[int]:
+        ids = []
+        for name in ("eos_token_id", "pad_token_id"):
+            v = getattr(tok, name, None)
+            if isinstance(v, int):
+                ids.append(v)
+        im_end = tok.convert_tokens_to_ids("<|im_end|>") if hasattr(tok, "convert_tokens_to_ids") else None
+        if isinstance(im_end, int) and im_end >= 0 and im_end != getattr(tok, "unk_token_id", None):
+            ids.append(im_end)
+        return sorted(set(ids))
+
+    def piece(self, tid: int) -> str:
+        p = self._pieces.get(tid)
+        if p is None:
+            p = "" if tid in self._banned else self.tok.decode([tid], skip_special_tokens=False)
+            self._pieces[tid] = p
+        return p
+
+    def _char_token(self, ch: str) -> int:
+        ids = self.tok.encode(ch, add_special_tokens=False)
+        if len(ids) != 1:
+            raise ValueError(f"字元 {ch!r} 不是單一 token")
+        return ids[0]
+
+    def _short_token_ids(self) -> List[int]:
+        # 最後手段：只含一個字元的 token（ASCII 標點、數字、常用漢字…）
+        if self._short_ids is None:
+            vocab = self.tok.get_vocab() if hasattr(self.tok, "get_vocab") else {}
+            self._short_ids = [i for i in sorted(set(vocab.values())) if len(self.piece(i)) == 1]
+        return self._short_ids
+
+    @staticmethod
+    def _in_free_string(state: State) -> bool:
+        # 被切開的多位元組字（中文）解碼成 U+FFFD：只能放在沒有 pattern/enum 的字串內，
+        # 且不會含引號或反斜線（皆為單位元組 ASCII），所以直接接受
+        if state[1] != "str" or state[2][1] is not False:
+            return False
+        obj, _, key = state[0][-1]
+        leaf = obj.props[key]
+        return leaf.char_re is None and leaf.enum is None
+
+    def _allowed(self, state: State, candidates: Sequence[int]) -> List[int]:
+        out = []
+        for tid in candidates:
+            if tid in self.eos_ids:
+                if self.automaton.is_done(state):
+                    out.append(tid)
+                continue
+            p = self.piece(tid)
+            if "\ufffd" in p:
+                if self._in_free_string(state):
+                    out.append(tid)
+                continue
+            if p and self.automaton.feed(state, p) is not None:
+                out.append(tid)
+        return out
+
+    def _advance(self, b: int, ids: Sequence[int]) -> None:
+        state = self.states[b]
+        for tid in ids[self.fed[b]:]:
+            if state is None:
+                break
+            if tid in self.eos_ids:
+                continue
+            p = self.piece(tid)
+            if "\ufffd" in p and self._in_free_string(state):
+                state = (state[0], "str", (state[2][0] + p, False), 0)
+                continue
+            nxt = self.automaton.feed(state, p)
+            if nxt is None:
+                self.violations += 1
+            state = nxt
+        self.states[b] = state
+        self.fed[b] = len(ids)
+
+    def __call__(self, input_ids, scores):
+        import torch
+
+        batch = input_ids.shape[0]
+        if not self.states:
+            self.states = [self.automaton.initial() for _ in range(batch)]
+            self.fed = [0] * batch
+        generated = input_ids[:, self.prompt_len:].tolist()
+        mask = torch.full_like(scores, float("-inf"))
+        for b in range(batch):
+            self._advance(b, generated[b])
+            state = self.states[b]
+            if state is None:
+                mask[b] = 0          # 約束已失效：不再干預這一列
+                continue
+            if self.automaton.is_done(state):
+                mask[b, self.eos_ids] = 0
+                continue
+            if self.max_new_tokens is not None and self.max_new_tokens - len(generated[b]) <= 96:
+                tail = self.automaton.completion(state)
+                if self.max_new_tokens - len(generated[b]) <= len(tail) + 2:
+                    # token 預算只夠收尾：逐字元強制補完，確保輸出仍可解析
+                    if b not in self._finishing:
+                        self._finishing.add(b)
+                        self.forced_finishes += 1
+                    mask[b, self._char_token(tail[0])] = 0
+                    continue
+            allowed: List[int] = []
+            for k in (self.top_k, 1024):
+                cand = torch.topk(scores[b], min(k, scores.shape[-1])).indices.tolist()
+                allowed = self._allowed(state, cand)
+                if allowed:
+                    break
+            if not allowed:
+                allowed = self._allowed(state, self._short_token_ids())
+            if not allowed:
+                self.violations += 1
+                mask[b] = 0
+                continue
+            mask[b, allowed] = 0
+        return scores + mask
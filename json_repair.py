@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+「幾乎 JSON」的單次掃描容錯解析（VAT_OCR.repair_json 與 old/VAT_test2._repair_json 的實作）。
+
+舊做法是 json.loads → ast.literal_eval → 數個整串 regex 改寫 → 再 json.loads 的串接，
+每一步都重新掃描整段文字，失敗的 json.loads / literal_eval 也要付出例外成本；
+schema 驗證每次都重新 import jsonschema 並重新編譯 schema。
+
+現在：
+  1) 先以 json.loads（C 實作）試整段去空白後的文字 —— 模型輸出多半本來就合法
+  2) 不合法時，以一個遞迴下降的容錯 parser 從第一個 '{'（沒有則 '['）開始只掃描一次，同時處理：
+       ``` 區塊外殼與前後說明文字、彎引號（“ ” ‘ ’）、單引號字串、
+       True/False/None、尾逗號、字串內的裸換行等控制字元
+  3) schema 驗證器依 schema 物件快取（jsonschema 只 import / 編譯一次）
+
+回傳值與舊版相同：(fixed_text, obj, logs)；解析或驗證失敗時 obj 為 {"raw": 原文}。
+repair_stats() 累計各種修補被觸發的次數（批次後處理時用來觀察模型常犯的錯）。
+"""
+
+from __future__ import annotations
+import json
+import threading
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from tracing import span
+
+# 修補代碼 → logs 文字（沿用舊版訊息）
+REPAIRS = {
+    "fences": "removed code fences",
+    "region": "extracted outer JSON-like region",
+    "curly_quotes": "normalized curly quotes",
+    "single_quotes": "replaced single quotes with double quotes",
+    "python_literals": "converted Python literals to JSON",
+    "trailing_commas": "removed trailing commas",
+    "control_chars": "escaped control characters in strings",
+}
+
+_OPEN_QUOTES = {'"': '"', "'": "'", "“": "”", "‘": "’"}
+_CLOSE_ALT = {"”": "“", "’": "‘"}   # 有些模型開頭也用右引號
+_ESCAPES = {'"': '"', "'": "'", "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+_LITERALS = {
+    "true": (True, None), "false": (False, None), "null": (None, None),
+    "True": (True, "python_literals"), "False": (False, "python_literals"), "None": (None, "python_literals"),
+}
+_NUM_CHARS = set("0123456789+-.eE")
+_WS = " \t\r\n﻿"
+
+_stats_lock = threading.Lock()
+_stats: Counter = Counter()
+
+
+class _ParseError(ValueError):
+    pass
+
+
+class _TolerantParser:
+    """遞迴下降；self.fired 收集這次觸發的修補代碼。"""
+
+    def __init__(self, text: str):
+        self.s = text
+        self.n = len(text)
+        self.i = 0
+        self.fired: set = set()
+
+    def fail(self, msg: str):
+        raise _ParseError(f"{msg} at char {self.i}")
+
+    def ws(self) -> None:
+        s, i, n = self.s, self.i, self.n
+        while i < n and s[i] in _WS:
+            i += 1
+        self.i = i
+
+    def value(self) -> Any:
+        self.ws()
+        if self.i >= self.n:
+            self.fail("unexpected end")
+        ch = self.s[self.i]
+        if ch == "{":
+            return self.obj()
+        if ch == "[":
+            return self.arr()
+        if ch in _OPEN_QUOTES or ch in _CLOSE_ALT:
+            return self.string()
+        if ch in _NUM_CHARS:
+            return self.number()
+        return self.literal()
+
+    def _sep(self, close: str) -> bool:
+        """讀完一個成員後：',' → 繼續（若後面直接是 close 則為尾逗號）；close → 結束。"""
+        self.ws()
+        if self.i >= self.n:
+            self.fail("unexpected end")
+        ch = self.s[self.i]
+        if ch == close:
+            self.i += 1
+            return False
+        if ch != ",":
+            self.fail(f"expected ',' or {close!r}")
+        self.i += 1
+        self.ws()
+        if self.i < self.n and self.s[self.i] == close:
+            self.fired.add("trailing_commas")
+            self.i += 1
+            return False
+        return True
+
+    def obj(self) -> Dict[str, Any]:
+        self.i += 1
+        out: Dict[str, Any] = {}
+        self.ws()
+        if self.i < self.n and self.s[self.i] == "}":
+            self.i += 1
+            return out
+        while True:
+            self.ws()
+            if self.i >= self.n:
+                self.fail("unexpected end")
+            ch = self.s[self.i]
+            if ch not in _OPEN_QUOTES and ch not in _CLOSE_ALT:
+                self.fail("expected key")
+            key = self.string()
+            self.ws()
+            if self.i >= self.n or self.s[self.i] != ":":
+                self.fail("expected ':'")
+            self.i += 1
+            out[key] = self.value()
+            if not self._sep("}"):
+                return out
+
+    def arr(self) -> List[Any]:
+        self.i += 1
+        out: List[Any] = []
+        self.ws()
+        if self.i < self.n and self.s[self.i] == "]":
+            self.i += 1
+            return out
+        while True:
+            out.append(self.value())
+            if not self._sep("]"):
+                return out
+
+    def string(self) -> str:
+        s, n = self.s, self.n
+        q = s[self.i]
+        if q in _CLOSE_ALT:
+            q = _CLOSE_ALT[q]
+        if q in "“‘":
+            self.fired.add("curly_quotes")
+        elif q == "'":
+            self.fired.add("single_quotes")
+        closers = (_OPEN_QUOTES[q], q) if q in "“‘" else (q,)
+        self.i += 1
+        buf: List[str] = []
+        start = self.i
+        i = self.i
+        while True:
+            if i >= n:
+                self.i = i
+                self.fail("unterminated string")
+            ch = s[i]
+            if ch in closers:
+                buf.append(s[start:i])
+                self.i = i + 1
+                return "".join(buf)
+            if ch == "\\":
+                buf.append(s[start:i])
+                if i + 1 >= n:
+                    self.i = i
+                    self.fail("unterminated escape")
+                e = s[i + 1]
+                if e == "u":
+                    h = s[i + 2:i + 6]
+                    try:
+                        cp = int(h, 16)
+                    except ValueError:
+                        self.i = i
+                        self.fail("bad \\u escape")
+                    if len(h) != 4:
+                        self.i = i
+                        self.fail("bad \\u escape")
+                    i += 6
+                    # UTF-16 代理對
+                    if 0xD800 <= cp <= 0xDBFF and s[i:i + 2] == "\\u":
+                        try:
+                            lo = int(s[i + 2:i + 6], 16)
+                        except ValueError:
+                            lo = 0
+                        if 0xDC00 <= lo <= 0xDFFF:
+                            cp = 0x10000 + ((cp - 0xD800) << 10) + (lo - 0xDC00)
+                            i += 6
+                    buf.append(chr(cp))
+                elif e in _ESCAPES:
+                    buf.append(_ESCAPES[e])
+                    i += 2
+                else:
+                    buf.append(e)          # 不認得的跳脫：保留字元本身
+                    i += 2
+                start = i
+                continue
+            if ch < " ":
+                self.fired.add("control_chars")
+            i += 1
+
+    def number(self) -> Any:
+        s, n, i = self.s, self.n, self.i
+        j = i
+        while j < n and s[j] in _NUM_CHARS:
+            j += 1
+        raw = s[i:j]
+        self.i = j
+        try:
+            return json.loads(raw)
+        except ValueError:
+            self.i = i
+            self.fail(f"bad number {raw!r}")
+
+    def literal(self) -> Any:
+        s, i = self.s, self.i
+        for word, (val, code) in _LITERALS.items():
+            if s.startswith(word, i):
+                self.i = i + len(word)
+                if code:
+                    self.fired.add(code)
+                return val
+        self.fail(f"unexpected {s[i]!r}")
+
+
+def tolerant_loads(text: str) -> Tuple[Any, List[str]]:
+    """
+    從 text 中找出第一個 JSON 物件（或陣列）並容錯解析；回傳 (obj, 觸發的修補代碼 list)。
+    失敗時拋出 ValueError。
+    """
+    fired: List[str] = []
+    if "```" in text:
+        fired.append("fences")
+    lb = text.find("{")
+    if lb == -1:
+        lb = text.find("[")
+    if lb == -1:
+        raise ValueError("no JSON object or array found")
+    p = _TolerantParser(text)
+    p.i = lb
+    obj = p.value()
+    # 前後若還有 ``` 之外的文字，視為擷取了區塊
+    rest = (text[:lb] + text[p.i:]).replace("```json", "").replace("```JSON", "").replace("```", "")
+    if rest.strip():
+        fired.append("region")
+    fired.extend(sorted(p.fired, key=list(REPAIRS).index))
+    return obj, fired
+
+
+_validators: Dict[int, Tuple[dict, Any]] = {}
+_validators_lock = threading.Lock()
+
+
+def get_validator(schema: dict):
+    """schema → 已編譯的 jsonschema validator（依 schema 物件快取；同一個 dict 只編譯一次）。"""
+    entry = _validators.get(id(schema))
+    if entry is not None and entry[0] is schema:
+        return entry[1]
+    from jsonschema.validators import validator_for
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    v = cls(schema)
+    with _validators_lock:
+        _validators[id(schema)] = (schema, v)   # 保留 schema 參照，id 不會被重用
+    return v
+
+
+def _count(*keys: str) -> None:
+    with _stats_lock:
+        for k in keys:
+            _stats[k] += 1
+
+
+def repair_stats() -> Dict[str, int]:
+    """累計：calls、parsed_json（本來就合法）、repaired、fallback（{"raw": ...}）、schema_invalid，以及各修補代碼次數。"""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_repair_stats() -> None:
+    with _stats_lock:
+        _stats.clear()
+
+
+def repair_json(s: str, schema: Optional[dict] = None) -> Tuple[str, Any, List[str]]:
+    """
+    將「幾乎 JSON」的字串修復成合法 JSON。
+    回傳: (fixed_text, obj, logs)
+      fixed_text: 修復後的 JSON 字串
+      obj:        對應的 Python 物件 (dict/list)；失敗時為 {"raw": s}
+      logs:       修復步驟紀錄
+    """
+    with span("repair_json"):
+        return _repair_json(s, schema)
+
+
+def _repair_json(s: str, schema: Optional[dict] = None) -> Tuple[str, Any, List[str]]:
+    logs: List[str] = []
+    text = s.strip()
+    _count("calls")
+    obj: Any = None
+    ok = False
+    try:
+        obj = json.loads(text)
+        ok = True
+        logs.append("parsed by json")
+        _count("parsed_json")
+    except ValueError as e:
+        logs.append(f"json.loads failed: {e}")
+        try:
+            obj, fired = tolerant_loads(text)
+            ok = True
+            logs.extend(REPAIRS[c] for c in fired)
+            logs.append("parsed by tolerant parser")
+            _count("repaired", *fired)
+        except ValueError as e2:
+            logs.append(f"tolerant parse failed: {e2}")
+
+    if ok and schema:
+        err = next(iter(get_validator(schema).iter_errors(obj)), None)
+        if err is None:
+            logs.append("validated by jsonschema")
+        else:
+            logs.append(f"jsonschema validation failed: {err.message}")
+            _count("schema_invalid")
+            ok = False
+
+    if ok:
+        return json.dumps(obj, ensure_ascii=False, indent=2), obj, logs
+
+    # 兜底：包 raw
+    _count("fallback")
+    fallback = {"raw": s}
+    if schema:
+        logs.append("returned raw because schema validation/parse failed")
+    return json.dumps(fallback, ensure_ascii=False, indent=2), fallback, logs
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+串流輸出的增量 JSON 欄位解析：模型每吐出一段文字就 feed 進來，
+某個欄位的值一閉合（字串的結尾引號、數字/null 後的 ',' 或 '}'）就立刻回報，不必等整段 JSON 完成。
+
+    parser = IncrementalJsonParser()
+    for piece in pieces:                     # Ollama stream 的 message.content / TextIteratorStreamer
+        for path, value in parser.feed(piece):
+            print(path, value)               # ('body', 'InvoiceNumber') '54957806'
+    parser.result                            # 解析完成的物件（done 為 True 時完整）
+
+FieldStream 再加上逐欄檢查與提早取消：每個欄位一到就跑 check(key, value)
+（通常為 VAT_OCR.check_field，與 check_compliance 同一套格式規則），
+不合格的欄位累積到 max_bad 個、或輸出根本不是 JSON 時，就取消生成（關閉 HTTP 串流 / 通知本地 generate 停止）。
+
+    stream = FieldStream(pieces, check=check_field, max_bad=2, cancel=on_cancel)
+    for ev in stream:                        # FieldEvent(path, key, value, ok)
+        render(ev)
+    stream.result, stream.text, stream.cancelled, stream.reason
+
+第一個 '{' 之前的內容（例如 ```json）會略過；根物件閉合後的內容也不再解析。
+陣列內的元素不個別回報，整個陣列閉合後以其 key 回報一次；巢狀物件（header/body/tail）回報其內的各欄位。
+"""
+
+from __future__ import annotations
+import json
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+_LITERAL_CHARS = set("0123456789+-.eEtruefalsn")
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class _Frame:
+    __slots__ = ("value", "key", "is_obj")
+
+    def __init__(self, is_obj: bool):
+        self.is_obj = is_obj
+        self.value: Any = {} if is_obj else []
+        self.key: Optional[str] = None
+
+
+class IncrementalJsonParser:
+    """
+    逐字元的 JSON 狀態機；feed() 回傳這次新閉合的 [(path, value), ...]。
+    遇到不合法的字元時 error 記下原因並停止解析（之後的 feed 都回傳空 list），
+    呼叫端照舊可把完整文字交給 repair_json。
+    """
+
+    def __init__(self):
+        self.mode = "pre"          # pre / value / key_or_end / key / colon / after / str / lit / done
+        self.stack: List[_Frame] = []
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self._buf: List[str] = []
+        self._esc = False
+        self._hex: Optional[str] = None    # \uXXXX 收集中
+        self._out: List[Tuple[Tuple[str, ...], Any]] = []
+
+    @property
+    def done(self) -> bool:
+        return self.mode == "done"
+
+    @property
+    def started(self) -> bool:
+        return self.mode != "pre"
+
+    def path(self) -> Tuple[str, ...]:
+        return tuple(f.key for f in self.stack if f.is_obj and f.key is not None)
+
+    def feed(self, text: str) -> List[Tuple[Tuple[str, ...], Any]]:
+        self._out = []
+        for ch in text:
+            if self.error or self.mode == "done":
+                break
+            self._step(ch)
+        return self._out
+
+    # ---- 內部 ---------------------------------------------------------------
+    def _fail(self, msg: str) -> None:
+        self.error = msg
+
+    def _open(self, is_obj: bool) -> None:
+        self.stack.append(_Frame(is_obj))
+        self.mode = "key_or_end" if is_obj else "value"
+
+    def _complete(self, value: Any, container: bool = False) -> None:
+        if not self.stack:
+            self.result = value
+            self.mode = "done"
+            return
+        parent = self.stack[-1]
+        if parent.is_obj:
+            parent.value[parent.key] = value
+            if not (container and isinstance(value, dict)):
+                self._out.append((self.path(), value))
+            parent.key = None
+        else:
+            parent.value.append(value)
+        self.mode = "after"
+
+    def _close(self, ch: str) -> None:
+        frame = self.stack[-1]
+        if frame.is_obj != (ch == "}"):
+            return self._fail(f"unexpected {ch!r}")
+        self.stack.pop()
+        self._complete(frame.value, container=True)
+
+    def _end_literal(self) -> bool:
+        raw = "".join(self._buf)
+        self._buf = []
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            self._fail(f"bad literal {raw!r}")
+            return False
+        self._complete(value)
+        return True
+
+    def _step(self, ch: str) -> None:
+        mode = self.mode
+        if mode == "pre":
+            if ch == "{":
+                self._open(True)
+            return
+        if mode in ("str", "key"):
+            return self._string_char(ch)
+        if mode == "lit":
+            if ch in _LITERAL_CHARS:
+                self._buf.append(ch)
+                return
+            if not self._end_literal():
+                return
+            mode = self.mode          # 分隔字元交給 after 處理
+        if ch in " \t\r\n":
+            return
+        if mode == "value":
+            if ch == "{" or ch == "[":
+                self._open(ch == "{")
+            elif ch == '"':
+                self.mode, self._buf = "str", []
+            elif ch in _LITERAL_CHARS:
+                self.mode, self._buf = "lit", [ch]
+            elif ch == "]" and self.stack and not self.stack[-1].is_obj and not self.stack[-1].value:
+                self._close(ch)       # 空陣列
+            else:
+                self._fail(f"unexpected {ch!r} for value")
+        elif mode == "key_or_end":
+            if ch == '"':
+                self.mode, self._buf = "key", []
+            elif ch == "}":
+                self._close(ch)
+            else:
+                self._fail(f"unexpected {ch!r} for key")
+        elif mode == "colon":
+            if ch == ":":
+                self.mode = "value"
+            else:
+                self._fail(f"expected ':' got {ch!r}")
+        elif mode == "after":
+            if ch == ",":
+                self.mode = "key_or_end" if self.stack[-1].is_obj else "value"
+            elif ch in "}]":
+                self._close(ch)
+            else:
+                self._fail(f"expected ',' got {ch!r}")
+
+    def _string_char(self, ch: str) -> None:
+        if self._hex is not None:
+            self._hex += ch
+            if len(self._hex) == 4:
+                try:
+                    self._buf.append(chr(int(self._hex, 16)))
+                except ValueError:
+                    self._fail(f"bad \\u escape {self._hex!r}")
+                self._hex = None
+            return
+        if self._esc:
+            self._esc = False
+            if ch == "u":
+                self._hex = ""
+            elif ch in _ESCAPES:
+                self._buf.append(_ESCAPES[ch])
+            else:
+                self._fail(f"bad escape \\{ch}")
+            return
+        if ch == "\\":
+            self._esc = True
+        elif ch == '"':
+            s = "".join(self._buf)
+            self._buf = []
+            # 合併 UTF-16 代理對（ensure_ascii 輸出的 emoji 等）
+            s = s.encode("utf-16", "surrogatepass").decode("utf-16", "replace") if any(
+                "\ud800" <= c <= "\udfff" for c in s) else s
+            if self.mode == "key":
+                self.stack[-1].key = s
+                self.mode = "colon"
+            else:
+                self._complete(s)
+        else:
+            self._buf.append(ch)
+
+
+@dataclass
+class FieldEvent:
+    path: Tuple[str, ...]      # 例：('body', 'InvoiceNumber')；扁平 gt_parse 為 ('gt_parse', 'InvoiceNumber')
+    key: str
+    value: Any
+    ok: Optional[bool] = None  # None = 未檢查（沒有 check 函式或不在規則內）
+    error: Optional[str] = None
+
+
+class FieldStream:
+    """
+    包住「文字片段」的迭代器：逐段餵給 IncrementalJsonParser，逐欄產生 FieldEvent。
+    check(key, value) → None（通過/不檢查）或錯誤訊息字串。
+    取消條件：不合格欄位數 ≥ max_bad（max_bad=0 不取消），或前 max_preamble 個字元內都沒有 '{'。
+    取消時會 close() 來源迭代器（Ollama 串流 → 關閉連線，伺服器隨即停止生成）並呼叫 cancel()。
+    """
+
+    def __init__(self, pieces: Iterable[str], check: Optional[Callable[[str, Any], Optional[str]]] = None,
+                 max_bad: int = 2, cancel: Optional[Callable[[], None]] = None, max_preamble: int = 200):
+        self.pieces = pieces
+        self.check = check
+        self.max_bad = max_bad
+        self.cancel_cb = cancel
+        self.max_preamble = max_preamble
+        self.parser = IncrementalJsonParser()
+        self.fields: List[FieldEvent] = []
+        self.bad: List[FieldEvent] = []
+        self.cancelled = False
+        self.reason: Optional[str] = None
+        self._chunks: List[str] = []
+
+    @property
+    def text(self) -> str:
+        return "".join(self._chunks)
+
+    @property
+    def result(self) -> Any:
+        return self.parser.result if self.parser.done else None
+
+    def _event(self, path: Tuple[str, ...], value: Any) -> FieldEvent:
+        key = path[-1] if path else ""
+        ev = FieldEvent(path, key, value)
+        if self.check is not None:
+            err = self.check(key, value)
+            ev.ok = err is None
+            ev.error = err
+        return ev
+
+    def cancel(self, reason: str) -> None:
+        if self.cancelled:
+            return
+        self.cancelled, self.reason = True, reason
+        self._stop()
+
+    def _stop(self) -> None:
+        close = getattr(self.pieces, "close", None)
+        if close is not None:
+            close()
+        if self.cancel_cb is not None:
+            self.cancel_cb()
+
+    def __iter__(self) -> Iterator[FieldEvent]:
+        for piece in self.pieces:
+            if not piece:
+                continue
+            self._chunks.append(piece)
+            for path, value in self.parser.feed(piece):
+                ev = self._event(path, value)
+                self.fields.append(ev)
+                if ev.ok is False:
+                    self.bad.append(ev)
+                yield ev
+                if self.max_bad and len(self.bad) >= self.max_bad:
+                    self.cancel("bad_fields: " + ", ".join(f"{b.key}={b.value!r}" for b in self.bad))
+                    return
+            if not self.parser.started and sum(map(len, self._chunks)) > self.max_preamble:
+                self.cancel("not_json")
+                return
+            if self.parser.done:
+                # 根物件已閉合：剩下的輸出（``` 或說明文字）不必再等
+                self.reason = "json_closed"
+                self._stop()
+                return
@@ -1,8 +1,12 @@
 # VAT_OCR.py  —— 以 Unsloth FastVisionModel 進行推論，並保證輸出為可解析 JSON 字串
+import os, sys
 import re, json, ast
 from typing import Tuple, Any, List, Optional
 from PIL import Image
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # 專案根目錄：共用模組
+from json_repair import repair_json
+
 # ====== 1) 載入模型（僅載入一次）=========================================
 from unsloth import FastVisionModel
 _model = None
@@ -35,88 +39,8 @@ def _extract_first_json_block(text: str) -> str:
     return t
 
 # ====== 3) JSON 修復器：把「幾乎 JSON」修成合法 JSON =====================
-def _repair_json(s: str, schema: Optional[dict] = None) -> Tuple[str, Any, List[str]]:
-    """
-    將「幾乎 JSON」的字串修復成合法 JSON。
-    回傳: (fixed_text, obj, logs)
-      fixed_text: 修復後的 JSON 字串
-      obj:        對應的 Python 物件 (dict/list)
-      logs:       修復步驟紀錄
-    """
-    logs: List[str] = []
-    text = s.strip()
-
-    # 去掉 ```json ... ``` 殼
-    if "```" in text:
-        text = re.sub(r"```(?:json|JSON)?", "", text)
-        text = text.replace("```", "").strip()
-        logs.append("removed code fences")
-
-    # 擷取外層 JSON 區塊
-    text2 = _extract_first_json_block(text)
-    if text2 != text:
-        logs.append("extracted outer JSON-like region")
-        text = text2
-
-    # 先試標準 JSON
-    try:
-        obj = json.loads(text)
-        logs.append("parsed by json")
-        if schema:
-            from jsonschema import validate
-            validate(obj, schema); logs.append("validated by jsonschema")
-        return json.dumps(obj, ensure_ascii=False, indent=2), obj, logs
-    except Exception as e:
-        logs.append(f"json.loads failed: {e}")
-
-    # 再試 Python 字面量（單引號/尾逗號）
-    try:
-        obj = ast.literal_eval(text)
-        logs.append("parsed by ast.literal_eval")
-        if schema:
-            from jsonschema import validate
-            validate(obj, schema); logs.append("validated by jsonschema")
-        return json.dumps(obj, ensure_ascii=False, indent=2), obj, logs
-    except Exception as e:
-        logs.append(f"ast.literal_eval failed: {e}")
-
-    # 常見修補
-    fixed = text.translate(str.maketrans({
-        "\u201c": '"', "\u201d": '"', "\u2018": "'", "\u2019": "'",
-    }))
-    if fixed != text:
-        logs.append("normalized curly quotes")
-
-    fixed2 = re.sub(r'(?<!")\bTrue\b(?!")', "true", fixed)
-    fixed2 = re.sub(r'(?<!")\bFalse\b(?!")', "false", fixed2)
-    fixed2 = re.sub(r'(?<!")\bNone\b(?!")', "null", fixed2)
-    if fixed2 != fixed:
-        logs.append("converted Python literals to JSON")
-    fixed = fixed2
-
-    fixed_no_trailing = re.sub(r",\s*([}\]])", r"\1", fixed)
-    if fixed_no_trailing != fixed:
-        logs.append("removed trailing commas")
-    fixed = fixed_no_trailing
-
-    dq = re.sub(r'(?<!\\)\'', '"', fixed)
-    if dq != fixed:
-        logs.append("replaced single quotes with double quotes")
-    fixed = dq
-
-    try:
-        obj = json.loads(fixed)
-        logs.append("fixed manually then parsed by json")
-        if schema:
-            from jsonschema import validate
-            validate(obj, schema); logs.append("validated by jsonschema")
-        return json.dumps(obj, ensure_ascii=False, indent=2), obj, logs
-    except Exception as e:
-        logs.append(f"final json.loads failed: {e}")
-        fallback = {"raw": s}
-        if schema:
-            logs.append("returned raw because schema validation/parse failed")
-        return json.dumps(fallback, ensure_ascii=False, indent=2), fallback, logs
+# 與 VAT_OCR.repair_json 共用同一個單次掃描容錯解析器
+_repair_json = repair_json
 
 # ====== 4) 正規化輸出鍵，保證有 header/body/tail 結構 ===================
 def _normalize_llm_object(obj: Any) -> dict:
@@ -3,8 +3,8 @@
 Ollama 視覺分類：一次暖機，多次分類（重用 context / 減少 token 與延遲）
 
 用法：
-1) 先暖機（只需一次，之後可重用）：
-   python ollama_fewshot_session_reuse.py --warmup
+1) 先暖機（只需一次，之後可重用；快照過期時也會自動重建）：
+   python ollama_fewshot_session_reuse.py --warmup [--variant triple_invoice]
 
 2) 分類單張影像：
    python ollama_fewshot_session_reuse.py ./invoice2.jpg
@@ -12,38 +12,50 @@ Ollama 視覺分類：一次暖機，多次分類（重用 context / 減少 toke
 3) 批次分類資料夾內所有影像：
    python ollama_fewshot_session_reuse.py --dir ./inbox
 
+4) 併發批次（asyncio；同時最多 N 個請求，結果完成即輸出為 JSONL，每行帶 path）：
+   python ollama_fewshot_session_reuse.py --dir ./inbox --concurrency 8 [--out results.jsonl]
+   （Ollama 端需設定 OLLAMA_NUM_PARALLEL 才會真正平行處理）
+
 說明：
-- 暖機時送出系統規則 + few-shot 影像範例一次，取得並保存 model context（/tmp/ollama_ctx_qwen2p5vl.json）。
+- 暖機時送出系統規則 + few-shot 影像範例一次，取得並保存 model context 快照（context_snapshots.py，
+  預設 ~/.cache/vat_ocr/ollama_ctx/<variant>.ctx + .json）。
+- 快照以「模型 digest + system_msg + 範例影像雜湊/回覆 + NUM_CTX」的指紋辨識；
+  模型更新或提示/範例改動時自動重新暖機，不會誤用舊 context。
+- --variant：default 為全部 8 類範例；指定 doc_class（例如 triple_invoice）則只用該類範例，
+  各 variant 的快照分開保存，可同時存在。
 - 之後每次分類只送一張影像 + 簡短指令 + 上次回傳的 context，
   讓模型「記住」規則與範例，無需每次重發 few-shot，降低 token 與延遲。
 - 若想清除並重建 context，加 --warmup 即可（會覆蓋原檔）。
 
 備註：
 - Ollama 的 chat 介面支援傳入/回傳 context；重用 context 可顯著降低提示長度與計算量。
-- 若 Python 套件版本不接受 keep_alive/context 參數，可改用 requests 直接呼叫 /api/chat。
+- 所有請求走共用的 ollama_client（連線池、5xx/逾時自動重試、--dir 結束時印出延遲統計）。
+- 每次呼叫的伺服器端統計（prompt/輸出 token、載入 / prompt 評估 / decode 秒數）記在 resp["metrics"]，
+  併發批次的每行 JSONL 以 "ollama" 欄位附上；--dir 結束時依策略（session_warmup / session_reuse）
+  印出彙總，可確認 context 重用是否真的縮短 prompt 評估時間、模型多常冷載入。
 """
 
 from __future__ import annotations
 import os
 import sys
 import json
-import base64
-from typing import List, Optional
-try:
-    import requests
-except Exception as e:  # pragma: no cover
-    raise RuntimeError("請先安裝 requests：pip install requests") from e
-
-try:
-    # 官方 ollama Python 客戶端（若版本不支援 context，將改走 REST）
-    from ollama import chat as ollama_chat  # noqa: F401
-except Exception:
-    ollama_chat = None  # 允許缺省，走 REST
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, TextIO
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # 專案根目錄：共用模組
+from vision_budget import encode_image_b64
+from vision_budget import resolve_budget
+from extraction_cache import cached_call, hash_bytes, hash_file, make_key, ollama_model_digest
+from context_snapshots import DEFAULT_CTX_DIR, ContextSnapshotStore, fingerprint
+from ollama_client import get_client, extract_first_json_block
+from tracing import annotate, doc_class_of, span
 
 
 # === 可調參數 ===
 MODEL = "qwen2.5vl:7b"     # 若顯存不足可改 "qwen2.5vl:3b"
-CTX_PATH = "/tmp/ollama_ctx_qwen2p5vl.json"  # 保存 context 的本機檔案
+CTX_DIR = DEFAULT_CTX_DIR  # 保存 context 快照的目錄（VAT_CTX_DIR 可覆寫）
+DEFAULT_VARIANT = "default"
 # 依環境變數覆寫（與 ollama CLI 一致）
 OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
 KEEP_ALIVE = "30m"          # 模型保留在記憶體時間
@@ -51,8 +63,8 @@ NUM_CTX = 8192               # 上下文長度（依機器與模型調整）
 
 
 def img_to_b64(path: str) -> str:
-    with open(path, 'rb') as f:
-        return base64.b64encode(f.read()).decode('utf-8')
+    # 依 vision_budget.DEFAULT_BUDGET 縮圖（環境變數 VAT_VISION_BUDGET）；預設 full 即原檔
+    return encode_image_b64(path)
 
 
 # === 系統規則（可與 Modelfile 串接，見文末說明） ===
@@ -96,10 +108,35 @@ example_answers = [
 ]
 
 
-def build_fewshot_messages() -> list:
+def _doc_class_of(path: str) -> str:
+    # '1_business_invoice.jpg' → 'business_invoice'
+    return os.path.splitext(os.path.basename(path))[0].split("_", 1)[-1]
+
+
+def exemplars_for(variant: Optional[str] = None) -> List[tuple]:
+    """variant 對應的 (影像路徑, 範例回覆)；default = 全部，doc_class = 只取該類範例。"""
+    pairs = list(zip(ex_paths, example_answers))
+    if variant in (None, DEFAULT_VARIANT):
+        return pairs
+    sel = [(p, a) for p, a in pairs if _doc_class_of(p) == variant]
+    if not sel:
+        names = ", ".join(_doc_class_of(p) for p in ex_paths)
+        raise ValueError(f"未知的 variant：{variant}（可用：{DEFAULT_VARIANT}, {names}）")
+    return sel
+
+
+def _warmup_tail_msg(n: int) -> str:
+    return (
+        f"你已讀取 {n} 種範例。接下來我只會送一張影像，"
+        "請直接輸出單一 JSON（不得有多餘文字）。若理解請回覆 READY。"
+    )
+
+
+def build_fewshot_messages(variant: Optional[str] = None) -> list:
     """建立一次性的 few-shot 對話訊息，用於暖機。"""
+    pairs = exemplars_for(variant)
     messages = [{"role": "system", "content": system_msg}]
-    for img_path, ans in zip(ex_paths, example_answers):
+    for img_path, ans in pairs:
         if not os.path.exists(img_path):
             print(f"[警告] 找不到 few-shot 影像：{img_path}")
             b64 = None
@@ -108,112 +145,122 @@ def build_fewshot_messages() -> list:
         messages.append({"role": "user", "content": "請分類這張文件", "images": [b64] if b64 else []})
         messages.append({"role": "assistant", "content": ans})
     # 清楚告知之後的互動規則，請模型只回覆 JSON。
-    messages.append({
-        "role": "user",
-        "content": (
-            "你已讀取 8 種範例。接下來我只會送一張影像，"
-            "請直接輸出單一 JSON（不得有多餘文字）。若理解請回覆 READY。"
-        ),
-    })
+    messages.append({"role": "user", "content": _warmup_tail_msg(len(pairs))})
     return messages
 
 
-def chat_once(messages: list, fmt: Optional[str] = None, context: Optional[list] = None):
+def chat_once(messages: list, fmt: Optional[str] = None, context: Optional[list] = None,
+              strategy: str = "session_warmup"):
     """呼叫 Ollama /api/chat，支援 format/context/keep_alive/options。
 
-    備註：部分 ollama Python 套件版本不接受 chat(context=...)，故統一改走 REST，
+    備註：部分 ollama Python 套件版本不接受 chat(context=...)，故統一走 ollama_client（REST），
     以確保 context 能正確傳遞與回傳。
     """
-    payload = {
-        "model": MODEL,
-        "messages": messages,
-        "stream": False,
-        "keep_alive": KEEP_ALIVE,
-        "options": {"temperature": 0, "seed": 42, "num_ctx": NUM_CTX},
-    }
-    if fmt is not None:
-        payload["format"] = fmt
-    if context is not None:
-        payload["context"] = context
-
-    url = f"{OLLAMA_HOST.rstrip('/')}/api/chat"
-    r = requests.post(url, json=payload, timeout=300)
-    r.raise_for_status()
-    return r.json()
-
-
-def save_context(ctx: list) -> None:
-    os.makedirs(os.path.dirname(CTX_PATH), exist_ok=True)
-    with open(CTX_PATH, "w", encoding="utf-8") as f:
-        json.dump({"context": ctx}, f)
-
-
-def load_context() -> Optional[list]:
-    if not os.path.exists(CTX_PATH):
-        return None
-    try:
-        with open(CTX_PATH, "r", encoding="utf-8") as f:
-            obj = json.load(f)
-            return obj.get("context")
-    except Exception:
-        return None
-
-
-def warmup() -> list:
-    """送出系統規則 + few-shot 一次，並保存 context。"""
-    messages = build_fewshot_messages()
-    resp = chat_once(messages, fmt=None, context=None)
-    # 取得 context 重用
-    ctx = resp.get("context") or []
-    save_context(ctx)
-    print("[暖機完成] context 已保存。模型回覆：", resp.get("message", {}).get("content"))
-    return ctx
-
-
-def _extract_first_json_block(text: str) -> str:
-    depth = 0
-    start = -1
-    for i, ch in enumerate(text or ""):
-        if ch == '{':
-            if depth == 0:
-                start = i
-            depth += 1
-        elif ch == '}':
-            if depth > 0:
-                depth -= 1
-                if depth == 0 and start != -1:
-                    return text[start:i+1]
-    return text
-
-
-def classify_image(img_path: str, ctx: Optional[list]) -> str:
-    """使用既有 context 分類新影像，回傳 JSON 字串。"""
+    return get_client(OLLAMA_HOST).chat(
+        MODEL, messages, fmt=fmt, context=context, keep_alive=KEEP_ALIVE,
+        options={"temperature": 0, "seed": 42, "num_ctx": NUM_CTX}, strategy=strategy,
+    )
+
+
+_snapshots = ContextSnapshotStore(CTX_DIR)
+
+
+def context_fingerprint(variant: Optional[str] = None) -> str:
+    """模型 digest + system_msg + 範例（影像雜湊、回覆）+ NUM_CTX + 影像預算 → 快照指紋。"""
+    pairs = exemplars_for(variant)
+    exemplars = [(hash_file(p) if os.path.exists(p) else "missing", a) for p, a in pairs]
+    return fingerprint(
+        ollama_model_digest(MODEL, OLLAMA_HOST), system_msg, exemplars, NUM_CTX,
+        extra={"tail": _warmup_tail_msg(len(pairs)), "budget": repr(resolve_budget(None))},
+    )
+
+
+def save_context(ctx: list, variant: Optional[str] = None) -> None:
+    _snapshots.save(variant or DEFAULT_VARIANT, context_fingerprint(variant), ctx,
+                    info={"model": MODEL, "num_ctx": NUM_CTX})
+
+
+def load_context(variant: Optional[str] = None) -> Optional[list]:
+    """回傳指紋相符的 context；沒有快照或已過期（模型/提示/範例變更）回傳 None。"""
+    return _snapshots.load(variant or DEFAULT_VARIANT, context_fingerprint(variant))
+
+
+def _warmup_tokens(variant: Optional[str]) -> list:
+    resp = chat_once(build_fewshot_messages(variant), fmt=None, context=None)
+    print(f"[暖機完成] variant={variant or DEFAULT_VARIANT} context 已保存。模型回覆：",
+          resp.get("message", {}).get("content"))
+    return resp.get("context") or []
+
+
+def warmup(variant: Optional[str] = None) -> list:
+    """送出系統規則 + few-shot 一次，並保存 context 快照（覆蓋同 variant 的舊快照）。"""
+    return _snapshots.get_or_build(variant or DEFAULT_VARIANT, context_fingerprint(variant),
+                                   lambda: _warmup_tokens(variant), force=True,
+                                   info={"model": MODEL, "num_ctx": NUM_CTX})
+
+
+def get_context(variant: Optional[str] = None) -> list:
+    """有相符快照就用（mmap 讀取），否則自動暖機重建。"""
+    return _snapshots.get_or_build(variant or DEFAULT_VARIANT, context_fingerprint(variant),
+                                   lambda: _warmup_tokens(variant),
+                                   info={"model": MODEL, "num_ctx": NUM_CTX})
+
+
+_extract_first_json_block = extract_first_json_block  # 舊名稱相容
+
+
+CLASSIFY_USER_MSG = (
+    "請分析這張文件並輸出單一 JSON。"
+    "1) 選擇 doc_class（上列九類其一）。"
+    "2) 擷取 header/body/tail 相關欄位；不確定的設為 null 或省略。"
+    "3) 僅輸出 JSON，不加解說。"
+)
+
+
+def classify_image(img_path: str, ctx: Optional[list], cache=None, with_metrics: bool = False):
+    """使用既有 context 分類新影像，回傳 JSON 字串。
+
+    cache：None → extraction_cache 行程共用快取；False → 不使用。
+    key 含影像內容、模型 digest、指令、context（暖機內容）與解碼參數。
+    with_metrics：True → 回傳 (JSON 字串, ollama_client.request_metrics)；快取命中時 metrics 為 None。
+    """
     if not os.path.exists(img_path):
         raise FileNotFoundError(img_path)
 
-    b64 = img_to_b64(img_path)
+    def _key():
+        return make_key(
+            image_path=img_path,
+            model=ollama_model_digest(MODEL, OLLAMA_HOST),
+            prompt={"user": CLASSIFY_USER_MSG, "context": hash_bytes(json.dumps(ctx or []).encode("utf-8"))},
+            options={"temperature": 0, "seed": 42, "num_ctx": NUM_CTX},
+        )
 
-    user_msg = (
-        "請分析這張文件並輸出單一 JSON。"
-        "1) 選擇 doc_class（上列九類其一）。"
-        "2) 擷取 header/body/tail 相關欄位；不確定的設為 null 或省略。"
-        "3) 僅輸出 JSON，不加解說。"
-    )
+    metrics = {}
+
+    def _run():
+        resp = classify_image_response(img_path, ctx)
+        metrics.update(resp.get("metrics") or {})
+        return resp.get("message", {}).get("content", "")
+
+    with span("classify_image", backend="session", model=MODEL, image=img_path) as sp:
+        content = cached_call(cache, _key, _run)
+        if sp:
+            annotate(doc_class=doc_class_of(content))
+    return (content, metrics or None) if with_metrics else content
+
+
+def classify_image_response(img_path: str, ctx: Optional[list]) -> dict:
+    """不經快取分類一次，回傳完整 Ollama 回應（resp["metrics"]：token 數與伺服器端各階段秒數）。"""
+    b64 = img_to_b64(img_path)
+    user_msg = CLASSIFY_USER_MSG
 
     messages = [{"role": "user", "content": user_msg, "images": [b64]}]
 
-    # 先嘗試 JSON 模式
-    try:
-        resp = chat_once(messages, fmt="json", context=ctx)
-        content = resp.get("message", {}).get("content", "")
-        if not content:
-            raise RuntimeError("空回覆")
-        return content
-    except Exception as e:
-        # 退而求其次：非 JSON 格式，手動擷取第一段 JSON
-        resp = chat_once(messages, fmt=None, context=ctx)
-        raw = resp.get("message", {}).get("content", "")
-        return _extract_first_json_block(raw)
+    # 先嘗試 JSON 模式；失敗或空回覆時 client 改用非 JSON 格式並擷取第一段 JSON
+    return get_client(OLLAMA_HOST).chat_json(
+        MODEL, messages, fmt="json", context=ctx, keep_alive=KEEP_ALIVE,
+        options={"temperature": 0, "seed": 42, "num_ctx": NUM_CTX}, strategy="session_reuse",
+    )
 
 
 def list_images_in_dir(d: str) -> List[str]:
@@ -226,21 +273,115 @@ def list_images_in_dir(d: str) -> List[str]:
     return sorted(files)
 
 
+def iter_images_in_dir(d: str) -> Iterator[str]:
+    """同 list_images_in_dir，但以 os.scandir 逐筆產生、不排序，超大資料夾也不需先載入完整清單。"""
+    exts = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff"}
+    with os.scandir(d) as it:
+        for entry in it:
+            if entry.is_file() and os.path.splitext(entry.name)[1].lower() in exts:
+                yield entry.path
+
+
+async def classify_dir_async(directory: str, ctx: Optional[list], concurrency: int = 4,
+                             out: TextIO = sys.stdout) -> dict:
+    """
+    併發分類整個資料夾：
+    - 最多 concurrency 個請求同時在跑（每個請求在專用的 concurrency 個執行緒中呼叫 classify_image；
+      不用 asyncio.to_thread，預設 executor 只有 min(32, CPU+4) 個執行緒，會默默壓低併發數）
+    - 待處理佇列上限 2 × concurrency，檔名由產生器逐筆放入 → 記憶體不隨資料夾大小成長
+    - 每張完成就寫出一行 JSON：{"path", "ok", "result" | "error", "elapsed_s", "ollama"}（完成順序，非檔名順序）；
+      ollama 為伺服器端統計（快取命中時為 null）
+    回傳統計 {"total", "ok", "failed", "elapsed_s"}。
+    """
+    concurrency = max(1, concurrency)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=2 * concurrency)
+    stats = {"total": 0, "ok": 0, "failed": 0}
+    t_start = time.perf_counter()
+
+    async def producer():
+        for p in iter_images_in_dir(directory):
+            await queue.put(p)         # 佇列滿時在此等待 → 背壓
+        for _ in range(concurrency):
+            await queue.put(None)      # 每個 worker 一個結束訊號
+
+    loop = asyncio.get_running_loop()
+    pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="classify")
+    get_client(OLLAMA_HOST, pool_size=concurrency)   # 連線池跟著併發數，每個執行緒都能重用 keep-alive 連線
+
+    async def worker():
+        while True:
+            p = await queue.get()
+            if p is None:
+                return
+            t0 = time.perf_counter()
+            try:
+                result, metrics = await loop.run_in_executor(pool, classify_image, p, ctx, None, True)
+                rec = {"path": p, "ok": True, "result": result, "ollama": metrics}
+                stats["ok"] += 1
+            except Exception as e:
+                rec = {"path": p, "ok": False, "error": f"{type(e).__name__}: {e}"}
+                stats["failed"] += 1
+            stats["total"] += 1
+            rec["elapsed_s"] = round(time.perf_counter() - t0, 3)
+            out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            out.flush()
+
+    try:
+        await asyncio.gather(producer(), *(worker() for _ in range(concurrency)))
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    stats["elapsed_s"] = round(time.perf_counter() - t_start, 3)
+    return stats
+
+
+def print_usage(out: TextIO = sys.stderr) -> None:
+    """依 (model, strategy) 印出伺服器端統計：context 重用的 prompt 評估時間、冷載入次數、decode 吞吐量。"""
+    for key, u in get_client(OLLAMA_HOST).usage_stats().items():
+        print(f"[usage] {key}: calls={u['calls']} prompt_tokens={u['prompt_tokens_mean']} "
+              f"prompt_eval={u['prompt_eval_s_mean']:.3f}s (p95 {u['prompt_eval_s_p95']:.3f}s) "
+              f"cold_loads={u['cold_loads']} decode={u['decode_tok_s']} tok/s", file=out)
+
+
+def _pop_option(argv: List[str], name: str, default=None):
+    if name in argv:
+        i = argv.index(name)
+        value = argv[i + 1]
+        del argv[i:i + 2]
+        return value
+    return default
+
+
 if __name__ == "__main__":
     # 命令列介面
-    if len(sys.argv) >= 2 and sys.argv[1] == "--warmup":
-        warmup()
+    argv = sys.argv[1:]
+    variant = _pop_option(argv, "--variant")
+    if argv and argv[0] == "--warmup":
+        warmup(variant)
         sys.exit(0)
 
     # 載入或建立 context
-    ctx = load_context()
+    ctx = load_context(variant)
     if ctx is None:
-        print("[提示] 未找到既有 context，先進行一次暖機……")
-        ctx = warmup()
-
-    if len(sys.argv) >= 3 and sys.argv[1] == "--dir":
+        print("[提示] 未找到相符的 context 快照（首次執行，或模型/提示/範例已變更），先進行一次暖機……")
+        ctx = warmup(variant)
+
+    concurrency = _pop_option(argv, "--concurrency")
+    out_path = _pop_option(argv, "--out")
+
+    if len(argv) >= 2 and argv[0] == "--dir" and concurrency is not None:
+        # 併發批次分類（結果以 JSONL 串流輸出）
+        out_f = open(out_path, "a", encoding="utf-8") if out_path else sys.stdout
+        try:
+            stats = asyncio.run(classify_dir_async(argv[1], ctx, int(concurrency), out_f))
+        finally:
+            if out_path:
+                out_f.close()
+        print(f"[完成] {stats}", file=sys.stderr)
+        print(f"[ollama] {get_client(OLLAMA_HOST).stats()}", file=sys.stderr)
+        print_usage()
+    elif len(argv) >= 2 and argv[0] == "--dir":
         # 批次分類
-        directory = sys.argv[2]
+        directory = argv[1]
         imgs = list_images_in_dir(directory)
         if not imgs:
             print(f"[訊息] {directory} 無影像檔")
@@ -250,9 +391,10 @@ if __name__ == "__main__":
             print("====", p)
             print(out)
             print()
+        print_usage()
     else:
         # 分類單檔（預設路徑可自行修改）
-        img_path = sys.argv[1] if len(sys.argv) > 1 else "./invoice2.jpg"
+        img_path = argv[0] if argv else "./invoice2.jpg"
         out = classify_image(img_path, ctx)
         print(out)
 
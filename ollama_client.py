@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+"""
+共用的 Ollama REST client：所有呼叫 /api/chat 的入口都走這裡。
+
+- keep-alive 連線池（requests.Session + HTTPAdapter），不再每次請求重新建立連線
+- 5xx / 連線錯誤 / 逾時 → 指數退避重試（含抖動）；4xx 直接拋出
+- 每次呼叫可給 deadline（秒）：所有重試加總不超過 deadline，單次逾時也會被截短
+- chat_json()：先用 format（"json" 或 JSON Schema），失敗或空回覆時改用無 format 再擷取第一段 JSON
+- chat_stream()：stream=True，逐段產生 NDJSON 回應（message.content 為新增的文字）；
+  提早關閉產生器即關閉連線，伺服器隨即停止生成
+- chat()：tracing 開啟時記一個 ollama_chat span，並把伺服器回報的 load / prompt_eval / eval_duration
+  補記成 ollama_load、prefill、decode 階段
+- stats()：請求數、重試數、錯誤數、JSON fallback 次數與延遲（平均/p50/p95/max）
+- 伺服器端統計：每次 chat（與串流的最後一個 chunk）都把 prompt_eval_count / eval_count /
+  load_duration / prompt_eval_duration / eval_duration 換算成秒與 token/s，放在 resp["metrics"]，
+  並依 (model, strategy) 累計；usage_stats() 看各提示策略的 prompt 評估時間、冷載入比例與 decode 吞吐量
+
+用法：
+    from ollama_client import get_client
+    resp = get_client().chat("qwen2.5vl:7b", messages, fmt="json", options={"temperature": 0})
+    content = resp["message"]["content"]
+
+主機位址：環境變數 OLLAMA_HOST（與 ollama CLI 一致），預設 http://localhost:11434
+"""
+
+from __future__ import annotations
+import os
+import json
+import time
+import random
+import threading
+from collections import deque
+from typing import Any, Dict, Iterator, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from tracing import record, span
+
+DEFAULT_HOST = "http://localhost:11434"
+COLD_LOAD_S = 0.5            # load_duration 超過這個秒數視為模型冷載入（已在記憶體時通常只有幾 ms）
+DEFAULT_STRATEGY = "default"
+DEFAULT_POOL_SIZE = 16       # 每個 host 的 keep-alive 連線數；併發更高時由 get_client(pool_size=...) 擴大
+
+
+class OllamaError(RuntimeError):
+    """Ollama 呼叫失敗（重試用盡、逾時或 4xx）。status 為 HTTP 狀態碼（連線錯誤時為 None）。"""
+    def __init__(self, msg: str, status: Optional[int] = None):
+        super().__init__(msg)
+        self.status = status
+
+
+def normalize_host(host: Optional[str]) -> str:
+    host = (host or os.environ.get("OLLAMA_HOST") or DEFAULT_HOST).strip().rstrip("/")
+    if host.endswith("/api/chat"):          # 允許直接給 /api/chat 完整網址（streamlit 設定欄位）
+        host = host[: -len("/api/chat")]
+    if "://" not in host:
+        host = "http://" + host
+    return host
+
+
+def extract_first_json_block(text: str) -> str:
+    depth = 0
+    start = -1
+    for i, ch in enumerate(text or ""):
+        if ch == '{':
+            if depth == 0:
+                start = i
+            depth += 1
+        elif ch == '}':
+            if depth > 0:
+                depth -= 1
+                if depth == 0 and start != -1:
+                    return text[start:i+1]
+    return text
+
+
+def request_metrics(resp: Dict[str, Any]) -> Dict[str, Any]:
+    """/api/chat 回應（或串流 done chunk）的伺服器端統計：奈秒換成秒，另算 prefill / decode 的 token/s。"""
+    def sec(key):
+        return (resp.get(key) or 0) / 1e9
+    m: Dict[str, Any] = {
+        "model": resp.get("model"),
+        "prompt_tokens": resp.get("prompt_eval_count") or 0,   # prompt 全部命中快取時伺服器會省略
+        "output_tokens": resp.get("eval_count") or 0,
+        "load_s": sec("load_duration"),
+        "prompt_eval_s": sec("prompt_eval_duration"),
+        "eval_s": sec("eval_duration"),
+        "total_s": sec("total_duration"),
+    }
+    m["cold_load"] = m["load_s"] >= COLD_LOAD_S
+    m["prefill_tok_s"] = round(m["prompt_tokens"] / m["prompt_eval_s"], 1) if m["prompt_eval_s"] else None
+    m["decode_tok_s"] = round(m["output_tokens"] / m["eval_s"], 1) if m["eval_s"] else None
+    return m
+
+
+class UsageStats:
+    """依 (model, strategy) 累計 request_metrics。"""
+
+    _SUMS = ("prompt_tokens", "output_tokens", "load_s", "prompt_eval_s", "eval_s", "total_s")
+
+    def __init__(self, max_samples: int = 2048):
+        self._lock = threading.Lock()
+        self._groups: Dict[tuple, dict] = {}
+        self.max_samples = max_samples
+
+    def add(self, model: str, strategy: Optional[str], m: Dict[str, Any]) -> None:
+        key = (model, strategy or DEFAULT_STRATEGY)
+        with self._lock:
+            g = self._groups.get(key)
+            if g is None:
+                g = self._groups[key] = {"calls": 0, "cold_loads": 0, **{k: 0 for k in self._SUMS},
+                                         "prompt_eval_samples": deque(maxlen=self.max_samples)}
+            g["calls"] += 1
+            g["cold_loads"] += bool(m["cold_load"])
+            for k in self._SUMS:
+                g[k] += m[k]
+            g["prompt_eval_samples"].append(m["prompt_eval_s"])
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """{"<model>|<strategy>": {...}}：平均 prompt/output token、prompt 評估時間、冷載入比例、吞吐量。"""
+        out = {}
+        with self._lock:
+            items = [(k, dict(g), sorted(g["prompt_eval_samples"])) for k, g in self._groups.items()]
+        for (model, strategy), g, pe in items:
+            n = g["calls"]
+            out[f"{model}|{strategy}"] = {
+                "model": model,
+                "strategy": strategy,
+                "calls": n,
+                "cold_loads": g["cold_loads"],
+                "cold_load_rate": round(g["cold_loads"] / n, 4),
+                "prompt_tokens_mean": round(g["prompt_tokens"] / n, 1),
+                "output_tokens_mean": round(g["output_tokens"] / n, 1),
+                "load_s_mean": round(g["load_s"] / n, 4),
+                "prompt_eval_s_mean": round(g["prompt_eval_s"] / n, 4),
+                "prompt_eval_s_p50": round(pe[len(pe) // 2], 4),
+                "prompt_eval_s_p95": round(pe[min(len(pe) - 1, int(len(pe) * 0.95))], 4),
+                "eval_s_mean": round(g["eval_s"] / n, 4),
+                "total_s_mean": round(g["total_s"] / n, 4),
+                "prefill_tok_s": round(g["prompt_tokens"] / g["prompt_eval_s"], 1) if g["prompt_eval_s"] else None,
+                "decode_tok_s": round(g["output_tokens"] / g["eval_s"], 1) if g["eval_s"] else None,
+            }
+        return out
+
+    def reset(self) -> None:
+        with self._lock:
+            self._groups.clear()
+
+
+class OllamaClient:
+    def __init__(self, host: Optional[str] = None, timeout: float = 300.0, max_retries: int = 3,
+                 backoff: float = 0.5, backoff_max: float = 8.0, pool_size: int = DEFAULT_POOL_SIZE):
+        self.host = normalize_host(host)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        self.pool_size = 0
+        self._lock = threading.Lock()
+        self.ensure_pool_size(pool_size)
+        self._latencies: deque = deque(maxlen=2048)
+        self._counters = {"requests": 0, "retries": 0, "errors": 0, "json_fallbacks": 0}
+        self.usage = UsageStats()
+
+    def ensure_pool_size(self, pool_size: int) -> None:
+        """
+        連線池至少能同時保留 pool_size 條連線（只會擴大）。連線池小於併發數時，
+        多出來的請求每次都得重新建立連線、用完即丟（urllib3 的 "Connection pool is full"）。
+        """
+        pool_size = max(1, int(pool_size))
+        with self._lock:
+            if pool_size <= self.pool_size:
+                return
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+            self.pool_size = pool_size
+
+    # ---- 底層 --------------------------------------------------------------
+    def _post(self, path: str, payload: dict, deadline: Optional[float] = None,
+              stream: bool = False) -> requests.Response:
+        return self._request("POST", path, payload, deadline, stream)
+
+    def _request(self, method: str, path: str, payload: Optional[dict] = None, deadline: Optional[float] = None,
+                 stream: bool = False) -> requests.Response:
+        url = f"{self.host}{path}"
+        t_end = time.monotonic() + deadline if deadline else None
+        attempt = 0
+        while True:
+            timeout = self.timeout
+            if t_end is not None:
+                timeout = min(timeout, t_end - time.monotonic())
+                if timeout <= 0:
+                    self._count("errors")
+                    raise OllamaError(f"deadline exceeded ({deadline}s) for {path}")
+            t0 = time.perf_counter()
+            err: Optional[Exception] = None
+            status = None
+            try:
+                r = self.session.request(method, url, json=payload, timeout=timeout, stream=stream)
+                status = r.status_code
+                if status < 500:
+                    with self._lock:
+                        self._counters["requests"] += 1
+                        self._latencies.append(time.perf_counter() - t0)
+                    if status >= 400:
+                        self._count("errors")
+                        raise OllamaError(f"HTTP {status}: {r.text[:500]}", status)
+                    return r
+                err = OllamaError(f"HTTP {status}: {r.text[:500]}", status)
+                r.close()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                err = e
+
+            with self._lock:
+                self._counters["requests"] += 1
+            attempt += 1
+            sleep = min(self.backoff_max, self.backoff * (2 ** (attempt - 1))) * (0.5 + random.random() / 2)
+            out_of_time = t_end is not None and time.monotonic() + sleep >= t_end
+            if attempt > self.max_retries or out_of_time:
+                self._count("errors")
+                if isinstance(err, OllamaError):
+                    raise err
+                raise OllamaError(f"{type(err).__name__}: {err}", status) from err
+            self._count("retries")
+            time.sleep(sleep)
+
+    def _count(self, key: str, n: int = 1) -> None:
+        with self._lock:
+            self._counters[key] += n
+
+    # ---- API ---------------------------------------------------------------
+    @staticmethod
+    def _chat_payload(model: str, messages: List[dict], stream: bool, fmt: Any = None,
+                      options: Optional[dict] = None, context: Optional[list] = None,
+                      keep_alive: Optional[str] = None) -> Dict[str, Any]:
+        payload: Dict[str, Any] = {"model": model, "messages": messages, "stream": stream}
+        if options is not None:
+            payload["options"] = options
+        if fmt is not None:
+            payload["format"] = fmt
+        if context is not None:
+            payload["context"] = context
+        if keep_alive is not None:
+            payload["keep_alive"] = keep_alive
+        return payload
+
+    def chat(self, model: str, messages: List[dict], fmt: Any = None, options: Optional[dict] = None,
+             context: Optional[list] = None, keep_alive: Optional[str] = None,
+             deadline: Optional[float] = None, strategy: Optional[str] = None) -> Dict[str, Any]:
+        """
+        POST /api/chat（stream=False），回傳完整回應 dict；resp["metrics"] 為 request_metrics()。
+        strategy：提示策略名稱（例如 fewshot、session_reuse），usage_stats() 依此分組。
+        """
+        payload = self._chat_payload(model, messages, False, fmt, options, context, keep_alive)
+        with span("ollama_chat", model=model, strategy=strategy) as sp:
+            resp = self._post("/api/chat", payload, deadline).json()
+            m = self._account(model, strategy, resp)
+            if sp:
+                record("ollama_load", m["load_s"])
+                record("prefill", m["prompt_eval_s"])
+                record("decode", m["eval_s"])
+                sp.set(prompt_tokens=m["prompt_tokens"], output_tokens=m["output_tokens"], cold_load=m["cold_load"])
+        return resp
+
+    def _account(self, model: str, strategy: Optional[str], resp: Dict[str, Any]) -> Dict[str, Any]:
+        m = resp["metrics"] = request_metrics(resp)
+        self.usage.add(resp.get("model") or model, strategy, m)
+        return m
+
+    def chat_stream(self, model: str, messages: List[dict], fmt: Any = None, options: Optional[dict] = None,
+                    context: Optional[list] = None, keep_alive: Optional[str] = None,
+                    deadline: Optional[float] = None, strategy: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """
+        POST /api/chat（stream=True），逐一產生伺服器送來的 chunk dict；
+        最後一個 chunk 的 done 為 True，帶有 eval_count 等統計（同 chat() 換算後放在 chunk["metrics"]）。
+        重試只發生在連線建立階段；串流開始後中斷會拋出 OllamaError。
+        呼叫端 close() 產生器（或 break 出迴圈後被回收）即關閉連線、取消生成。
+        """
+        payload = self._chat_payload(model, messages, True, fmt, options, context, keep_alive)
+        r = self._post("/api/chat", payload, deadline, stream=True)
+        try:
+            for line in r.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if chunk.get("error"):
+                    self._count("errors")
+                    raise OllamaError(f"stream error: {chunk['error']}")
+                if chunk.get("done"):
+                    self._account(model, strategy, chunk)
+                    yield chunk
+                    break
+                yield chunk
+        except (requests.ConnectionError, requests.Timeout) as e:
+            self._count("errors")
+            raise OllamaError(f"{type(e).__name__}: {e}") from e
+        finally:
+            r.close()
+
+    def chat_stream_text(self, model: str, messages: List[dict], **kwargs) -> Iterator[str]:
+        """chat_stream 只取每段新增的 message.content（給 json_stream.FieldStream 用）。"""
+        chunks = self.chat_stream(model, messages, **kwargs)
+        try:
+            for chunk in chunks:
+                piece = (chunk.get("message") or {}).get("content")
+                if piece:
+                    yield piece
+        finally:
+            chunks.close()
+
+    def chat_json(self, model: str, messages: List[dict], fmt: Any = "json", **kwargs) -> Dict[str, Any]:
+        """
+        JSON 模式 + 後備：先帶 format 呼叫；伺服器/模型不吃 format（錯誤）或回空字串時，
+        改用無 format 重送並擷取第一段 {...}。回傳的 resp 內 message.content 即 JSON 文字，
+        resp["json_fallback"] 標示是否走了後備路徑。
+        """
+        try:
+            resp = self.chat(model, messages, fmt=fmt, **kwargs)
+            if (resp.get("message") or {}).get("content", "").strip():
+                resp["json_fallback"] = False
+                return resp
+        except OllamaError as e:
+            if e.status is None or e.status >= 500:
+                raise                 # 連線/伺服器問題：重試已用盡，不必再送一次
+        self._count("json_fallbacks")
+        resp = self.chat(model, messages, fmt=None, **kwargs)
+        msg = resp.setdefault("message", {})
+        msg["content"] = extract_first_json_block(msg.get("content", ""))
+        resp["json_fallback"] = True
+        return resp
+
+    def tags(self, deadline: Optional[float] = 10.0) -> dict:
+        return self._request("GET", "/api/tags", deadline=deadline).json()
+
+    def show(self, model: str, deadline: Optional[float] = 10.0) -> dict:
+        return self._post("/api/show", {"model": model}, deadline).json()
+
+    def usage_stats(self) -> Dict[str, Dict[str, Any]]:
+        """依 (model, strategy) 彙整的伺服器端統計，見 UsageStats.summary()。"""
+        return self.usage.summary()
+
+    def stats(self) -> dict:
+        with self._lock:
+            c = dict(self._counters)
+            lat = sorted(self._latencies)
+        if lat:
+            c["latency_mean_s"] = sum(lat) / len(lat)
+            c["latency_p50_s"] = lat[len(lat) // 2]
+            c["latency_p95_s"] = lat[min(len(lat) - 1, int(len(lat) * 0.95))]
+            c["latency_max_s"] = lat[-1]
+        return c
+
+
+_clients: Dict[str, OllamaClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(host: Optional[str] = None, pool_size: Optional[int] = None) -> OllamaClient:
+    """
+    同一個 host 共用一個 client（同一個連線池與統計）。
+    pool_size：呼叫端的併發數；連線池不足時擴大到這個大小（None → 至少 DEFAULT_POOL_SIZE）。
+    """
+    key = normalize_host(host)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = OllamaClient(key, pool_size=max(pool_size or 0, DEFAULT_POOL_SIZE))
+        client = _clients[key]
+    if pool_size is not None:
+        client.ensure_pool_size(pool_size)
+    return client
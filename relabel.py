@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+標註清洗批次工作（VAT_finetune_inference.ipynb 的 label-cleaning 迴圈）：
+每張圖跑 chat_once + check_compliance，全通過 → label/<mode>_new，否則 → label/<mode>_fail。
+
+與 notebook 版的差別：
+  - 進度清單（manifest，label/<mode>_relabel_manifest.jsonl）：每完成一筆附加一行並 fsync，
+    當機或 Ctrl-C 後重跑會略過已完成的項目；判斷依據是影像內容雜湊 + 工作設定（backend / model / doc_class）
+    + 模型權重 digest（local：VAT_model adapter 內容雜湊；ollama：/api/tags 的 digest），
+    影像被換掉、換了模型或重新訓練就會重跑
+  - 一律不經抽取結果快取：--retry-fail 與重新訓練後的重跑都是真的重新推論
+  - 結果檔先寫暫存檔再 os.replace，不會留下寫一半的 JSON；manifest 在結果檔落地後才記錄
+  - 多個 model worker：local → 每個 worker 一個行程、各自載入模型（--devices 0,1 指定各自的 GPU）；
+    ollama → 多執行緒並行送請求。寫檔與 manifest 只在主行程進行
+  - 每筆回報 throughput 與 ETA，結束時寫 label/<mode>_relabel_summary.json
+
+用法：
+    python relabel.py --root ../AllDataset/VAT-OCR --doc-class triple_receipt --mode train --devices 0,1
+    python relabel.py --root ../AllDataset/VAT-OCR --doc-class triple_invoice --backend ollama --workers 4
+    python relabel.py ... --retry-fail      # 上次判為 fail 的也重跑
+"""
+
+from __future__ import annotations
+import os
+import sys
+import json
+import time
+import argparse
+import hashlib
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from extraction_cache import hash_file, model_dir_digest, ollama_model_digest
+
+STATUS_PASS = "pass"
+STATUS_FAIL = "fail"
+STATUS_ERROR = "error"
+
+
+# ---- 檔案工具 -----------------------------------------------------------------
+def atomic_write_json(path: str, obj: Any) -> None:
+    """寫到同目錄的暫存檔、fsync 後 os.replace：讀者只會看到舊檔或完整的新檔。"""
+    tmp = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Manifest:
+    """
+    append-only JSONL：一行一筆 {entry, hash, status, dest, failed, seconds, error, ts}，同一 entry 以最後一行為準。
+    載入時略過寫到一半的最後一行（當機時可能發生）。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.records: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.records[rec["entry"]] = rec
+        self._f = open(path, "a", encoding="utf-8")
+
+    def done(self, entry: str, content_hash: str, retry_fail: bool = False) -> bool:
+        rec = self.records.get(entry)
+        if rec is None or rec.get("hash") != content_hash:
+            return False
+        if rec["status"] == STATUS_ERROR or (retry_fail and rec["status"] == STATUS_FAIL):
+            return False
+        return bool(rec.get("dest")) and os.path.exists(rec["dest"])
+
+    def append(self, rec: dict) -> None:
+        self.records[rec["entry"]] = rec
+        self._f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def close(self) -> None:
+        self._f.close()
+
+
+# ---- 單筆處理（在 worker 中執行） --------------------------------------------------
+_backend = None   # worker 內的推論函式：img_path → 模型輸出（dict 或 JSON 字串）
+
+
+def _init_worker(backend: str, model: str, devices=None) -> None:
+    """每個 worker 啟動時呼叫一次：指定 GPU、載入模型。"""
+    global _backend
+    if devices is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(devices.get())
+    # cache=False：--retry-fail 重跑同一張圖時要真的重新推論，不能拿回快取裡同一份不合格輸出
+    if backend == "local":
+        import functools
+        import VAT_OCR
+        VAT_OCR._load_model_once()
+        _backend = functools.partial(VAT_OCR.chat_once, cache=False)
+    else:
+        root = os.path.dirname(os.path.abspath(__file__))
+        sys.path.insert(0, os.path.join(root, "docvqa"))
+        from docvqa_final2 import infer_image_json
+        _backend = lambda p: infer_image_json(p, model=model, cache=False)
+
+
+def process_entry(entry: str, img_path: str, doc_class: str) -> dict:
+    """chat_once → 指定 doc_class → check_compliance；回傳結果 dict（不寫檔）。"""
+    from VAT_OCR import check_compliance, flatten_sections, repair_json
+    t0 = time.perf_counter()
+    out: Dict[str, Any] = {"entry": entry}
+    model_output = None
+    try:
+        model_output = _backend(img_path)
+        obj = model_output if isinstance(model_output, dict) else repair_json(model_output)[1]
+        obj = flatten_sections(obj)
+        obj["gt_parse"]["doc_class"] = doc_class      # 與 notebook 相同：以資料夾類別為準
+        compliance, edit_string = check_compliance(obj)
+        bool_flags = [v for v in compliance.values() if isinstance(v, bool)]
+        out["status"] = STATUS_PASS if bool_flags and all(bool_flags) else STATUS_FAIL
+        out["failed"] = [k for k, v in compliance.items() if v is False]
+        out["payload"] = edit_string["gt_parse"]
+    except Exception as e:
+        # 與 notebook 相同：保留模型原輸出，避免遺失樣本
+        out["status"] = STATUS_ERROR
+        out["error"] = f"{type(e).__name__}: {e}"
+        out["payload"] = {"raw": model_output if isinstance(model_output, (str, type(None))) else str(model_output)}
+    out["seconds"] = time.perf_counter() - t0
+    return out
+
+
+# ---- 進度 ---------------------------------------------------------------------
+def _fmt_s(s: float) -> str:
+    s = int(s)
+    return f"{s // 3600}:{s % 3600 // 60:02d}:{s % 60:02d}"
+
+
+@dataclass
+class Progress:
+    total: int
+    skipped: int = 0
+    done: int = 0
+    counts: Dict[str, int] = field(default_factory=lambda: {STATUS_PASS: 0, STATUS_FAIL: 0, STATUS_ERROR: 0})
+    model_s: float = 0.0
+    t0: float = field(default_factory=time.perf_counter)
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.t0
+
+    @property
+    def throughput(self) -> float:
+        """本次執行的每分鐘完成數（略過的不算）。"""
+        return self.done / self.elapsed * 60 if self.done else 0.0
+
+    @property
+    def eta(self) -> Optional[float]:
+        remaining = self.total - self.skipped - self.done
+        return remaining / self.done * self.elapsed if self.done else None
+
+    def line(self) -> str:
+        eta = self.eta
+        return (f"[{self.skipped + self.done}/{self.total}] {self.throughput:.2f} it/min, "
+                f"{self.elapsed / self.done if self.done else 0:.1f} s/it, "
+                f"ETA {_fmt_s(eta) if eta is not None else '?'}")
+
+    def summary(self) -> dict:
+        return {
+            "total": self.total, "skipped": self.skipped, "processed": self.done, **self.counts,
+            "elapsed_s": round(self.elapsed, 1), "throughput_per_min": round(self.throughput, 3),
+            "model_s_per_item": round(self.model_s / self.done, 2) if self.done else None,
+        }
+
+
+# ---- 工作 ---------------------------------------------------------------------
+def _weights_digest(backend: str, model: str) -> str:
+    """模型權重的 digest：重新訓練 / 更新模型後指紋改變，已完成的項目會重跑。"""
+    if backend == "local":
+        from VAT_OCR import MODEL_DIR
+        return model_dir_digest(MODEL_DIR)
+    return ollama_model_digest(model)
+
+
+def _job_fingerprint(backend: str, model: str, doc_class: str) -> str:
+    return json.dumps({"backend": backend, "model": model, "doc_class": doc_class,
+                       "weights": _weights_digest(backend, model)}, sort_keys=True)
+
+
+def list_entries(image_dir: str) -> List[Tuple[str, str]]:
+    """與 notebook 相同：以 image/*.jpg 為準 → [(標註檔名 <base>.json, 影像檔名)]。"""
+    return sorted((os.path.splitext(f)[0] + ".json", f) for f in os.listdir(image_dir) if f.lower().endswith(".jpg"))
+
+
+def _executor(backend: str, model: str, workers: int, devices: Optional[List[str]]):
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    if backend == "ollama":
+        # 伺服器端排程；worker 只是並行的 HTTP 請求
+        from ollama_client import get_client
+        _init_worker(backend, model)
+        get_client(pool_size=workers)   # 連線池跟著併發數
+        return ThreadPoolExecutor(max_workers=workers)
+    import multiprocessing as mp
+    ctx = mp.get_context("spawn")     # CUDA 不能 fork
+    queue = None
+    if devices:
+        queue = ctx.Queue()
+        for i in range(workers):
+            queue.put(devices[i % len(devices)])
+    return ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_init_worker,
+                               initargs=(backend, model, queue))
+
+
+def run(root: str, doc_class: str, mode: str = "train", backend: str = "local", model: str = "VAT_model",
+        workers: int = 1, devices: Optional[List[str]] = None, retry_fail: bool = False,
+        limit: int = 0, quiet: bool = False) -> dict:
+    root_dir = os.path.join(root, doc_class)
+    label_base = os.path.join(root_dir, "label")
+    image_dir = os.path.join(root_dir, "image")
+    out_dirs = {STATUS_PASS: os.path.join(label_base, f"{mode}_new"),
+                STATUS_FAIL: os.path.join(label_base, f"{mode}_fail")}
+    out_dirs[STATUS_ERROR] = out_dirs[STATUS_FAIL]
+    for d in set(out_dirs.values()):
+        os.makedirs(d, exist_ok=True)
+
+    entries = list_entries(image_dir)
+    if limit:
+        entries = entries[:limit]
+    manifest = Manifest(os.path.join(label_base, f"{mode}_relabel_manifest.jsonl"))
+    fingerprint = _job_fingerprint(backend, model, doc_class)
+
+    todo, hashes = [], {}
+    for entry, img_name in entries:
+        img_path = os.path.join(image_dir, img_name)
+        h = hashlib.sha256((hash_file(img_path) + fingerprint).encode("utf-8")).hexdigest()
+        hashes[entry] = h
+        if not manifest.done(entry, h, retry_fail):
+            todo.append((entry, img_path))
+    prog = Progress(total=len(entries), skipped=len(entries) - len(todo))
+    print(f"Total entries: {len(entries)}, already done: {prog.skipped}, to process: {len(todo)}")
+
+    def _record(res: dict) -> None:
+        entry, status = res["entry"], res["status"]
+        dest = os.path.join(out_dirs[status], entry)
+        atomic_write_json(dest, res["payload"])
+        # 上次落在另一個資料夾的舊結果移除，避免同一筆同時出現在 _new 與 _fail
+        for d in set(out_dirs.values()) - {out_dirs[status]}:
+            stale = os.path.join(d, entry)
+            if os.path.exists(stale):
+                os.remove(stale)
+        manifest.append({"entry": entry, "hash": hashes[entry], "status": status, "dest": dest,
+                         "failed": res.get("failed", []), "error": res.get("error"),
+                         "seconds": round(res["seconds"], 2), "ts": time.time()})
+        prog.done += 1
+        prog.counts[status] += 1
+        prog.model_s += res["seconds"]
+        if not quiet:
+            tag = {STATUS_PASS: "OK", STATUS_FAIL: "FAIL", STATUS_ERROR: "ERROR"}[status]
+            extra = f" {res.get('error')}" if status == STATUS_ERROR else ""
+            print(f"[{tag}] {entry} -> {dest}{extra}  {prog.line()}")
+
+    try:
+        if workers <= 1 and backend == "local":
+            if devices:
+                os.environ["CUDA_VISIBLE_DEVICES"] = devices[0]
+            _init_worker(backend, model)
+            for entry, img_path in todo:
+                _record(process_entry(entry, img_path, doc_class))
+        else:
+            from concurrent.futures import as_completed
+            pool = _executor(backend, model, workers, devices)
+            futures = []
+            try:
+                futures = [pool.submit(process_entry, entry, img_path, doc_class) for entry, img_path in todo]
+                for fut in as_completed(futures):
+                    _record(fut.result())
+            except KeyboardInterrupt:
+                for fut in futures:
+                    fut.cancel()
+                raise
+            finally:
+                pool.shutdown(wait=True, cancel_futures=True)
+    except KeyboardInterrupt:
+        print(f"\n中斷：已完成的 {prog.skipped + prog.done} 筆記錄在 manifest，重跑即可接續")
+    finally:
+        manifest.close()
+
+    summary = {"doc_class": doc_class, "mode": mode, "backend": backend, "model": model,
+               "workers": workers, **prog.summary()}
+    atomic_write_json(os.path.join(label_base, f"{mode}_relabel_summary.json"), summary)
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    return summary
+
+
+def main():
+    ap = argparse.ArgumentParser(description="可接續、可並行的標註清洗工作")
+    ap.add_argument("--root", required=True, help="資料集根目錄（底下為 <doc_class>/image、<doc_class>/label/<mode>）")
+    ap.add_argument("--doc-class", required=True, help="triple_receipt / triple_invoice ...")
+    ap.add_argument("--mode", default="train", help="train / test")
+    ap.add_argument("--backend", choices=["local", "ollama"], default="local")
+    ap.add_argument("--model", default=None, help="local：紀錄用名稱（預設 VAT_model）；ollama：模型名稱")
+    ap.add_argument("--workers", type=int, default=None, help="預設 = --devices 數量（local）或 1")
+    ap.add_argument("--devices", default=None, help="local 多 GPU：逗號分隔的 CUDA 裝置，例如 0,1")
+    ap.add_argument("--retry-fail", action="store_true", help="上次判為 fail 的項目也重跑")
+    ap.add_argument("--limit", type=int, default=0)
+    ap.add_argument("--quiet", action="store_true")
+    args = ap.parse_args()
+
+    devices = [d.strip() for d in args.devices.split(",")] if args.devices else None
+    workers = args.workers or (len(devices) if devices else 1)
+    model = args.model or ("VAT_model" if args.backend == "local" else "qwen2.5vl:7b")
+    run(args.root, args.doc_class, args.mode, args.backend, model, workers, devices,
+        args.retry_fail, args.limit, args.quiet)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+model.generate 的提早停止條件（VAT_OCR.chat_once 預設啟用）。
+
+  - JsonClosureCriteria：最外層 JSON 物件的 '}' 一出現就停；不必再等模型吐 EOS、
+    也不會繼續產生 ``` 收尾或多餘的說明文字（字串內的括號、跳脫的引號都會略過）
+  - RepetitionCriteria：輸出尾端出現同一個 n-gram 連續重複（模型陷入迴圈，
+    VAT_Modelfile.txt 需要 repeat_penalty 1.5 的原因）→ 直接中止，不再把 token 預算燒完
+  - CancelCriteria：外部 threading.Event 被 set 就停（串流模式逐欄檢查不合格時取消，見 json_stream.py）
+  - FirstTokenTimer：不停止，只記下第一個新 token 的時間（tracing 用來拆開 prefill 與 decode）
+
+每個 batch row 各自判斷，停止原因記在 StopTracker.reasons，代碼為：
+    eos             模型自己結束
+    json_closed     最外層 JSON 已閉合
+    repetition      偵測到重複迴圈而中止（輸出多半不完整，交給 repair_json）
+    max_new_tokens  用完 token 預算
+    cancelled       被呼叫端取消
+
+用法：
+    from stopping import build_stopping_criteria
+    criteria, tracker = build_stopping_criteria(text_tokenizer, prompt_len, batch_size=1)
+    gen_ids = model.generate(**inputs, stopping_criteria=criteria, ...)
+    reason = tracker.reason(0, gen_ids[0, prompt_len:], max_new_tokens)
+"""
+
+from __future__ import annotations
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+STOP_EOS = "eos"
+STOP_JSON_CLOSED = "json_closed"
+STOP_REPETITION = "repetition"
+STOP_MAX_TOKENS = "max_new_tokens"
+STOP_CANCELLED = "cancelled"
+STOP_REASONS = (STOP_EOS, STOP_JSON_CLOSED, STOP_REPETITION, STOP_MAX_TOKENS, STOP_CANCELLED)
+
+
+def _bool_tensor(flags: Sequence[bool], like):
+    import torch
+    return torch.tensor(list(flags), dtype=torch.bool, device=like.device)
+
+
+class StopTracker:
+    """各 row 的停止原因；generate 結束後用 reason() 補上 eos / max_new_tokens。"""
+
+    def __init__(self, batch_size: int = 1, eos_ids: Sequence[int] = ()):
+        self.reasons: List[Optional[str]] = [None] * batch_size
+        self.eos_ids = set(eos_ids)
+
+    def mark(self, row: int, reason: str) -> None:
+        if self.reasons[row] is None:
+            self.reasons[row] = reason
+
+    def reason(self, row: int, new_token_ids, max_new_tokens: int) -> str:
+        if self.reasons[row] is not None:
+            return self.reasons[row]
+        ids = [int(t) for t in new_token_ids]
+        # 批次中較早結束的 row 之後會被補 pad（通常等於 eos）
+        if any(t in self.eos_ids for t in ids):
+            return STOP_EOS
+        return STOP_MAX_TOKENS if len(ids) >= max_new_tokens else STOP_EOS
+
+
+class JsonClosureCriteria:
+    """
+    逐 token 掃描新產生的文字，追蹤 {}/[] 深度與字串狀態；深度回到 0 即停止。
+    第一個 '{' 之前的內容（例如 ```json）不計入。token → 文字的解碼結果依 id 快取，
+    中文被切開的位元組會解成 U+FFFD，不影響結構字元（皆為 ASCII）的判斷。
+    """
+
+    def __init__(self, tokenizer, prompt_len: int, tracker: StopTracker):
+        self.tok = tokenizer
+        self.prompt_len = prompt_len
+        self.tracker = tracker
+        self._pieces: Dict[int, str] = {}
+        n = len(tracker.reasons)
+        self.state: List[Tuple[int, bool, bool, bool]] = [(0, False, False, False)] * n  # depth, started, in_str, esc
+        self.fed = [0] * n
+        self.done = [False] * n
+
+    def piece(self, tid: int) -> str:
+        p = self._pieces.get(tid)
+        if p is None:
+            p = self.tok.decode([tid], skip_special_tokens=True)
+            self._pieces[tid] = p
+        return p
+
+    @staticmethod
+    def scan(state: Tuple[int, bool, bool, bool], text: str) -> Tuple[Tuple[int, bool, bool, bool], bool]:
+        depth, started, in_str, esc = state
+        for ch in text:
+            if in_str:
+                if esc:
+                    esc = False
+                elif ch == "\\":
+                    esc = True
+                elif ch == '"':
+                    in_str = False
+            elif ch in "{[":
+                if started or ch == "{":
+                    depth += 1
+                    started = True
+            elif not started:
+                continue
+            elif ch in "}]":
+                depth -= 1
+                if depth <= 0:
+                    return (0, True, False, False), True
+            elif ch == '"':
+                in_str = True
+        return (depth, started, in_str, esc), False
+
+    def __call__(self, input_ids, scores, **kwargs):
+        flags = []
+        for row in range(input_ids.shape[0]):
+            if not self.done[row]:
+                ids = input_ids[row, self.prompt_len + self.fed[row]:].tolist()
+                self.fed[row] += len(ids)
+                state = self.state[row]
+                for tid in ids:
+                    state, closed = self.scan(state, self.piece(tid))
+                    if closed:
+                        self.done[row] = True
+                        self.tracker.mark(row, STOP_JSON_CLOSED)
+                        break
+                self.state[row] = state
+            flags.append(self.done[row])
+        return _bool_tensor(flags, input_ids)
+
+
+class RepetitionCriteria:
+    """
+    新產生 token 的尾端若是某個長度 n（1..max_ngram）的片段連續重複，且重複次數
+    ≥ max(min_repeats, ceil(min_span / n)) 就中止。min_span 讓短片段需要更多次重複才算迴圈
+    （例如 n=1 時 "00000000" 這類正常的數字不會誤判）。
+    """
+
+    def __init__(self, prompt_len: int, tracker: StopTracker, max_ngram: int = 24,
+                 min_repeats: int = 3, min_span: int = 32):
+        self.prompt_len = prompt_len
+        self.tracker = tracker
+        self.max_ngram = max_ngram
+        self.need = {n: max(min_repeats, -(-min_span // n)) for n in range(1, max_ngram + 1)}
+        self.done = [False] * len(tracker.reasons)
+
+    def looping(self, ids: List[int]) -> bool:
+        L = len(ids)
+        for n, k in self.need.items():
+            span = n * k
+            if span > L:
+                continue
+            tail = ids[L - n:]
+            if all(ids[L - span + i] == tail[i % n] for i in range(span - n)):
+                return True
+        return False
+
+    def __call__(self, input_ids, scores, **kwargs):
+        flags = []
+        # 只需檢查尾端 max 片段長度
+        window = max(n * k for n, k in self.need.items())
+        for row in range(input_ids.shape[0]):
+            if not self.done[row]:
+                start = max(self.prompt_len, input_ids.shape[1] - window)
+                if self.looping(input_ids[row, start:].tolist()):
+                    self.done[row] = True
+                    self.tracker.mark(row, STOP_REPETITION)
+            flags.append(self.done[row])
+        return _bool_tensor(flags, input_ids)
+
+
+class CancelCriteria:
+    """event.set() 之後，所有 row 在下一步停止。"""
+
+    def __init__(self, event, tracker: StopTracker):
+        self.event = event
+        self.tracker = tracker
+
+    def __call__(self, input_ids, scores, **kwargs):
+        stop = self.event.is_set()
+        if stop:
+            for row in range(input_ids.shape[0]):
+                self.tracker.mark(row, STOP_CANCELLED)
+        return _bool_tensor([stop] * input_ids.shape[0], input_ids)
+
+
+class FirstTokenTimer:
+    """第一次被呼叫時（第一個新 token 已產生 = prefill 結束）記下 time.perf_counter()。"""
+
+    def __init__(self):
+        self.t_first: Optional[float] = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.t_first is None:
+            self.t_first = time.perf_counter()
+        return _bool_tensor([False] * input_ids.shape[0], input_ids)
+
+
+def build_stopping_criteria(tokenizer, prompt_len: int, batch_size: int = 1, json_closure: bool = True,
+                            repetition: bool = True, eos_ids: Sequence[int] = (), cancel_event=None):
+    """回傳 (可直接給 model.generate(stopping_criteria=...) 的 list, StopTracker)。"""
+    if not eos_ids:
+        eos_ids = [v for v in (getattr(tokenizer, "eos_token_id", None), getattr(tokenizer, "pad_token_id", None))
+                   if isinstance(v, int)]
+    tracker = StopTracker(batch_size, eos_ids)
+    criteria = []
+    if json_closure:
+        criteria.append(JsonClosureCriteria(tokenizer, prompt_len, tracker))
+    if repetition:
+        criteria.append(RepetitionCriteria(prompt_len, tracker))
+    if cancel_event is not None:
+        criteria.append(CancelCriteria(cancel_event, tracker))
+    from transformers import StoppingCriteriaList
+    return StoppingCriteriaList(criteria), tracker
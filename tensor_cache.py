@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+影像前處理結果的磁碟快取（memory-mapped）：每個 epoch、每次跑 val_donut_dataset.json 評估，
+同一張圖都要重做 JPEG 解碼 → 縮圖 → processor 正規化。這裡把 processor 的輸出
+（pixel_values、image_grid_thw）存成 .npy，之後以 np.load(mmap_mode="r") 直接對應到記憶體讀取。
+
+key = sha256(影像位元組) + processor 設定（image_processor.to_dict()）+ vision 預算 + 儲存 dtype 的雜湊；
+換 processor 設定或預算就是不同的 key，不會讀到舊的張量。
+檔案：<cache_dir>/<key[:2]>/<key>.pv.npy 與 <key>.thw.npy，先寫暫存檔再 os.replace。
+
+用法：
+    # 1) 平行建立快取（每個 worker 行程各自載入 processor）
+    python tensor_cache.py build --dataset ../AllDataset/VAT-OCR/train2_donut_dataset.json \
+        --root ../AllDataset/VAT-OCR/ --processor unsloth/Qwen2.5-VL-7B-Instruct-bnb-4bit --workers 8
+    python tensor_cache.py stats
+
+    # 2) 訓練：資料集只放影像路徑，collator 從快取讀張量（沒命中時現算並寫入）
+    from train_dataset import LazyConversationDataset
+    from tensor_cache import TensorCache, CachedVisionCollator
+    cache = TensorCache(processor=tokenizer)
+    ds = LazyConversationDataset.from_donut_json(path, root, decode=False)
+    trainer = SFTTrainer(..., train_dataset=ds, data_collator=CachedVisionCollator(tokenizer, cache))
+
+    # 3) 推論 / 評估：VAT_OCR.chat_once(path, tensor_cache=cache)
+"""
+
+from __future__ import annotations
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from extraction_cache import hash_file
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "VAT_TENSOR_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "vat_ocr", "tensors")
+)
+IMAGE_TOKEN = "<|image_pad|>"
+_PLACEHOLDER = "<|placeholder|>"
+
+
+def _image_processor(processor):
+    # Unsloth 回傳的 tokenizer 是整個 processor；也接受直接給 image_processor
+    return getattr(processor, "image_processor", processor)
+
+
+def processor_fingerprint(processor, budget=None, dtype: str = "float32") -> str:
+    """processor 設定 + vision 預算 + dtype → 短雜湊（快取 key 的一部分）。budget=None 即 DEFAULT_BUDGET。"""
+    from vision_budget import resolve_budget
+    ip = _image_processor(processor)
+    cfg = ip.to_dict() if hasattr(ip, "to_dict") else {}
+    cfg.pop("processor_class", None)
+    payload = json.dumps({"processor": cfg, "budget": repr(resolve_budget(budget)),
+                          "dtype": dtype}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+class TensorCache:
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, processor=None, budget=None, dtype: str = "float32"):
+        self.cache_dir = cache_dir
+        self.processor = processor
+        from vision_budget import resolve_budget
+        self.budget = resolve_budget(budget)   # 與 chat_once 的 load_image(path, budget) 相同：None → DEFAULT_BUDGET
+        self.dtype = dtype
+        self.fingerprint = processor_fingerprint(processor, budget, dtype) if processor is not None else None
+        self._hashes: Dict[str, Tuple[float, int, str]] = {}   # path → (mtime, size, sha256)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # ---- key / 路徑 -----------------------------------------------------------
+    def _file_hash(self, image_path: str) -> str:
+        st = os.stat(image_path)
+        cached = self._hashes.get(image_path)
+        if cached and cached[:2] == (st.st_mtime, st.st_size):
+            return cached[2]
+        h = hash_file(image_path)
+        with self._lock:
+            self._hashes[image_path] = (st.st_mtime, st.st_size, h)
+        return h
+
+    def key(self, image_path: str) -> str:
+        if self.fingerprint is None:
+            raise ValueError("TensorCache 需要 processor 才能計算 key")
+        return hashlib.sha256((self._file_hash(image_path) + self.fingerprint).encode("utf-8")).hexdigest()
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        d = os.path.join(self.cache_dir, key[:2])
+        return os.path.join(d, key + ".pv.npy"), os.path.join(d, key + ".thw.npy")
+
+    def contains(self, image_path: str) -> bool:
+        pv, thw = self._paths(self.key(image_path))
+        return os.path.exists(pv) and os.path.exists(thw)
+
+    # ---- 讀寫 -----------------------------------------------------------------
+    def get(self, image_path: str):
+        """命中 → (pixel_values, image_grid_thw) 兩個唯讀 memmap 的 numpy 陣列；未命中 → None。"""
+        import numpy as np
+        pv, thw = self._paths(self.key(image_path))
+        try:
+            out = np.load(pv, mmap_mode="r"), np.load(thw)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return out
+
+    def put(self, image_path: str, pixel_values, image_grid_thw) -> None:
+        import numpy as np
+        pv_path, thw_path = self._paths(self.key(image_path))
+        os.makedirs(os.path.dirname(pv_path), exist_ok=True)
+        suffix = f".tmp.{os.getpid()}.{threading.get_ident()}"
+        for path, arr in ((pv_path, np.asarray(pixel_values, dtype=self.dtype)),
+                          (thw_path, np.asarray(image_grid_thw, dtype=np.int64))):
+            tmp = path + suffix
+            with open(tmp, "wb") as f:
+                np.save(f, arr)
+            os.replace(tmp, path)
+
+    def compute(self, image_path: str):
+        """解碼 → 依預算縮圖 → processor；回傳 (pixel_values, image_grid_thw) numpy 陣列。"""
+        from vision_budget import load_image
+        image = load_image(image_path, self.budget)
+        out = _image_processor(self.processor)(images=[image], return_tensors="np")
+        return out["pixel_values"], out["image_grid_thw"]
+
+    def get_or_compute(self, image_path: str):
+        hit = self.get(image_path)
+        if hit is not None:
+            return hit
+        pv, thw = self.compute(image_path)
+        self.put(image_path, pv, thw)
+        return pv, thw
+
+    def stats(self) -> dict:
+        files = nbytes = 0
+        if os.path.isdir(self.cache_dir):
+            for d, _, names in os.walk(self.cache_dir):
+                for n in names:
+                    if n.endswith(".pv.npy"):
+                        files += 1
+                    nbytes += os.path.getsize(os.path.join(d, n))
+        return {"dir": self.cache_dir, "entries": files, "bytes": nbytes, "hits": self.hits, "misses": self.misses}
+
+
+# ---- processor 輸入組裝 ------------------------------------------------------------
+def expand_image_tokens(texts: Sequence[str], grids: Sequence[Sequence[int]], merge_size: int) -> List[str]:
+    """同 Qwen2.5-VL processor：每個 <|image_pad|> 依 grid_thw 展開成 t*h*w / merge_size² 個。"""
+    out, idx = [], 0
+    merge_length = merge_size ** 2
+    for text in texts:
+        while IMAGE_TOKEN in text:
+            t, h, w = (int(x) for x in grids[idx])
+            text = text.replace(IMAGE_TOKEN, _PLACEHOLDER * (t * h * w // merge_length), 1)
+            idx += 1
+        out.append(text.replace(_PLACEHOLDER, IMAGE_TOKEN))
+    if idx != len(grids):
+        raise ValueError(f"影像數（{len(grids)}）與文字中的 {IMAGE_TOKEN} 數（{idx}）不一致")
+    return out
+
+
+def encode(processor, texts: Sequence[str], images: Sequence[Any], cache: TensorCache, **tokenizer_kwargs):
+    """
+    取代 processor(text=texts, images=images)：images 為影像路徑時從快取讀（未命中現算並寫入），
+    PIL 影像則照常經過 image_processor（不快取）。回傳含 input_ids / attention_mask /
+    pixel_values / image_grid_thw 的 dict（torch tensor）。
+    """
+    import numpy as np
+    import torch
+    pvs, grids = [], []
+    for img in images:
+        if isinstance(img, str):
+            pv, thw = cache.get_or_compute(img)
+        else:
+            out = _image_processor(processor)(images=[img], return_tensors="np")
+            pv, thw = out["pixel_values"], out["image_grid_thw"]
+        pvs.append(np.asarray(pv))
+        grids.extend(np.asarray(thw).reshape(-1, 3).tolist())
+    merge_size = getattr(_image_processor(processor), "merge_size", 2)
+    texts = expand_image_tokens(list(texts), grids, merge_size)
+    tok = getattr(processor, "tokenizer", processor)
+    batch = dict(tok(texts, return_tensors="pt", **tokenizer_kwargs))
+    if pvs:
+        batch["pixel_values"] = torch.from_numpy(np.concatenate(pvs)).to(torch.float32)
+        batch["image_grid_thw"] = torch.tensor(grids, dtype=torch.long)
+    return batch
+
+
+class CachedVisionCollator:
+    """
+    SFTTrainer 的 data_collator：輸入為 {"messages": [...]} 對話（影像欄位可為路徑或 PIL），
+    影像張量從 TensorCache 讀，文字經 chat template + 影像 token 展開後 tokenize。
+    labels 同 UnslothVisionDataCollator 的預設：padding 與影像相關 token 設為 -100。
+    """
+
+    def __init__(self, processor, cache: TensorCache):
+        self.processor = processor
+        self.cache = cache
+        tok = getattr(processor, "tokenizer", processor)
+        ids = [tok.convert_tokens_to_ids(t) for t in ("<|vision_start|>", "<|vision_end|>", IMAGE_TOKEN)]
+        self.ignore_ids = [i for i in ids if isinstance(i, int) and i >= 0]
+
+    def __call__(self, examples: List[Dict[str, Any]]) -> Dict[str, Any]:
+        import torch
+        texts, images = [], []
+        for ex in examples:
+            messages = ex["messages"]
+            texts.append(self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=False))
+            for m in messages:
+                content = m.get("content")
+                if isinstance(content, list):
+                    images += [p["image"] for p in content if p.get("type") == "image" and "image" in p]
+        # 不截斷：截斷會切掉影像 token，與 pixel_values 對不上
+        batch = encode(self.processor, texts, images, self.cache, padding=True)
+        labels = batch["input_ids"].clone()
+        labels[batch["attention_mask"] == 0] = -100
+        for i in self.ignore_ids:
+            labels[labels == i] = -100
+        batch["labels"] = labels
+        return batch
+
+
+# ---- 建立快取（CLI） ---------------------------------------------------------------
+_worker_cache: Optional[TensorCache] = None
+
+
+def _init_builder(cache_dir: str, processor_id: str, budget, dtype: str) -> None:
+    global _worker_cache
+    from transformers import AutoProcessor
+    _worker_cache = TensorCache(cache_dir, AutoProcessor.from_pretrained(processor_id), budget, dtype)
+
+
+def _build_one(image_path: str) -> Tuple[str, str, Optional[str]]:
+    try:
+        if _worker_cache.contains(image_path):
+            return image_path, "skipped", None
+        pv, thw = _worker_cache.compute(image_path)
+        _worker_cache.put(image_path, pv, thw)
+        return image_path, "built", None
+    except Exception as e:
+        return image_path, "error", f"{type(e).__name__}: {e}"
+
+
+def _dataset_images(dataset: str, root: str) -> List[str]:
+    with open(dataset, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    seen, out = set(), []
+    for d in data:
+        p = os.path.join(root, d["image_path"])
+        if p not in seen:
+            seen.add(p)
+            out.append(p)
+    return out
+
+
+def build(images: Sequence[str], processor_id: str, cache_dir: str = DEFAULT_CACHE_DIR, budget=None,
+          dtype: str = "float32", workers: int = 4) -> dict:
+    from concurrent.futures import ProcessPoolExecutor
+    counts = {"built": 0, "skipped": 0, "error": 0}
+    errors = {}
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_builder,
+                             initargs=(cache_dir, processor_id, budget, dtype)) as pool:
+        for i, (path, status, err) in enumerate(pool.map(_build_one, images, chunksize=8), 1):
+            counts[status] += 1
+            if err:
+                errors[path] = err
+            if i % 100 == 0 or i == len(images):
+                rate = i / (time.perf_counter() - t0)
+                print(f"[{i}/{len(images)}] {counts}  {rate:.1f} img/s")
+    return {**counts, "errors": errors, "seconds": round(time.perf_counter() - t0, 1)}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="processor 輸出（pixel_values / image_grid_thw）的 memmap 快取")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("build", help="平行建立快取")
+    b.add_argument("--dataset", action="append", required=True, help="Donut 格式資料集，可重複指定")
+    b.add_argument("--root", default="")
+    b.add_argument("--processor", required=True, help="AutoProcessor.from_pretrained 的模型 id 或路徑")
+    b.add_argument("--budget", default=None, help="low / medium / high / full（與訓練/推論時一致；預設 = vision_budget.DEFAULT_BUDGET，原圖請給 full）")
+    b.add_argument("--dtype", default="float32", choices=["float32", "float16"])
+    b.add_argument("--workers", type=int, default=os.cpu_count() or 4)
+    b.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    s = sub.add_parser("stats", help="快取目錄的筆數與大小")
+    s.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    args = ap.parse_args()
+
+    if args.cmd == "stats":
+        print(json.dumps(TensorCache(args.cache_dir).stats(), ensure_ascii=False, indent=2))
+        return
+    images = list(dict.fromkeys(p for ds in args.dataset for p in _dataset_images(ds, args.root)))
+    report = build(images, args.processor, args.cache_dir, args.budget, args.dtype, args.workers)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+"""
+輕量 tracing：量測每張文件在各階段花的時間（影像載入、img_to_b64、chat template、processor、
+prefill、decode、Ollama 呼叫、repair_json、check_compliance）。
+
+關閉時（預設）span() 直接回傳共用的 no-op 物件，成本只有一次函式呼叫與旗標判斷；
+開啟後每個最外層 span（例如一次 chat_once）結束時整批輸出：
+  - JSONL：每個 span 一行 {trace_id, name, parent, start, duration_s, doc_class, attrs}
+  - Prometheus 文字格式：vat_stage_duration_seconds{stage, doc_class} histogram
+    （檔案定期覆寫，或以 HTTP 端點提供 /metrics）
+doc_class 在後處理之後才知道：以 annotate(doc_class=...) 標在整個 trace 上，同一 trace 的所有階段都用這個標籤。
+
+用法：
+    import tracing
+    tracing.enable(jsonl_path="traces.jsonl", prometheus_path="vat_metrics.prom", prometheus_port=9464)
+    VAT_OCR.chat_once("invoice.jpg")
+
+    with tracing.span("my_stage", image=path) as sp:
+        ...
+        sp.set(n_fields=12)
+
+    python tracing.py summarize traces.jsonl            # 各階段 × doc_class 的 count / mean / p50 / p95
+    python tracing.py prom traces.jsonl --out m.prom     # JSONL 轉成 Prometheus 文字格式
+
+環境變數（import 時生效）：VAT_TRACE=<jsonl 路徑>、VAT_TRACE_PROM=<.prom 路徑>、VAT_TRACE_PORT=<埠號>
+"""
+
+from __future__ import annotations
+import os
+import sys
+import json
+import time
+import uuid
+import atexit
+import argparse
+import threading
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Tuple
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRIC = "vat_stage_duration_seconds"
+UNKNOWN = "unknown"
+
+ENABLED = False
+_current: ContextVar[Optional["Span"]] = ContextVar("vat_trace_span", default=None)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __bool__(self):
+        return False
+
+    def set(self, **attrs):
+        return self
+
+
+_NOOP = _NoopSpan()
+
+
+class Span:
+    __slots__ = ("name", "attrs", "parent", "root", "trace_id", "start", "duration", "_t0", "_token", "_spans")
+
+    def __init__(self, name: str, attrs: Dict[str, Any]):
+        self.name = name
+        self.attrs = attrs
+        self.duration: Optional[float] = None
+
+    def set(self, **attrs) -> "Span":
+        self.attrs.update(attrs)
+        return self
+
+    def __enter__(self) -> "Span":
+        parent = _current.get()
+        self.parent = parent
+        self.root = parent.root if parent is not None else self
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex[:16]
+        if parent is None:
+            self._spans: List[Span] = []
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self._t0
+        _current.reset(self._token)
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.root._spans.append(self)
+        if self.root is self and _collector is not None:
+            _collector.finish(self)
+        return False
+
+
+def span(name: str, **attrs):
+    """with span("stage"): ...；tracing 關閉時回傳 no-op（bool 為 False，可用來略過只為 tracing 算的屬性）。"""
+    if not ENABLED:
+        return _NOOP
+    return Span(name, attrs)
+
+
+def annotate(**attrs) -> None:
+    """把屬性標在目前 trace 的最外層 span（例如後處理後才知道的 doc_class）。"""
+    if ENABLED:
+        cur = _current.get()
+        if cur is not None:
+            cur.root.attrs.update(attrs)
+
+
+def record(name: str, seconds: float, **attrs) -> None:
+    """補記一段已知長度的階段（例如 prefill/decode、Ollama 回報的 eval_duration）。"""
+    if not ENABLED:
+        return
+    sp = Span(name, attrs)
+    parent = _current.get()
+    sp.parent = parent
+    sp.root = parent.root if parent is not None else sp
+    sp.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex[:16]
+    sp.duration = max(0.0, float(seconds))
+    sp.start = time.time() - sp.duration
+    if parent is None:
+        sp._spans = [sp]
+        if _collector is not None:
+            _collector.finish(sp)
+    else:
+        sp.root._spans.append(sp)
+
+
+def doc_class_of(result: Any) -> str:
+    """從抽取結果（dict、JSON 字串、{"gt_parse": ...} 或 header/body/tail 格式）取出 doc_class。"""
+    if isinstance(result, str):
+        try:
+            result = json.loads(result)
+        except ValueError:
+            return UNKNOWN
+    if not isinstance(result, dict):
+        return UNKNOWN
+    root = result.get("gt_parse", result)
+    if not isinstance(root, dict):
+        return UNKNOWN
+    v = root.get("Doc_class") or root.get("doc_class") or root.get("class")
+    return str(v) if v else UNKNOWN
+
+
+# ---- 收集與輸出 -------------------------------------------------------------------
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, v: float) -> None:
+        for i, b in enumerate(BUCKETS):
+            if v <= b:
+                self.counts[i] += 1
+                break
+        self.sum += v
+        self.count += 1
+
+
+def _labels(stage: str, doc_class: str) -> str:
+    esc = lambda s: str(s).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'stage="{esc(stage)}",doc_class="{esc(doc_class)}"'
+
+
+def prometheus_text_from(hists: Dict[Tuple[str, str], Histogram]) -> str:
+    lines = [f"# HELP {METRIC} Duration of VAT-OCR pipeline stages.", f"# TYPE {METRIC} histogram"]
+    for (stage, doc_class), h in sorted(hists.items()):
+        lab = _labels(stage, doc_class)
+        acc = 0
+        for b, c in zip(BUCKETS, h.counts):
+            acc += c
+            lines.append(f'{METRIC}_bucket{{{lab},le="{b}"}} {acc}')
+        lines.append(f'{METRIC}_bucket{{{lab},le="+Inf"}} {h.count}')
+        lines.append(f"{METRIC}_sum{{{lab}}} {h.sum:.6f}")
+        lines.append(f"{METRIC}_count{{{lab}}} {h.count}")
+    return "\n".join(lines) + "\n"
+
+
+def _span_row(sp: Span, doc_class: str) -> dict:
+    return {
+        "trace_id": sp.trace_id,
+        "name": sp.name,
+        "parent": sp.parent.name if sp.parent is not None else None,
+        "start": round(sp.start, 6),
+        "duration_s": round(sp.duration, 6),
+        "doc_class": doc_class,
+        "attrs": sp.attrs,
+    }
+
+
+class Collector:
+    def __init__(self, jsonl_path: Optional[str] = None, prometheus_path: Optional[str] = None,
+                 prometheus_interval: float = 5.0):
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.prometheus_interval = prometheus_interval
+        self.hists: Dict[Tuple[str, str], Histogram] = {}
+        self._lock = threading.Lock()
+        self._jsonl = open(jsonl_path, "a", encoding="utf-8") if jsonl_path else None
+        self._last_prom = 0.0
+
+    def finish(self, root: Span) -> None:
+        doc_class = str(root.attrs.get("doc_class") or UNKNOWN)
+        rows = [_span_row(sp, doc_class) for sp in root._spans] if self._jsonl else None
+        with self._lock:
+            for sp in root._spans:
+                h = self.hists.get((sp.name, doc_class))
+                if h is None:
+                    h = self.hists[(sp.name, doc_class)] = Histogram()
+                h.observe(sp.duration)
+            if rows:
+                self._jsonl.write("".join(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in rows))
+                self._jsonl.flush()
+            write_prom = self.prometheus_path and time.monotonic() - self._last_prom >= self.prometheus_interval
+        if write_prom:
+            self.write_prometheus()
+
+    def prometheus_text(self) -> str:
+        with self._lock:
+            return prometheus_text_from(self.hists)
+
+    def write_prometheus(self, path: Optional[str] = None) -> None:
+        path = path or self.prometheus_path
+        if not path:
+            return
+        text = self.prometheus_text()
+        tmp = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+        self._last_prom = time.monotonic()
+
+    def close(self) -> None:
+        self.write_prometheus()
+        if self._jsonl:
+            self._jsonl.close()
+            self._jsonl = None
+
+
+_collector: Optional[Collector] = None
+_server = None
+
+
+def enable(jsonl_path: Optional[str] = None, prometheus_path: Optional[str] = None,
+           prometheus_port: Optional[int] = None, prometheus_interval: float = 5.0) -> Collector:
+    """開啟 tracing（重複呼叫會換成新的 collector；histogram 從零開始）。"""
+    global ENABLED, _collector
+    if _collector is not None:
+        _collector.close()
+    _collector = Collector(jsonl_path, prometheus_path, prometheus_interval)
+    if prometheus_port:
+        serve_prometheus(prometheus_port)
+    ENABLED = True
+    return _collector
+
+
+def disable() -> None:
+    global ENABLED, _collector
+    ENABLED = False
+    if _collector is not None:
+        _collector.close()
+        _collector = None
+
+
+def is_enabled() -> bool:
+    return ENABLED
+
+
+def prometheus_text() -> str:
+    return _collector.prometheus_text() if _collector is not None else prometheus_text_from({})
+
+
+def serve_prometheus(port: int = 9464, host: str = "0.0.0.0"):
+    """背景執行緒提供 GET /metrics（Prometheus 文字格式）。"""
+    global _server
+    if _server is not None:
+        return _server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    _server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=_server.serve_forever, daemon=True, name="vat-trace-metrics").start()
+    return _server
+
+
+@atexit.register
+def _flush_at_exit() -> None:
+    if _collector is not None:
+        _collector.close()
+
+
+if os.environ.get("VAT_TRACE") or os.environ.get("VAT_TRACE_PROM") or os.environ.get("VAT_TRACE_PORT"):
+    enable(os.environ.get("VAT_TRACE") or None, os.environ.get("VAT_TRACE_PROM") or None,
+           int(os.environ["VAT_TRACE_PORT"]) if os.environ.get("VAT_TRACE_PORT") else None)
+
+
+# ---- CLI：離線彙整 JSONL ---------------------------------------------------------------
+def _load_rows(path: str) -> List[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _pct(xs: List[float], q: float) -> float:
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * q))]
+
+
+def main():
+    ap = argparse.ArgumentParser(description="tracing JSONL 彙整")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    s = sub.add_parser("summarize", help="各階段 × doc_class 的 count / mean / p50 / p95")
+    s.add_argument("jsonl")
+    s.add_argument("--by-doc-class", action="store_true", help="依 doc_class 分列（預設只分階段）")
+    p = sub.add_parser("prom", help="轉成 Prometheus 文字格式")
+    p.add_argument("jsonl")
+    p.add_argument("--out", default=None)
+    args = ap.parse_args()
+
+    rows = _load_rows(args.jsonl)
+    if args.cmd == "prom":
+        hists: Dict[Tuple[str, str], Histogram] = {}
+        for r in rows:
+            hists.setdefault((r["name"], r.get("doc_class") or UNKNOWN), Histogram()).observe(r["duration_s"])
+        text = prometheus_text_from(hists)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                f.write(text)
+        else:
+            sys.stdout.write(text)
+        return
+
+    groups: Dict[Tuple[str, ...], List[float]] = {}
+    for r in rows:
+        key = (r["name"], r.get("doc_class") or UNKNOWN) if args.by_doc_class else (r["name"],)
+        groups.setdefault(key, []).append(r["duration_s"])
+    traces = len({r["trace_id"] for r in rows})
+    print(f"{len(rows)} spans / {traces} traces")
+    print(f"{'stage':<40}{'count':>8}{'mean_ms':>11}{'p50_ms':>10}{'p95_ms':>10}{'total_s':>10}")
+    for key, xs in sorted(groups.items(), key=lambda kv: -sum(kv[1])):
+        name = " / ".join(key)
+        print(f"{name:<40}{len(xs):>8}{sum(xs) / len(xs) * 1e3:>11.2f}{_pct(xs, 0.5) * 1e3:>10.2f}"
+              f"{_pct(xs, 0.95) * 1e3:>10.2f}{sum(xs):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
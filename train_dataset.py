@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+延遲解碼的訓練資料集：取代微調 notebook 的
+    converted_dataset = [convert_to_conversation(sample) for sample in dataset]
+（一開始就把每張訓練圖解碼成 PIL 物件：記憶體隨資料量成長，第一步之前要先等全部解碼完）。
+
+LazyConversationDataset 只保存 (image_path, ground_truth)；__getitem__ 時才開圖並組成同樣的
+{"messages": [...]} 對話格式，可直接給 SFTTrainer(train_dataset=...) + UnslothVisionDataCollator：
+  - budget：解碼時就依 vision_budget 等比例縮圖（JPEG 先用 draft() 以較小尺寸解碼）
+  - cache_size：最近用過的解碼影像放在有上限的 LRU（多個 epoch / 重複取樣時不必重解）
+  - decode=False：影像欄位只放路徑，由 tensor_cache.CachedVisionCollator 從預先算好的張量快取讀取
+  - 預取：SFTConfig(**dataloader_kwargs(num_workers=4)) 讓 DataLoader worker 行程同時解碼影像
+    並執行 collator（每個 worker 有自己的 LRU）；不經 Trainer 時可用 iter_prefetch()
+
+用法（notebook）：
+    from train_dataset import LazyConversationDataset, dataloader_kwargs
+    converted_dataset = LazyConversationDataset.from_donut_json(
+        dataset_path + "train2_donut_dataset.json", root=dataset_path, budget="high")
+    trainer = SFTTrainer(..., train_dataset=converted_dataset,
+                         args=SFTConfig(..., **dataloader_kwargs(num_workers=4)))
+
+量測（峰值 RSS、第一個 batch 的等待時間）：python bench/bench_train_dataset.py --dataset ... --root ...
+"""
+
+from __future__ import annotations
+import os
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, Optional, Sequence, Tuple
+
+INSTRUCTION = "你是發票/單據分類器與結構化抽取器，請辨識這張文件"
+
+
+def _open_image(path: str, budget=None):
+    from PIL import Image
+    if budget is None:
+        return Image.open(path).convert("RGB")
+    from vision_budget import load_image
+    return load_image(path, budget)
+
+
+def build_conversation(image, ground_truth: str, instruction: str = INSTRUCTION) -> Dict[str, Any]:
+    """與 notebook 的 convert_to_conversation 相同的對話格式。"""
+    return {"messages": [
+        {"role": "user",
+         "content": [
+             {"type": "text", "text": instruction},
+             {"type": "image", "image": image}]},
+        {"role": "assistant",
+         "content": [
+             {"type": "text", "text": ground_truth}]},
+    ]}
+
+
+class LazyConversationDataset:
+    """map-style 資料集（__len__ / __getitem__），可 pickle 給 DataLoader worker 行程。"""
+
+    def __init__(self, samples: Sequence[Tuple[str, str]], instruction: str = INSTRUCTION, budget=None,
+                 cache_size: int = 64, decode: bool = True):
+        self.samples = list(samples)          # [(影像完整路徑, ground_truth 字串)]
+        self.instruction = instruction
+        self.budget = budget
+        self.cache_size = cache_size
+        self.decode = decode                  # False → 影像欄位放路徑，交給 tensor_cache.CachedVisionCollator
+        self._init_cache()
+
+    def _init_cache(self) -> None:
+        self._cache: "OrderedDict[int, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # DataLoader worker：只傳路徑清單，不傳已解碼影像與鎖
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ("_cache", "_lock", "hits", "misses"):
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_cache()
+
+    @classmethod
+    def from_records(cls, records: Iterable[Dict[str, Any]], root: str = "", **kwargs) -> "LazyConversationDataset":
+        """Donut 格式的記錄（list 或 HF datasets.Dataset）：{"image_path", "ground_truth"}。"""
+        samples = []
+        for r in records:
+            gt = r["ground_truth"]
+            samples.append((os.path.join(root, r["image_path"]),
+                            gt if isinstance(gt, str) else json.dumps(gt, ensure_ascii=False)))
+        return cls(samples, **kwargs)
+
+    @classmethod
+    def from_donut_json(cls, path: str, root: str = "", **kwargs) -> "LazyConversationDataset":
+        with open(path, "r", encoding="utf-8") as f:
+            return cls.from_records(json.load(f), root, **kwargs)
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def image(self, i: int):
+        """第 i 筆的解碼影像（經 LRU）。"""
+        if self.cache_size:
+            with self._lock:
+                img = self._cache.get(i)
+                if img is not None:
+                    self._cache.move_to_end(i)
+                    self.hits += 1
+                    return img
+                self.misses += 1
+        img = _open_image(self.samples[i][0], self.budget)
+        if self.cache_size:
+            with self._lock:
+                self._cache[i] = img
+                self._cache.move_to_end(i)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return img
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        image = self.image(i) if self.decode else self.samples[i][0]
+        return build_conversation(image, self.samples[i][1], self.instruction)
+
+    def iter_prefetch(self, indices: Optional[Iterable[int]] = None, workers: int = 4,
+                      ahead: int = 8) -> Iterator[Dict[str, Any]]:
+        """依 indices 順序產生對話；背景執行緒先解碼後面 ahead 筆（PIL 解碼會釋放 GIL）。"""
+        order = list(range(len(self))) if indices is None else list(indices)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending: "OrderedDict[int, Any]" = OrderedDict()
+            nxt = 0
+            for pos in range(len(order)):
+                while nxt < len(order) and nxt < pos + ahead:
+                    pending[nxt] = pool.submit(self.image, order[nxt])
+                    nxt += 1
+                img = pending.pop(pos).result()
+                yield build_conversation(img, self.samples[order[pos]][1], self.instruction)
+
+    def cache_info(self) -> dict:
+        return {"size": len(self._cache), "capacity": self.cache_size, "hits": self.hits, "misses": self.misses}
+
+
+def dataloader_kwargs(num_workers: int = 4, prefetch_factor: int = 2) -> dict:
+    """
+    給 SFTConfig / TrainingArguments 的 DataLoader 參數：num_workers 個行程各自解碼影像並跑 collator，
+    每個 worker 預先備妥 prefetch_factor 個 batch；persistent_workers 讓 worker（與其 LRU）跨 epoch 保留。
+    Windows 上 worker 以 spawn 啟動，notebook 內請確認 collator / dataset 可被 pickle。
+    """
+    if num_workers <= 0:
+        return {"dataloader_num_workers": 0}
+    return {
+        "dataloader_num_workers": num_workers,
+        "dataloader_prefetch_factor": prefetch_factor,
+        "dataloader_persistent_workers": True,
+        "dataloader_pin_memory": True,
+    }
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+影像解析度（vision token）預算：所有入口共用同一套縮圖規則。
+
+Qwen2.5-VL 每 28x28 像素約 1 個 vision token，手機原圖動輒數千 token，
+prefill 成本主要來自這裡。VisionBudget 統一描述：
+  - min_pixels / max_pixels：總像素上下限（與 Qwen processor 的同名參數一致）
+  - max_long_edge：長邊上限（px），None 表示不限
+縮放一律等比例（aspect-preserving），只縮不放大（min_pixels 例外）。
+
+用法：
+  - 本機 Unsloth：VAT_OCR.chat_once(path, budget=VisionBudget(...))
+  - Ollama：encode_image_b64(path, budget) 取代 img_to_b64
+  - 環境變數 VAT_VISION_BUDGET=low|medium|high|full，或 VAT_MIN_PIXELS / VAT_MAX_PIXELS / VAT_MAX_LONG_EDGE
+"""
+
+from __future__ import annotations
+import io
+import os
+import base64
+from dataclasses import dataclass, replace
+from typing import Optional, Tuple
+
+from tracing import span
+
+TOKEN_PX = 28  # patch_size(14) * merge_size(2)
+
+
+@dataclass(frozen=True)
+class VisionBudget:
+    name: str = "custom"
+    min_pixels: int = 4 * TOKEN_PX * TOKEN_PX
+    max_pixels: Optional[int] = None
+    max_long_edge: Optional[int] = None
+    jpeg_quality: int = 90
+
+    def target_size(self, size: Tuple[int, int]) -> Tuple[int, int]:
+        """回傳套用預算後的 (w, h)；不需縮放時原樣回傳。"""
+        w, h = size
+        if w <= 0 or h <= 0:
+            return size
+        scale = 1.0
+        if self.max_long_edge and max(w, h) > self.max_long_edge:
+            scale = min(scale, self.max_long_edge / max(w, h))
+        if self.max_pixels and w * h * scale * scale > self.max_pixels:
+            scale = min(scale, (self.max_pixels / (w * h)) ** 0.5)
+        if self.min_pixels and w * h < self.min_pixels:
+            scale = (self.min_pixels / (w * h)) ** 0.5
+        if scale == 1.0:
+            return size
+        return max(1, int(round(w * scale))), max(1, int(round(h * scale)))
+
+    def estimate_tokens(self, size: Tuple[int, int]) -> int:
+        """粗估 vision token 數（以 28px 為一格）。"""
+        w, h = self.target_size(size)
+        return max(1, round(w / TOKEN_PX)) * max(1, round(h / TOKEN_PX))
+
+    def processor_kwargs(self) -> dict:
+        """給 Qwen AutoProcessor / image_processor 的 min_pixels/max_pixels。"""
+        kw = {"min_pixels": self.min_pixels}
+        if self.max_pixels:
+            kw["max_pixels"] = self.max_pixels
+        return kw
+
+
+PRESETS = {
+    "low":    VisionBudget("low",    max_pixels=256 * TOKEN_PX * TOKEN_PX,  max_long_edge=896),
+    "medium": VisionBudget("medium", max_pixels=640 * TOKEN_PX * TOKEN_PX,  max_long_edge=1344),
+    "high":   VisionBudget("high",   max_pixels=1280 * TOKEN_PX * TOKEN_PX, max_long_edge=2016),
+    "full":   VisionBudget("full"),
+}
+
+
+def budget_from_env() -> VisionBudget:
+    budget = PRESETS.get(os.environ.get("VAT_VISION_BUDGET", "full"), PRESETS["full"])
+    overrides = {}
+    for env, attr in (("VAT_MIN_PIXELS", "min_pixels"), ("VAT_MAX_PIXELS", "max_pixels"),
+                      ("VAT_MAX_LONG_EDGE", "max_long_edge")):
+        if os.environ.get(env):
+            overrides[attr] = int(os.environ[env])
+    return replace(budget, name="env", **overrides) if overrides else budget
+
+
+DEFAULT_BUDGET = budget_from_env()
+
+
+def resolve_budget(budget) -> VisionBudget:
+    """接受 VisionBudget / 預設名稱字串 / None（= DEFAULT_BUDGET）。"""
+    if budget is None:
+        return DEFAULT_BUDGET
+    if isinstance(budget, str):
+        return PRESETS[budget]
+    return budget
+
+
+def resize_image(image, budget=None):
+    """PIL.Image → 依預算等比例縮放後的 PIL.Image（不需縮放時回傳原物件）。"""
+    from PIL import Image
+    b = resolve_budget(budget)
+    size = b.target_size(image.size)
+    if size == image.size:
+        return image
+    return image.resize(size, Image.BICUBIC)
+
+
+def load_image(path: str, budget=None):
+    """開檔 → RGB → 套預算。JPEG 先用 draft() 讓解碼器直接以較小尺寸解碼，省 CPU。"""
+    from PIL import Image
+    with span("image_load"):
+        b = resolve_budget(budget)
+        image = Image.open(path)
+        target = b.target_size(image.size)
+        if target != image.size and image.format == "JPEG":
+            image.draft("RGB", target)
+        return resize_image(image.convert("RGB"), b)
+
+
+def encode_image_b64(path: str, budget=None) -> str:
+    """
+    Ollama 用的 base64 影像。不需縮放時直接 base64 原始檔案位元組（不重新壓縮），
+    需要縮放時以 JPEG(quality=budget.jpeg_quality) 重新編碼。
+    """
+    with span("img_to_b64"), open(path, "rb") as f:
+        return _encode_bytes_b64(f.read(), budget)
+
+
+def encode_bytes_b64(data: bytes, budget=None) -> str:
+    """同 encode_image_b64，但輸入是已讀入的檔案位元組（例如 Streamlit 上傳檔）。"""
+    with span("img_to_b64"):
+        return _encode_bytes_b64(data, budget)
+
+
+def _encode_bytes_b64(data: bytes, budget=None) -> str:
+    b = resolve_budget(budget)
+    if b.max_pixels is None and b.max_long_edge is None:
+        return base64.b64encode(data).decode("utf-8")
+
+    from PIL import Image
+    image = Image.open(io.BytesIO(data))
+    target = b.target_size(image.size)
+    if target == image.size:
+        return base64.b64encode(data).decode("utf-8")
+    if image.format == "JPEG":
+        image.draft("RGB", target)
+    image = resize_image(image.convert("RGB"), b)
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=b.jpeg_quality)
+    return base64.b64encode(buf.getvalue()).decode("utf-8")
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Self-consistency 投票：同一張圖取 N 個樣本，逐欄多數決（VAT_RE.ipynb 的 add_element / Counter 做法內建化）。
+
+  - 比較前先正規化：字串去頭尾空白、金額去千分位與 .00、月/日去前導 0、空字串視為 None
+  - 權重依合規程度：樣本權重 = 0.5 + 0.5 × 該樣本 check_compliance 的通過比例；
+    單一欄位格式不符（check_field）時該票再乘 bad_field_weight
+  - 三個金額整組投票（joint_amounts）：避免各欄各自勝出後湊成加總不成立的組合；
+    加總規則不成立的組合同樣乘 bad_field_weight
+  - 勝出值沿用權重最高的那個樣本的原始寫法；Rationale 不投票，取自 Doc_class 與共識相同、權重最高的樣本
+
+agreement[欄位] = 與共識值相同的樣本數 / 可解析的樣本數（1.0 = 全體一致，低的欄位值得人工複核）。
+
+用法：
+    from voting import vote
+    res = vote([{"gt_parse": {...}}, {...}, ...])
+    res.consensus, res.agreement, res.low_agreement(0.6)
+本地模型請用 VAT_OCR.chat_vote(image_path, n=5)：prompt 只 prefill 一次，N 個樣本共用 KV cache 接著取樣。
+"""
+
+from __future__ import annotations
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Hashable, List, Optional
+
+from compliance import FIELD_RULES, check_field, get_engine, normalize_amount, strip_leading_zero
+
+_AMOUNTS = ("SalesTotalAmount", "SalesTax", "TotalAmount")
+_CANONICAL = {k.lower(): k for k in FIELD_RULES}
+_NO_VOTE = ("Rationale",)
+
+
+@dataclass
+class VoteResult:
+    consensus: Dict[str, Any]                   # {"gt_parse": {...}}
+    agreement: Dict[str, float]                 # 欄位 → 與共識相同的樣本比例
+    samples: List[Dict[str, Any]]               # 各樣本（扁平、鍵名已對齊）；無法解析的樣本不在內
+    weights: List[float]                        # 對應 samples 的樣本權重
+    n: int = 0                                  # 原始樣本數（含無法解析的）
+    stop_reasons: List[str] = field(default_factory=list)
+    prefill_s: Optional[float] = None           # chat_vote：共用 prefill 耗時（只算一次，與 n 無關）
+    decode_s: Optional[float] = None            # chat_vote：n 列 decode 耗時
+
+    def low_agreement(self, threshold: float = 0.6) -> List[str]:
+        return [k for k, a in self.agreement.items() if a < threshold]
+
+    def summary(self) -> dict:
+        return {
+            "n": self.n,
+            "parsed": len(self.samples),
+            "agreement": {k: round(a, 3) for k, a in self.agreement.items()},
+            "mean_agreement": round(sum(self.agreement.values()) / len(self.agreement), 3) if self.agreement else None,
+            "weights": [round(w, 3) for w in self.weights],
+            "stop_reasons": self.stop_reasons,
+            "prefill_s": round(self.prefill_s, 3) if self.prefill_s is not None else None,
+            "decode_s": round(self.decode_s, 3) if self.decode_s is not None else None,
+        }
+
+
+def _root(sample: Any) -> Optional[Dict[str, Any]]:
+    """樣本 → 鍵名對齊（doc_class → Doc_class 等）的扁平 dict；repair_json 失敗的 {"raw": ...} 回傳 None。"""
+    if not isinstance(sample, dict):
+        return None
+    root = sample.get("gt_parse", sample)
+    if not isinstance(root, dict) or set(root) == {"raw"}:
+        return None
+    out: Dict[str, Any] = {}
+    for k, v in root.items():
+        out[_CANONICAL.get(k.lower(), k)] = v
+    return out
+
+
+def _key(name: str, v: Any) -> Hashable:
+    """投票用的比較鍵：同義寫法（'1,000' / '1000'、'03' / '3'、' KY'）視為同一票。"""
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        v = str(int(v)) if float(v).is_integer() else str(v)
+    if isinstance(v, str):
+        v = v.strip()
+        if not v:
+            return None
+        if name in _AMOUNTS:
+            return normalize_amount(v) or v
+        if name in ("InvoiceMonth", "InvoiceDay"):
+            return strip_leading_zero(v) or v
+        return v
+    if v is None:
+        return None
+    return repr(v)
+
+
+def _sum_ok(keys) -> bool:
+    try:
+        st, tax, total = (int(k) for k in keys)
+    except (TypeError, ValueError):
+        return False
+    return st + tax == total
+
+
+def _elect(ballots):
+    """ballots：[(比較鍵, 權重, 樣本序號)] → (勝出鍵, 代表樣本序號)。同分時先出現者勝。"""
+    score: "OrderedDict[Hashable, float]" = OrderedDict()
+    best: Dict[Hashable, tuple] = {}
+    for k, w, i in ballots:
+        score[k] = score.get(k, 0.0) + w
+        if k not in best or w > best[k][0]:
+            best[k] = (w, i)
+    winner = max(score, key=lambda k: score[k])   # max 遇同分回傳第一個
+    return winner, best[winner][1]
+
+
+def vote(samples: List[Any], weight_compliance: bool = True, bad_field_weight: float = 0.25,
+         joint_amounts: bool = True) -> VoteResult:
+    roots = [r for r in (_root(s) for s in samples) if r is not None]
+    res = VoteResult({"gt_parse": {}}, {}, roots, [], n=len(samples))
+    if not roots:
+        return res
+
+    engine = get_engine()
+    for r in roots:
+        w = 1.0
+        if weight_compliance:
+            comp, _ = engine.check({"gt_parse": r})
+            flags = [v for v in comp.values() if isinstance(v, bool)]
+            w = 0.5 + 0.5 * (sum(flags) / len(flags) if flags else 1.0)
+        res.weights.append(w)
+
+    def field_weight(i: int, name: str, v: Any) -> float:
+        w = res.weights[i]
+        if weight_compliance and v is not None and check_field(name, v) is not None:
+            w *= bad_field_weight
+        return w
+
+    names: List[str] = []
+    for r in roots:
+        names += [k for k in r if k not in names]
+    consensus: Dict[str, Any] = {}
+    agreement: Dict[str, float] = {}
+    n = len(roots)
+
+    amounts = [k for k in _AMOUNTS if k in names] if joint_amounts else []
+    if amounts:
+        ballots = []
+        for i, r in enumerate(roots):
+            keys = tuple(_key(k, r.get(k)) for k in _AMOUNTS)
+            w = res.weights[i]
+            if weight_compliance:
+                for k in _AMOUNTS:
+                    if r.get(k) is not None and check_field(k, r[k]) is not None:
+                        w *= bad_field_weight
+                if not _sum_ok(keys):
+                    w *= bad_field_weight
+            ballots.append((keys, w, i))
+        win, rep = _elect(ballots)
+        for j, k in enumerate(_AMOUNTS):
+            if k in amounts:
+                consensus[k] = roots[rep].get(k)
+                agreement[k] = sum(_key(k, r.get(k)) == win[j] for r in roots) / n
+
+    for name in names:
+        if name in consensus or name in _NO_VOTE:
+            continue
+        ballots = [(_key(name, r.get(name)), field_weight(i, name, r.get(name)), i) for i, r in enumerate(roots)]
+        win, rep = _elect(ballots)
+        consensus[name] = roots[rep].get(name)
+        agreement[name] = sum(b[0] == win for b in ballots) / n
+
+    # Rationale：取自與共識 Doc_class 相同、權重最高的樣本
+    if any("Rationale" in r for r in roots):
+        dc = _key("Doc_class", consensus.get("Doc_class"))
+        cand = [i for i, r in enumerate(roots) if _key("Doc_class", r.get("Doc_class")) == dc] or list(range(n))
+        consensus["Rationale"] = roots[max(cand, key=lambda i: res.weights[i])].get("Rationale")
+
+    # 輸出順序：依第一個出現的樣本的鍵順序
+    order = [k for k in names if k in consensus]
+    res.consensus = {"gt_parse": {k: consensus[k] for k in order}}
+    res.agreement = {k: agreement[k] for k in order if k in agreement}
+    return res